@@ -0,0 +1,187 @@
+"""
+Benchmarks event argument decoding and normalisation on the events in moonworm/fixture/abis.
+
+Compares the previous path used by the log scanner:
+
+    json.loads(Web3.toJSON(utfy_dict(dict(get_event_data(codec, event_abi, log)["args"]))))
+
+against moonworm.crawler.event_decoder.EventDecoder, which decodes with prebuilt eth_abi decoders and
+normalises the arguments with a type-driven normaliser built from the ABI.
+
+Both paths are checked to produce the same arguments for every log.
+
+Usage:
+    python benchmarks/event_decoding.py [--logs-per-event N]
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import time
+from typing import Any, Dict, List, Tuple
+
+from eth_abi import encode_abi, encode_single
+from eth_utils import event_abi_to_log_topic, keccak
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.abi import collapse_if_tuple
+from web3._utils.events import get_event_data
+
+from moonworm.crawler.event_decoder import EventDecoder
+from moonworm.crawler.function_call_crawler import utfy_dict
+
+ABIS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "moonworm",
+    "fixture",
+    "abis",
+)
+
+ARRAY_TYPE_REGEX = re.compile(r"^(.*)\[(\d*)\]$")
+
+
+def sample_value(type_str: str, abi_input: Dict[str, Any]) -> Any:
+    """
+    Generates a random value of the given ABI type.
+    """
+    array_match = ARRAY_TYPE_REGEX.match(type_str)
+    if array_match is not None:
+        size = (
+            int(array_match.group(2)) if array_match.group(2) else random.randint(0, 4)
+        )
+        return [sample_value(array_match.group(1), abi_input) for _ in range(size)]
+    if type_str == "tuple":
+        return tuple(
+            sample_value(component["type"], component)
+            for component in abi_input["components"]
+        )
+    if type_str == "address":
+        return Web3.toChecksumAddress(os.urandom(20))
+    if type_str == "bool":
+        return random.random() < 0.5
+    if type_str == "string":
+        return "moonworm-" + os.urandom(4).hex()
+    if type_str == "bytes":
+        return os.urandom(random.randint(0, 64))
+    if type_str.startswith("bytes"):
+        return os.urandom(int(type_str[len("bytes") :]))
+    if type_str.startswith("uint"):
+        return random.getrandbits(int(type_str[len("uint") :] or 256))
+    if type_str.startswith("int"):
+        bits = int(type_str[len("int") :] or 256)
+        return random.getrandbits(bits - 1) * random.choice([-1, 1])
+    raise ValueError(f"Unsupported type: {type_str}")
+
+
+def sample_log(event_abi: Dict[str, Any], log_index: int) -> Dict[str, Any]:
+    """
+    Generates a raw log (in the format returned by eth_getLogs) for the given event.
+    """
+    topics = [] if event_abi.get("anonymous") else [event_abi_to_log_topic(event_abi)]
+    data_types = []
+    data_values = []
+    for abi_input in event_abi["inputs"]:
+        value = sample_value(abi_input["type"], abi_input)
+        type_str = collapse_if_tuple(abi_input)
+        if abi_input.get("indexed"):
+            if type_str in {"string", "bytes"} or type_str.endswith("]"):
+                topics.append(keccak(encode_single(type_str, value)))
+            else:
+                topics.append(encode_single(type_str, value))
+        else:
+            data_types.append(type_str)
+            data_values.append(value)
+
+    return {
+        "address": Web3.toChecksumAddress(os.urandom(20)),
+        "blockHash": HexBytes(os.urandom(32)),
+        "blockNumber": 1,
+        "data": Web3.toHex(encode_abi(data_types, data_values)),
+        "logIndex": log_index,
+        "topics": [HexBytes(topic) for topic in topics],
+        "transactionHash": HexBytes(os.urandom(32)),
+        "transactionIndex": 0,
+    }
+
+
+def previous_decode(codec, event_abi: Dict[str, Any], log: Dict[str, Any]) -> Any:
+    raw_event = get_event_data(codec, event_abi, log)
+    return json.loads(Web3.toJSON(utfy_dict(dict(raw_event["args"]))))
+
+
+def benchmark(logs_per_event: int) -> List[Tuple[str, int, float, float]]:
+    codec = Web3().codec
+    results = []
+    for abi_file in sorted(glob.glob(os.path.join(ABIS_DIR, "*.json"))):
+        with open(abi_file, "r") as ifp:
+            abi = json.load(ifp)
+        event_abis = [item for item in abi if item["type"] == "event"]
+        if not event_abis:
+            continue
+
+        samples = [
+            (event_abi, sample_log(event_abi, i))
+            for event_abi in event_abis
+            for i in range(logs_per_event)
+        ]
+        decoders = {
+            id(event_abi): EventDecoder(codec, event_abi) for event_abi in event_abis
+        }
+
+        for event_abi, log in samples:
+            expected = previous_decode(codec, event_abi, log)
+            actual = decoders[id(event_abi)].decode_args(log["topics"], log["data"])
+            if expected != actual:
+                raise AssertionError(
+                    f"Mismatch for {event_abi['name']} in {abi_file}: {expected} != {actual}"
+                )
+
+        start = time.perf_counter()
+        for event_abi, log in samples:
+            previous_decode(codec, event_abi, log)
+        previous_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for event_abi, log in samples:
+            decoders[id(event_abi)].decode_log(log)
+        current_duration = time.perf_counter() - start
+
+        results.append(
+            (
+                os.path.basename(abi_file),
+                len(samples),
+                previous_duration,
+                current_duration,
+            )
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark event decoding")
+    parser.add_argument(
+        "--logs-per-event",
+        type=int,
+        default=1000,
+        help="Number of logs to decode for each event in each ABI. Default=1000",
+    )
+    args = parser.parse_args()
+
+    random.seed(42)
+    results = benchmark(args.logs_per_event)
+
+    print(
+        f"{'ABI':<28}{'logs':>8}{'get_event_data (s)':>22}{'EventDecoder (s)':>20}{'speedup':>10}"
+    )
+    for abi_file, num_logs, previous_duration, current_duration in results:
+        print(
+            f"{abi_file:<28}{num_logs:>8}{previous_duration:>22.4f}{current_duration:>20.4f}"
+            f"{previous_duration / current_duration:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmarks function call decoding on calldata of the functions in moonworm/fixture/abis/OpenseaExchange.json.
+
+Compares the previous path used by the function call crawler:
+
+    Contract.decode_function_input(call_data), followed by utfy_dict on the arguments
+
+against moonworm.crawler.function_decoder.FunctionDecoderRegistry, which finds the function by its
+selector and decodes with prebuilt eth_abi decoders and a type-driven normaliser built from the ABI.
+
+Both paths are checked to produce the same arguments for every call.
+
+Usage:
+    python benchmarks/function_decoding.py [--calls-per-function N] [--abi PATH]
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+from typing import Any, Dict, List, Tuple
+
+from eth_utils import function_abi_to_4byte_selector
+from event_decoding import ABIS_DIR, sample_value
+from web3 import Web3
+
+from moonworm.crawler.function_call_crawler import utfy_dict
+from moonworm.crawler.function_decoder import FunctionDecoderRegistry
+
+
+def sample_call_data(contract, function_abi: Dict[str, Any]) -> str:
+    """
+    Generates the call data of a call to the given function, with random arguments.
+    """
+    args = [
+        sample_value(abi_input["type"], abi_input)
+        for abi_input in function_abi["inputs"]
+    ]
+    function = contract.get_function_by_selector(
+        function_abi_to_4byte_selector(function_abi)
+    )
+    return function(*args)._encode_transaction_data()
+
+
+def previous_decode(contract, call_data: str) -> Tuple[str, Any]:
+    function, args = contract.decode_function_input(call_data)
+    return function.fn_name, utfy_dict(args)
+
+
+def normalized(decoded: Tuple[str, Any]) -> Tuple[str, Any]:
+    # Struct arguments are tuples on the previous path, and lists on the current one
+    name, args = decoded
+    return name, json.loads(Web3.toJSON(args))
+
+
+def benchmark(
+    abi_file: str, calls_per_function: int
+) -> List[Tuple[str, int, float, float]]:
+    with open(abi_file, "r") as ifp:
+        abi = json.load(ifp)
+    function_abis = [item for item in abi if item["type"] == "function"]
+    contract = Web3().eth.contract(abi=abi)
+    registry = FunctionDecoderRegistry(Web3().codec, abi)
+
+    results = []
+    for function_abi in function_abis:
+        samples = [
+            sample_call_data(contract, function_abi) for _ in range(calls_per_function)
+        ]
+
+        for call_data in samples:
+            expected = normalized(previous_decode(contract, call_data))
+            actual = normalized(registry.decode_function_input(call_data))
+            if expected != actual:
+                raise AssertionError(
+                    f"Mismatch for {function_abi['name']}: {expected} != {actual}"
+                )
+
+        start = time.perf_counter()
+        for call_data in samples:
+            previous_decode(contract, call_data)
+        previous_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for call_data in samples:
+            registry.decode_function_input(call_data)
+        current_duration = time.perf_counter() - start
+
+        results.append(
+            (function_abi["name"], len(samples), previous_duration, current_duration)
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark function call decoding")
+    parser.add_argument(
+        "--calls-per-function",
+        type=int,
+        default=200,
+        help="Number of calls to decode for each function in the ABI. Default=200",
+    )
+    parser.add_argument(
+        "--abi",
+        default=os.path.join(ABIS_DIR, "OpenseaExchange.json"),
+        help="Path to the contract ABI. Default=moonworm/fixture/abis/OpenseaExchange.json",
+    )
+    args = parser.parse_args()
+
+    random.seed(42)
+    results = benchmark(args.abi, args.calls_per_function)
+
+    print(
+        f"{'function':<30}{'calls':>8}{'decode_function_input (s)':>29}{'registry (s)':>16}{'speedup':>10}"
+    )
+    for name, num_calls, previous_duration, current_duration in results:
+        print(
+            f"{name:<30}{num_calls:>8}{previous_duration:>29.4f}{current_duration:>16.4f}"
+            f"{previous_duration / current_duration:>9.1f}x"
+        )
+    previous_total = sum(result[2] for result in results)
+    current_total = sum(result[3] for result in results)
+    num_calls = sum(result[1] for result in results)
+    print(
+        f"{'total':<30}{num_calls:>8}{previous_total:>29.4f}{current_total:>16.4f}"
+        f"{previous_total / current_total:>9.1f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,22 @@
 import argparse
 import json
 import os
+from dataclasses import asdict
 from pathlib import Path
 from shutil import copyfile
 from types import MappingProxyType
-from typing import Any
+from typing import Any, Dict, Iterator, List
 
 from web3.main import Web3
 from web3.middleware import geth_poa_middleware
 
 from moonworm.crawler.ethereum_state_provider import Web3StateProvider
-from moonworm.watch import watch_contract
+from moonworm.watch import iter_watch, watch_contract
 
 from .contracts import CU, ERC20, ERC721
+from .crawler.backfill import SQLiteBackfillQueue, merge_outputs, run_backfill_worker
+from .crawler.rpc_cache import DEFAULT_CACHE_PATH, ResponseCache, add_response_cache
+from .crawler.state.sqlite_state import SQLiteState
 from .deployment import find_deployment_block
 from .generators.basic import (
     generate_contract_cli_content,
@@ -20,6 +24,7 @@ from .generators.basic import (
 )
 from .generators.brownie import generate_brownie_interface
 from .version import MOONWORM_VERSION
+from .web3_util import connect
 
 
 def write_file(content: str, path: str):
@@ -158,65 +163,90 @@ def handle_watch(args: argparse.Namespace) -> None:
     Handler for the "moonworm watch" command, which records all events and transactions against a given
     smart contract between the specified block range.
     """
-    if args.abi == "erc20":
-        contract_abi = ERC20.abi()
-    elif args.abi == "erc721":
-        contract_abi = ERC721.abi()
-    elif args.abi == "cu":
-        contract_abi = CU.abi()
-    else:
-        with open(args.abi, "r") as ifp:
-            contract_abi = json.load(ifp)
+    contract_abi = _load_abi(args.abi)
 
-    web3 = Web3(Web3.HTTPProvider(args.web3))
+    web3 = connect(
+        args.web3,
+        requests_per_second=args.rate_limit,
+        compute_units_per_second=args.compute_units_per_second,
+    )
     if args.poa:
         web3.middleware_onion.inject(geth_poa_middleware, layer=0)
-    if args.db:
-        if args.network is None:
-            raise ValueError("Please specify --network")
+    if args.cache is not None:
+        add_response_cache(
+            web3,
+            ResponseCache(
+                args.cache,
+                max_bytes=int(args.cache_size * 2**20),
+                finality_depth=max(args.confirmations, 1),
+                grid=args.chunk_grid,
+            ),
+        )
+    watch_kwargs: Dict[str, Any] = dict(
+        contract_address=web3.toChecksumAddress(args.contract),
+        contract_abi=contract_abi,
+        num_confirmations=args.confirmations,
+        start_block=args.start,
+        end_block=args.end,
+        min_blocks_batch=args.min_blocks_batch,
+        max_blocks_batch=args.max_blocks_batch,
+        batch_size_update_threshold=args.batch_size_update_threshold,
+        only_events=args.only_events,
+        outfile=args.outfile,
+        combine_event_requests=args.combine_event_requests,
+        concurrency=args.concurrency,
+        follow_head=args.follow_head,
+        chunk_grid=args.chunk_grid,
+        parquet_directory=args.parquet,
+        quiet=args.quiet,
+        decode_processes=args.decode_processes,
+        compression=args.compression,
+        rotate_blocks=args.rotate_blocks,
+        rotate_bytes=(
+            int(args.rotate_mb * 2**20) if args.rotate_mb is not None else None
+        ),
+    )
+
+    state = None
+    if args.state_db is not None:
+        state = SQLiteState(args.state_db)
+    try:
+        if args.db:
+            if args.network is None:
+                raise ValueError("Please specify --network")
 
-        from .crawler.networks import Network
+            from .crawler.networks import Network
 
-        network = Network.__members__[args.network]
+            network = Network.__members__[args.network]
 
-        from .crawler.moonstream_ethereum_state_provider import (
-            MoonstreamEthereumStateProvider,
-        )
-        from .crawler.networks import yield_db_session_ctx
-
-        state_provider = MoonstreamEthereumStateProvider(web3, network)
-
-        with yield_db_session_ctx() as db_session:
-            try:
-                state_provider.set_db_session(db_session)
-                watch_contract(
-                    web3=web3,
-                    state_provider=state_provider,
-                    contract_address=web3.toChecksumAddress(args.contract),
-                    contract_abi=contract_abi,
-                    num_confirmations=args.confirmations,
-                    start_block=args.start,
-                    end_block=args.end,
-                    outfile=args.outfile,
-                )
-            finally:
-                state_provider.clear_db_session()
-
-    else:
-        watch_contract(
-            web3=web3,
-            state_provider=Web3StateProvider(web3),
-            contract_address=web3.toChecksumAddress(args.contract),
-            contract_abi=contract_abi,
-            num_confirmations=args.confirmations,
-            start_block=args.start,
-            end_block=args.end,
-            min_blocks_batch=args.min_blocks_batch,
-            max_blocks_batch=args.max_blocks_batch,
-            batch_size_update_threshold=args.batch_size_update_threshold,
-            only_events=args.only_events,
-            outfile=args.outfile,
-        )
+            from .crawler.moonstream_ethereum_state_provider import (
+                MoonstreamEthereumStateProvider,
+            )
+            from .crawler.networks import yield_db_session_ctx
+
+            state_provider = MoonstreamEthereumStateProvider(web3, network)
+
+            with yield_db_session_ctx() as db_session:
+                try:
+                    state_provider.set_db_session(db_session)
+                    watch_contract(
+                        web3=web3,
+                        state_provider=state_provider,
+                        state=state,
+                        **watch_kwargs,
+                    )
+                finally:
+                    state_provider.clear_db_session()
+        else:
+            watch_contract(
+                web3=web3,
+                state_provider=Web3StateProvider(web3),
+                state=state,
+                **watch_kwargs,
+            )
+    finally:
+        if state is not None:
+            state.close()
 
 
 def handle_find_deployment(args: argparse.Namespace) -> None:
@@ -224,7 +254,11 @@ def handle_find_deployment(args: argparse.Namespace) -> None:
     Handler for the "moonworm find-deployment" command, which finds the deployment block for a given
     smart contract.
     """
-    web3_client = Web3(Web3.HTTPProvider(args.web3))
+    web3_client = connect(
+        args.web3,
+        requests_per_second=args.rate_limit,
+        compute_units_per_second=args.compute_units_per_second,
+    )
     result = find_deployment_block(web3_client, args.contract, args.interval)
     if result is None:
         raise ValueError(
@@ -233,6 +267,96 @@ def handle_find_deployment(args: argparse.Namespace) -> None:
     print(result)
 
 
+def _load_abi(abi: str) -> List[Dict[str, Any]]:
+    if abi == "erc20":
+        return ERC20.abi()
+    elif abi == "erc721":
+        return ERC721.abi()
+    elif abi == "cu":
+        return CU.abi()
+    with open(abi, "r") as ifp:
+        return json.load(ifp)
+
+
+def handle_backfill_plan(args: argparse.Namespace) -> None:
+    """
+    Handler for the "moonworm backfill plan" command, which adds the work units of a range of blocks to
+    a backfill queue.
+    """
+    backfill_queue = SQLiteBackfillQueue(args.queue)
+    added = backfill_queue.add_range(args.start, args.end, args.unit_blocks)
+    print(f"Added {added} work units")
+
+
+def handle_backfill_work(args: argparse.Namespace) -> None:
+    """
+    Handler for the "moonworm backfill work" command, which crawls work units of a backfill queue until
+    none is left.
+    """
+    contract_abi = _load_abi(args.abi)
+    web3 = connect(
+        args.web3,
+        requests_per_second=args.rate_limit,
+        compute_units_per_second=args.compute_units_per_second,
+    )
+    if args.poa:
+        web3.middleware_onion.inject(geth_poa_middleware, layer=0)
+    contract_address = web3.toChecksumAddress(args.contract)
+    state_provider = Web3StateProvider(web3)
+
+    def crawl_unit(from_block: int, to_block: int) -> Iterator[Dict[str, Any]]:
+        for batch in iter_watch(
+            web3,
+            state_provider,
+            contract_address,
+            contract_abi,
+            num_confirmations=0,
+            start_block=from_block,
+            end_block=to_block,
+            min_blocks_batch=args.min_blocks_batch,
+            max_blocks_batch=args.max_blocks_batch,
+            only_events=args.only_events,
+            combine_event_requests=True,
+            concurrency=args.concurrency,
+        ):
+            # Events are in log order, and the sort is stable: in every block, method calls come first,
+            # then events
+            records = [asdict(call) for call in batch.calls] + batch.events
+            records.sort(
+                key=lambda record: record.get("block_number", record.get("blockNumber"))
+            )
+            yield from records
+
+    backfill_queue = SQLiteBackfillQueue(args.queue, lease_seconds=args.lease_seconds)
+    completed = run_backfill_worker(
+        backfill_queue,
+        crawl_unit,
+        args.output_dir,
+        heartbeat_seconds=args.lease_seconds / 4,
+    )
+    print(f"Completed {completed} work units")
+
+
+def handle_backfill_status(args: argparse.Namespace) -> None:
+    """
+    Handler for the "moonworm backfill status" command, which prints the number of work units in every
+    status.
+    """
+    backfill_queue = SQLiteBackfillQueue(args.queue)
+    if args.retry_failed:
+        print(f"Retrying {backfill_queue.retry_failed()} failed work units")
+    print(json.dumps(backfill_queue.progress()))
+
+
+def handle_backfill_merge(args: argparse.Namespace) -> None:
+    """
+    Handler for the "moonworm backfill merge" command, which concatenates the outputs of all work units
+    in block order.
+    """
+    merged = merge_outputs(SQLiteBackfillQueue(args.queue), args.outfile)
+    print(f"Merged {merged} work units into {args.outfile}")
+
+
 def generate_argument_parser() -> argparse.ArgumentParser:
     """
     Generates the command-line argument parser for the "moonworm" command.
@@ -275,7 +399,21 @@ def generate_argument_parser() -> argparse.ArgumentParser:
         "-w",
         "--web3",
         required=True,
-        help="Web3 provider",
+        help="Web3 provider URI (HTTP(S), WebSocket or IPC). Pass several comma-separated HTTP(S) URIs to spread requests over all of them",
+    )
+
+    watch_parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=None,
+        help="Maximum number of JSON-RPC requests per second to each endpoint. Default: no limit",
+    )
+
+    watch_parser.add_argument(
+        "--compute-units-per-second",
+        type=float,
+        default=None,
+        help="Maximum number of provider compute units per second to spend on each endpoint. Default: no limit",
     )
 
     watch_parser.add_argument(
@@ -347,6 +485,66 @@ def generate_argument_parser() -> argparse.ArgumentParser:
         help="Only watch events. Default=False",
     )
 
+    watch_parser.add_argument(
+        "--combine-event-requests",
+        action="store_true",
+        help="Fetch all events in the ABI with a single eth_getLogs call per batch of blocks. Default=False",
+    )
+
+    watch_parser.add_argument(
+        "--concurrency",
+        default=1,
+        type=int,
+        help="Number of eth_getLogs requests to make in parallel over disjoint block ranges. Default=1",
+    )
+
+    watch_parser.add_argument(
+        "--decode-processes",
+        type=int,
+        default=None,
+        help="Decode event logs in a pool of this many worker processes while the next logs are fetched",
+    )
+
+    watch_parser.add_argument(
+        "--follow-head",
+        action="store_true",
+        help="Emit events and method calls as soon as their blocks are mined, marked as provisional until they have --confirmations confirmations, and retract them if a chain reorganization replaces their blocks. Default=False",
+    )
+
+    watch_parser.add_argument(
+        "--cache",
+        nargs="?",
+        const=DEFAULT_CACHE_PATH,
+        default=None,
+        help=f"Cache JSON-RPC responses about blocks with at least --confirmations confirmations in this SQLite file, so that reruns are answered from disk. Default path: {DEFAULT_CACHE_PATH}",
+    )
+
+    watch_parser.add_argument(
+        "--cache-size",
+        type=float,
+        default=1024,
+        help="Size budget of the --cache, in MiB. Least recently used responses are evicted beyond it. Default=1024",
+    )
+
+    watch_parser.add_argument(
+        "--chunk-grid",
+        type=int,
+        default=None,
+        help="End batches of blocks at multiples of this number of blocks where possible, so that reruns request the same ranges and hit the --cache",
+    )
+
+    watch_parser.add_argument(
+        "--state-db",
+        default=None,
+        help="Store events and method calls in this SQLite database, and resume from the last block stored in it",
+    )
+
+    watch_parser.add_argument(
+        "--parquet",
+        default=None,
+        help="Also write events and method calls to Parquet files in this directory, one per event type and method, with a column per argument. Requires: pip install moonworm[parquet]",
+    )
+
     watch_parser.add_argument(
         "-o",
         "--outfile",
@@ -354,6 +552,34 @@ def generate_argument_parser() -> argparse.ArgumentParser:
         help="Optional JSONL (JsON lines) file into which to write events and method calls",
     )
 
+    watch_parser.add_argument(
+        "--compression",
+        choices=["gzip", "zstd"],
+        default=None,
+        help="Compress the --outfile. zstd requires: pip install moonworm[zstd]",
+    )
+
+    watch_parser.add_argument(
+        "--rotate-blocks",
+        type=int,
+        default=None,
+        help="Start a new --outfile every this many blocks. The first block of every file is added to its name",
+    )
+
+    watch_parser.add_argument(
+        "--rotate-mb",
+        type=float,
+        default=None,
+        help="Start a new --outfile once this many MiB (before compression) have been written to it",
+    )
+
+    watch_parser.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Do not print events and method calls to stdout",
+    )
+
     watch_parser.set_defaults(func=handle_watch)
 
     generate_brownie_parser = subcommands.add_parser(
@@ -443,7 +669,7 @@ def generate_argument_parser() -> argparse.ArgumentParser:
         "-w",
         "--web3",
         required=True,
-        help="Web3 provider",
+        help="Web3 provider URI (HTTP(S), WebSocket or IPC). Pass several comma-separated HTTP(S) URIs to spread requests over all of them",
     )
     find_deployment_parser.add_argument(
         "-c",
@@ -459,8 +685,147 @@ def generate_argument_parser() -> argparse.ArgumentParser:
         default=1.0,
         help="Number of seconds (float) to wait between web3 calls",
     )
+    find_deployment_parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=None,
+        help="Maximum number of JSON-RPC requests per second to each endpoint. Default: no limit",
+    )
+    find_deployment_parser.add_argument(
+        "--compute-units-per-second",
+        type=float,
+        default=None,
+        help="Maximum number of provider compute units per second to spend on each endpoint. Default: no limit",
+    )
     find_deployment_parser.set_defaults(func=handle_find_deployment)
 
+    backfill_parser = subcommands.add_parser(
+        "backfill",
+        description="Crawl a range of blocks with several worker processes sharing a queue of work units",
+    )
+    backfill_parser.set_defaults(func=lambda _: backfill_parser.print_help())
+    backfill_subcommands = backfill_parser.add_subparsers()
+
+    backfill_plan_parser = backfill_subcommands.add_parser(
+        "plan", description="Add the work units of a range of blocks to the queue"
+    )
+    backfill_plan_parser.add_argument(
+        "-q", "--queue", required=True, help="Path of the SQLite queue database"
+    )
+    backfill_plan_parser.add_argument(
+        "-s", "--start", type=int, required=True, help="First block of the range"
+    )
+    backfill_plan_parser.add_argument(
+        "-e", "--end", type=int, required=True, help="Last block of the range"
+    )
+    backfill_plan_parser.add_argument(
+        "--unit-blocks",
+        type=int,
+        default=100000,
+        help="Number of blocks per work unit. Default=100000",
+    )
+    backfill_plan_parser.set_defaults(func=handle_backfill_plan)
+
+    backfill_work_parser = backfill_subcommands.add_parser(
+        "work", description="Crawl work units of the queue until none is left"
+    )
+    backfill_work_parser.add_argument(
+        "-q", "--queue", required=True, help="Path of the SQLite queue database"
+    )
+    backfill_work_parser.add_argument(
+        "-i",
+        "--abi",
+        required=True,
+        help="ABI file path or 'erc20' or 'erc721' or cu",
+    )
+    backfill_work_parser.add_argument(
+        "-c", "--contract", required=True, help="Contract address"
+    )
+    backfill_work_parser.add_argument(
+        "-w",
+        "--web3",
+        required=True,
+        help="Web3 provider URI (HTTP(S), WebSocket or IPC). Pass several comma-separated HTTP(S) URIs to spread requests over all of them",
+    )
+    backfill_work_parser.add_argument(
+        "-o",
+        "--output-dir",
+        required=True,
+        help="Directory in which to write the output of every work unit",
+    )
+    backfill_work_parser.add_argument(
+        "--poa",
+        action="store_true",
+        help="Pass this flag if u are using PoA network",
+    )
+    backfill_work_parser.add_argument(
+        "--only-events",
+        action="store_true",
+        help="Only crawl events",
+    )
+    backfill_work_parser.add_argument(
+        "--min-blocks-batch",
+        type=int,
+        default=100,
+        help="Minimum number of blocks to crawl in a single batch",
+    )
+    backfill_work_parser.add_argument(
+        "--max-blocks-batch",
+        type=int,
+        default=5000,
+        help="Maximum number of blocks to crawl in a single batch",
+    )
+    backfill_work_parser.add_argument(
+        "--concurrency",
+        default=1,
+        type=int,
+        help="Number of eth_getLogs requests to make in parallel over disjoint block ranges. Default=1",
+    )
+    backfill_work_parser.add_argument(
+        "--lease-seconds",
+        type=float,
+        default=300,
+        help="Duration of the leases on work units, which the worker renews while it crawls them. Default=300",
+    )
+    backfill_work_parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=None,
+        help="Maximum number of JSON-RPC requests per second to each endpoint. Default: no limit",
+    )
+    backfill_work_parser.add_argument(
+        "--compute-units-per-second",
+        type=float,
+        default=None,
+        help="Maximum number of provider compute units per second to spend on each endpoint. Default: no limit",
+    )
+    backfill_work_parser.set_defaults(func=handle_backfill_work)
+
+    backfill_status_parser = backfill_subcommands.add_parser(
+        "status", description="Print the number of work units in every status"
+    )
+    backfill_status_parser.add_argument(
+        "-q", "--queue", required=True, help="Path of the SQLite queue database"
+    )
+    backfill_status_parser.add_argument(
+        "--retry-failed",
+        action="store_true",
+        help="Make the work units which failed too many times available again",
+    )
+    backfill_status_parser.set_defaults(func=handle_backfill_status)
+
+    backfill_merge_parser = backfill_subcommands.add_parser(
+        "merge",
+        description="Concatenate the outputs of all work units, in block order, into one JSONL file",
+    )
+    backfill_merge_parser.add_argument(
+        "-q", "--queue", required=True, help="Path of the SQLite queue database"
+    )
+    backfill_merge_parser.add_argument(
+        "-o", "--outfile", required=True, help="Path of the merged JSONL file"
+    )
+    backfill_merge_parser.set_defaults(func=handle_backfill_merge)
+
     return parser
 
 
@@ -0,0 +1,532 @@
+"""
+asyncio-native counterpart of [`EventScanner`][moonworm.crawler.log_scanner.EventScanner].
+
+`AsyncEventScanner` is meant to be embedded in asyncio services. It expects a web3 client built on an
+asynchronous provider, for example:
+
+```python
+from moonworm.web3_util import connect_async
+
+web3 = connect_async(uri, requests_per_second=25)
+```
+
+Requests of the scanner are subject to the rate limits of the endpoint (see
+[`moonworm.crawler.rate_limit`][moonworm.crawler.rate_limit]): the scanner adds
+`async_rate_limit_middleware` to clients which were built without it.
+
+It uses the same [`EventScannerState`][moonworm.crawler.state.EventScannerState] contract as
+`EventScanner`. eth_getLogs requests and block timestamp lookups run concurrently, bounded by a
+semaphore, and retries back off with `asyncio.sleep` instead of blocking the event loop.
+"""
+
+import asyncio
+import datetime
+import logging
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from eth_typing.evm import ChecksumAddress
+from web3 import Web3
+from web3._utils.filters import construct_event_filter_params
+from web3.exceptions import BlockNotFound
+
+from .batch_rpc import async_get_block_timestamps
+from .chunk_size import AdaptiveChunkSizeController, ChunkSizeController
+from .event_decoder import EventDecoder, EventDecoderRegistry
+from .log_scanner import ScanBatch, _log_position
+from .rate_limit import async_rate_limit_middleware
+from .retry_policy import RetryPolicy
+from .state import EventScannerState
+from .timestamp_index import BlockTimestampIndex
+
+logger = logging.getLogger(__name__)
+
+
+async def _async_bisect_web3_call(
+    func: Callable[..., Awaitable[list]],
+    start_block: int,
+    end_block: int,
+    retry_policy: RetryPolicy,
+    addresses: Optional[List[str]] = None,
+    on_failure: Optional[Callable[[int], Any]] = None,
+) -> list:
+    """Asynchronous version of `moonworm.crawler.log_scanner._bisect_web3_call`.
+
+    The requests which replace a failing request are made concurrently. Waits between retries without
+    blocking the event loop.
+    """
+    failures = 0
+
+    async def _fetch(
+        range_start: int, range_end: int, range_addresses: Optional[List[str]]
+    ) -> list:
+        nonlocal failures
+        attempt = 0
+        while True:
+            try:
+                if range_addresses is None:
+                    return await func(range_start, range_end)
+                return await func(range_start, range_end, range_addresses)
+            except Exception as e:
+                failures += 1
+                if on_failure is not None:
+                    on_failure(range_end - range_start + 1)
+                if failures >= retry_policy.max_retries:
+                    logger.warning("Out of retries")
+                    raise
+                action = retry_policy.on_error(
+                    e, range_start, range_end, range_addresses, attempt
+                )
+                attempt += 1
+                if action.delay > 0:
+                    await asyncio.sleep(action.delay)
+                if action.requests:
+                    results = await asyncio.gather(
+                        *[_fetch(*request) for request in action.requests]
+                    )
+                    merged = [item for result in results for item in result]
+                    if action.split_addresses:
+                        merged.sort(key=_log_position)
+                    return merged
+
+    return await _fetch(start_block, end_block, addresses)
+
+
+def _decode_logs(
+    decode: Callable[[Any], Dict[str, Any]],
+    logs: List[Any],
+    on_decode_error: Optional[Callable[[Exception], None]] = None,
+) -> List[Dict[str, Any]]:
+    all_events = []
+    for log in logs:
+        try:
+            all_events.append(decode(log))
+        except Exception as e:
+            if on_decode_error:
+                on_decode_error(e)
+            continue
+    return all_events
+
+
+async def _async_fetch_events_chunk(
+    web3,
+    decoder: EventDecoder,
+    from_block: int,
+    to_block: int,
+    addresses: Optional[List[ChecksumAddress]] = None,
+    on_decode_error: Optional[Callable[[Exception], None]] = None,
+) -> List[Dict[str, Any]]:
+    """Asynchronous version of `moonworm.crawler.log_scanner._fetch_events_chunk`."""
+    _, event_filter_params = construct_event_filter_params(
+        decoder.event_abi,
+        web3.codec,
+        fromBlock=from_block,
+        toBlock=to_block,
+    )
+    if addresses:
+        event_filter_params["address"] = addresses
+
+    logs = await web3.eth.get_logs(event_filter_params)
+    return _decode_logs(decoder.decode_log, logs, on_decode_error)
+
+
+async def _async_fetch_all_events_chunk(
+    web3,
+    decoders: EventDecoderRegistry,
+    from_block: int,
+    to_block: int,
+    addresses: Optional[List[ChecksumAddress]] = None,
+    on_decode_error: Optional[Callable[[Exception], None]] = None,
+) -> List[Dict[str, Any]]:
+    """Asynchronous version of `moonworm.crawler.log_scanner._fetch_all_events_chunk`."""
+    requests = []
+    if decoders.topics:
+        filter_params: Dict[str, Any] = {
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "topics": [decoders.topics],
+        }
+        if addresses:
+            filter_params["address"] = addresses
+
+        async def _fetch_topics() -> List[Dict[str, Any]]:
+            logs = await web3.eth.get_logs(filter_params)
+            return _decode_logs(decoders.decode_log, logs, on_decode_error)
+
+        requests.append(_fetch_topics())
+
+    for decoder in decoders.anonymous:
+        requests.append(
+            _async_fetch_events_chunk(
+                web3, decoder, from_block, to_block, addresses, on_decode_error
+            )
+        )
+
+    all_events = [
+        event for events in await asyncio.gather(*requests) for event in events
+    ]
+    all_events.sort(key=lambda event: (event["blockNumber"], event["logIndex"]))
+    return all_events
+
+
+class AsyncEventScanner:
+    def __init__(
+        self,
+        web3: Web3,
+        events: List,
+        addresses: Optional[List[str]] = None,
+        scanner_state: Optional[EventScannerState] = None,
+        max_chunk_scan_size: int = 10000,
+        max_request_retries: int = 30,
+        request_retry_seconds: float = 3.0,
+        skip_block_timestamp: bool = False,
+        combine_event_requests: bool = False,
+        max_concurrent_requests: int = 8,
+        chunk_size_controller: Optional[ChunkSizeController] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        timestamp_index: Optional[BlockTimestampIndex] = None,
+    ):
+        """
+        :param web3: web3 client with an asynchronous provider and the AsyncEth module
+        :param events: List of web3 Event we scan
+        :param max_chunk_scan_size: JSON-RPC API limit in the number of blocks we query. (Recommendation: 10,000 for mainnet, 500,000 for testnets)
+        :param max_request_retries: How many times we try to reattempt a failed JSON-RPC call
+        :param request_retry_seconds: Delay between failed requests to let JSON-RPC server to recover
+        :param combine_event_requests: Fetch all event types with a single eth_getLogs call per chunk
+        :param max_concurrent_requests: Maximum number of JSON-RPC requests in flight at any time
+        :param chunk_size_controller: Decides the size of the next chunk after every chunk. Defaults to
+        an AdaptiveChunkSizeController between min_scan_chunk_size and max_chunk_scan_size
+        :param retry_policy: Decides how to retry failed JSON-RPC calls. Defaults to a RetryPolicy with
+        max_request_retries retries and request_retry_seconds as base delay
+        :param timestamp_index: Persistent index to look up and store block timestamps in
+        """
+
+        self.web3 = web3
+        middleware_onion = getattr(web3, "middleware_onion", None)
+        if middleware_onion is not None and "rate_limit" not in middleware_onion:
+            # Innermost, so that only requests which reach the provider count against the limits
+            middleware_onion.inject(async_rate_limit_middleware, "rate_limit", layer=0)
+        self.state = scanner_state
+        self.events = events
+        self.skip_block_timestamp = skip_block_timestamp
+        self.timestamp_index = timestamp_index
+        self.combine_event_requests = combine_event_requests
+        self.max_concurrent_requests = max_concurrent_requests
+
+        self.decoders = EventDecoderRegistry(web3.codec, events)
+        self.event_decoders = [EventDecoder(web3.codec, event) for event in events]
+
+        self.checksum_addresses = []
+        if addresses:
+            for address in addresses:
+                self.checksum_addresses.append(Web3.toChecksumAddress(address))
+
+        # Our JSON-RPC throttling parameters
+        self.min_scan_chunk_size = 10  # 12 s/block = 120 seconds period
+        self.max_scan_chunk_size = max_chunk_scan_size
+        self.max_request_retries = max_request_retries
+        self.request_retry_seconds = request_retry_seconds
+
+        # Factor how fast we increase the chunk size if results are found
+        # # (slow down scan after starting to get hits)
+        self.chunk_size_decrease = 0.5
+
+        # Factor how was we increase chunk size if no results found
+        self.chunk_size_increase = 2.0
+
+        if chunk_size_controller is None:
+            chunk_size_controller = AdaptiveChunkSizeController(
+                self.min_scan_chunk_size,
+                self.max_scan_chunk_size,
+                increase_factor=self.chunk_size_increase,
+                decrease_factor=self.chunk_size_decrease,
+            )
+        self.chunk_size_controller = chunk_size_controller
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy(
+                max_retries=self.max_request_retries,
+                delay=self.request_retry_seconds,
+            )
+        self.retry_policy = retry_policy
+
+        # Created on first use, so that it belongs to the event loop the scanner runs in
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+        return self._semaphore
+
+    async def get_block_timestamp(self, block_num) -> Optional[datetime.datetime]:
+        """Get Ethereum block timestamp"""
+        if self.skip_block_timestamp:
+            # Returning None since, config set to skip getting block timestamp data
+            return None
+        try:
+            async with self.semaphore:
+                block_info = await self.web3.eth.get_block(block_num)
+        except BlockNotFound:
+            # Block was not mined yet,
+            # minor chain reorganisation?
+            return None
+        last_time = block_info["timestamp"]
+        return datetime.datetime.utcfromtimestamp(last_time)
+
+    async def get_block_timestamps(
+        self, block_numbers: Iterable[int]
+    ) -> Dict[int, Optional[datetime.datetime]]:
+        """Get Ethereum block timestamps for several blocks, using JSON-RPC batches where possible"""
+        block_numbers = set(block_numbers)
+        if self.skip_block_timestamp:
+            # Returning None since, config set to skip getting block timestamp data
+            return {block_number: None for block_number in block_numbers}
+        timestamps = {}
+        if self.timestamp_index is not None:
+            timestamps = self.timestamp_index.get_many(block_numbers)
+        missing = block_numbers.difference(timestamps)
+        if missing:
+            fetched = await async_get_block_timestamps(
+                self.web3, missing, semaphore=self.semaphore
+            )
+            if self.timestamp_index is not None:
+                self.timestamp_index.put_many(fetched)
+            timestamps.update(fetched)
+        # Blocks which were not mined yet (minor chain reorganisation?) have no timestamp
+        return {
+            block_number: (
+                datetime.datetime.utcfromtimestamp(timestamps[block_number])
+                if block_number in timestamps
+                else None
+            )
+            for block_number in block_numbers
+        }
+
+    async def get_suggested_scan_end_block(self) -> int:
+        """Get the last mined block on Ethereum chain we are following."""
+
+        # Do not scan all the way to the final block, as this
+        # block might not be mined yet
+        return (await self.web3.eth.block_number) - 1
+
+    def get_last_scanned_block(self) -> int:
+        return self.state.get_last_scanned_block()
+
+    def delete_potentially_forked_block_data(self, after_block: int):
+        """Purge old data in the case of blockchain reorganisation."""
+        self.state.delete_data(after_block)
+
+    def estimate_next_chunk_size(
+        self,
+        current_chuck_size: int,
+        event_found_count: int,
+        duration: float = 0.0,
+    ):
+        """Try to figure out optimal chunk size.
+
+        Same heuristics as `EventScanner.estimate_next_chunk_size`.
+        """
+        return self.chunk_size_controller.next_chunk_size(
+            current_chuck_size, event_found_count, duration
+        )
+
+    async def _fetch_with_retries(
+        self, fetch: Callable[[int, int], Awaitable[list]], start_block, end_block
+    ) -> list:
+        async def _bounded_fetch(
+            _start_block: int, _end_block: int, _addresses=None
+        ) -> list:
+            async with self.semaphore:
+                return await fetch(_start_block, _end_block, _addresses)
+
+        return await _async_bisect_web3_call(
+            _bounded_fetch,
+            start_block=start_block,
+            end_block=end_block,
+            retry_policy=self.retry_policy,
+            addresses=self.checksum_addresses or None,
+            on_failure=self.chunk_size_controller.on_failure,
+        )
+
+    async def scan_chunk(
+        self, start_block, end_block
+    ) -> Tuple[int, Optional[datetime.datetime], list]:
+        """Read and process events between to block numbers.
+
+        Event types are fetched concurrently. If the JSON-RPC server cannot serve the whole chunk, the
+        failing part of the chunk is split as the retry policy decides, so the whole chunk is always scanned.
+
+        :return: tuple(actual end block number, when this block was mined, processed events)
+        """
+        batch = await self._scan_chunk(start_block, end_block)
+        return batch.end_block, batch.end_block_timestamp, batch.processed
+
+    async def _scan_chunk(self, start_block: int, end_block: int) -> ScanBatch:
+        fetchers: List[Callable[[int, int], Awaitable[list]]] = []
+        if self.combine_event_requests:
+            fetchers.append(
+                lambda _start_block, _end_block, _addresses=None: _async_fetch_all_events_chunk(
+                    self.web3,
+                    self.decoders,
+                    _start_block,
+                    _end_block,
+                    addresses=_addresses,
+                )
+            )
+        else:
+            for decoder in self.event_decoders:
+                fetchers.append(
+                    lambda _start_block, _end_block, _addresses=None, decoder=decoder: _async_fetch_events_chunk(
+                        self.web3,
+                        decoder,
+                        _start_block,
+                        _end_block,
+                        addresses=_addresses,
+                    )
+                )
+
+        results = await asyncio.gather(
+            *[
+                self._fetch_with_retries(fetch, start_block, end_block)
+                for fetch in fetchers
+            ]
+        )
+
+        events = [evt for fetched_events in results for evt in fetched_events]
+        events.sort(key=lambda evt: (evt["blockNumber"], evt["logIndex"]))
+
+        for evt in events:
+            # We cannot avoid minor chain reorganisations, but
+            # at least we must avoid blocks that are not mined yet
+            assert evt["logIndex"] is not None, "Somehow tried to scan a pending block"
+
+        block_timestamps = await self.get_block_timestamps(
+            [evt["blockNumber"] for evt in events] + [end_block]
+        )
+
+        all_processed = []
+        for evt in events:
+            logger.debug(
+                "Processing event %s, block:%d",
+                evt["event"],
+                evt["blockNumber"],
+            )
+            processed = self.state.process_event(
+                block_timestamps[evt["blockNumber"]], evt
+            )
+            all_processed.append(processed)
+
+        return ScanBatch(
+            start_block=start_block,
+            end_block=end_block,
+            end_block_timestamp=block_timestamps[end_block],
+            events=events,
+            processed=all_processed,
+        )
+
+    async def iter_scan(
+        self,
+        start_block: int,
+        end_block: int,
+        start_chunk_size: int = 20,
+        progress_callback: Optional[Callable] = None,
+        cursor: Optional[int] = None,
+    ) -> AsyncIterator[ScanBatch]:
+        """Perform a scan, yielding the events of every chunk as soon as the chunk is scanned. Same as
+        `EventScanner.iter_scan`, without prefetching: the next chunk is scanned when the consumer asks
+        for it.
+        """
+
+        if cursor is not None:
+            start_block = max(start_block, cursor + 1)
+
+        current_block = start_block
+
+        # Scan in chunks, commit between
+        chunk_size = start_chunk_size
+        last_scan_duration = last_logs_found = 0
+
+        while current_block <= end_block:
+            self.state.start_chunk(current_block, chunk_size)
+
+            estimated_end_block = min(current_block + chunk_size, end_block)
+            logger.debug(
+                "Scanning token transfers for blocks: %d - %d, chunk size %d, last chunk scan took %f, last logs found %d",
+                current_block,
+                estimated_end_block,
+                chunk_size,
+                last_scan_duration,
+                last_logs_found,
+            )
+
+            start = time.time()
+            batch = await self._scan_chunk(current_block, estimated_end_block)
+
+            current_end = batch.end_block
+
+            last_scan_duration = time.time() - start
+            last_logs_found = len(batch.processed)
+
+            if progress_callback:
+                progress_callback(
+                    start_block,
+                    end_block,
+                    current_block,
+                    batch.end_block_timestamp,
+                    chunk_size,
+                    len(batch.processed),
+                )
+
+            chunk_size = self.estimate_next_chunk_size(
+                current_end - current_block + 1,
+                len(batch.processed),
+                last_scan_duration,
+            )
+
+            current_block = current_end + 1
+            self.state.end_chunk(current_end)
+            yield batch
+
+    async def scan(
+        self,
+        start_block,
+        end_block,
+        start_chunk_size=20,
+        progress_callback: Optional[Callable] = None,
+    ) -> Tuple[list, int]:
+        """Perform a scan, same as `EventScanner.scan`.
+
+        :param start_block: The first block included in the scan
+
+        :param end_block: The last block included in the scan
+
+        :param start_chunk_size: How many blocks we try to fetch over JSON-RPC on the first attempt
+
+        :param progress_callback: If this is an UI application, update the progress of the scan
+
+        :return: [All processed events, number of chunks used]
+        """
+
+        assert start_block <= end_block
+
+        # All processed entries we got on this scan cycle
+        all_processed = []
+        total_chunks_scanned = 0
+        async for batch in self.iter_scan(
+            start_block, end_block, start_chunk_size, progress_callback
+        ):
+            all_processed += batch.processed
+            total_chunks_scanned += 1
+
+        return all_processed, total_chunks_scanned
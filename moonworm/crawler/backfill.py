@@ -0,0 +1,403 @@
+"""
+Sharded backfills: several worker processes, on one host or many, crawl a range of blocks together.
+
+The range is split into work units which are stored in a durable queue. Workers lease units from the
+queue, crawl them, write the output of every unit to its own file and mark the unit as done. A worker
+renews its lease with heartbeats while it crawls a unit. If it dies, its lease expires and another
+worker crawls the unit again. Once all units are done, `merge_outputs` concatenates their outputs in
+block order.
+
+[`SQLiteBackfillQueue`][moonworm.crawler.backfill.SQLiteBackfillQueue] keeps the queue in a SQLite
+database, which workers on several hosts can share over a network filesystem with working file locks.
+Other queues can implement the [`BackfillQueue`][moonworm.crawler.backfill.BackfillQueue] interface.
+
+Leases are timed with the wall clocks of the workers, which must be roughly in sync.
+
+Usage:
+```python
+from moonworm.crawler.backfill import SQLiteBackfillQueue, merge_outputs, run_backfill_worker
+
+backfill_queue = SQLiteBackfillQueue("backfill.sqlite")
+backfill_queue.add_range(12000000, 16000000, unit_blocks=100000)
+
+# In every worker process
+run_backfill_worker(backfill_queue, crawl_unit, "backfill-outputs")
+
+# Once all units are done
+merge_outputs(backfill_queue, "crawldata.jsonl")
+```
+"""
+
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from .sinks import encode_records
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+@dataclass
+class WorkUnit:
+    """
+    A range of blocks of a backfill, leased by a worker.
+    """
+
+    id: int
+    from_block: int
+    to_block: int
+    # Number of times the unit has been leased, including this lease
+    attempts: int
+
+
+class BackfillQueue(ABC):
+    """
+    Abstract class for the durable queue which hands out the work units of a backfill.
+    If you want to use a different queue, you can implement this class.
+    """
+
+    @abstractmethod
+    def add_range(self, from_block: int, to_block: int, unit_blocks: int) -> int:
+        """
+        Splits the given range of blocks into work units of unit_blocks blocks and adds them to the
+        queue. Units which are already in the queue are not added again. Returns the number of units
+        added.
+        """
+        pass
+
+    @abstractmethod
+    def lease(self, worker_id: str) -> Optional[WorkUnit]:
+        """
+        Leases the next available work unit to the given worker: a pending unit, or a unit whose lease
+        has expired. Returns None if there is no available unit.
+        """
+        pass
+
+    @abstractmethod
+    def heartbeat(self, unit: WorkUnit, worker_id: str) -> bool:
+        """
+        Extends the lease of the worker on the unit. Returns False if the worker lost the lease.
+        """
+        pass
+
+    @abstractmethod
+    def complete(self, unit: WorkUnit, worker_id: str, output: str) -> bool:
+        """
+        Marks the unit as done, with the path of its output. Returns False if the unit was already
+        completed by another worker.
+        """
+        pass
+
+    @abstractmethod
+    def fail(self, unit: WorkUnit, worker_id: str, error: str) -> None:
+        """
+        Releases the lease of the worker on the unit after an error, so that the unit can be retried.
+        """
+        pass
+
+    @abstractmethod
+    def progress(self) -> Dict[str, int]:
+        """
+        Returns the number of units in every status.
+        """
+        pass
+
+    @abstractmethod
+    def outputs(self) -> List[Optional[str]]:
+        """
+        Returns the output paths of all units in block order, None for the units which are not done.
+        """
+        pass
+
+
+class SQLiteBackfillQueue(BackfillQueue):
+    """
+    Implements the BackfillQueue interface on a SQLite database.
+
+    Leases are taken in IMMEDIATE transactions, so that concurrent workers never lease the same unit.
+    The database uses SQLite's rollback journal rather than WAL mode, as WAL does not work across hosts
+    sharing the database file over a network filesystem.
+
+    A unit which failed, or whose lease expired, max_attempts times is marked as failed and not leased
+    again, until retry_failed is called.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 300, max_attempts: int = 5):
+        """
+        :param path: Path of the database file. It is created if it does not exist.
+        :param lease_seconds: Duration of leases. Workers renew their leases with heartbeats.
+        :param max_attempts: Number of times a unit is leased before it is marked as failed
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # The connection is shared with the heartbeat thread of the worker
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self._lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS units (
+                    id INTEGER PRIMARY KEY,
+                    from_block INTEGER NOT NULL,
+                    to_block INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    worker_id TEXT,
+                    lease_expires_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    output TEXT,
+                    error TEXT,
+                    UNIQUE (from_block, to_block)
+                );
+                CREATE INDEX IF NOT EXISTS units_status_idx ON units (status, id);
+                """)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def add_range(self, from_block: int, to_block: int, unit_blocks: int) -> int:
+        if unit_blocks <= 0:
+            raise ValueError("unit_blocks must be positive")
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                added = 0
+                for unit_from_block in range(from_block, to_block + 1, unit_blocks):
+                    added += self.conn.execute(
+                        "INSERT OR IGNORE INTO units (from_block, to_block, status) VALUES (?, ?, ?)",
+                        (
+                            unit_from_block,
+                            min(unit_from_block + unit_blocks - 1, to_block),
+                            PENDING,
+                        ),
+                    ).rowcount
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return added
+
+    def lease(self, worker_id: str) -> Optional[WorkUnit]:
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Units abandoned too many times are not retried
+                self.conn.execute(
+                    "UPDATE units SET status = ? WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                    (FAILED, LEASED, now, self.max_attempts),
+                )
+                row = self.conn.execute(
+                    """
+                    SELECT id, from_block, to_block, attempts FROM units
+                    WHERE status = ? OR (status = ? AND lease_expires_at < ?)
+                    ORDER BY id LIMIT 1
+                    """,
+                    (PENDING, LEASED, now),
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        """
+                        UPDATE units SET status = ?, worker_id = ?, lease_expires_at = ?,
+                        attempts = attempts + 1 WHERE id = ?
+                        """,
+                        (LEASED, worker_id, now + self.lease_seconds, row[0]),
+                    )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return WorkUnit(
+            id=row[0], from_block=row[1], to_block=row[2], attempts=row[3] + 1
+        )
+
+    def heartbeat(self, unit: WorkUnit, worker_id: str) -> bool:
+        with self._lock:
+            return (
+                self.conn.execute(
+                    "UPDATE units SET lease_expires_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+                    (time.time() + self.lease_seconds, unit.id, worker_id, LEASED),
+                ).rowcount
+                > 0
+            )
+
+    def complete(self, unit: WorkUnit, worker_id: str, output: str) -> bool:
+        # A worker which lost its lease crawled the same blocks, so its output is as good as any
+        with self._lock:
+            return (
+                self.conn.execute(
+                    "UPDATE units SET status = ?, worker_id = ?, output = ?, error = NULL WHERE id = ? AND status != ?",
+                    (DONE, worker_id, output, unit.id, DONE),
+                ).rowcount
+                > 0
+            )
+
+    def fail(self, unit: WorkUnit, worker_id: str, error: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                """
+                UPDATE units SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?
+                WHERE id = ? AND worker_id = ? AND status = ?
+                """,
+                (
+                    self.max_attempts,
+                    FAILED,
+                    PENDING,
+                    error,
+                    unit.id,
+                    worker_id,
+                    LEASED,
+                ),
+            )
+
+    def retry_failed(self) -> int:
+        """
+        Makes failed units available again. Returns the number of units.
+        """
+        with self._lock:
+            return self.conn.execute(
+                "UPDATE units SET status = ?, attempts = 0 WHERE status = ?",
+                (PENDING, FAILED),
+            ).rowcount
+
+    def progress(self) -> Dict[str, int]:
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        with self._lock:
+            for status, count in self.conn.execute(
+                "SELECT status, COUNT(*) FROM units GROUP BY status"
+            ):
+                counts[status] = count
+        return counts
+
+    def outputs(self) -> List[Optional[str]]:
+        with self._lock:
+            return [
+                output if status == DONE else None
+                for status, output in self.conn.execute(
+                    "SELECT status, output FROM units ORDER BY from_block"
+                )
+            ]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def run_backfill_worker(
+    backfill_queue: BackfillQueue,
+    crawl_unit: Callable[[int, int], Iterable[Dict[str, Any]]],
+    output_directory: str,
+    worker_id: Optional[str] = None,
+    heartbeat_seconds: float = 60,
+    max_units: Optional[int] = None,
+) -> int:
+    """
+    Leases work units from the queue and crawls them until no unit is available.
+
+    crawl_unit(from_block, to_block) returns the records of a unit, in block order. They are written in
+    JSON Lines format, as they are produced, to a file of the output directory, named after the blocks
+    of the unit, which is only renamed to its final name once it is complete. crawl_unit can be a
+    generator, so that a unit is never held in memory as a whole.
+
+    While a unit is crawled, its lease is renewed every heartbeat_seconds, which must be well below the
+    lease duration of the queue. Returns the number of units completed.
+    """
+    if worker_id is None:
+        worker_id = default_worker_id()
+    os.makedirs(output_directory, exist_ok=True)
+
+    completed = 0
+    while max_units is None or completed < max_units:
+        unit = backfill_queue.lease(worker_id)
+        if unit is None:
+            break
+        logger.info(
+            "Worker %s crawling blocks %d-%d (attempt %d)",
+            worker_id,
+            unit.from_block,
+            unit.to_block,
+            unit.attempts,
+        )
+
+        stop_heartbeats = threading.Event()
+
+        def _heartbeats(unit: WorkUnit = unit) -> None:
+            while not stop_heartbeats.wait(heartbeat_seconds):
+                if not backfill_queue.heartbeat(unit, worker_id):
+                    logger.warning(
+                        "Worker %s lost its lease on blocks %d-%d",
+                        worker_id,
+                        unit.from_block,
+                        unit.to_block,
+                    )
+                    return
+
+        heartbeat_thread = threading.Thread(target=_heartbeats, daemon=True)
+        heartbeat_thread.start()
+        output = os.path.abspath(
+            os.path.join(
+                output_directory,
+                f"unit-{unit.from_block:010d}-{unit.to_block:010d}.jsonl",
+            )
+        )
+        temporary_output = f"{output}.{worker_id}.tmp"
+        try:
+            with open(temporary_output, "wb") as ofp:
+                for record in crawl_unit(unit.from_block, unit.to_block):
+                    ofp.write(encode_records((record,)))
+            os.replace(temporary_output, output)
+        except Exception as e:
+            logger.error(
+                "Worker %s failed to crawl blocks %d-%d: %s",
+                worker_id,
+                unit.from_block,
+                unit.to_block,
+                e,
+            )
+            backfill_queue.fail(unit, worker_id, repr(e))
+            if os.path.exists(temporary_output):
+                os.remove(temporary_output)
+            continue
+        finally:
+            stop_heartbeats.set()
+            heartbeat_thread.join()
+
+        backfill_queue.complete(unit, worker_id, output)
+        completed += 1
+    return completed
+
+
+def merge_outputs(backfill_queue: BackfillQueue, outfile: str) -> int:
+    """
+    Concatenates the outputs of all units in block order into outfile. Raises a ValueError if some
+    units are not done yet. Returns the number of units merged.
+    """
+    outputs = backfill_queue.outputs()
+    missing = sum(1 for output in outputs if output is None)
+    if missing:
+        raise ValueError(f"{missing} of {len(outputs)} work units are not done yet")
+
+    temporary_outfile = f"{outfile}.tmp"
+    with open(temporary_outfile, "wb") as ofp:
+        for output in outputs:
+            assert output is not None
+            with open(output, "rb") as ifp:
+                shutil.copyfileobj(ifp, ofp)
+    os.replace(temporary_outfile, outfile)
+    return len(outputs)
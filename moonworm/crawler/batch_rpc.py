@@ -0,0 +1,372 @@
+"""
+JSON-RPC batch requests.
+
+web3.py sends one HTTP request per JSON-RPC call. Crawlers which need the same call for many blocks
+(e.g. block timestamps for every block with events in a scanned chunk) can use the functions in this
+module to send those calls as JSON-RPC batches instead.
+
+Batches are only sent over HTTP providers (including pools of HTTP endpoints, see
+[`moonworm.crawler.provider_pool`][moonworm.crawler.provider_pool]). For other providers, or if the JSON-RPC server does not
+accept batches, the calls are made one by one through web3.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from web3 import AsyncHTTPProvider, HTTPProvider, Web3
+from web3._utils.method_formatters import receipt_formatter
+from web3._utils.request import async_make_post_request, make_post_request
+from web3.exceptions import BlockNotFound, TransactionNotFound
+
+from .provider_pool import PooledHTTPProvider
+from .rate_limit import get_rate_limiter
+from .rpc_cache import cached_batch_request
+
+logger = logging.getLogger(__name__)
+
+# Number of calls per JSON-RPC batch. Most hosted providers accept batches of at least 100 calls.
+DEFAULT_BATCH_SIZE = 100
+
+
+class BatchRequestsNotSupported(Exception):
+    """
+    Raised if a batch cannot be sent over the given provider, or if the JSON-RPC server rejects it.
+    """
+
+
+# JSON-RPC error code of calls to methods the server does not implement
+METHOD_NOT_FOUND = -32601
+
+# Messages of servers which do not use the error code above for methods they do not implement
+METHOD_NOT_FOUND_MESSAGES = (
+    "method not found",
+    "not supported",
+    "does not exist",
+    "not available",
+    "unknown rpc endpoint",
+)
+
+
+def is_method_not_found(error: ValueError) -> bool:
+    """
+    Returns True if the given error, as raised by web3 or by the functions of this module for a JSON-RPC
+    error response, means that the server does not implement the method which was called.
+    """
+    details = error.args[0] if error.args else None
+    if isinstance(details, dict):
+        if details.get("code") == METHOD_NOT_FOUND:
+            return True
+        message = str(details.get("message", ""))
+    else:
+        message = str(details)
+    message = message.lower()
+    return any(text in message for text in METHOD_NOT_FOUND_MESSAGES)
+
+
+def _encode_batch(calls: Sequence[Tuple[str, Any]]) -> bytes:
+    return json.dumps(
+        [
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": request_id}
+            for request_id, (method, params) in enumerate(calls)
+        ]
+    ).encode("utf-8")
+
+
+def _decode_batch(raw_response: bytes, num_calls: int) -> List[Any]:
+    response = json.loads(raw_response)
+    # Servers which do not support batches answer with a single error object
+    if not isinstance(response, list) or len(response) != num_calls:
+        raise BatchRequestsNotSupported(f"Unexpected response to batch: {response}")
+
+    results: List[Any] = [None] * num_calls
+    for item in response:
+        if "error" in item:
+            # Same as web3.py does for single requests
+            raise ValueError(item["error"])
+        results[item["id"]] = item.get("result")
+    return results
+
+
+def make_batch_request(web3: Web3, calls: Sequence[Tuple[str, Any]]) -> List[Any]:
+    """
+    Sends the given (method, params) calls to the web3 provider as a single JSON-RPC batch and returns
+    their raw results, in the order of the calls.
+
+    Middlewares of the web3 client are not applied to batches, but the rate limits of the endpoint are
+    (see moonworm.crawler.rate_limit), and calls about finalized blocks are served from the response
+    cache of the client, if it has one (see moonworm.crawler.rpc_cache).
+    """
+    return cached_batch_request(
+        web3, calls, lambda missing_calls: _send_batch(web3, missing_calls)
+    )
+
+
+def _send_batch(web3: Web3, calls: Sequence[Tuple[str, Any]]) -> List[Any]:
+    provider = web3.provider
+    methods = [method for method, _ in calls]
+    if isinstance(provider, PooledHTTPProvider):
+        # The pool applies the rate limits of the endpoint it sends the batch to
+        raw_response = provider.make_raw_request(
+            _encode_batch(calls),
+            hedged=all(method in provider.hedged_methods for method in methods),
+            methods=methods,
+        )
+        return _decode_batch(raw_response, len(calls))
+    if not isinstance(provider, HTTPProvider):
+        raise BatchRequestsNotSupported(
+            f"Batches are not supported over {type(provider).__name__}"
+        )
+    limiter = get_rate_limiter(provider.endpoint_uri)
+    if limiter is not None:
+        limiter.acquire(methods)
+    raw_response = make_post_request(
+        provider.endpoint_uri, _encode_batch(calls), **provider.get_request_kwargs()
+    )
+    return _decode_batch(raw_response, len(calls))
+
+
+async def async_make_batch_request(
+    web3: Web3, calls: Sequence[Tuple[str, Any]]
+) -> List[Any]:
+    """
+    Asynchronous version of `make_batch_request`, for web3 clients with an AsyncHTTPProvider.
+    """
+    provider = getattr(web3, "provider", None)
+    if not isinstance(provider, AsyncHTTPProvider):
+        raise BatchRequestsNotSupported(
+            f"Batches are not supported over {type(provider).__name__}"
+        )
+    limiter = get_rate_limiter(provider.endpoint_uri)
+    if limiter is not None:
+        await limiter.async_acquire([method for method, _ in calls])
+    raw_response = await async_make_post_request(
+        provider.endpoint_uri, _encode_batch(calls), **provider.get_request_kwargs()
+    )
+    return _decode_batch(raw_response, len(calls))
+
+
+def _batches(items: List[Any], batch_size: int) -> Iterable[List[Any]]:
+    for i in range(0, len(items), batch_size):
+        yield items[i : i + batch_size]
+
+
+def _block_calls(block_numbers: List[int]) -> List[Tuple[str, Any]]:
+    # Without full transactions, so responses stay small
+    return [
+        ("eth_getBlockByNumber", [hex(block_number), False])
+        for block_number in block_numbers
+    ]
+
+
+def _timestamps_from_results(
+    block_numbers: List[int], results: List[Any]
+) -> Dict[int, int]:
+    return {
+        block_number: int(block["timestamp"], 16)
+        for block_number, block in zip(block_numbers, results)
+        # Blocks which were not mined yet are returned as null
+        if block is not None
+    }
+
+
+def get_block_headers(
+    web3: Web3, block_numbers: Iterable[int], batch_size: int = DEFAULT_BATCH_SIZE
+) -> Dict[int, Dict[str, Any]]:
+    """
+    Returns the number, hash, parentHash and timestamp of the given blocks, using JSON-RPC batches where
+    possible. Hashes are 0x-prefixed hex strings.
+
+    Blocks which were not found are left out of the result.
+    """
+    block_numbers = sorted(set(block_numbers))
+    headers: Dict[int, Dict[str, Any]] = {}
+    batched = True
+    for batch in _batches(block_numbers, batch_size):
+        if batched:
+            try:
+                results = make_batch_request(web3, _block_calls(batch))
+                for block_number, block in zip(batch, results):
+                    # Blocks which were not mined yet are returned as null
+                    if block is not None:
+                        headers[block_number] = {
+                            "number": int(block["number"], 16),
+                            "hash": block["hash"],
+                            "parentHash": block["parentHash"],
+                            "timestamp": int(block["timestamp"], 16),
+                        }
+                continue
+            except BatchRequestsNotSupported as e:
+                logger.debug("Falling back to single requests: %s", e)
+                batched = False
+        for block_number in batch:
+            try:
+                block = web3.eth.get_block(block_number)
+            except BlockNotFound:
+                continue
+            headers[block_number] = {
+                "number": block["number"],
+                "hash": Web3.toHex(block["hash"]),
+                "parentHash": Web3.toHex(block["parentHash"]),
+                "timestamp": block["timestamp"],
+            }
+    return headers
+
+
+def get_block_timestamps(
+    web3: Web3, block_numbers: Iterable[int], batch_size: int = DEFAULT_BATCH_SIZE
+) -> Dict[int, int]:
+    """
+    Returns the timestamps of the given blocks, using JSON-RPC batches where possible.
+
+    Blocks which were not found are left out of the result.
+    """
+    return {
+        block_number: header["timestamp"]
+        for block_number, header in get_block_headers(
+            web3, block_numbers, batch_size
+        ).items()
+    }
+
+
+def get_block_receipts(
+    web3: Web3, block_numbers: Iterable[int], batch_size: int = DEFAULT_BATCH_SIZE
+) -> Tuple[Dict[int, List[Dict[str, Any]]], int]:
+    """
+    Returns the receipts of all the transactions in each of the given blocks, using eth_getBlockReceipts
+    calls sent as JSON-RPC batches where possible, and the number of requests which were sent.
+
+    Raises ValueError if the JSON-RPC server does not support eth_getBlockReceipts. Blocks which were
+    not found are left out of the result.
+    """
+    block_numbers = sorted(set(block_numbers))
+    block_receipts: Dict[int, List[Dict[str, Any]]] = {}
+    num_requests = 0
+
+    def _add(block_number: int, receipts: Optional[List[Dict[str, Any]]]) -> None:
+        if receipts is not None:
+            block_receipts[block_number] = [
+                receipt_formatter(receipt) for receipt in receipts
+            ]
+
+    batched = True
+    for batch in _batches(block_numbers, batch_size):
+        if batched:
+            try:
+                results = make_batch_request(
+                    web3,
+                    [
+                        ("eth_getBlockReceipts", [hex(block_number)])
+                        for block_number in batch
+                    ],
+                )
+                num_requests += 1
+                for block_number, receipts in zip(batch, results):
+                    _add(block_number, receipts)
+                continue
+            except BatchRequestsNotSupported as e:
+                logger.debug("Falling back to single requests: %s", e)
+                batched = False
+        for block_number in batch:
+            num_requests += 1
+            _add(
+                block_number,
+                web3.manager.request_blocking(
+                    "eth_getBlockReceipts", [hex(block_number)]
+                ),
+            )
+    return block_receipts, num_requests
+
+
+def get_transaction_receipts(
+    web3: Web3,
+    transaction_hashes: Iterable[str],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> Tuple[Dict[str, Dict[str, Any]], int]:
+    """
+    Returns the receipts of the given transactions, keyed by their 0x-prefixed hex hashes, using
+    JSON-RPC batches where possible, and the number of requests which were sent.
+
+    Transactions which were not found are left out of the result.
+    """
+    transaction_hashes = sorted(set(transaction_hashes))
+    receipts: Dict[str, Dict[str, Any]] = {}
+    num_requests = 0
+    batched = True
+    for batch in _batches(transaction_hashes, batch_size):
+        if batched:
+            try:
+                results = make_batch_request(
+                    web3,
+                    [
+                        ("eth_getTransactionReceipt", [transaction_hash])
+                        for transaction_hash in batch
+                    ],
+                )
+                num_requests += 1
+                for transaction_hash, receipt in zip(batch, results):
+                    # Receipts of pending transactions are returned as null
+                    if receipt is not None:
+                        receipts[transaction_hash] = receipt_formatter(receipt)
+                continue
+            except BatchRequestsNotSupported as e:
+                logger.debug("Falling back to single requests: %s", e)
+                batched = False
+        for transaction_hash in batch:
+            num_requests += 1
+            try:
+                receipts[transaction_hash] = web3.eth.get_transaction_receipt(
+                    transaction_hash
+                )
+            except TransactionNotFound:
+                continue
+    return receipts, num_requests
+
+
+async def async_get_block_timestamps(
+    web3: Web3,
+    block_numbers: Iterable[int],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    semaphore: Optional[asyncio.Semaphore] = None,
+) -> Dict[int, int]:
+    """
+    Asynchronous version of `get_block_timestamps`. Batches (or, as fallback, single requests) are sent
+    concurrently, holding the given semaphore for every request.
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(DEFAULT_BATCH_SIZE)
+    block_numbers = sorted(set(block_numbers))
+
+    async def _get_block_timestamp(block_number: int) -> Dict[int, int]:
+        async with semaphore:
+            try:
+                block = await web3.eth.get_block(block_number)
+            except BlockNotFound:
+                return {}
+        return {block_number: block["timestamp"]}
+
+    async def _get_batch_timestamps(batch: List[int]) -> Dict[int, int]:
+        async with semaphore:
+            results = await async_make_batch_request(web3, _block_calls(batch))
+        return _timestamps_from_results(batch, results)
+
+    timestamps: Dict[int, int] = {}
+    if isinstance(getattr(web3, "provider", None), AsyncHTTPProvider):
+        try:
+            for batch_timestamps in await asyncio.gather(
+                *[
+                    _get_batch_timestamps(batch)
+                    for batch in _batches(block_numbers, batch_size)
+                ]
+            ):
+                timestamps.update(batch_timestamps)
+            return timestamps
+        except BatchRequestsNotSupported as e:
+            logger.debug("Falling back to single requests: %s", e)
+
+    for block_timestamps in await asyncio.gather(
+        *[_get_block_timestamp(block_number) for block_number in block_numbers]
+    ):
+        timestamps.update(block_timestamps)
+    return timestamps
@@ -0,0 +1,194 @@
+"""
+Controllers which decide how many blocks to request in the next eth_getLogs call.
+
+Both [`EventScanner`][moonworm.crawler.log_scanner.EventScanner] and the `_crawl_events` family of
+functions in [`moonworm.crawler.log_scanner`][moonworm.crawler.log_scanner] ask a
+`ChunkSizeController` for the size of their next chunk after every request. They can also align the
+ends of their chunks to a grid with `align_chunk_end`, so that reruns request the same ranges (see
+[`moonworm.crawler.rpc_cache`][moonworm.crawler.rpc_cache]).
+"""
+
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkSizeController(ABC):
+    """
+    Abstract class for chunk size controllers.
+    If you want to use a different strategy, you can implement this class.
+
+    Controllers expose their decisions in the `metrics` dictionary.
+    """
+
+    metrics: Dict[str, Any]
+
+    @abstractmethod
+    def next_chunk_size(self, num_blocks: int, num_events: int, duration: float) -> int:
+        """
+        Returns the number of blocks to request next, given that the last successful request spanned
+        num_blocks blocks, returned num_events events and took duration seconds.
+        """
+        pass
+
+    @abstractmethod
+    def on_failure(self, num_blocks: int) -> int:
+        """
+        Returns the number of blocks to request next, given that a request spanning num_blocks blocks
+        failed. Called by the retry loops of the scanners for every failed request, before the range is
+        retried or split.
+        """
+        pass
+
+
+class AdaptiveChunkSizeController(ChunkSizeController):
+    """
+    Targets a response size (in events) and a request duration (in seconds) per eth_getLogs call.
+
+    The controller keeps exponentially weighted moving averages of the number of events per block and of
+    the request duration per block. After every successful request it picks the largest chunk size which
+    is expected to stay within both targets:
+
+    - The chunk size grows at most by `increase_factor` per request, so sparse ranges ramp up quickly
+    (doubling by default) without overshooting into a dense range.
+    - The chunk size drops straight to the expected size when the targets are exceeded, instead of
+    resetting to `min_chunk_size`.
+    - On failures the chunk size is multiplied by `decrease_factor` (additive-increase/multiplicative-
+    decrease style back off): the next chunk is at most that size, however fast the failed range was
+    eventually fetched.
+
+    The controller is thread-safe, so several workers crawling the same contract can share it.
+    """
+
+    def __init__(
+        self,
+        min_chunk_size: int,
+        max_chunk_size: int,
+        target_events: int = 1000,
+        target_duration: float = 5.0,
+        increase_factor: float = 2.0,
+        decrease_factor: float = 0.5,
+        smoothing: float = 0.5,
+    ):
+        """
+        :param min_chunk_size: Minimum number of blocks per request
+        :param max_chunk_size: Maximum number of blocks per request
+        :param target_events: Number of events we want each response to contain at most
+        :param target_duration: Number of seconds we want each request to take at most
+        :param increase_factor: Maximum growth of the chunk size from one request to the next
+        :param decrease_factor: Factor applied to the chunk size when a request fails
+        :param smoothing: Weight of the latest observation in the moving averages, between 0 and 1
+        """
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max(min_chunk_size, max_chunk_size)
+        self.target_events = target_events
+        self.target_duration = target_duration
+        self.increase_factor = increase_factor
+        self.decrease_factor = decrease_factor
+        self.smoothing = smoothing
+
+        self.events_per_block: float = 0.0
+        self.seconds_per_block: float = 0.0
+        self._observed = False
+        # Chunk size after the largest request which failed since the last successful chunk, if any.
+        # Sub-ranges split off a failed request fail too, but should not hold the next chunk back.
+        self._failure_chunk_size: Optional[int] = None
+        self._lock = threading.Lock()
+
+        self.metrics: Dict[str, Any] = {
+            "requests": 0,
+            "failures": 0,
+            "increases": 0,
+            "decreases": 0,
+            "chunk_size": min_chunk_size,
+            "events_per_block": 0.0,
+            "seconds_per_block": 0.0,
+            "limited_by": None,
+        }
+
+    def _clamp(self, chunk_size: float) -> int:
+        return int(max(self.min_chunk_size, min(self.max_chunk_size, chunk_size)))
+
+    def _record(self, num_blocks: int, chunk_size: int, limited_by: str) -> None:
+        if chunk_size > num_blocks:
+            self.metrics["increases"] += 1
+        elif chunk_size < num_blocks:
+            self.metrics["decreases"] += 1
+        self.metrics["chunk_size"] = chunk_size
+        self.metrics["events_per_block"] = self.events_per_block
+        self.metrics["seconds_per_block"] = self.seconds_per_block
+        self.metrics["limited_by"] = limited_by
+        logger.debug(
+            "Next chunk size %d (previous %d, limited by %s, %f events/block, %f s/block)",
+            chunk_size,
+            num_blocks,
+            limited_by,
+            self.events_per_block,
+            self.seconds_per_block,
+        )
+
+    def next_chunk_size(self, num_blocks: int, num_events: int, duration: float) -> int:
+        num_blocks = max(num_blocks, 1)
+        with self._lock:
+            self.metrics["requests"] += 1
+
+            observed_events_per_block = num_events / num_blocks
+            observed_seconds_per_block = max(duration, 0.0) / num_blocks
+            if not self._observed:
+                self.events_per_block = observed_events_per_block
+                self.seconds_per_block = observed_seconds_per_block
+                self._observed = True
+            else:
+                self.events_per_block = (
+                    self.smoothing * observed_events_per_block
+                    + (1 - self.smoothing) * self.events_per_block
+                )
+                self.seconds_per_block = (
+                    self.smoothing * observed_seconds_per_block
+                    + (1 - self.smoothing) * self.seconds_per_block
+                )
+
+            candidates = {"ramp": num_blocks * self.increase_factor}
+            if self.events_per_block > 0:
+                candidates["payload"] = self.target_events / self.events_per_block
+            if self.seconds_per_block > 0:
+                candidates["latency"] = self.target_duration / self.seconds_per_block
+            if self._failure_chunk_size is not None:
+                candidates["failure"] = self._failure_chunk_size
+                self._failure_chunk_size = None
+
+            limited_by = min(candidates, key=lambda reason: candidates[reason])
+            chunk_size = self._clamp(candidates[limited_by])
+            if chunk_size == self.max_chunk_size:
+                limited_by = "max_chunk_size"
+            elif chunk_size == self.min_chunk_size:
+                limited_by = "min_chunk_size"
+
+            self._record(num_blocks, chunk_size, limited_by)
+            return chunk_size
+
+    def on_failure(self, num_blocks: int) -> int:
+        with self._lock:
+            self.metrics["failures"] += 1
+            chunk_size = self._clamp(num_blocks * self.decrease_factor)
+            if self._failure_chunk_size is None:
+                self._failure_chunk_size = chunk_size
+            else:
+                self._failure_chunk_size = max(self._failure_chunk_size, chunk_size)
+            self._record(num_blocks, chunk_size, "failure")
+            return chunk_size
+
+
+def align_chunk_end(from_block: int, to_block: int, grid: Optional[int]) -> int:
+    """
+    Moves the end of the chunk from_block..to_block back to the end of a grid cell (the block before a
+    multiple of grid). Chunks which do not cross the end of a cell are left as they are, so that
+    alignment never holds a crawl back.
+    """
+    if not grid:
+        return to_block
+    aligned = (to_block + 1) // grid * grid - 1
+    return aligned if aligned >= from_block else to_block
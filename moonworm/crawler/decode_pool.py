@@ -0,0 +1,274 @@
+"""
+Process pool which decodes event logs on other cores than the one which fetches them.
+
+Decoding logs with [`EventDecoder`][moonworm.crawler.event_decoder.EventDecoder]s is CPU-bound, and
+runs under the GIL of the fetching thread. A [`DecodePool`][moonworm.crawler.decode_pool.DecodePool]
+sends batches of raw logs, stripped down to tuples of bytes and integers, to worker processes which
+build their decoders once, when they start. `DecodePool.submit` returns immediately, so the fetching
+thread requests the next chunk of logs while the previous ones are decoded.
+
+The log crawlers in `moonworm.crawler.log_scanner` take a `decode_pool` argument. Given one, the
+crawlers resolve the decoded events of a range of blocks once all its chunks have been fetched.
+
+Usage:
+```python
+from moonworm.crawler.decode_pool import DecodePool
+
+with DecodePool(event_abis, processes=8) as decode_pool:
+    events, batch_size = _crawl_all_events(web3, event_abis, ..., decode_pool=decode_pool)
+```
+"""
+
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from eth_abi.codec import ABICodec
+from hexbytes import HexBytes
+from web3._utils.abi import build_default_registry
+
+from .event_decoder import EventDecoder, EventDecoderRegistry
+
+# (topics, data, address, blockHash, blockNumber, transactionHash, logIndex)
+RawLog = Tuple[List[bytes], bytes, str, bytes, int, bytes, int]
+
+# Decoded events of a task, and (position, error message) of the logs which could not be decoded
+TaskResult = Tuple[List[Dict[str, Any]], List[Tuple[int, str]]]
+
+# Set in every worker process by _init_worker
+_worker_registry: Optional[EventDecoderRegistry] = None
+_worker_decoders: List[EventDecoder] = []
+
+
+def _init_worker(event_abis: List[Dict[str, Any]]) -> None:
+    global _worker_registry, _worker_decoders
+    codec = ABICodec(build_default_registry())
+    _worker_registry = EventDecoderRegistry(codec, event_abis)
+    _worker_decoders = [EventDecoder(codec, event_abi) for event_abi in event_abis]
+
+
+def _decode_task(logs: List[RawLog], decoder_index: Optional[int]) -> TaskResult:
+    assert _worker_registry is not None, "decode worker was not initialized"
+    events = []
+    errors = []
+    for position, (
+        topics,
+        data,
+        address,
+        block_hash,
+        block_number,
+        transaction_hash,
+        log_index,
+    ) in enumerate(logs):
+        log = {
+            "topics": topics,
+            "data": data,
+            "address": address,
+            "blockHash": HexBytes(block_hash),
+            "blockNumber": block_number,
+            "transactionHash": HexBytes(transaction_hash),
+            "logIndex": log_index,
+        }
+        try:
+            if decoder_index is None:
+                events.append(_worker_registry.decode_log(log))
+            else:
+                events.append(_worker_decoders[decoder_index].decode_log(log))
+        except Exception as e:
+            errors.append((position, f"{type(e).__name__}: {e}"))
+    return events, errors
+
+
+def _raw_log(log: Dict[str, Any]) -> RawLog:
+    data = log["data"]
+    return (
+        [bytes(topic) for topic in log["topics"]],
+        bytes(HexBytes(data)) if isinstance(data, str) else bytes(data),
+        log["address"],
+        bytes(log["blockHash"]),
+        log["blockNumber"],
+        bytes(log["transactionHash"]),
+        log["logIndex"],
+    )
+
+
+class DecodeError(Exception):
+    """
+    A log could not be decoded by a worker process of a DecodePool.
+    """
+
+
+class DecodedLogs:
+    """
+    Events being decoded by a DecodePool, in the order of their logs. Its length is the number of logs,
+    which is known before they are decoded. result() waits for the decoded events.
+
+    Decoded logs of several requests are concatenated with `DecodedLogs.concat`.
+    """
+
+    def __init__(
+        self,
+        futures: List[Future],
+        num_logs: int,
+        on_decode_error: Optional[Callable[[Exception], None]] = None,
+    ):
+        self.futures = futures
+        self.num_logs = num_logs
+        self.on_decode_error = on_decode_error
+        self.parts: List[Union["DecodedLogs", List[Dict[str, Any]]]] = []
+        self.sort = False
+
+    def __len__(self) -> int:
+        return self.num_logs + sum(len(part) for part in self.parts)
+
+    @classmethod
+    def concat(
+        cls,
+        parts: Sequence[Union["DecodedLogs", List[Dict[str, Any]]]],
+        sort: bool = False,
+    ) -> "DecodedLogs":
+        """
+        Concatenates decoded logs and lists of events. If sort is True, the result is sorted by
+        (blockNumber, logIndex).
+        """
+        decoded_logs = cls([], 0)
+        decoded_logs.parts = list(parts)
+        decoded_logs.sort = sort
+        return decoded_logs
+
+    def result(self) -> List[Dict[str, Any]]:
+        events: List[Dict[str, Any]] = []
+        for future in self.futures:
+            task_events, errors = future.result()
+            events.extend(task_events)
+            if self.on_decode_error is not None:
+                for _, message in errors:
+                    self.on_decode_error(DecodeError(message))
+        for part in self.parts:
+            events.extend(resolve_events(part))
+        if self.sort:
+            events.sort(key=lambda event: (event["blockNumber"], event["logIndex"]))
+        return events
+
+
+def resolve_events(
+    events: Union[DecodedLogs, List[Dict[str, Any]]],
+) -> List[Dict[str, Any]]:
+    """
+    Returns the decoded events, waiting for them if they are being decoded by a DecodePool.
+    """
+    if isinstance(events, DecodedLogs):
+        return events.result()
+    return events
+
+
+def concat_events(
+    parts: Sequence[Union[DecodedLogs, List[Dict[str, Any]]]], sort: bool = False
+) -> Union[DecodedLogs, List[Dict[str, Any]]]:
+    """
+    Concatenates lists of events, some of which may still be decoded by a DecodePool. If sort is True,
+    the result is sorted by (blockNumber, logIndex).
+    """
+    if any(isinstance(part, DecodedLogs) for part in parts):
+        return DecodedLogs.concat(parts, sort)
+    events = [event for part in parts for event in part]
+    if sort:
+        events.sort(key=lambda event: (event["blockNumber"], event["logIndex"]))
+    return events
+
+
+class DecodePool:
+    """
+    Decodes the logs of the given event ABIs in a pool of worker processes.
+
+    Logs of a request are split into tasks of up to logs_per_task logs. Tasks should be large enough to
+    be worth the cost of sending them to another process.
+
+    The logs submitted are counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        event_abis: List[Dict[str, Any]],
+        processes: Optional[int] = None,
+        logs_per_task: int = 1000,
+        mp_context: Optional[Any] = None,
+    ):
+        """
+        :param event_abis: ABIs of the events to decode
+        :param processes: Number of worker processes. Defaults to the number of CPUs.
+        :param logs_per_task: Maximum number of logs sent to a worker at once
+        :param mp_context: multiprocessing context used to start the workers. Defaults to "spawn", as
+        crawlers run threads which forked workers would inherit in an undefined state.
+        """
+        self.event_abis = [dict(event_abi) for event_abi in event_abis]
+        self.logs_per_task = logs_per_task
+        self._decoder_indices = {
+            repr(event_abi): i for i, event_abi in enumerate(self.event_abis)
+        }
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=mp_context or multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(self.event_abis,),
+        )
+        self.metrics = {
+            "logs_submitted": 0,
+            "tasks_submitted": 0,
+        }
+
+    def __enter__(self) -> "DecodePool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+    def submit(
+        self,
+        logs: Sequence[Dict[str, Any]],
+        event_abi: Optional[Dict[str, Any]] = None,
+        on_decode_error: Optional[Callable[[Exception], None]] = None,
+    ) -> DecodedLogs:
+        """
+        Sends raw logs (as returned by eth_getLogs) to the workers, and returns without waiting for them
+        to be decoded.
+
+        If event_abi is given, the logs are decoded as events of that ABI, which must be one of the ABIs
+        of the pool. This is how the logs of anonymous events are decoded. Otherwise, every log is
+        decoded by the event ABI which matches its topics.
+
+        Logs which cannot be decoded are skipped, and on_decode_error is called for each of them when
+        the result is resolved.
+        """
+        decoder_index = None
+        if event_abi is not None:
+            decoder_index = self._decoder_indices.get(repr(dict(event_abi)))
+            if decoder_index is None:
+                raise ValueError(
+                    f"Event ABI {event_abi.get('name')} is not decoded by this pool"
+                )
+
+        raw_logs = [_raw_log(log) for log in logs]
+        futures = [
+            self.executor.submit(
+                _decode_task, raw_logs[i : i + self.logs_per_task], decoder_index
+            )
+            for i in range(0, len(raw_logs), self.logs_per_task)
+        ]
+        self.metrics["logs_submitted"] += len(raw_logs)
+        self.metrics["tasks_submitted"] += len(futures)
+        return DecodedLogs(futures, len(raw_logs), on_decode_error)
+
+    def decode(
+        self,
+        logs: Sequence[Dict[str, Any]],
+        event_abi: Optional[Dict[str, Any]] = None,
+        on_decode_error: Optional[Callable[[Exception], None]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Decodes raw logs in the workers and waits for the decoded events.
+        """
+        return self.submit(logs, event_abi, on_decode_error).result()
@@ -1,10 +1,30 @@
+import itertools
 import logging
 from abc import ABC, abstractmethod
-from typing import Any, Dict, List, Optional, Union
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from eth_typing.evm import ChecksumAddress
 from web3 import Web3
 
+from .batch_rpc import (
+    DEFAULT_BATCH_SIZE,
+    get_block_receipts,
+    get_transaction_receipts,
+    is_method_not_found,
+)
+from .timestamp_index import BlockTimestampIndex
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -12,6 +32,50 @@ logger = logging.getLogger(__name__)
 black_logger = logging.getLogger("blib2to3")
 black_logger.setLevel("WARN")
 
+# Maximum number of receipts cached by Web3StateProvider. The oldest receipts are evicted beyond it.
+RECEIPTS_CACHE_SIZE = 50000
+
+
+def transaction_hash_hex(transaction_hash: Union[str, bytes]) -> str:
+    """
+    Returns the given transaction hash as a lowercase 0x-prefixed hex string.
+    """
+    if isinstance(transaction_hash, str):
+        return transaction_hash.lower()
+    return Web3.toHex(transaction_hash)
+
+
+def address_set(addresses: Iterable[str]) -> Set[str]:
+    """
+    Returns a set which contains every address in both its checksum and its lowercase form, so that
+    the "to" field of transactions can be looked up in it as it is returned by the node.
+    """
+    result: Set[str] = set()
+    for address in addresses:
+        result.add(address)
+        result.add(address.lower())
+        result.add(Web3.toChecksumAddress(address))
+    return result
+
+
+def filter_transactions(
+    transactions: Iterable[Dict[str, Any]],
+    addresses: Set[str],
+    selectors: Optional[Collection[str]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Returns the transactions sent to one of the given addresses, as built by `address_set`. If selectors
+    are given, only transactions whose input starts with one of those 4-byte selectors (as 0x-prefixed
+    hex strings) are returned.
+    """
+    if selectors is None:
+        return [tx for tx in transactions if tx.get("to") in addresses]
+    return [
+        tx
+        for tx in transactions
+        if tx.get("to") in addresses and (tx.get("input") or "")[:10] in selectors
+    ]
+
 
 class EthereumStateProvider(ABC):
     """
@@ -42,25 +106,178 @@ class EthereumStateProvider(ABC):
         """
         pass
 
+    def get_transactions_to_addresses(
+        self,
+        addresses: Iterable[str],
+        from_block: int,
+        to_block: int,
+        selectors: Optional[Collection[str]] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns all transactions to any of the given addresses in the given range of blocks (inclusive),
+        in block order. If selectors are given, only the transactions whose input starts with one of
+        those 4-byte selectors are returned.
+
+        This implementation asks get_transactions_to_address for every block and address. Providers
+        which hold whole blocks should override it to make a single pass over the transactions of each
+        block.
+        """
+        addresses = list(addresses)
+        transactions = []
+        for block_number in range(from_block, to_block + 1):
+            for address in addresses:
+                transactions.extend(
+                    tx
+                    for tx in self.get_transactions_to_address(address, block_number)
+                    if selectors is None or (tx.get("input") or "")[:10] in selectors
+                )
+        return transactions
+
+    @abstractmethod
+    def get_transaction_reciept(self, transaction_hash: str) -> Dict[str, Any]:
+        """
+        Returns the receipt of the transaction with the given hash.
+        """
+        pass
+
+    def get_transaction_receipts(
+        self, transactions: Sequence[Dict[str, Any]]
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Returns the receipts of the given transactions, in the same order. Receipts which were not
+        retrieved are None, and callers ask get_transaction_reciept for them.
+
+        This implementation retrieves none of them. Providers which can retrieve receipts of whole
+        blocks, or several receipts per request, should override it.
+        """
+        return [None for _ in transactions]
+
+    def forget_blocks(self, from_block: int) -> None:
+        """
+        Drops anything the provider cached about the given block and the blocks after it, once a chain
+        reorganization replaced them.
+        """
+        pass
+
 
 class Web3StateProvider(EthereumStateProvider):
     """
     Implementation of EthereumStateProvider with web3.
+
+    Receipts are retrieved for whole blocks with eth_getBlockReceipts where the node supports it, and
+    otherwise with eth_getTransactionReceipt calls sent as JSON-RPC batches. They are cached, so that
+    the receipts of a block are only requested once. The cache holds at most RECEIPTS_CACHE_SIZE
+    receipts, and evicts the oldest ones beyond it. `metrics["receipt_round_trips_saved"]` counts the
+    requests saved compared to asking for every receipt on its own.
     """
 
-    def __init__(self, w3: Web3):
+    def __init__(
+        self,
+        w3: Web3,
+        timestamp_index: Optional[BlockTimestampIndex] = None,
+        use_block_receipts: bool = True,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+    ):
         self.w3 = w3
+        self.timestamp_index = timestamp_index
+        self.use_block_receipts = use_block_receipts
+        self.batch_size = batch_size
         self.metrics = {
             "web3_get_block_calls": 0,
             "web3_get_transaction_receipt_calls": 0,
+            "web3_get_block_receipts_requests": 0,
+            "web3_get_transaction_receipts_requests": 0,
+            "receipt_cache_hits": 0,
+            "receipt_round_trips_saved": 0,
         }
 
         self.blocks_cache = {}
+        self.receipts_cache: Dict[str, Dict[str, Any]] = {}
 
     def get_transaction_reciept(self, transaction_hash: str) -> Dict[str, Any]:
+        receipt = self.receipts_cache.get(transaction_hash_hex(transaction_hash))
+        if receipt is not None:
+            self.metrics["receipt_cache_hits"] += 1
+            return receipt
         self.metrics["web3_get_transaction_receipt_calls"] += 1
         return self.w3.eth.get_transaction_receipt(transaction_hash)
 
+    def _cache_receipts(self, receipts: Dict[str, Dict[str, Any]]) -> None:
+        self.receipts_cache.update(receipts)
+        num_evicted = len(self.receipts_cache) - RECEIPTS_CACHE_SIZE
+        if num_evicted > 0:
+            for transaction_hash in list(
+                itertools.islice(self.receipts_cache, num_evicted)
+            ):
+                del self.receipts_cache[transaction_hash]
+
+    def _fetch_receipts(
+        self, hashes_by_block: Dict[int, List[str]]
+    ) -> Tuple[Dict[str, Dict[str, Any]], int]:
+        """
+        Returns the receipts fetched for the given transactions, keyed by transaction hash, and the
+        number of requests it took. With eth_getBlockReceipts, the receipts of the other transactions of
+        the blocks are returned too.
+        """
+        if self.use_block_receipts:
+            try:
+                block_receipts, num_requests = get_block_receipts(
+                    self.w3, hashes_by_block, self.batch_size
+                )
+                self.metrics["web3_get_block_receipts_requests"] += num_requests
+                return {
+                    transaction_hash_hex(receipt["transactionHash"]): receipt
+                    for receipts in block_receipts.values()
+                    for receipt in receipts
+                }, num_requests
+            except ValueError as e:
+                # Other errors, e.g. rate limits, are not a reason to stop using the method
+                if not is_method_not_found(e):
+                    raise
+                logger.info(
+                    "eth_getBlockReceipts is not supported, falling back to eth_getTransactionReceipt: %s",
+                    e,
+                )
+                self.use_block_receipts = False
+
+        receipts, num_requests = get_transaction_receipts(
+            self.w3,
+            [
+                transaction_hash
+                for transaction_hashes in hashes_by_block.values()
+                for transaction_hash in transaction_hashes
+            ],
+            self.batch_size,
+        )
+        self.metrics["web3_get_transaction_receipts_requests"] += num_requests
+        return receipts, num_requests
+
+    def get_transaction_receipts(
+        self, transactions: Sequence[Dict[str, Any]]
+    ) -> List[Optional[Dict[str, Any]]]:
+        transaction_hashes = [transaction_hash_hex(tx["hash"]) for tx in transactions]
+        hashes_by_block: Dict[int, List[str]] = {}
+        for tx, transaction_hash in zip(transactions, transaction_hashes):
+            if transaction_hash in self.receipts_cache:
+                self.metrics["receipt_cache_hits"] += 1
+            else:
+                hashes_by_block.setdefault(tx["blockNumber"], []).append(
+                    transaction_hash
+                )
+
+        receipts: Dict[str, Dict[str, Any]] = {}
+        if hashes_by_block:
+            num_missing = sum(len(hashes) for hashes in hashes_by_block.values())
+            receipts, num_requests = self._fetch_receipts(hashes_by_block)
+            self.metrics["receipt_round_trips_saved"] += num_missing - num_requests
+        # Looked up before caching, as the cache may evict some of the receipts just fetched
+        results = [
+            receipts.get(transaction_hash, self.receipts_cache.get(transaction_hash))
+            for transaction_hash in transaction_hashes
+        ]
+        self._cache_receipts(receipts)
+        return results
+
     def get_last_block_number(self) -> int:
         return self.w3.eth.block_number
 
@@ -75,9 +292,29 @@ class Web3StateProvider(EthereumStateProvider):
             self.blocks_cache = {}
 
         self.blocks_cache[block_number] = block
+        if self.timestamp_index is not None:
+            self.timestamp_index.put(block_number, block["timestamp"])
         return block
 
+    def forget_blocks(self, from_block: int) -> None:
+        self.blocks_cache = {
+            block_number: block
+            for block_number, block in self.blocks_cache.items()
+            if block_number < from_block
+        }
+        if self.timestamp_index is not None:
+            self.timestamp_index.forget(from_block)
+        self.receipts_cache = {
+            transaction_hash: receipt
+            for transaction_hash, receipt in self.receipts_cache.items()
+            if receipt["blockNumber"] < from_block
+        }
+
     def get_block_timestamp(self, block_number: int) -> int:
+        if self.timestamp_index is not None:
+            timestamp = self.timestamp_index.get(block_number)
+            if timestamp is not None:
+                return timestamp
         block = self._get_block(block_number)
         return block["timestamp"]
 
@@ -88,3 +325,19 @@ class Web3StateProvider(EthereumStateProvider):
 
         all_transactions = block["transactions"]
         return [tx for tx in all_transactions if tx.get("to") == address]
+
+    def get_transactions_to_addresses(
+        self,
+        addresses: Iterable[str],
+        from_block: int,
+        to_block: int,
+        selectors: Optional[Collection[str]] = None,
+    ) -> List[Dict[str, Any]]:
+        addresses = address_set(addresses)
+        transactions = []
+        for block_number in range(from_block, to_block + 1):
+            block = self._get_block(block_number)
+            transactions.extend(
+                filter_transactions(block["transactions"], addresses, selectors)
+            )
+        return transactions
@@ -0,0 +1,173 @@
+"""
+Precompiled event log decoders.
+
+`web3._utils.events.get_event_data` re-derives the ABI types of an event, checks its topic and builds
+AttributeDicts every time it decodes a log. The decoders in this module do that work once per ABI
+and decode logs straight into plain dicts.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from eth_abi.codec import ABICodec
+from eth_abi.decoding import TupleDecoder
+from eth_utils import encode_hex, event_abi_to_log_topic, to_bytes
+from web3._utils.abi import normalize_event_input_types
+from web3._utils.events import get_event_abi_types_for_decoding
+from web3.exceptions import InvalidEventABI, LogTopicError, MismatchedABI
+
+from .normalizers import ArgumentsNormalizer
+
+
+def _to_bytes(value: Any) -> bytes:
+    if isinstance(value, str):
+        return to_bytes(hexstr=value)
+    return bytes(value)
+
+
+class EventDecoder:
+    """
+    Decodes the logs of a single event ABI using eth_abi decoders which are built once, when the
+    EventDecoder is created.
+    """
+
+    def __init__(self, codec: ABICodec, event_abi: Dict[str, Any]):
+        self.event_abi = event_abi
+        self.name: str = event_abi["name"]
+        self.anonymous: bool = bool(event_abi.get("anonymous", False))
+        self.topic0: Optional[bytes] = (
+            None if self.anonymous else bytes(event_abi_to_log_topic(event_abi))
+        )
+
+        indexed_inputs = [
+            arg for arg in event_abi["inputs"] if arg.get("indexed", False)
+        ]
+        data_inputs = [
+            arg for arg in event_abi["inputs"] if not arg.get("indexed", False)
+        ]
+        self.num_indexed = len(indexed_inputs)
+
+        self.topic_names = [arg["name"] for arg in indexed_inputs]
+        self.data_names = [arg["name"] for arg in data_inputs]
+        duplicate_names = set(self.topic_names).intersection(self.data_names)
+        if duplicate_names:
+            raise InvalidEventABI(
+                "The following argument names are duplicated "
+                f"between event inputs: '{', '.join(duplicate_names)}'"
+            )
+
+        self.topic_types = get_event_abi_types_for_decoding(
+            normalize_event_input_types(indexed_inputs)
+        )
+        self.data_types = get_event_abi_types_for_decoding(
+            normalize_event_input_types(data_inputs)
+        )
+
+        registry = codec._registry
+        self._stream_class = codec.stream_class
+        self._topic_decoders = [
+            registry.get_decoder(type_str) for type_str in self.topic_types
+        ]
+        self._data_decoder = TupleDecoder(
+            decoders=[registry.get_decoder(type_str) for type_str in self.data_types]
+        )
+
+        # Indexed inputs of dynamic types are stored as the keccak hash of their value, so they are
+        # normalised as the bytes32 they are decoded as.
+        self._topic_normalizer = ArgumentsNormalizer(
+            [
+                (
+                    {"name": arg["name"], "type": type_str}
+                    if type_str == "bytes32"
+                    else arg
+                )
+                for arg, type_str in zip(indexed_inputs, self.topic_types)
+            ]
+        )
+        self._data_normalizer = ArgumentsNormalizer(data_inputs)
+
+    def decode_args(self, topics: Sequence[Any], data: Any) -> Dict[str, Any]:
+        """
+        Decodes event arguments from the topics of a log (including topic0 for non-anonymous events)
+        and its data.
+        """
+        if not self.anonymous:
+            if not topics:
+                raise MismatchedABI(
+                    "Expected non-anonymous event to have 1 or more topics"
+                )
+            if _to_bytes(topics[0]) != self.topic0:
+                raise MismatchedABI(
+                    "The event signature did not match the provided ABI"
+                )
+            topics = topics[1:]
+
+        if len(topics) != self.num_indexed:
+            raise LogTopicError(
+                f"Expected {self.num_indexed} log topics.  Got {len(topics)}"
+            )
+
+        topic_values = [
+            decoder(self._stream_class(_to_bytes(topic)))
+            for decoder, topic in zip(self._topic_decoders, topics)
+        ]
+        data_values = self._data_decoder(self._stream_class(_to_bytes(data)))
+
+        args = self._topic_normalizer.normalize(topic_values)
+        args.update(self._data_normalizer.normalize(data_values))
+        return args
+
+    def decode_log(self, log: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Decodes a raw log (as returned by eth_getLogs) into the event structure used by
+        `moonworm.crawler.log_scanner`.
+        """
+        return {
+            "event": self.name,
+            "args": self.decode_args(log["topics"], log["data"]),
+            "address": log["address"],
+            "blockHash": log["blockHash"],
+            "blockNumber": log["blockNumber"],
+            "transactionHash": log["transactionHash"].hex(),
+            "logIndex": log["logIndex"],
+        }
+
+
+class EventDecoderRegistry:
+    """
+    Maps (topic0, number of indexed inputs) to an EventDecoder for every event in an ABI set.
+
+    The number of indexed inputs is part of the key so that events which share a signature but not
+    their indexing (e.g. ERC20 and ERC721 `Transfer`) can be told apart.
+
+    Build one registry per ABI set and reuse it across chunks.
+    """
+
+    def __init__(self, codec: ABICodec, event_abis: List[Dict[str, Any]]):
+        self.decoders: Dict[Tuple[bytes, int], EventDecoder] = {}
+        self.anonymous: List[EventDecoder] = []
+        for event_abi in event_abis:
+            decoder = EventDecoder(codec, event_abi)
+            if decoder.topic0 is None:
+                self.anonymous.append(decoder)
+            else:
+                self.decoders.setdefault((decoder.topic0, decoder.num_indexed), decoder)
+
+        # topic0 values of all non-anonymous events, hex encoded, for use in eth_getLogs filters
+        self.topics: List[str] = list(
+            dict.fromkeys(encode_hex(topic0) for topic0, _ in self.decoders)
+        )
+
+    def get(self, topics: Sequence[Any]) -> Optional[EventDecoder]:
+        """
+        Returns the decoder for a log with the given topics, or None if the log does not belong to any
+        non-anonymous event in the registry.
+        """
+        if not topics:
+            return None
+        return self.decoders.get((_to_bytes(topics[0]), len(topics) - 1))
+
+    def decode_log(self, log: Dict[str, Any]) -> Dict[str, Any]:
+        decoder = self.get(log["topics"])
+        if decoder is None:
+            raise MismatchedABI("No event ABI in the registry matches the log topics")
+        return decoder.decode_log(log)
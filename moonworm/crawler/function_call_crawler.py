@@ -6,7 +6,6 @@ from logging import error
 from typing import Any, Callable, Dict, List, Optional
 
 from eth_typing.evm import ChecksumAddress
-from eth_utils import function_abi_to_4byte_selector
 from web3 import Web3
 from web3.contract import Contract
 from web3.types import ABI
@@ -14,6 +13,7 @@ from web3.types import ABI
 from moonworm.contracts import ERC1155
 
 from .ethereum_state_provider import EthereumStateProvider, Web3StateProvider
+from .function_decoder import FunctionDecoderRegistry
 
 
 @dataclass
@@ -146,25 +146,28 @@ class FunctionCallCrawler:
         self.ethereum_state_provider = ethereum_state_provider
         self.contract_abi = contract_abi
         self.contract_addresses = contract_addresses
-        self.contract = Web3().eth.contract(abi=self.contract_abi)
+        self.function_decoders = FunctionDecoderRegistry(
+            Web3().codec, self.contract_abi
+        )
         self.on_decode_error = on_decode_error
-        self.whitelisted_methods = {
-            Web3.toHex(function_abi_to_4byte_selector(a)) for a in self.contract_abi
-        }
+        self.whitelisted_methods = set(self.function_decoders.selectors)
 
-    def process_transaction(self, transaction: Dict[str, Any]):
+    def process_transaction(
+        self,
+        transaction: Dict[str, Any],
+        transaction_reciept: Optional[Dict[str, Any]] = None,
+    ):
         try:
-            raw_function_call = self.contract.decode_function_input(
+            function_name, function_args = self.function_decoders.decode_function_input(
                 transaction["input"]
             )
-            function_name = raw_function_call[0].fn_name
-
-            function_args = utfy_dict(raw_function_call[1])
 
-            # TODO: check transaction reciept for none
-            transaction_reciept = self.ethereum_state_provider.get_transaction_reciept(
-                transaction["hash"]
-            )
+            if transaction_reciept is None:
+                transaction_reciept = (
+                    self.ethereum_state_provider.get_transaction_reciept(
+                        transaction["hash"]
+                    )
+                )
 
             function_call = ContractFunctionCall(
                 block_hash=transaction["blockHash"],
@@ -189,16 +192,21 @@ class FunctionCallCrawler:
             print(e)
 
     def crawl(self, from_block: int, to_block: int, flush_state: bool = False):
-        for block_number in range(from_block, to_block + 1):
-            for address in self.contract_addresses:
-                transactions = self.ethereum_state_provider.get_transactions_to_address(
-                    address, block_number
-                )
-                for transaction in transactions:
-                    method_id = transaction.get("input")[:10]
-                    if method_id in self.whitelisted_methods:
-                        self.process_transaction(transaction)
+        # A single pass over the transactions of each block, whatever the number of contracts: the
+        # provider matches "to" against a set of addresses and checks the selector prefix of the input
+        # before any transaction is decoded.
+        transactions = self.ethereum_state_provider.get_transactions_to_addresses(
+            self.contract_addresses,
+            from_block,
+            to_block,
+            selectors=self.whitelisted_methods,
+        )
+        # Receipts are requested for all the transactions at once, so that providers can batch them
+        transaction_reciepts = self.ethereum_state_provider.get_transaction_receipts(
+            transactions
+        )
+        for transaction, transaction_reciept in zip(transactions, transaction_reciepts):
+            self.process_transaction(transaction, transaction_reciept)
 
-            self.state.state
         if flush_state:
             self.state.flush()
@@ -0,0 +1,88 @@
+"""
+Precompiled function call decoders.
+
+`Contract.decode_function_input` looks up the function ABI matching the selector of the call data,
+re-derives its ABI types and builds eth_abi decoders every time it decodes a transaction input. The
+decoders in this module do that work once per ABI, and decode call data straight into normalised
+arguments (see `moonworm.crawler.normalizers`).
+"""
+
+from typing import Any, Dict, List, Optional, Tuple
+
+from eth_abi.codec import ABICodec
+from eth_abi.decoding import TupleDecoder
+from eth_utils import encode_hex, function_abi_to_4byte_selector
+from web3._utils.abi import get_abi_input_types
+from web3.exceptions import MismatchedABI
+
+from .event_decoder import _to_bytes
+from .normalizers import ArgumentsNormalizer
+
+
+class FunctionDecoder:
+    """
+    Decodes the call data of a single function ABI using eth_abi decoders which are built once, when the
+    FunctionDecoder is created.
+    """
+
+    def __init__(self, codec: ABICodec, function_abi: Dict[str, Any]):
+        self.function_abi = function_abi
+        self.name: str = function_abi["name"]
+        self.selector: bytes = bytes(function_abi_to_4byte_selector(function_abi))
+
+        registry = codec._registry
+        self._stream_class = codec.stream_class
+        self._decoder = TupleDecoder(
+            decoders=[
+                registry.get_decoder(type_str)
+                for type_str in get_abi_input_types(function_abi)
+            ]
+        )
+        self._normalizer = ArgumentsNormalizer(function_abi.get("inputs", []))
+
+    def decode_args(self, call_data: Any) -> Dict[str, Any]:
+        """
+        Decodes the arguments of a call from its call data, including the 4-byte selector.
+        """
+        call_data = _to_bytes(call_data)
+        if call_data[:4] != self.selector:
+            raise MismatchedABI("The function selector did not match the provided ABI")
+        values = self._decoder(self._stream_class(call_data[4:]))
+        return self._normalizer.normalize(values)
+
+
+class FunctionDecoderRegistry:
+    """
+    Maps 4-byte selectors to a FunctionDecoder for every function in an ABI. Other ABI entries (events,
+    constructors, fallback and receive functions) are ignored.
+
+    Build one registry per ABI and reuse it across transactions.
+    """
+
+    def __init__(self, codec: ABICodec, contract_abi: List[Dict[str, Any]]):
+        self.decoders: Dict[bytes, FunctionDecoder] = {}
+        for item in contract_abi:
+            if item.get("type", "function") != "function":
+                continue
+            decoder = FunctionDecoder(codec, item)
+            self.decoders.setdefault(decoder.selector, decoder)
+
+        # Selectors of all functions, hex encoded, as found at the start of transaction inputs
+        self.selectors: List[str] = [encode_hex(selector) for selector in self.decoders]
+
+    def get(self, call_data: Any) -> Optional[FunctionDecoder]:
+        """
+        Returns the decoder for the given call data, or None if it does not call any function in the
+        registry.
+        """
+        return self.decoders.get(_to_bytes(call_data)[:4])
+
+    def decode_function_input(self, call_data: Any) -> Tuple[str, Dict[str, Any]]:
+        """
+        Returns the name of the function called with the given call data, and its normalised
+        arguments.
+        """
+        decoder = self.get(call_data)
+        if decoder is None:
+            raise MismatchedABI("No function ABI in the registry matches the selector")
+        return decoder.name, decoder.decode_args(call_data)
@@ -0,0 +1,335 @@
+"""
+Tracks the head of the chain for crawlers which follow it.
+
+Instead of calling `eth_blockNumber` in every iteration of their loops, crawlers ask a shared
+[`HeadTracker`][moonworm.crawler.head_tracker.HeadTracker] for the last block number it saw, or wait
+until it sees a given block. The tracker learns about new blocks from an `eth_subscribe("newHeads")`
+subscription if the JSON-RPC endpoint supports it (over WebSocket or IPC), and otherwise polls
+`eth_blockNumber` in a background thread. The poll interval is bounded, and polls are skipped while
+the next block is not expected yet.
+
+Usage:
+```python
+from web3 import Web3
+from moonworm.crawler.head_tracker import HeadTracker
+
+web3 = Web3(Web3.WebsocketProvider("ws://localhost:8546"))
+tracker = HeadTracker.for_web3(web3)
+head = tracker.wait_for_block(tracker.get_head() + 1)
+```
+"""
+
+import asyncio
+import json
+import logging
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from web3 import IPCProvider, Web3, WebsocketProvider
+
+logger = logging.getLogger(__name__)
+
+_trackers: Dict[str, "HeadTracker"] = {}
+_trackers_lock = threading.Lock()
+
+# Seconds between checks of whether the tracker should stop, while waiting for notifications
+NOTIFICATION_WAIT_SECONDS = 1.0
+
+
+def endpoint_uri(web3: Web3) -> Optional[str]:
+    """
+    URI of the endpoint the web3 client is connected to, if any. IPC paths are prefixed with ipc://.
+    """
+    provider = web3.provider
+    if isinstance(provider, IPCProvider):
+        return f"ipc://{provider.ipc_path}"
+    return getattr(provider, "endpoint_uri", None)
+
+
+class HeadTracker:
+    """
+    Keeps the number of the last block of the chain up to date in a background thread.
+
+    The thread is started by the first call to get_head or wait_for_block, and stops after idle_timeout
+    seconds without calls. Its activity is counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        web3: Web3,
+        subscription_uri: Optional[str] = None,
+        target_latency: float = 1.0,
+        min_poll_interval: float = 0.1,
+        max_poll_interval: float = 15.0,
+        resubscribe_interval: float = 60.0,
+        idle_timeout: float = 300.0,
+    ):
+        """
+        :param web3: Client for the chain to track
+        :param subscription_uri: WebSocket (ws:// or wss://) or IPC (ipc://<path>) endpoint to subscribe
+        to new heads on. Defaults to the endpoint of the web3 provider, if it is a WebSocket or IPC
+        provider. If None, the tracker polls.
+        :param target_latency: Average delay, in seconds, we accept between a block being mined and the
+        tracker seeing it when polling
+        :param min_poll_interval: Minimum number of seconds between polls
+        :param max_poll_interval: Maximum number of seconds between polls
+        :param resubscribe_interval: Seconds to poll for after a subscription failed, before subscribing
+        again
+        :param idle_timeout: Seconds without calls after which the background thread stops
+        """
+        self.web3 = web3
+        if subscription_uri is None and isinstance(
+            web3.provider, (WebsocketProvider, IPCProvider)
+        ):
+            subscription_uri = endpoint_uri(web3)
+        self.subscription_uri = subscription_uri
+        self.target_latency = target_latency
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.resubscribe_interval = resubscribe_interval
+        self.idle_timeout = idle_timeout
+
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._head: Optional[int] = None
+        self._head_seen_at: Optional[float] = None
+        # Smoothed number of seconds between blocks
+        self._block_time: Optional[float] = None
+        self._last_used = time.monotonic()
+        self._waiters = 0
+
+        self.metrics = {
+            "polls": 0,
+            "poll_errors": 0,
+            "notifications": 0,
+            "subscriptions": 0,
+            "subscription_failures": 0,
+        }
+
+    @classmethod
+    def for_web3(cls, web3: Web3, **kwargs) -> "HeadTracker":
+        """
+        Returns the tracker for the endpoint the web3 client is connected to. Trackers are shared by
+        everything in the process which uses the same endpoint. Clients without an endpoint URI (e.g.
+        EthereumTesterProvider) get a tracker of their own.
+        """
+        endpoint = endpoint_uri(web3)
+        if endpoint is None:
+            return cls(web3, **kwargs)
+        with _trackers_lock:
+            if endpoint not in _trackers:
+                _trackers[endpoint] = cls(web3, **kwargs)
+            return _trackers[endpoint]
+
+    @property
+    def block_time(self) -> Optional[float]:
+        """
+        Average number of seconds between blocks, as observed by the tracker.
+        """
+        return self._block_time
+
+    def _set_head(self, block_number: int) -> None:
+        now = time.monotonic()
+        with self._condition:
+            if self._head is not None and block_number > self._head:
+                if self._head_seen_at is not None:
+                    observed = (now - self._head_seen_at) / (block_number - self._head)
+                    self._block_time = (
+                        observed
+                        if self._block_time is None
+                        else 0.5 * self._block_time + 0.5 * observed
+                    )
+            if block_number != self._head:
+                self._head_seen_at = now
+            # A reorganization can make the chain shorter, so the head may also go back
+            self._head = block_number
+            self._condition.notify_all()
+
+    def _ensure_started(self) -> None:
+        with self._condition:
+            self._last_used = time.monotonic()
+            if self._thread is not None and self._thread.is_alive():
+                return
+        # The cached head is stale if the thread is not running
+        self._set_head(self.web3.eth.block_number)
+        with self._condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def get_head(self) -> int:
+        """
+        Returns the number of the last block of the chain.
+        """
+        self._ensure_started()
+        assert self._head is not None
+        return self._head
+
+    def wait_for_block(self, block_number: int, timeout: Optional[float] = None) -> int:
+        """
+        Waits until the head of the chain reaches the given block, or until timeout seconds passed.
+
+        :return: The number of the last block of the chain
+        """
+        self._ensure_started()
+        with self._condition:
+            self._waiters += 1
+            try:
+                self._condition.wait_for(
+                    lambda: self._stopped.is_set()
+                    or (self._head is not None and self._head >= block_number),
+                    timeout,
+                )
+            finally:
+                self._waiters -= 1
+                self._last_used = time.monotonic()
+            assert self._head is not None
+            return self._head
+
+    def stop(self) -> None:
+        """
+        Stops the background thread. It is started again by the next call to get_head or wait_for_block.
+        """
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _should_stop(self) -> bool:
+        if self._stopped.is_set():
+            return True
+        with self._condition:
+            return (
+                self._waiters == 0
+                and time.monotonic() - self._last_used > self.idle_timeout
+            )
+
+    def _run(self) -> None:
+        while not self._should_stop():
+            if self.subscription_uri is None:
+                self._poll()
+                continue
+            try:
+                self.metrics["subscriptions"] += 1
+                if self.subscription_uri.startswith("ipc://"):
+                    self._follow_ipc_subscription(
+                        self.subscription_uri[len("ipc://") :]
+                    )
+                else:
+                    asyncio.run(self._follow_websocket_subscription())
+            except Exception as e:
+                self.metrics["subscription_failures"] += 1
+                logger.warning(
+                    "Subscription to new heads on %s failed, polling for %.1f seconds: %s",
+                    self.subscription_uri,
+                    self.resubscribe_interval,
+                    e,
+                )
+                self._poll(until=time.monotonic() + self.resubscribe_interval)
+
+    def _poll_delay(self) -> float:
+        # Polling every 2 * target_latency seconds sees new blocks target_latency seconds after they
+        # are mined on average
+        delay = 2 * self.target_latency
+        if self._block_time is not None and self._head_seen_at is not None:
+            # Do not poll before the next block is expected
+            expected_in = self._head_seen_at + self._block_time - time.monotonic()
+            delay = max(delay, expected_in)
+        return min(max(delay, self.min_poll_interval), self.max_poll_interval)
+
+    def _poll(self, until: Optional[float] = None) -> None:
+        while not self._should_stop():
+            if until is not None and time.monotonic() >= until:
+                return
+            self.metrics["polls"] += 1
+            try:
+                self._set_head(self.web3.eth.block_number)
+            except Exception as e:
+                self.metrics["poll_errors"] += 1
+                logger.warning("Could not poll the head of the chain: %s", e)
+            self._stopped.wait(self._poll_delay())
+
+    def _on_message(self, message: Dict[str, Any]) -> None:
+        if message.get("method") != "eth_subscription":
+            return
+        header = message.get("params", {}).get("result")
+        if header is None or "number" not in header:
+            return
+        self.metrics["notifications"] += 1
+        self._set_head(int(header["number"], 16))
+
+    @staticmethod
+    def _subscribe_request() -> bytes:
+        return json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "id": 1,
+                "method": "eth_subscribe",
+                "params": ["newHeads"],
+            }
+        ).encode("utf-8")
+
+    @staticmethod
+    def _check_subscribed(response: Dict[str, Any]) -> None:
+        if "error" in response:
+            # Same as web3.py does for failed requests
+            raise ValueError(response["error"])
+
+    async def _follow_websocket_subscription(self) -> None:
+        import websockets
+
+        websocket_kwargs = {}
+        if isinstance(self.web3.provider, WebsocketProvider):
+            websocket_kwargs = self.web3.provider.conn.websocket_kwargs
+        async with websockets.connect(
+            self.subscription_uri, **websocket_kwargs
+        ) as connection:
+            await connection.send(self._subscribe_request().decode("utf-8"))
+            self._check_subscribed(json.loads(await connection.recv()))
+            # Notifications only cover blocks mined from now on
+            self._set_head(self.web3.eth.block_number)
+            while not self._should_stop():
+                try:
+                    message = await asyncio.wait_for(
+                        connection.recv(), NOTIFICATION_WAIT_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    continue
+                self._on_message(json.loads(message))
+
+    def _follow_ipc_subscription(self, ipc_path: str) -> None:
+        decoder = json.JSONDecoder()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(ipc_path)
+            connection.settimeout(NOTIFICATION_WAIT_SECONDS)
+            connection.sendall(self._subscribe_request())
+
+            subscribed = False
+            buffer = ""
+            while not self._should_stop():
+                try:
+                    data = connection.recv(65536)
+                except socket.timeout:
+                    continue
+                if not data:
+                    raise ConnectionError("IPC connection closed")
+                buffer += data.decode("utf-8")
+                # Messages are concatenated JSON objects
+                while buffer.strip():
+                    try:
+                        message, end = decoder.raw_decode(buffer.lstrip())
+                    except ValueError:
+                        break
+                    buffer = buffer.lstrip()[end:]
+                    if not subscribed:
+                        self._check_subscribed(message)
+                        subscribed = True
+                        self._set_head(self.web3.eth.block_number)
+                    else:
+                        self._on_message(message)
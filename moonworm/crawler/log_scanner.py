@@ -1,66 +1,107 @@
 # Used example scanner from web3 documentation : https://web3py.readthedocs.io/en/stable/examples.html#eth-getlogs-limitations
 import datetime
-import json
 import logging
+import queue
+import threading
 import time
-from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 from eth_abi.codec import ABICodec
 from eth_typing.evm import ChecksumAddress
 from web3 import Web3
-from web3._utils.events import get_event_data
 from web3._utils.filters import construct_event_filter_params
 from web3.datastructures import AttributeDict
 from web3.exceptions import BlockNotFound
 from web3.types import ABIEvent, FilterParams
 
-from .function_call_crawler import utfy_dict
+from .batch_rpc import get_block_timestamps
+from .chunk_size import (
+    AdaptiveChunkSizeController,
+    ChunkSizeController,
+    align_chunk_end,
+)
+from .decode_pool import DecodePool, concat_events, resolve_events
+from .event_decoder import EventDecoder, EventDecoderRegistry
+from .head_tracker import HeadTracker
+from .reorg import HeadersUnavailable, ReorgDetector
+from .retry_policy import RetryPolicy
 from .state import EventScannerState
+from .timestamp_index import BlockTimestampIndex
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Number of failed eth_getLogs requests we accept while bisecting a single batch in _crawl_events
+BISECT_MAX_RETRIES = 30
 
-def _retry_web3_call(func, start_block, end_block, retries, delay) -> Tuple[int, list]:
-    """A custom retry loop to throttle down block range.
 
-    If our JSON-RPC server cannot serve all incoming `eth_getLogs` in a single request,
-    we retry and throttle down block range for every retry.
+def _log_position(evt: Dict[str, Any]) -> Tuple[int, int]:
+    return evt["blockNumber"], evt["logIndex"]
+
+
+def _bisect_web3_call(
+    func: Callable[..., List[Any]],
+    start_block: int,
+    end_block: int,
+    retry_policy: RetryPolicy,
+    addresses: Optional[List[str]] = None,
+    on_failure: Optional[Callable[[int], Any]] = None,
+) -> List[Any]:
+    """A custom retry loop which splits failing block ranges.
+
+    If our JSON-RPC server cannot serve an `eth_getLogs` request for the whole block range,
+    retry_policy decides how to split the range (or the list of addresses) into smaller requests, or how
+    long to wait before retrying. Requests which succeed are kept, and only the requests which fail are
+    split further.
 
     For example, Go Ethereum does not indicate what is an acceptable response size.
     It just fails on the server-side with a "context was cancelled" warning.
 
-    :param func: A callable that triggers Ethereum JSON-RPC, as func(start_block, end_block)
-    :param start_block: The initial start block of the block range
-    :param end_block: The initial start block of the block range
-    :param retries: How many times we retry
-    :param delay: Time to sleep between retries
+    :param func: A callable that triggers Ethereum JSON-RPC, as func(start_block, end_block), or as
+    func(start_block, end_block, addresses) if addresses are given
+    :param start_block: The first block of the block range
+    :param end_block: The last block of the block range
+    :param retry_policy: Decides how to retry failed requests
+    :param addresses: Addresses to fetch logs for, if the request may be split by address
+    :param on_failure: Called with the number of blocks of every request which fails, e.g.
+    `ChunkSizeController.on_failure`
+    :return: Results of func over the whole block range, in block order
     """
-    for i in range(retries):
-        try:
-            return end_block, func(start_block, end_block)
-        except Exception as e:
-            # Assume this is HTTPConnectionPool(host='localhost', port=8545): Read timed out. (read timeout=10)
-            # from Go Ethereum. This translates to the error "context was cancelled" on the server side:
-            # https://github.com/ethereum/go-ethereum/issues/20426
-            if i < retries - 1:
-                # Give some more verbose info than the default middleware
-                logger.warning(
-                    "Retrying events for block range %d - %d (%d) failed with %s, retrying in %s seconds",
-                    start_block,
-                    end_block,
-                    end_block - start_block,
-                    e,
-                    delay,
+    failures = 0
+
+    def _fetch(
+        range_start: int, range_end: int, range_addresses: Optional[List[str]]
+    ) -> List[Any]:
+        nonlocal failures
+        attempt = 0
+        while True:
+            try:
+                if range_addresses is None:
+                    return func(range_start, range_end)
+                return func(range_start, range_end, range_addresses)
+            except Exception as e:
+                failures += 1
+                if on_failure is not None:
+                    on_failure(range_end - range_start + 1)
+                if failures >= retry_policy.max_retries:
+                    logger.warning("Out of retries")
+                    raise
+                action = retry_policy.on_error(
+                    e, range_start, range_end, range_addresses, attempt
                 )
-                # Decrease the `eth_getBlocks` range
-                end_block = start_block + ((end_block - start_block) // 2)
-                # Let the JSON-RPC to recover e.g. from restart
-                time.sleep(delay)
-                continue
-            else:
-                logger.warning("Out of retries")
-                raise
+                attempt += 1
+                if action.delay > 0:
+                    # Let the JSON-RPC to recover e.g. from restart
+                    time.sleep(action.delay)
+                if action.requests:
+                    return concat_events(
+                        [_fetch(*request) for request in action.requests],
+                        sort=action.split_addresses,
+                    )
+
+    return _fetch(start_block, end_block, addresses)
 
 
 def _fetch_events_chunk(
@@ -70,9 +111,17 @@ def _fetch_events_chunk(
     to_block: int,
     addresses: Optional[List[ChecksumAddress]] = None,
     on_decode_error: Optional[Callable[[Exception], None]] = None,
+    decoder: Optional[EventDecoder] = None,
+    decode_pool: Optional[DecodePool] = None,
 ) -> List[Any]:
     """Get events using eth_getLogs API.
 
+    If a prebuilt `decoder` for `event_abi` is not passed, one is built for this call.
+
+    If a `decode_pool` is passed, the logs are decoded by its worker processes, and the
+    [`DecodedLogs`][moonworm.crawler.decode_pool.DecodedLogs] being decoded are returned instead of a
+    list of events.
+
     Event structure:
     {
         "event": Event name,
@@ -107,21 +156,17 @@ def _fetch_events_chunk(
 
     logs = web3.eth.get_logs(event_filter_params)
 
+    if decode_pool is not None:
+        return decode_pool.submit(logs, event_abi, on_decode_error)  # type: ignore
+
+    if decoder is None:
+        decoder = EventDecoder(codec, event_abi)
+
     # Convert raw binary data to Python proxy objects as described by ABI
     all_events = []
     for log in logs:
         try:
-            raw_event = get_event_data(codec, event_abi, log)
-            event = {
-                "event": raw_event["event"],
-                "args": json.loads(Web3.toJSON(utfy_dict(dict(raw_event["args"])))),
-                "address": raw_event["address"],
-                "blockHash": raw_event["blockHash"],
-                "blockNumber": raw_event["blockNumber"],
-                "transactionHash": raw_event["transactionHash"].hex(),
-                "logIndex": raw_event["logIndex"],
-            }
-            all_events.append(event)
+            all_events.append(decoder.decode_log(log))
         except Exception as e:
             if on_decode_error:
                 on_decode_error(e)
@@ -129,6 +174,202 @@ def _fetch_events_chunk(
     return all_events
 
 
+def _fetch_all_events_chunk(
+    web3,
+    event_abis: List[Any],
+    from_block: int,
+    to_block: int,
+    addresses: Optional[List[ChecksumAddress]] = None,
+    on_decode_error: Optional[Callable[[Exception], None]] = None,
+    decoders: Optional[EventDecoderRegistry] = None,
+    decode_pool: Optional[DecodePool] = None,
+) -> List[Any]:
+    """Get events of every type in `event_abis` using a single eth_getLogs call.
+
+    The request filters on topic0 with an OR-list of the signatures of all the given events. Each
+    returned log is routed to its decoder through the (topic0, indexed inputs) -> decoder table of
+    `decoders`, which is built from `event_abis` if it is not passed. Anonymous events have no topic0
+    and are fetched with one request each.
+
+    With a `decode_pool`, logs are decoded by its worker processes as in `_fetch_events_chunk`.
+
+    Returns events with the same structure as `_fetch_events_chunk`, ordered by (blockNumber, logIndex).
+    """
+
+    if from_block is None:
+        raise TypeError("Missing mandatory keyword argument to getLogs: fromBlock")
+
+    if decoders is None:
+        decoders = EventDecoderRegistry(web3.codec, event_abis)
+
+    all_events: List[Any] = []
+    parts: List[Any] = []
+    if decoders.topics:
+        filter_params: Dict[str, Any] = {
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "topics": [decoders.topics],
+        }
+        if addresses:
+            filter_params["address"] = addresses
+
+        logs = web3.eth.get_logs(filter_params)
+
+        if decode_pool is not None:
+            parts.append(decode_pool.submit(logs, on_decode_error=on_decode_error))
+            logs = []
+        for log in logs:
+            try:
+                all_events.append(decoders.decode_log(log))
+            except Exception as e:
+                if on_decode_error:
+                    on_decode_error(e)
+                continue
+
+    for decoder in decoders.anonymous:
+        parts.append(
+            _fetch_events_chunk(
+                web3,
+                decoder.event_abi,
+                from_block,
+                to_block,
+                addresses,
+                on_decode_error,
+                decoder,
+                decode_pool,
+            )
+        )
+
+    return concat_events([all_events] + parts, sort=True)  # type: ignore
+
+
+def _crawl_chunks(
+    fetch_chunk: Callable[[int, int], List[Dict[str, Any]]],
+    from_block: int,
+    to_block: int,
+    batch_size: int,
+    batch_size_update_threshold: int = 1000,
+    max_blocks_batch: int = 10000,
+    min_blocks_batch: int = 100,
+    concurrency: int = 1,
+    chunk_size_controller: Optional[ChunkSizeController] = None,
+    chunk_grid: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Calls fetch_chunk(from_block, to_block) over the given block range in batches.
+
+    After every request, the batch size is updated by chunk_size_controller from the number of events
+    and the duration of that request. If no controller is passed, an AdaptiveChunkSizeController is used
+    which targets batch_size_update_threshold events per request.
+
+    If concurrency > 1, the block range is split into disjoint work units which are crawled by
+    `concurrency` worker threads. Every worker adapts its own batch size. Results are reassembled in
+    block order.
+
+    If chunk_grid is set, batches end at the end of grid cells where possible (see
+    `moonworm.crawler.chunk_size.align_chunk_end`).
+    """
+    if chunk_size_controller is None:
+        chunk_size_controller = AdaptiveChunkSizeController(
+            min_blocks_batch,
+            max_blocks_batch,
+            target_events=batch_size_update_threshold,
+        )
+
+    retry_policy = RetryPolicy(max_retries=BISECT_MAX_RETRIES, delay=0.1)
+
+    if concurrency <= 1:
+        return _crawl_chunks_sequentially(
+            fetch_chunk,
+            from_block,
+            to_block,
+            batch_size,
+            chunk_size_controller,
+            retry_policy,
+            chunk_grid,
+        )
+
+    # A few work units per worker, so that a worker stuck on a dense part of the range does not hold
+    # back the others
+    num_blocks = to_block - from_block + 1
+    unit_size = max(min_blocks_batch, -(-num_blocks // (concurrency * 4)))
+    unit_starts = list(range(from_block, to_block + 1, unit_size))
+    if chunk_grid:
+        # Units made of whole grid cells
+        unit_size = -(-unit_size // chunk_grid) * chunk_grid
+        first_boundary = (from_block // unit_size + 1) * unit_size
+        unit_starts = [from_block] + list(
+            range(first_boundary, to_block + 1, unit_size)
+        )
+    units = [
+        (unit_from_block, next_unit_from_block - 1)
+        for unit_from_block, next_unit_from_block in zip(
+            unit_starts, unit_starts[1:] + [to_block + 1]
+        )
+    ]
+
+    worker_state = threading.local()
+
+    def _crawl_unit(unit: Tuple[int, int]) -> Tuple[List[Dict[str, Any]], int]:
+        unit_from_block, unit_to_block = unit
+        unit_events, worker_state.batch_size = _crawl_chunks_sequentially(
+            fetch_chunk,
+            unit_from_block,
+            unit_to_block,
+            getattr(worker_state, "batch_size", batch_size),
+            chunk_size_controller,
+            retry_policy,
+            chunk_grid,
+        )
+        return unit_events, worker_state.batch_size
+
+    events: List[Dict[str, Any]] = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # executor.map yields results in the order of the units
+        for unit_events, batch_size in executor.map(_crawl_unit, units):
+            events.extend(unit_events)
+    return events, batch_size
+
+
+def _crawl_chunks_sequentially(
+    fetch_chunk: Callable[[int, int], List[Dict[str, Any]]],
+    from_block: int,
+    to_block: int,
+    batch_size: int,
+    chunk_size_controller: ChunkSizeController,
+    retry_policy: RetryPolicy,
+    chunk_grid: Optional[int] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    # Chunks may still be decoded by a DecodePool while the next ones are fetched
+    chunks = []
+    current_from_block = from_block
+
+    while current_from_block <= to_block:
+        current_to_block = align_chunk_end(
+            current_from_block,
+            min(current_from_block + batch_size, to_block),
+            chunk_grid,
+        )
+        start = time.time()
+        # Failing batches are bisected, so the blocks which could be fetched are never requested twice
+        events_chunk = _bisect_web3_call(
+            fetch_chunk,
+            current_from_block,
+            current_to_block,
+            retry_policy,
+            on_failure=chunk_size_controller.on_failure,
+        )
+        chunks.append(events_chunk)
+        batch_size = chunk_size_controller.next_chunk_size(
+            current_to_block - current_from_block + 1,
+            len(events_chunk),
+            time.time() - start,
+        )
+        current_from_block = current_to_block + 1
+    events = [event for chunk in chunks for event in resolve_events(chunk)]
+    return events, batch_size
+
+
 def _crawl_events(
     web3: Web3,
     event_abi: Any,
@@ -139,42 +380,146 @@ def _crawl_events(
     batch_size_update_threshold: int = 1000,
     max_blocks_batch: int = 10000,
     min_blocks_batch: int = 100,
+    decoder: Optional[EventDecoder] = None,
+    concurrency: int = 1,
+    chunk_size_controller: Optional[ChunkSizeController] = None,
+    chunk_grid: Optional[int] = None,
+    decode_pool: Optional[DecodePool] = None,
 ) -> Tuple[List[Dict[str, Any]], int]:
     """
     Crawls events from the given block range.
-    reduces the batch_size if response is failing.
-    increases the batch_size if response is successful.
-    """
-    events = []
-    current_from_block = from_block
+    The batch size is adapted after every request by chunk_size_controller (see `_crawl_chunks`).
+
+    With concurrency > 1, up to `concurrency` eth_getLogs requests are made in parallel over disjoint
+    parts of the block range.
 
+    With a `decode_pool`, logs are decoded by its worker processes while the next chunks are fetched.
+    """
     address_list = (
         [contract_address] if isinstance(contract_address, str) else contract_address
     )  # for backwards compatibility
 
-    while current_from_block <= to_block:
-        current_to_block = min(current_from_block + batch_size, to_block)
-        try:
-            events_chunk = _fetch_events_chunk(
-                web3,
-                event_abi,
-                current_from_block,
-                current_to_block,
-                address_list,
-            )
-            events.extend(events_chunk)
-            current_from_block = current_to_block + 1
-            if len(events) <= batch_size_update_threshold:
-                batch_size = min(batch_size * 2, max_blocks_batch)
-        except Exception as e:
-            if batch_size <= min_blocks_batch:
-                raise e
-            time.sleep(0.1)
-            batch_size = max(batch_size // 2, min_blocks_batch)
-    return events, batch_size
+    if decoder is None:
+        decoder = EventDecoder(web3.codec, event_abi)
+
+    def _fetch(current_from_block: int, current_to_block: int):
+        return _fetch_events_chunk(
+            web3,
+            event_abi,
+            current_from_block,
+            current_to_block,
+            address_list,
+            decoder=decoder,
+            decode_pool=decode_pool,
+        )
+
+    return _crawl_chunks(
+        _fetch,
+        from_block,
+        to_block,
+        batch_size,
+        batch_size_update_threshold,
+        max_blocks_batch,
+        min_blocks_batch,
+        concurrency,
+        chunk_size_controller,
+        chunk_grid,
+    )
+
+
+def _crawl_all_events(
+    web3: Web3,
+    event_abis: List[Any],
+    from_block: int,
+    to_block: int,
+    batch_size: int,
+    contract_address: Union[ChecksumAddress, List[ChecksumAddress]],
+    batch_size_update_threshold: int = 1000,
+    max_blocks_batch: int = 10000,
+    min_blocks_batch: int = 100,
+    decoders: Optional[EventDecoderRegistry] = None,
+    concurrency: int = 1,
+    chunk_size_controller: Optional[ChunkSizeController] = None,
+    chunk_grid: Optional[int] = None,
+    decode_pool: Optional[DecodePool] = None,
+) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Same as `_crawl_events`, but crawls all the given event types with one eth_getLogs call per batch.
+    Events are returned ordered by (blockNumber, logIndex).
+    """
+    address_list = (
+        [contract_address] if isinstance(contract_address, str) else contract_address
+    )
+
+    if decoders is None:
+        decoders = EventDecoderRegistry(web3.codec, event_abis)
+
+    def _fetch(current_from_block: int, current_to_block: int):
+        return _fetch_all_events_chunk(
+            web3,
+            event_abis,
+            current_from_block,
+            current_to_block,
+            address_list,
+            decoders=decoders,
+            decode_pool=decode_pool,
+        )
+
+    return _crawl_chunks(
+        _fetch,
+        from_block,
+        to_block,
+        batch_size,
+        batch_size_update_threshold,
+        max_blocks_batch,
+        min_blocks_batch,
+        concurrency,
+        chunk_size_controller,
+        chunk_grid,
+    )
+
+
+@dataclass
+class ScanBatch:
+    """
+    Events from one chunk of blocks scanned by an EventScanner.
+    """
+
+    start_block: int
+    end_block: int
+    # When end_block was mined
+    end_block_timestamp: Optional[datetime.datetime]
+    # Decoded events, in (blockNumber, logIndex) order
+    events: List[Dict[str, Any]]
+    # Values returned by the scanner state's process_event for each event
+    processed: List[Any]
+    # Set by iter_follow: the last block with enough confirmations. Events after it are provisional.
+    confirmed_block: Optional[int] = None
+    # Set by iter_follow if a chain reorganization replaced blocks whose events were emitted before: the
+    # data of all blocks from this one onwards was deleted from the scanner state and has to be dropped.
+    retracted_from_block: Optional[int] = None
+
+    @property
+    def cursor(self) -> int:
+        """
+        Pass this as cursor to iter_scan to resume the scan after this batch.
+        """
+        return self.end_block
+
+    def is_provisional(self, event: Dict[str, Any]) -> bool:
+        """
+        True if the event is in a block which may still be replaced by a chain reorganization.
+        """
+        return (
+            self.confirmed_block is not None
+            and event["blockNumber"] > self.confirmed_block
+        )
 
 
 class EventScanner:
+    # Number of blocks get_suggested_scan_start_block rescans if it cannot tell where a fork happened
+    NUM_BLOCKS_RESCAN_FOR_FORKS = 10
+
     def __init__(
         self,
         web3: Web3,
@@ -185,18 +530,45 @@ class EventScanner:
         max_request_retries: int = 30,
         request_retry_seconds: float = 3.0,
         skip_block_timestamp: bool = False,
+        combine_event_requests: bool = False,
+        chunk_size_controller: Optional[ChunkSizeController] = None,
+        retry_policy: Optional[RetryPolicy] = None,
+        timestamp_index: Optional[BlockTimestampIndex] = None,
+        reorg_detector: Optional[ReorgDetector] = None,
+        chunk_grid: Optional[int] = None,
+        decode_pool: Optional[DecodePool] = None,
     ):
         """
         :param events: List of web3 Event we scan
         :param max_chunk_scan_size: JSON-RPC API limit in the number of blocks we query. (Recommendation: 10,000 for mainnet, 500,000 for testnets)
         :param max_request_retries: How many times we try to reattempt a failed JSON-RPC call
         :param request_retry_seconds: Delay between failed requests to let JSON-RPC server to recover
+        :param combine_event_requests: Fetch all event types with a single eth_getLogs call per chunk
+        :param chunk_size_controller: Decides the size of the next chunk after every chunk. Defaults to
+        an AdaptiveChunkSizeController between min_scan_chunk_size and max_chunk_scan_size
+        :param retry_policy: Decides how to retry failed JSON-RPC calls. Defaults to a RetryPolicy with
+        max_request_retries retries and request_retry_seconds as base delay
+        :param timestamp_index: Persistent index to look up and store block timestamps in
+        :param reorg_detector: Records the hashes of scanned blocks to detect chain reorganizations. Set
+        by iter_follow if not given.
+        :param chunk_grid: If set, chunks end at the end of aligned ranges of this many blocks where
+        possible, so that reruns request the same ranges (see moonworm.crawler.rpc_cache)
+        :param decode_pool: Process pool which decodes the logs of the events, built for the same events
         """
 
         self.web3 = web3
         self.state = scanner_state
         self.events = events
         self.skip_block_timestamp = skip_block_timestamp
+        self.timestamp_index = timestamp_index
+        self.reorg_detector = reorg_detector
+        self.combine_event_requests = combine_event_requests
+        self.chunk_grid = chunk_grid
+        self.decode_pool = decode_pool
+
+        # Decoders are built once for the whole scan
+        self.decoders = EventDecoderRegistry(web3.codec, events)
+        self.event_decoders = [EventDecoder(web3.codec, event) for event in events]
 
         self.checksum_addresses = []
         if addresses:
@@ -216,6 +588,22 @@ class EventScanner:
         # Factor how was we increase chunk size if no results found
         self.chunk_size_increase = 2.0
 
+        if chunk_size_controller is None:
+            chunk_size_controller = AdaptiveChunkSizeController(
+                self.min_scan_chunk_size,
+                self.max_scan_chunk_size,
+                increase_factor=self.chunk_size_increase,
+                decrease_factor=self.chunk_size_decrease,
+            )
+        self.chunk_size_controller = chunk_size_controller
+
+        if retry_policy is None:
+            retry_policy = RetryPolicy(
+                max_retries=self.max_request_retries,
+                delay=self.request_retry_seconds,
+            )
+        self.retry_policy = retry_policy
+
     def get_block_timestamp(self, block_num) -> Optional[datetime.datetime]:
         """Get Ethereum block timestamp"""
         if self.skip_block_timestamp:
@@ -230,20 +618,54 @@ class EventScanner:
         last_time = block_info["timestamp"]
         return datetime.datetime.utcfromtimestamp(last_time)
 
+    def get_block_timestamps(
+        self, block_numbers: Iterable[int]
+    ) -> Dict[int, Optional[datetime.datetime]]:
+        """Get Ethereum block timestamps for several blocks, using JSON-RPC batches where possible"""
+        block_numbers = set(block_numbers)
+        if self.skip_block_timestamp:
+            # Returning None since, config set to skip getting block timestamp data
+            return {block_number: None for block_number in block_numbers}
+        if self.timestamp_index is not None:
+            timestamps = self.timestamp_index.get_block_timestamps(
+                self.web3, block_numbers
+            )
+        else:
+            timestamps = get_block_timestamps(self.web3, block_numbers)
+        # Blocks which were not mined yet (minor chain reorganisation?) have no timestamp
+        return {
+            block_number: (
+                datetime.datetime.utcfromtimestamp(timestamps[block_number])
+                if block_number in timestamps
+                else None
+            )
+            for block_number in block_numbers
+        }
+
     def get_suggested_scan_start_block(self):
         """Get where we should start to scan for new token events.
 
         If there are no prior scans, start from block 1.
-        Otherwise, start from the last end block minus ten blocks.
-        We rescan the last ten scanned blocks in the case there were forks to avoid
+        If our reorg detector has a record of the last scanned block, we start right after it, or from the
+        first block replaced by a fork (after deleting the data of the replaced blocks).
+        Otherwise, start from the last end block minus NUM_BLOCKS_RESCAN_FOR_FORKS blocks.
+        We rescan the last scanned blocks in the case there were forks to avoid
         misaccounting due to minor single block works (happens once in a hour in Ethereum).
-        These heurestics could be made more robust, but this is for the sake of simple reference implementation.
         """
 
         end_block = self.get_last_scanned_block()
-        if end_block:
-            return max(1, end_block - self.NUM_BLOCKS_RESCAN_FOR_FORKS)
-        return 1
+        if not end_block:
+            return 1
+        if (
+            self.reorg_detector is not None
+            and self.reorg_detector.get_hash(end_block) is not None
+        ):
+            fork_block = self.reorg_detector.advance(end_block + 1, end_block)
+            if fork_block is None:
+                return end_block + 1
+            self.delete_potentially_forked_block_data(fork_block)
+            return fork_block
+        return max(1, end_block - self.NUM_BLOCKS_RESCAN_FOR_FORKS)
 
     def get_suggested_scan_end_block(self):
         """Get the last mined block on Ethereum chain we are following."""
@@ -259,7 +681,12 @@ class EventScanner:
         """Purge old data in the case of blockchain reorganisation."""
         self.state.delete_data(after_block)
 
-    def estimate_next_chunk_size(self, current_chuck_size: int, event_found_count: int):
+    def estimate_next_chunk_size(
+        self,
+        current_chuck_size: int,
+        event_found_count: int,
+        duration: float = 0.0,
+    ):
         """Try to figure out optimal chunk size
 
         Our scanner might need to scan the whole blockchain for all events
@@ -270,101 +697,140 @@ class EventScanner:
 
         * Do not overload node serving JSON-RPC API by asking data for too many events at a time
 
-        Currently Ethereum JSON-API does not have an API to tell when a first event occured in a blockchain
-        and our heuristics try to accelerate block fetching (chunk size) until we see the first event.
-
-        These heurestics exponentially increase the scan chunk size depending on if we are seeing events or not.
-        When any transfers are encountered, we are back to scanning only a few blocks at a time.
-        It does not make sense to do a full chain scan starting from block 1, doing one JSON-RPC call per 20 blocks.
+        The decision is delegated to `self.chunk_size_controller`, which by default targets a number of
+        events and a scan duration per chunk from the event density and scan durations it observed.
         """
-
-        if event_found_count > 0:
-            # When we encounter first events, reset the chunk size window
-            current_chuck_size = self.min_scan_chunk_size
-        else:
-            current_chuck_size *= self.chunk_size_increase
-
-        current_chuck_size = max(self.min_scan_chunk_size, current_chuck_size)
-        current_chuck_size = min(self.max_scan_chunk_size, current_chuck_size)
-        return int(current_chuck_size)
+        return self.chunk_size_controller.next_chunk_size(
+            current_chuck_size, event_found_count, duration
+        )
 
     def scan_chunk(self, start_block, end_block) -> Tuple[int, datetime.datetime, list]:
         """Read and process events between to block numbers.
 
-        Dynamically decrease the size of the chunk if the case JSON-RPC server pukes out.
+        If the JSON-RPC server pukes out, the failing part of the chunk is split as the retry policy decides,
+        so the whole chunk is always scanned.
 
         :return: tuple(actual end block number, when this block was mined, processed events)
         """
-
-        block_timestamps = {}
-        get_block_timestamp = self.get_block_timestamp
-
-        # Cache block timestamps to reduce some RPC overhead
-        # Real solution might include smarter models around block
-        def get_block_when(block_num):
-            if block_num not in block_timestamps:
-                block_timestamps[block_num] = get_block_timestamp(block_num)
-            return block_timestamps[block_num]
-
-        all_processed = []
-
-        for event_type in self.events:
-            # Callable that takes care of the underlying web3 call
-            def _fetch_events(_start_block, _end_block):
-                return _fetch_events_chunk(
+        batch = self._scan_chunk(start_block, end_block)
+        return batch.end_block, batch.end_block_timestamp, batch.processed
+
+    def _scan_chunk(self, start_block: int, end_block: int) -> ScanBatch:
+        events = self._fetch_chunk_events(start_block, end_block)
+        return self._process_chunk_events(start_block, end_block, events)
+
+    def _fetch_chunk_events(
+        self, start_block: int, end_block: int
+    ) -> List[Dict[str, Any]]:
+        # Each fetcher is a callable that takes care of the underlying web3 call
+        fetchers: List[Callable[[int, int], List[Any]]] = []
+        if self.combine_event_requests:
+            fetchers.append(
+                lambda _start_block, _end_block, _addresses=None: _fetch_all_events_chunk(
                     self.web3,
-                    event_type,
+                    self.events,
                     from_block=_start_block,
                     to_block=_end_block,
-                    addresses=self.checksum_addresses,
+                    addresses=_addresses,
+                    decoders=self.decoders,
+                    decode_pool=self.decode_pool,
                 )
-
-            # Do `n` retries on `eth_getLogs`,
-            # throttle down block range if needed
-            end_block, events = _retry_web3_call(
-                _fetch_events,
-                start_block=start_block,
-                end_block=end_block,
-                retries=self.max_request_retries,
-                delay=self.request_retry_seconds,
             )
+        else:
+            for decoder in self.event_decoders:
+                fetchers.append(
+                    lambda _start_block, _end_block, _addresses=None, decoder=decoder: _fetch_events_chunk(
+                        self.web3,
+                        decoder.event_abi,
+                        from_block=_start_block,
+                        to_block=_end_block,
+                        addresses=_addresses,
+                        decoder=decoder,
+                        decode_pool=self.decode_pool,
+                    )
+                )
 
-            for evt in events:
-                idx = evt[
-                    "logIndex"
-                ]  # Integer of the log index position in the block, null when its pending
+        parts = []
+        for _fetch_events in fetchers:
+            # Retry `eth_getLogs` as the retry policy decides,
+            # splitting the block range or the addresses where needed
+            parts.append(
+                _bisect_web3_call(
+                    _fetch_events,
+                    start_block=start_block,
+                    end_block=end_block,
+                    retry_policy=self.retry_policy,
+                    addresses=self.checksum_addresses or None,
+                    on_failure=self.chunk_size_controller.on_failure,
+                )
+            )
+        return resolve_events(concat_events(parts, sort=True))
 
-                # We cannot avoid minor chain reorganisations, but
-                # at least we must avoid blocks that are not mined yet
-                assert idx is not None, "Somehow tried to scan a pending block"
+    def _process_chunk_events(
+        self,
+        start_block: int,
+        end_block: int,
+        events: List[Dict[str, Any]],
+        known_timestamps: Optional[Dict[int, int]] = None,
+    ) -> ScanBatch:
+        all_processed = []
 
-                block_number = evt["blockNumber"]
+        # Get UTC time when these events happened (block mined timestamp)
+        # for all blocks of the chunk at once. Blocks whose timestamps we already know are not fetched.
+        if known_timestamps is None or self.skip_block_timestamp:
+            known_timestamps = {}
+        block_numbers = {evt["blockNumber"] for evt in events} | {end_block}
+        block_timestamps = self.get_block_timestamps(
+            block_number
+            for block_number in block_numbers
+            if block_number not in known_timestamps
+        )
+        for block_number in block_numbers:
+            if block_number in known_timestamps:
+                block_timestamps[block_number] = datetime.datetime.utcfromtimestamp(
+                    known_timestamps[block_number]
+                )
 
-                # Get UTC time when this event happened (block mined timestamp)
-                # from our in-memory cache
-                block_when = get_block_when(block_number)
+        for evt in events:
+            idx = evt[
+                "logIndex"
+            ]  # Integer of the log index position in the block, null when its pending
 
-                logger.debug(
-                    "Processing event %s, block:%d count:%d",
-                    evt["event"],
-                    evt["blockNumber"],
-                )
-                processed = self.state.process_event(block_when, evt)
-                all_processed.append(processed)
+            # We cannot avoid minor chain reorganisations, but
+            # at least we must avoid blocks that are not mined yet
+            assert idx is not None, "Somehow tried to scan a pending block"
 
-        end_block_timestamp = get_block_when(end_block)
-        return end_block, end_block_timestamp, all_processed
+            block_when = block_timestamps[evt["blockNumber"]]
 
-    def scan(
+            logger.debug(
+                "Processing event %s, block:%d",
+                evt["event"],
+                evt["blockNumber"],
+            )
+            processed = self.state.process_event(block_when, evt)
+            all_processed.append(processed)
+
+        return ScanBatch(
+            start_block=start_block,
+            end_block=end_block,
+            end_block_timestamp=block_timestamps[end_block],
+            events=events,
+            processed=all_processed,
+        )
+
+    def iter_scan(
         self,
-        start_block,
-        end_block,
-        start_chunk_size=20,
-        progress_callback=Optional[Callable],
-    ) -> Tuple[list, int]:
-        """Perform a token balances scan.
-
-        Assumes all balances in the database are valid before start_block (no forks sneaked in).
+        start_block: int,
+        end_block: int,
+        start_chunk_size: int = 20,
+        progress_callback: Optional[Callable] = None,
+        cursor: Optional[int] = None,
+        prefetch_chunks: int = 0,
+    ) -> Iterator[ScanBatch]:
+        """Perform a scan, yielding the events of every chunk as soon as the chunk is scanned.
+
+        Only the chunks which have been yielded, and at most prefetch_chunks chunks ahead of them, are held
+        in memory. The scanner stops scanning while that many chunks are waiting to be consumed.
 
         :param start_block: The first block included in the scan
 
@@ -374,26 +840,79 @@ class EventScanner:
 
         :param progress_callback: If this is an UI application, update the progress of the scan
 
-        :return: [All processed events, number of chunks used]
-        """
+        :param cursor: The cursor of the last batch consumed by a previous scan. The scan resumes from the
+        block after it.
 
-        assert start_block <= end_block
+        :param prefetch_chunks: Number of chunks to scan in a background thread ahead of the consumer. If
+        0, chunks are only scanned when the consumer asks for them.
+        """
 
+        if cursor is not None:
+            start_block = max(start_block, cursor + 1)
+
+        batches = self._iter_scan(
+            start_block, end_block, start_chunk_size, progress_callback
+        )
+        if prefetch_chunks <= 0:
+            yield from batches
+            return
+
+        buffer: queue.Queue = queue.Queue(maxsize=prefetch_chunks)
+        stopped = threading.Event()
+
+        def _produce() -> None:
+            try:
+                for batch in batches:
+                    # Blocks while the buffer is full, until the consumer catches up or goes away
+                    while not stopped.is_set():
+                        try:
+                            buffer.put(("batch", batch), timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+                    if stopped.is_set():
+                        return
+                buffer.put(("done", None))
+            except Exception as e:
+                buffer.put(("error", e))
+
+        producer = threading.Thread(target=_produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                kind, item = buffer.get()
+                if kind == "batch":
+                    yield item
+                elif kind == "error":
+                    raise item
+                else:
+                    return
+        finally:
+            stopped.set()
+            producer.join()
+
+    def _iter_scan(
+        self,
+        start_block: int,
+        end_block: int,
+        start_chunk_size: int,
+        progress_callback: Optional[Callable],
+    ) -> Iterator[ScanBatch]:
         current_block = start_block
 
         # Scan in chunks, commit between
         chunk_size = start_chunk_size
         last_scan_duration = last_logs_found = 0
-        total_chunks_scanned = 0
-
-        # All processed entries we got on this scan cycle
-        all_processed = []
 
         while current_block <= end_block:
             self.state.start_chunk(current_block, chunk_size)
 
             # Print some diagnostics to logs to try to fiddle with real world JSON-RPC API performance
-            estimated_end_block = current_block + chunk_size
+            estimated_end_block = align_chunk_end(
+                current_block,
+                min(current_block + chunk_size, end_block),
+                self.chunk_grid,
+            )
             logger.debug(
                 "Scanning token transfers for blocks: %d - %d, chunk size %d, last chunk scan took %f, last logs found %d",
                 current_block,
@@ -404,15 +923,13 @@ class EventScanner:
             )
 
             start = time.time()
-            actual_end_block, end_block_timestamp, new_entries = self.scan_chunk(
-                current_block, estimated_end_block
-            )
+            batch = self._scan_chunk(current_block, estimated_end_block)
 
             # Where does our current chunk scan ends - are we out of chain yet?
-            current_end = actual_end_block
+            current_end = batch.end_block
 
             last_scan_duration = time.time() - start
-            all_processed += new_entries
+            last_logs_found = len(batch.processed)
 
             # Print progress bar
             if progress_callback:
@@ -420,17 +937,179 @@ class EventScanner:
                     start_block,
                     end_block,
                     current_block,
-                    end_block_timestamp,
+                    batch.end_block_timestamp,
                     chunk_size,
-                    len(new_entries),
+                    len(batch.processed),
                 )
 
             # Try to guess how many blocks to fetch over `eth_getLogs` API next time
-            chunk_size = self.estimate_next_chunk_size(chunk_size, len(new_entries))
+            chunk_size = self.estimate_next_chunk_size(
+                current_end - current_block + 1,
+                len(batch.processed),
+                last_scan_duration,
+            )
 
             # Set where the next chunk starts
             current_block = current_end + 1
-            total_chunks_scanned += 1
             self.state.end_chunk(current_end)
+            yield batch
+
+    def scan(
+        self,
+        start_block,
+        end_block,
+        start_chunk_size=20,
+        progress_callback: Optional[Callable] = None,
+    ) -> Tuple[list, int]:
+        """Perform a token balances scan.
+
+        Assumes all balances in the database are valid before start_block (no forks sneaked in).
+
+        Collects all processed events in memory. Use iter_scan for long scans.
+
+        :param start_block: The first block included in the scan
+
+        :param end_block: The last block included in the scan
+
+        :param start_chunk_size: How many blocks we try to fetch over JSON-RPC on the first attempt
+
+        :param progress_callback: If this is an UI application, update the progress of the scan
+
+        :return: [All processed events, number of chunks used]
+        """
+
+        assert start_block <= end_block
+
+        # All processed entries we got on this scan cycle
+        all_processed = []
+        total_chunks_scanned = 0
+        for batch in self.iter_scan(
+            start_block, end_block, start_chunk_size, progress_callback
+        ):
+            all_processed += batch.processed
+            total_chunks_scanned += 1
 
         return all_processed, total_chunks_scanned
+
+    def iter_follow(
+        self,
+        start_block: int,
+        num_confirmations: int = 12,
+        poll_interval: float = 1.0,
+        end_block: Optional[int] = None,
+        start_chunk_size: int = 20,
+        cursor: Optional[int] = None,
+        head_tracker: Optional[HeadTracker] = None,
+    ) -> Iterator[ScanBatch]:
+        """Follow the head of the chain, yielding the events of every chunk as soon as its blocks are mined.
+
+        Events are emitted without waiting for confirmations. Events in blocks after the confirmed_block
+        of their batch are provisional (see ScanBatch.is_provisional).
+
+        The hash and parentHash of every scanned block within num_confirmations blocks of the head are
+        recorded by self.reorg_detector. If a chain reorganization replaces blocks whose events were
+        emitted, the data of those blocks (and only of those blocks) is deleted from the scanner state
+        with delete_data, and an empty batch with retracted_from_block set to the first replaced block is
+        yielded. The scan then continues from that block, on the new branch of the chain.
+
+        :param start_block: The first block included in the scan
+
+        :param num_confirmations: Number of blocks after which we consider a block final
+
+        :param poll_interval: Seconds between checks of the last scanned block for reorganizations, once
+        we caught up with the head of the chain and while no new block is mined
+
+        :param end_block: The last block included in the scan. If None, follows the chain forever.
+
+        :param start_chunk_size: How many blocks we try to fetch over JSON-RPC on the first attempt
+
+        :param cursor: The cursor of the last batch consumed by a previous scan. The scan resumes from the
+        block after it.
+
+        :param head_tracker: Tells the scanner about new blocks. Defaults to the tracker shared by all
+        crawlers using the same JSON-RPC endpoint.
+        """
+        if head_tracker is None:
+            head_tracker = HeadTracker.for_web3(self.web3)
+        if self.reorg_detector is None:
+            self.reorg_detector = ReorgDetector(
+                self.web3, max_depth=max(num_confirmations, 1)
+            )
+        detector = self.reorg_detector
+
+        current_block = start_block
+        if cursor is not None:
+            current_block = max(start_block, cursor + 1)
+        chunk_size = start_chunk_size
+
+        while end_block is None or current_block <= end_block:
+            head = head_tracker.get_head()
+            confirmed_block = head - num_confirmations
+            target_block = head if end_block is None else min(head, end_block)
+            chunk_end = align_chunk_end(
+                current_block,
+                min(current_block + chunk_size, target_block),
+                self.chunk_grid,
+            )
+
+            # Blocks with enough confirmations are final, we only keep track of the ones after them.
+            # Once we caught up with the head, this checks that the last block we scanned is still on chain.
+            if chunk_end > confirmed_block or chunk_end < current_block:
+                try:
+                    fork_block = detector.advance(current_block, chunk_end)
+                except HeadersUnavailable as e:
+                    # The endpoint has not caught up with the head yet
+                    logger.warning("%s, retrying on the next head", e)
+                    head_tracker.wait_for_block(head + 1, timeout=poll_interval)
+                    continue
+                if fork_block is not None:
+                    self.delete_potentially_forked_block_data(fork_block)
+                    if self.timestamp_index is not None:
+                        self.timestamp_index.forget(fork_block)
+                    current_block = fork_block
+                    yield ScanBatch(
+                        start_block=fork_block,
+                        end_block=fork_block - 1,
+                        end_block_timestamp=None,
+                        events=[],
+                        processed=[],
+                        confirmed_block=confirmed_block,
+                        retracted_from_block=fork_block,
+                    )
+                    continue
+
+            if chunk_end < current_block:
+                head_tracker.wait_for_block(current_block, timeout=poll_interval)
+                continue
+
+            start = time.time()
+            events = self._fetch_chunk_events(current_block, chunk_end)
+            mismatch = detector.find_mismatch(events)
+            if mismatch is not None:
+                # The logs were served from another branch of the chain than the headers we recorded.
+                # Fetching the headers again finds the fork if it reaches back before this chunk.
+                logger.warning(
+                    "Events in block %d do not match its recorded hash, scanning blocks %d - %d again",
+                    mismatch,
+                    current_block,
+                    chunk_end,
+                )
+                detector.forget(current_block)
+                if self.timestamp_index is not None:
+                    self.timestamp_index.forget(current_block)
+                continue
+
+            self.state.start_chunk(current_block, chunk_size)
+            batch = self._process_chunk_events(
+                current_block, chunk_end, events, detector.get_timestamps()
+            )
+            batch.confirmed_block = confirmed_block
+
+            chunk_size = self.estimate_next_chunk_size(
+                chunk_end - current_block + 1,
+                len(batch.processed),
+                time.time() - start,
+            )
+            current_block = chunk_end + 1
+            self.state.end_chunk(chunk_end)
+            yield batch
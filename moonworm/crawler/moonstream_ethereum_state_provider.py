@@ -1,13 +1,20 @@
 import logging
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Collection, Dict, Iterable, List, Optional, Sequence, Union
 
 from eth_typing.evm import ChecksumAddress
 from hexbytes.main import HexBytes
 from sqlalchemy.orm import Session
 from web3 import Web3
 
-from .ethereum_state_provider import EthereumStateProvider
+from .batch_rpc import get_transaction_receipts
+from .ethereum_state_provider import (
+    EthereumStateProvider,
+    address_set,
+    filter_transactions,
+    transaction_hash_hex,
+)
 from .networks import MODELS, Network, tx_raw_types
+from .timestamp_index import BlockTimestampIndex
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,8 +33,10 @@ class MoonstreamEthereumStateProvider(EthereumStateProvider):
         network: Network,
         db_session: Optional[Session] = None,
         batch_load_count: int = 100,
+        timestamp_index: Optional[BlockTimestampIndex] = None,
     ):
         self.w3 = w3
+        self.timestamp_index = timestamp_index
         self.db_session = db_session
 
         self.metrics = {
@@ -36,6 +45,8 @@ class MoonstreamEthereumStateProvider(EthereumStateProvider):
             "db_get_block_calls": 0,
             "db_get_transaction_calls": 0,
             "block_found_in_cache": 0,
+            "web3_get_transaction_receipts_requests": 0,
+            "receipt_round_trips_saved": 0,
         }
 
         self.blocks_model = MODELS[network]["blocks"]
@@ -55,6 +66,27 @@ class MoonstreamEthereumStateProvider(EthereumStateProvider):
         self.metrics["web3_get_transaction_receipt_calls"] += 1
         return self.w3.eth.get_transaction_receipt(transaction_hash)
 
+    def get_transaction_receipts(
+        self, transactions: Sequence[Dict[str, Any]]
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Requests the receipts of the given transactions from the node in JSON-RPC batches.
+
+        Unlike Web3StateProvider, which caches the receipts of whole blocks fetched with
+        eth_getBlockReceipts, this provider only requests the receipts it is asked for and does not
+        cache them: transactions come from the database, and the crawler asks for the receipts of every
+        transaction once.
+        """
+        transaction_hashes = [transaction_hash_hex(tx["hash"]) for tx in transactions]
+        receipts, num_requests = get_transaction_receipts(self.w3, transaction_hashes)
+        self.metrics["web3_get_transaction_receipts_requests"] += num_requests
+        self.metrics["receipt_round_trips_saved"] += (
+            len(set(transaction_hashes)) - num_requests
+        )
+        return [
+            receipts.get(transaction_hash) for transaction_hash in transaction_hashes
+        ]
+
     def get_last_block_number(self) -> int:
         last_block = (
             self.db_session.query(self.blocks_model)
@@ -160,12 +192,27 @@ class MoonstreamEthereumStateProvider(EthereumStateProvider):
             self.blocks_cache = {}
 
         self.blocks_cache[block_number] = block
+        if self.timestamp_index is not None:
+            self.timestamp_index.put(block_number, block["timestamp"])
         return block
 
+    def forget_blocks(self, from_block: int) -> None:
+        self.blocks_cache = {
+            block_number: block
+            for block_number, block in self.blocks_cache.items()
+            if block_number < from_block
+        }
+        if self.timestamp_index is not None:
+            self.timestamp_index.forget(from_block)
+
     def get_block_timestamp(self, block_number: int) -> int:
         logger.debug(
             f"MoonstreamEthereumStateProvider.get_block_timestamp: block_number={block_number},network={self.network.value}"
         )
+        if self.timestamp_index is not None:
+            timestamp = self.timestamp_index.get(block_number)
+            if timestamp is not None:
+                return timestamp
         block = self._get_block(block_number)
         return block["timestamp"]
 
@@ -179,3 +226,22 @@ class MoonstreamEthereumStateProvider(EthereumStateProvider):
 
         all_transactions = block["transactions"]
         return [tx for tx in all_transactions if tx["to"] == address]
+
+    def get_transactions_to_addresses(
+        self,
+        addresses: Iterable[str],
+        from_block: int,
+        to_block: int,
+        selectors: Optional[Collection[str]] = None,
+    ) -> List[Dict[str, Any]]:
+        logger.debug(
+            f"MoonstreamEthereumStateProvider.get_transactions_to_addresses: from_block={from_block},to_block={to_block},network={self.network.value}"
+        )
+        addresses = address_set(addresses)
+        transactions = []
+        for block_number in range(from_block, to_block + 1):
+            block = self._get_block(block_number)
+            transactions.extend(
+                filter_transactions(block["transactions"], addresses, selectors)
+            )
+        return transactions
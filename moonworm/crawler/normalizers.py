@@ -0,0 +1,109 @@
+"""
+Type-driven normalisation of decoded ABI values into JSON-safe Python values.
+
+`utfy_dict` walks decoded values and checks the type of every one of them. The normalisers in this
+module are instead built once from the ABI types of an event or function and then applied to every
+decoded value with a single pass:
+
+- `address` values become checksum addresses
+- `bytes` and `bytesN` values become 0x-prefixed hex strings
+- tuples (structs) become lists, or dicts keyed by component name if `named_tuples` is set
+- arrays become lists
+- integers (including big integers), booleans and strings are left as they are
+"""
+
+import re
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from eth_utils import to_checksum_address
+
+Normalizer = Callable[[Any], Any]
+
+ARRAY_TYPE_REGEX = re.compile(r"^(.*)\[(\d*)\]$")
+
+
+@lru_cache(maxsize=65536)
+def _checksum_address(address: str) -> str:
+    return to_checksum_address(address)
+
+
+def _bytes_to_hex(value: bytes) -> str:
+    return "0x" + value.hex()
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def build_normalizer(
+    abi_input: Dict[str, Any], named_tuples: bool = False
+) -> Optional[Normalizer]:
+    """
+    Builds a normaliser for values decoded with the type of the given ABI input (an item of the
+    "inputs" or "outputs" list of an ABI entry).
+
+    Returns None if values of that type are already JSON-safe and need no normalisation.
+    """
+    return _build_normalizer(abi_input["type"], abi_input, named_tuples)
+
+
+def _build_normalizer(
+    type_str: str, abi_input: Dict[str, Any], named_tuples: bool
+) -> Optional[Normalizer]:
+    array_match = ARRAY_TYPE_REGEX.match(type_str)
+    if array_match is not None:
+        item_normalizer = _build_normalizer(
+            array_match.group(1), abi_input, named_tuples
+        )
+        if item_normalizer is None:
+            return list
+        return lambda values: [item_normalizer(value) for value in values]
+
+    if type_str == "tuple":
+        components = abi_input.get("components", [])
+        normalizers = [
+            build_normalizer(component, named_tuples) or _identity
+            for component in components
+        ]
+        if named_tuples:
+            names = [component["name"] for component in components]
+            return lambda values: {
+                name: normalizer(value)
+                for name, normalizer, value in zip(names, normalizers, values)
+            }
+        return lambda values: [
+            normalizer(value) for normalizer, value in zip(normalizers, values)
+        ]
+
+    if type_str == "address":
+        return _checksum_address
+
+    if type_str.startswith("bytes"):
+        return _bytes_to_hex
+
+    return None
+
+
+class ArgumentsNormalizer:
+    """
+    Normalises the decoded arguments of a single event or function, given the ABI items of those
+    arguments in decoding order.
+    """
+
+    def __init__(
+        self, abi_inputs: Sequence[Dict[str, Any]], named_tuples: bool = False
+    ):
+        self.names: List[str] = [abi_input["name"] for abi_input in abi_inputs]
+        self.normalizers: List[Optional[Normalizer]] = [
+            build_normalizer(abi_input, named_tuples) for abi_input in abi_inputs
+        ]
+
+    def normalize(self, values: Sequence[Any]) -> Dict[str, Any]:
+        """
+        Returns a dictionary mapping argument names to their normalised values.
+        """
+        return {
+            name: value if normalizer is None else normalizer(value)
+            for name, normalizer, value in zip(self.names, self.normalizers, values)
+        }
@@ -0,0 +1,354 @@
+"""
+Columnar export of crawled events and method calls to Parquet files.
+
+Every event type and every method of the contract gets its own Parquet file, with a typed column per
+argument, derived from the contract ABI:
+
+| ABI type | Column type |
+|---|---|
+| `uint8` ... `uint64`, `int8` ... `int64` | `uint64`, `int64` |
+| `uint256`, `int256` and other integers wider than 64 bits | decimal `string` |
+| `address` | dictionary-encoded `string` |
+| `bool` | `bool` |
+| `bytes`, `bytes1` ... `bytes32` | `binary` |
+| `string` | `string` |
+| arrays and tuples | JSON `string` |
+
+Arguments are stored in `arg_<name>` columns, next to the columns which locate the event or call in the
+chain. Overloaded events and methods share a file, with the arguments of all overloads: an argument
+whose type differs between overloads is stored as a JSON `string`. Addresses and event and function names are dictionary-encoded. Rows are written in row groups
+which cover ranges of at least `row_group_blocks` blocks.
+
+Requires pyarrow, which is installed with `pip install moonworm[parquet]`.
+
+Usage:
+```python
+from moonworm.crawler.parquet_writer import ParquetExporter
+
+exporter = ParquetExporter("crawldata", contract_abi)
+for batch in iter_watch(...):
+    exporter.add_events(batch.events)
+    exporter.add_calls(batch.calls)
+    exporter.end_block_range(batch.to_block)
+exporter.close()
+```
+"""
+
+import json
+import os
+import re
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    print("this feature requires pyarrow which is not installed")
+    print("to enable, run: `pip install moonworm[parquet]`")
+    raise ImportError(
+        "pyarrow not installed, to install, run: `pip install moonworm[parquet]`"
+    )
+
+from .function_call_crawler import ContractFunctionCall
+from .sinks import json_safe
+
+INTEGER_TYPE_REGEX = re.compile(r"^(u?)int(\d*)$")
+
+# Type of the columns of event and function names, which are dictionary-encoded like addresses
+NAME_TYPE = "name"
+
+# Type of the columns of arguments whose ABI type differs between overloads, which store JSON
+JSON_TYPE = "json"
+
+EVENT_COLUMNS: List[Tuple[str, str]] = [
+    ("block_number", "uint64"),
+    ("block_hash", "string"),
+    ("transaction_hash", "string"),
+    ("log_index", "uint64"),
+    ("address", "address"),
+    ("event", NAME_TYPE),
+]
+
+CALL_COLUMNS: List[Tuple[str, str]] = [
+    ("block_number", "uint64"),
+    ("block_hash", "string"),
+    ("block_timestamp", "uint64"),
+    ("transaction_hash", "string"),
+    ("contract_address", "address"),
+    ("caller_address", "address"),
+    ("function_name", NAME_TYPE),
+    ("gas_used", "uint64"),
+    ("status", "uint64"),
+]
+
+
+def abi_columns(abi_item: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """
+    Returns the (column name, ABI type) pairs of the arguments of an event or function ABI. Unnamed
+    arguments are named after their position.
+    """
+    columns = []
+    for i, abi_input in enumerate(abi_item.get("inputs", [])):
+        name = abi_input.get("name") or str(i)
+        columns.append((f"arg_{name}", abi_input["type"]))
+    return columns
+
+
+def merge_columns(
+    columns: List[Tuple[str, str]], other_columns: List[Tuple[str, str]]
+) -> List[Tuple[str, str]]:
+    """
+    Returns the columns of both lists, in order. Columns of both lists with different types are stored
+    as JSON.
+    """
+    merged = dict(columns)
+    for name, abi_type in other_columns:
+        if merged.setdefault(name, abi_type) != abi_type:
+            merged[name] = JSON_TYPE
+    return list(merged.items())
+
+
+def arrow_type(abi_type: str) -> "pa.DataType":
+    """
+    Returns the Arrow type of the column which stores values of the given ABI type.
+    """
+    if abi_type.endswith("]") or abi_type.startswith("tuple"):
+        return pa.string()
+    match = INTEGER_TYPE_REGEX.match(abi_type)
+    if match is not None:
+        bits = int(match.group(2) or 256)
+        if bits > 64:
+            return pa.string()
+        return pa.uint64() if match.group(1) else pa.int64()
+    if abi_type in ("address", NAME_TYPE):
+        return pa.dictionary(pa.int32(), pa.string())
+    if abi_type == "bool":
+        return pa.bool_()
+    if abi_type.startswith("bytes"):
+        return pa.binary()
+    return pa.string()
+
+
+def column_value(abi_type: str, value: Any) -> Any:
+    """
+    Converts a decoded value of the given ABI type into the value stored in its column.
+    """
+    if value is None:
+        return None
+    if abi_type == JSON_TYPE or abi_type.endswith("]") or abi_type.startswith("tuple"):
+        return json.dumps(json_safe(value))
+    match = INTEGER_TYPE_REGEX.match(abi_type)
+    if match is not None:
+        if int(match.group(2) or 256) > 64:
+            return str(value)
+        return int(value)
+    if abi_type.startswith("bytes"):
+        if isinstance(value, str):
+            return bytes.fromhex(value[2:] if value.startswith("0x") else value)
+        return bytes(value)
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + bytes(value).hex()
+    return value
+
+
+class _TableBuffer:
+    """
+    Rows of one Parquet file which have not been written yet.
+    """
+
+    def __init__(self, path: str, columns: List[Tuple[str, str]], compression: str):
+        self.path = path
+        self.columns = columns
+        self.compression = compression
+        self.schema = pa.schema([(name, arrow_type(t)) for name, t in columns])
+        self.values: Dict[str, List[Any]] = {name: [] for name, _ in columns}
+        self.first_block: Optional[int] = None
+        self.writer: Optional["pq.ParquetWriter"] = None
+
+    def __len__(self) -> int:
+        return len(self.values["block_number"])
+
+    def append(self, row: Dict[str, Any]) -> None:
+        if self.first_block is None:
+            self.first_block = row["block_number"]
+        for name, abi_type in self.columns:
+            self.values[name].append(column_value(abi_type, row.get(name)))
+
+    def flush(self) -> int:
+        """
+        Writes the buffered rows as one row group. Returns the number of rows written.
+        """
+        rows = len(self)
+        if rows == 0:
+            return 0
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                self.path.format(first_block=self.first_block),
+                self.schema,
+                compression=self.compression,
+                use_dictionary=[
+                    name
+                    for name, field_type in zip(self.schema.names, self.schema.types)
+                    if pa.types.is_dictionary(field_type)
+                ],
+            )
+        arrays = []
+        for name, field in zip(self.schema.names, self.schema):
+            if pa.types.is_dictionary(field.type):
+                arrays.append(
+                    pa.array(self.values[name], type=field.type.value_type)
+                    .dictionary_encode()
+                    .cast(field.type)
+                )
+            else:
+                arrays.append(pa.array(self.values[name], type=field.type))
+        self.writer.write_table(
+            pa.Table.from_arrays(arrays, schema=self.schema), row_group_size=rows
+        )
+        self.values = {name: [] for name, _ in self.columns}
+        self.first_block = None
+        return rows
+
+    def close(self) -> None:
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class ParquetExporter:
+    """
+    Writes events and method calls of a contract to one Parquet file per event type and per method, in
+    the given directory. File names start with "events-<event name>" or "calls-<method name>", followed
+    by the first block they contain, so that the files of consecutive runs do not overwrite each other.
+
+    Rows are buffered until they cover at least row_group_blocks blocks, or until close.
+
+    The rows written are counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        contract_abi: List[Dict[str, Any]],
+        row_group_blocks: int = 10000,
+        compression: str = "zstd",
+    ):
+        """
+        :param directory: Directory in which to write the files. It is created if it does not exist.
+        :param contract_abi: ABI of the contract, which defines the columns of the files
+        :param row_group_blocks: Minimum number of blocks covered by a row group
+        :param compression: Parquet compression codec
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.row_group_blocks = row_group_blocks
+        self.compression = compression
+
+        # Events and calls only carry their name, so overloads share the columns of all of them
+        self.event_columns: Dict[str, List[Tuple[str, str]]] = {}
+        self.function_columns: Dict[str, List[Tuple[str, str]]] = {}
+        for item in contract_abi:
+            if not item.get("name"):
+                continue
+            if item.get("type") == "event":
+                columns_by_name, base_columns = self.event_columns, EVENT_COLUMNS
+            elif item.get("type") == "function":
+                columns_by_name, base_columns = self.function_columns, CALL_COLUMNS
+            else:
+                continue
+            columns_by_name[item["name"]] = merge_columns(
+                columns_by_name.get(item["name"], base_columns), abi_columns(item)
+            )
+        self._tables: Dict[str, _TableBuffer] = {}
+        self._range_start: Optional[int] = None
+
+        self.metrics = {
+            "rows_written": 0,
+            "row_groups": 0,
+            "skipped_rows": 0,
+        }
+
+    def _table(
+        self, kind: str, name: str, columns: List[Tuple[str, str]]
+    ) -> _TableBuffer:
+        key = f"{kind}-{name}"
+        if key not in self._tables:
+            self._tables[key] = _TableBuffer(
+                os.path.join(self.directory, key + "-{first_block:010d}.parquet"),
+                columns,
+                self.compression,
+            )
+        return self._tables[key]
+
+    def _start_range(self, block_number: int) -> None:
+        if self._range_start is None:
+            self._range_start = block_number
+
+    def add_events(self, events: List[Dict[str, Any]]) -> None:
+        """
+        Buffers decoded events, in the format returned by the moonworm event crawlers.
+        """
+        for event in events:
+            columns = self.event_columns.get(event["event"])
+            if columns is None:
+                self.metrics["skipped_rows"] += 1
+                continue
+            self._start_range(event["blockNumber"])
+            row = {
+                "block_number": event["blockNumber"],
+                "block_hash": column_value("string", event.get("blockHash")),
+                "transaction_hash": column_value(
+                    "string", event.get("transactionHash")
+                ),
+                "log_index": event.get("logIndex"),
+                "address": event.get("address"),
+                "event": event["event"],
+            }
+            for name, value in event.get("args", {}).items():
+                row[f"arg_{name}"] = value
+            self._table("events", event["event"], columns).append(row)
+
+    def add_calls(self, calls: List[ContractFunctionCall]) -> None:
+        """
+        Buffers method calls crawled by a FunctionCallCrawler.
+        """
+        for call in calls:
+            columns = self.function_columns.get(call.function_name)
+            if columns is None:
+                self.metrics["skipped_rows"] += 1
+                continue
+            self._start_range(call.block_number)
+            row = asdict(call)
+            row["block_hash"] = column_value("string", call.block_hash)
+            for name, value in row.pop("function_args").items():
+                row[f"arg_{name}"] = value
+            self._table("calls", call.function_name, columns).append(row)
+
+    def end_block_range(self, to_block: int) -> None:
+        """
+        Signals that all events and calls up to to_block were added. Writes a row group to every file
+        once the buffered rows cover at least row_group_blocks blocks.
+        """
+        if (
+            self._range_start is not None
+            and to_block - self._range_start + 1 >= self.row_group_blocks
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered rows of every file as a row group.
+        """
+        for table in self._tables.values():
+            rows = table.flush()
+            if rows > 0:
+                self.metrics["rows_written"] += rows
+                self.metrics["row_groups"] += 1
+        self._range_start = None
+
+    def close(self) -> None:
+        self.flush()
+        for table in self._tables.values():
+            table.close()
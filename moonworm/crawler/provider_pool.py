@@ -0,0 +1,371 @@
+"""
+A web3 provider which spreads JSON-RPC requests over several HTTP endpoints.
+
+[`PooledHTTPProvider`][moonworm.crawler.provider_pool.PooledHTTPProvider] measures the latency and
+error rate of every endpoint and sends each request to a healthy, fast and lightly loaded one. An
+endpoint which keeps failing is taken out of the pool for a while (its circuit breaker opens), and the
+request fails over to another endpoint. Slow `eth_getLogs` and `eth_getBlockBy*` requests are hedged:
+if the first endpoint has not answered after its usual response time, the same request is sent to a
+second endpoint and the first answer wins.
+
+Since it is a regular web3 provider, everything that takes a web3 client (e.g. `Web3StateProvider`,
+`EventScanner` and `find_deployment_block`) can use it as it is.
+
+Usage:
+```python
+from web3 import Web3
+from moonworm.crawler.provider_pool import PooledHTTPProvider
+
+web3 = Web3(PooledHTTPProvider(["http://node-1:8545", "http://node-2:8545", "http://node-3:8545"]))
+```
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from web3._utils.request import make_post_request
+from web3.providers.base import JSONBaseProvider
+from web3.types import RPCEndpoint, RPCResponse
+
+from .rate_limit import get_rate_limiter
+from .retry_policy import RATE_LIMITED, TRANSIENT, classify_error
+
+logger = logging.getLogger(__name__)
+
+# Requests which are hedged by default. They are read-only, so sending them twice is harmless.
+HEDGED_METHODS = frozenset(
+    ["eth_getLogs", "eth_getBlockByNumber", "eth_getBlockByHash"]
+)
+
+# JSON-RPC errors which say something about the endpoint rather than about the request
+UNHEALTHY_ERROR_KINDS = frozenset([RATE_LIMITED, TRANSIENT])
+
+
+@dataclass
+class EndpointHealth:
+    uri: str
+    # Smoothed response time and its mean deviation, in seconds (as for TCP retransmission timeouts)
+    latency: Optional[float] = None
+    latency_deviation: float = 0.0
+    # Smoothed fraction of failed requests
+    error_rate: float = 0.0
+    consecutive_failures: int = 0
+    # Monotonic time until which the circuit breaker is open
+    open_until: float = 0.0
+    # How long the circuit breaker opens for the next time
+    cooldown: float = 0.0
+    in_flight: int = 0
+    requests: int = 0
+    failures: int = 0
+
+    def score(self) -> float:
+        """
+        Expected cost of sending a request to this endpoint. Lower is better.
+        """
+        if self.latency is None:
+            # Endpoints we know nothing about yet are tried first, endpoints which never answered last
+            return float("inf") if self.failures else 0.0
+        return self.latency * (1 + self.in_flight) / max(1.0 - self.error_rate, 0.05)
+
+
+class PooledHTTPProvider(JSONBaseProvider):
+    """
+    Sends JSON-RPC requests over HTTP to the healthiest of several endpoints.
+
+    Endpoints are picked by "power of two choices": of two random endpoints whose circuit breakers are
+    closed, the one with the lower score (see EndpointHealth.score) gets the request. This spreads load
+    over all endpoints while favouring the fast and reliable ones.
+
+    The health of the endpoints and the activity of the pool are counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        endpoint_uris: Sequence[str],
+        request_kwargs: Optional[Dict[str, Any]] = None,
+        failure_threshold: int = 3,
+        cooldown: float = 5.0,
+        max_cooldown: float = 300.0,
+        hedged_methods: Iterable[str] = HEDGED_METHODS,
+        hedge_delay: Optional[float] = None,
+        min_hedge_delay: float = 0.25,
+        smoothing: float = 0.125,
+        max_workers: Optional[int] = None,
+    ):
+        """
+        :param endpoint_uris: HTTP(S) URIs of the JSON-RPC endpoints
+        :param request_kwargs: Keyword arguments for requests.post, as for web3.HTTPProvider
+        :param failure_threshold: Number of consecutive failures after which an endpoint's circuit
+        breaker opens
+        :param cooldown: Seconds for which a circuit breaker first opens. The time doubles every time it
+        opens again without a successful request in between.
+        :param max_cooldown: Maximum number of seconds for which a circuit breaker opens
+        :param hedged_methods: JSON-RPC methods which are hedged
+        :param hedge_delay: Seconds after which a hedged request is sent to a second endpoint. If None,
+        it is derived from the response times of the first endpoint.
+        :param min_hedge_delay: Minimum number of seconds before a hedged request is sent
+        :param smoothing: Weight of each new observation in the smoothed latencies and error rates
+        :param max_workers: Maximum number of requests in flight. Defaults to 8 per endpoint.
+        """
+        if not endpoint_uris:
+            raise ValueError("At least one endpoint URI is required")
+        self.endpoint_uris = list(endpoint_uris)
+        self.request_kwargs = request_kwargs or {}
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hedged_methods = frozenset(hedged_methods)
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.smoothing = smoothing
+
+        self.endpoints = [
+            EndpointHealth(uri, cooldown=cooldown) for uri in self.endpoint_uris
+        ]
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or 8 * len(self.endpoints),
+            thread_name_prefix="moonworm-provider-pool",
+        )
+        self.metrics = {
+            "requests": 0,
+            "hedged_requests": 0,
+            "hedges_won": 0,
+            "failovers": 0,
+            "circuit_breaker_openings": 0,
+        }
+        super().__init__()
+
+    def __str__(self) -> str:
+        return f"Pooled RPC connection {self.endpoint_uris}"
+
+    @property
+    def endpoint_uri(self) -> str:
+        """
+        Identifies the pool, e.g. to share head trackers between clients of the same pool.
+        """
+        return ",".join(self.endpoint_uris)
+
+    def get_request_kwargs(self) -> Dict[str, Any]:
+        return {"timeout": 10, **self.request_kwargs}
+
+    def endpoint_metrics(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Health of every endpoint, by URI.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return {
+                endpoint.uri: {
+                    "latency": endpoint.latency,
+                    "error_rate": endpoint.error_rate,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                    "in_flight": endpoint.in_flight,
+                    "circuit_open": endpoint.open_until > now,
+                }
+                for endpoint in self.endpoints
+            }
+
+    def _choose(self, exclude: Set[str]) -> Optional[EndpointHealth]:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.uri not in exclude]
+            if not candidates:
+                return None
+            available = [e for e in candidates if e.open_until <= now]
+            if not available:
+                # All circuit breakers are open: try the endpoint which would be back first
+                return min(candidates, key=lambda e: e.open_until)
+            if len(available) == 1:
+                return available[0]
+            first, second = random.sample(available, 2)
+            return first if first.score() <= second.score() else second
+
+    def _record(self, endpoint: EndpointHealth, duration: float, ok: bool) -> None:
+        alpha = self.smoothing
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.requests += 1
+            if ok:
+                if endpoint.latency is None:
+                    endpoint.latency = duration
+                    endpoint.latency_deviation = duration / 2
+                else:
+                    endpoint.latency_deviation = (
+                        1 - 2 * alpha
+                    ) * endpoint.latency_deviation + 2 * alpha * abs(
+                        duration - endpoint.latency
+                    )
+                    endpoint.latency = (1 - alpha) * endpoint.latency + alpha * duration
+                endpoint.error_rate *= 1 - alpha
+                endpoint.consecutive_failures = 0
+                endpoint.cooldown = self.cooldown
+                return
+
+            endpoint.failures += 1
+            endpoint.error_rate = (1 - alpha) * endpoint.error_rate + alpha
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.failure_threshold:
+                endpoint.open_until = time.monotonic() + endpoint.cooldown
+                logger.warning(
+                    "Taking %s out of the pool for %.1f seconds after %d failed requests",
+                    endpoint.uri,
+                    endpoint.cooldown,
+                    endpoint.consecutive_failures,
+                )
+                endpoint.cooldown = min(2 * endpoint.cooldown, self.max_cooldown)
+                # Reopens right away if the next request fails too
+                endpoint.consecutive_failures = self.failure_threshold - 1
+                self.metrics["circuit_breaker_openings"] += 1
+
+    @staticmethod
+    def _is_healthy(raw_response: bytes) -> bool:
+        try:
+            response = json.loads(raw_response)
+        except ValueError:
+            return False
+        items = response if isinstance(response, list) else [response]
+        for item in items:
+            if not isinstance(item, dict):
+                return False
+            error = item.get("error")
+            if error is not None:
+                if classify_error(ValueError(error)).kind in UNHEALTHY_ERROR_KINDS:
+                    return False
+        return True
+
+    def _attempt(
+        self,
+        endpoint: EndpointHealth,
+        request_data: bytes,
+        methods: Optional[List[str]],
+    ) -> Tuple[Optional[bytes], Optional[Exception]]:
+        limiter = get_rate_limiter(endpoint.uri)
+        if limiter is not None and methods is not None:
+            limiter.acquire(methods)
+        start = time.monotonic()
+        try:
+            raw_response = make_post_request(
+                endpoint.uri, request_data, **self.get_request_kwargs()
+            )
+        except Exception as e:
+            self._record(endpoint, time.monotonic() - start, False)
+            logger.debug("Request to %s failed: %s", endpoint.uri, e)
+            return None, e
+        healthy = self._is_healthy(raw_response)
+        self._record(endpoint, time.monotonic() - start, healthy)
+        if not healthy:
+            return raw_response, ValueError(
+                f"Unhealthy response from {endpoint.uri}: {raw_response[:200]!r}"
+            )
+        return raw_response, None
+
+    def _hedge_after(self, endpoint: EndpointHealth) -> float:
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        with self._lock:
+            if endpoint.latency is None:
+                return max(self.min_hedge_delay, 1.0)
+            return max(
+                self.min_hedge_delay,
+                endpoint.latency + 4 * endpoint.latency_deviation,
+            )
+
+    def make_raw_request(
+        self,
+        request_data: bytes,
+        hedged: bool = False,
+        methods: Optional[List[str]] = None,
+    ) -> bytes:
+        """
+        Sends an encoded JSON-RPC request (or batch) to the pool and returns the raw response.
+
+        The request fails over to other endpoints if an endpoint fails, or answers that it is rate
+        limited or unavailable. If hedged, the request is also sent to a second endpoint if the first one
+        is slow to answer. If the methods the request calls are given, every endpoint it is sent to
+        applies its rate limits (see moonworm.crawler.rate_limit) to it.
+        """
+        with self._lock:
+            self.metrics["requests"] += 1
+        tried: Set[str] = set()
+        pending: Dict[Future, EndpointHealth] = {}
+        first_future: Optional[Future] = None
+        hedge_available = hedged and len(self.endpoints) > 1
+        last_error: Optional[Exception] = None
+        unhealthy_response: Optional[bytes] = None
+
+        def _launch() -> Optional[Future]:
+            endpoint = self._choose(tried)
+            if endpoint is None:
+                return None
+            tried.add(endpoint.uri)
+            with self._lock:
+                endpoint.in_flight += 1
+            future = self._executor.submit(
+                self._attempt, endpoint, request_data, methods
+            )
+            pending[future] = endpoint
+            return future
+
+        first_future = _launch()
+        while pending:
+            timeout = None
+            if hedge_available:
+                timeout = self._hedge_after(pending[first_future])
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # The first endpoint is slow: send the same request to another one
+                hedge_available = False
+                if _launch() is not None:
+                    with self._lock:
+                        self.metrics["hedged_requests"] += 1
+                continue
+
+            for future in done:
+                pending.pop(future)
+                raw_response, error = future.result()
+                if error is None:
+                    if future is not first_future:
+                        with self._lock:
+                            self.metrics["hedges_won"] += 1
+                    return raw_response
+                last_error = error
+                if raw_response is not None:
+                    unhealthy_response = raw_response
+
+            if not pending:
+                hedge_available = False
+                if _launch() is not None:
+                    logger.debug("Failing over after: %s", last_error)
+                    with self._lock:
+                        self.metrics["failovers"] += 1
+
+        # Every endpoint failed. A JSON-RPC error is passed on to web3, which raises it.
+        if unhealthy_response is not None:
+            return unhealthy_response
+        assert last_error is not None
+        raise last_error
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        logger.debug(
+            "Making request to pool %s. Method: %s", self.endpoint_uris, method
+        )
+        request_data = self.encode_rpc_request(method, params)
+        raw_response = self.make_raw_request(
+            request_data, hedged=method in self.hedged_methods, methods=[method]
+        )
+        return self.decode_rpc_response(raw_response)
+
+
+def parse_endpoint_uris(uris: str) -> List[str]:
+    """
+    Splits a comma-separated list of endpoint URIs.
+    """
+    return [uri.strip() for uri in uris.split(",") if uri.strip()]
@@ -0,0 +1,253 @@
+"""
+Process-wide rate limits for JSON-RPC requests.
+
+Hosted JSON-RPC providers limit both the number of requests per second and the "compute units" spent
+per second, where every method has its own cost. Rate limits are set per endpoint URI with
+[`set_rate_limit`][moonworm.crawler.rate_limit.set_rate_limit], and every request to that endpoint
+made in the process counts against the same token buckets, however many crawlers share it:
+
+- requests of web3 clients with [`rate_limit_middleware`][moonworm.crawler.rate_limit.rate_limit_middleware]
+  (`moonworm.web3_util.connect` adds it to the clients it creates), or with
+  `async_rate_limit_middleware` for asynchronous clients (added by `moonworm.web3_util.connect_async`
+  and by `AsyncEventScanner`)
+- JSON-RPC batches sent by [`moonworm.crawler.batch_rpc`][moonworm.crawler.batch_rpc]
+- requests of a [`PooledHTTPProvider`][moonworm.crawler.provider_pool.PooledHTTPProvider] to each of
+  its endpoints
+
+A request waits exactly as long as needed to stay within the limits, instead of sleeping for a fixed
+interval.
+
+Usage:
+```python
+from moonworm.crawler.rate_limit import set_rate_limit
+from moonworm.web3_util import connect
+
+set_rate_limit("https://eth-mainnet.example.com/v2/KEY", requests_per_second=25, compute_units_per_second=330)
+web3 = connect("https://eth-mainnet.example.com/v2/KEY")
+```
+"""
+
+import asyncio
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Mapping, Optional
+
+from web3 import Web3
+from web3.types import RPCEndpoint, RPCResponse
+
+from .head_tracker import endpoint_uri
+
+# Compute units per method, as charged by common hosted providers
+COMPUTE_UNITS: Dict[str, float] = {
+    "eth_chainId": 0,
+    "net_version": 0,
+    "eth_blockNumber": 10,
+    "eth_subscribe": 10,
+    "eth_getTransactionReceipt": 15,
+    "eth_getBlockByNumber": 16,
+    "eth_getBlockByHash": 16,
+    "eth_getTransactionByHash": 17,
+    "eth_getStorageAt": 17,
+    "eth_getBalance": 19,
+    "eth_gasPrice": 19,
+    "eth_call": 26,
+    "eth_getCode": 26,
+    "eth_getTransactionCount": 26,
+    "eth_getLogs": 75,
+    "eth_estimateGas": 87,
+    "eth_getBlockReceipts": 500,
+}
+
+# Compute units of methods which are not in COMPUTE_UNITS
+DEFAULT_COMPUTE_UNITS = 20.0
+
+_limiters: Dict[str, "RateLimiter"] = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Allows `rate` units per second on average, and bursts of up to `capacity` units.
+
+    Units are reserved in the order in which they are requested. A reservation which exceeds the units
+    available puts the bucket in debt, so the next reservations wait until the debt is paid off.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, units: float = 1.0) -> float:
+        """
+        Takes the units from the bucket and returns the number of seconds to wait before using them.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= units
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+
+class RateLimiter:
+    """
+    Rate limits for one endpoint: requests per second, compute units per second and requests per second
+    for individual methods. The requests it let through are counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        requests_per_second: Optional[float] = None,
+        compute_units_per_second: Optional[float] = None,
+        method_requests_per_second: Optional[Mapping[str, float]] = None,
+        compute_units: Optional[Mapping[str, float]] = None,
+        burst_seconds: float = 1.0,
+    ):
+        """
+        :param requests_per_second: Maximum number of requests per second, if any
+        :param compute_units_per_second: Maximum number of compute units per second, if any
+        :param method_requests_per_second: Maximum number of requests per second for specific methods
+        :param compute_units: Compute units per method, which override those in COMPUTE_UNITS
+        :param burst_seconds: Size of the bursts allowed after idle periods, in seconds of budget
+        """
+        self.requests = (
+            TokenBucket(requests_per_second, requests_per_second * burst_seconds)
+            if requests_per_second
+            else None
+        )
+        self.compute_units = (
+            TokenBucket(
+                compute_units_per_second, compute_units_per_second * burst_seconds
+            )
+            if compute_units_per_second
+            else None
+        )
+        self.methods = {
+            method: TokenBucket(rate, rate * burst_seconds)
+            for method, rate in (method_requests_per_second or {}).items()
+        }
+        self.costs = {**COMPUTE_UNITS, **(compute_units or {})}
+        self._lock = threading.Lock()
+        self.metrics = {
+            "requests": 0,
+            "compute_units": 0.0,
+            "throttled_requests": 0,
+            "seconds_throttled": 0.0,
+        }
+
+    def cost(self, method: str) -> float:
+        return self.costs.get(method, DEFAULT_COMPUTE_UNITS)
+
+    def reserve(self, methods: Iterable[str]) -> float:
+        """
+        Reserves the budget for a request, or a JSON-RPC batch, which calls the given methods. Returns
+        the number of seconds to wait before sending it.
+        """
+        methods = list(methods)
+        delays = [0.0]
+        if self.requests is not None:
+            delays.append(self.requests.reserve(len(methods)))
+        cost = sum(self.cost(method) for method in methods)
+        if self.compute_units is not None and cost > 0:
+            delays.append(self.compute_units.reserve(cost))
+        for method in set(methods):
+            bucket = self.methods.get(method)
+            if bucket is not None:
+                delays.append(bucket.reserve(methods.count(method)))
+        delay = max(delays)
+
+        with self._lock:
+            self.metrics["requests"] += len(methods)
+            self.metrics["compute_units"] += cost
+            if delay > 0:
+                self.metrics["throttled_requests"] += len(methods)
+                self.metrics["seconds_throttled"] += delay
+        return delay
+
+    def acquire(self, methods: Iterable[str]) -> float:
+        """
+        Waits until a request which calls the given methods can be sent. Returns the number of seconds
+        waited.
+        """
+        delay = self.reserve(methods)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    async def async_acquire(self, methods: Iterable[str]) -> float:
+        """
+        Asynchronous version of acquire, which waits without blocking the event loop.
+        """
+        delay = self.reserve(methods)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+
+def set_rate_limit(endpoint_uri: str, **kwargs) -> RateLimiter:
+    """
+    Sets the rate limits for all requests to the given endpoint made in this process. Takes the
+    arguments of RateLimiter, and replaces the limits previously set for the endpoint, if any.
+    """
+    limiter = RateLimiter(**kwargs)
+    with _limiters_lock:
+        _limiters[endpoint_uri] = limiter
+    return limiter
+
+
+def remove_rate_limit(endpoint_uri: str) -> None:
+    with _limiters_lock:
+        _limiters.pop(endpoint_uri, None)
+
+
+def get_rate_limiter(endpoint_uri: Optional[str]) -> Optional[RateLimiter]:
+    """
+    Returns the rate limiter for the given endpoint, or None if its requests are not rate limited.
+    """
+    if endpoint_uri is None:
+        return None
+    with _limiters_lock:
+        return _limiters.get(endpoint_uri)
+
+
+def rate_limit_middleware(
+    make_request: Callable[[RPCEndpoint, Any], Any], web3: Web3
+) -> Callable[[RPCEndpoint, Any], RPCResponse]:
+    """
+    web3 middleware which holds requests back until the rate limits of the endpoint allow them.
+
+    The limits are looked up for every request, so they can be set after the middleware was added.
+    """
+
+    def middleware(method: RPCEndpoint, params: Any) -> RPCResponse:
+        limiter = get_rate_limiter(endpoint_uri(web3))
+        if limiter is not None:
+            limiter.acquire([method])
+        return make_request(method, params)
+
+    return middleware
+
+
+async def async_rate_limit_middleware(
+    make_request: Callable[[RPCEndpoint, Any], Any], web3: Web3
+) -> Callable[[RPCEndpoint, Any], Any]:
+    """
+    Asynchronous version of rate_limit_middleware, for web3 clients with an asynchronous provider.
+    """
+
+    async def middleware(method: RPCEndpoint, params: Any) -> RPCResponse:
+        limiter = get_rate_limiter(endpoint_uri(web3))
+        if limiter is not None:
+            await limiter.async_acquire([method])
+        return await make_request(method, params)
+
+    return middleware
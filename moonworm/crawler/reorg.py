@@ -0,0 +1,250 @@
+"""
+Detection of chain reorganizations.
+
+Crawlers which follow the head of the chain emit events from blocks which may still be replaced by a
+reorganization. A [`ReorgDetector`][moonworm.crawler.reorg.ReorgDetector] records the hash and
+parentHash of every block a crawler emitted data for, as long as the block is within `max_depth`
+blocks of the last one. When the crawler moves on, the detector checks that the parentHash of the
+next block is the hash it recorded for the previous one. If it is not, the detector walks back over
+the recorded blocks to the last one which is still on chain, and reports the first block whose data
+has to be retracted.
+
+Usage:
+```python
+detector = ReorgDetector(web3, max_depth=64)
+fork_block = detector.advance(from_block, to_block)
+if fork_block is not None:
+    # Data from fork_block onwards is no longer on chain
+    state.delete_data(fork_block)
+```
+"""
+
+import logging
+import time
+from typing import Any, Dict, Iterable, Optional, Union
+
+from web3 import Web3
+
+from .batch_rpc import DEFAULT_BATCH_SIZE, get_block_headers
+
+logger = logging.getLogger(__name__)
+
+# How many times we fetch the headers of a block range again if the chain changes while we fetch them
+MAX_HEADER_FETCH_ATTEMPTS = 5
+
+
+class HeadersUnavailable(Exception):
+    """
+    Raised by ReorgDetector.advance when the headers of a block range are still missing, or do not form
+    a chain, after MAX_HEADER_FETCH_ATTEMPTS attempts. This happens when an endpoint lags behind the
+    head reported by another one, e.g. behind a pool of endpoints. Callers retry on the next head.
+    """
+
+
+def _hash_hex(block_hash: Union[str, bytes]) -> str:
+    # Providers return hashes as bytes (web3) or as hex strings (e.g. Moonstream's database)
+    if isinstance(block_hash, str):
+        return Web3.toHex(hexstr=block_hash).lower()
+    return Web3.toHex(block_hash)
+
+
+class ReorgDetector:
+    """
+    Records the hash and parentHash of the last max_depth blocks a crawler advanced over, and finds the
+    first block replaced by a chain reorganization.
+
+    Reorganizations deeper than max_depth blocks cannot be detected exactly. They are reported from
+    the oldest block the detector still has a record of.
+
+    Detected reorganizations are counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        web3: Web3,
+        max_depth: int = 64,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        retry_seconds: float = 0.5,
+    ):
+        """
+        :param web3: Client for the chain to follow
+        :param max_depth: Number of blocks (counted back from the last one) we keep records of
+        :param batch_size: Number of headers per JSON-RPC batch
+        :param retry_seconds: Delay before fetching headers again when the chain changed while we were
+        fetching them
+        """
+        if max_depth < 1:
+            raise ValueError(f"max_depth must be at least 1, not {max_depth}")
+        self.web3 = web3
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.retry_seconds = retry_seconds
+
+        # block number -> {"number", "hash", "parentHash", "timestamp"}
+        self._headers: Dict[int, Dict[str, Any]] = {}
+
+        self.metrics = {
+            "headers_fetched": 0,
+            "reorgs": 0,
+            "max_reorg_depth": 0,
+            "event_hash_mismatches": 0,
+        }
+
+    @property
+    def last_block(self) -> Optional[int]:
+        """
+        The last block the detector has a record of.
+        """
+        return max(self._headers) if self._headers else None
+
+    def get_hash(self, block_number: int) -> Optional[str]:
+        """
+        Returns the recorded hash of the given block, or None if it has no record of it.
+        """
+        header = self._headers.get(block_number)
+        return None if header is None else header["hash"]
+
+    def get_timestamps(self) -> Dict[int, int]:
+        """
+        Timestamps of the recorded blocks.
+        """
+        return {
+            block_number: header["timestamp"]
+            for block_number, header in self._headers.items()
+        }
+
+    def forget(self, from_block: int) -> None:
+        """
+        Drops the records of the given block and of all blocks after it.
+        """
+        self._headers = {
+            block_number: header
+            for block_number, header in self._headers.items()
+            if block_number < from_block
+        }
+
+    def forget_before(self, block_number: int) -> None:
+        """
+        Drops the records of all blocks before the given one.
+        """
+        for n in [n for n in self._headers if n < block_number]:
+            del self._headers[n]
+
+    def _fetch_headers(self, block_numbers: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        headers = get_block_headers(self.web3, block_numbers, self.batch_size)
+        self.metrics["headers_fetched"] += len(headers)
+        return headers
+
+    def _find_fork(self, block_number: int) -> int:
+        """
+        Walks back from the given recorded block, whose hash changed, to the last recorded block which
+        is still on chain. Returns the block after it.
+        """
+        recorded = sorted(n for n in self._headers if n <= block_number)
+        headers = self._fetch_headers(recorded)
+        fork_block = recorded[0]
+        for n in reversed(recorded):
+            header = headers.get(n)
+            if header is not None and header["hash"] == self._headers[n]["hash"]:
+                fork_block = n + 1
+                break
+        else:
+            logger.warning(
+                "Chain reorganization is deeper than the %d blocks we keep records of, "
+                "retracting from block %d",
+                self.max_depth,
+                fork_block,
+            )
+
+        depth = block_number - fork_block + 1
+        logger.warning(
+            "Chain reorganization detected: blocks %d - %d (%d) were replaced",
+            fork_block,
+            block_number,
+            depth,
+        )
+        self.metrics["reorgs"] += 1
+        self.metrics["max_reorg_depth"] = max(self.metrics["max_reorg_depth"], depth)
+        self.forget(fork_block)
+        return fork_block
+
+    def advance(self, from_block: int, to_block: int) -> Optional[int]:
+        """
+        Records the headers of blocks from_block to to_block (inclusive), after checking that they
+        extend the blocks recorded so far. Only the last max_depth blocks of the range are fetched.
+
+        If from_block > to_block, only checks that the last recorded block is still on chain.
+
+        :return: None if the chain was not reorganized. Otherwise, the first block whose recorded data
+        is no longer on chain. Nothing is recorded in that case: the caller should retract its data from
+        that block onwards and advance again from it.
+        :raises HeadersUnavailable: If the headers of the range could not be fetched. Nothing is
+        recorded in that case either.
+        """
+        previous = from_block - 1
+        if previous not in self._headers:
+            previous = None
+        block_numbers = list(
+            range(max(from_block, to_block - self.max_depth + 1), to_block + 1)
+        )
+
+        for attempt in range(MAX_HEADER_FETCH_ATTEMPTS):
+            headers = self._fetch_headers(
+                block_numbers + ([previous] if previous is not None else [])
+            )
+            if previous is not None:
+                previous_header = headers.get(previous)
+                if (
+                    previous_header is None
+                    or previous_header["hash"] != self._headers[previous]["hash"]
+                ):
+                    return self._find_fork(previous)
+
+            # Headers of the range must form a chain. If they do not, a reorganization happened while
+            # we were fetching them.
+            consistent = True
+            for n in block_numbers:
+                header = headers.get(n)
+                parent = headers.get(n - 1)
+                if header is None or (
+                    parent is not None and header["parentHash"] != parent["hash"]
+                ):
+                    consistent = False
+                    break
+            if consistent:
+                break
+            logger.debug(
+                "Chain changed while fetching headers of blocks %d - %d (attempt %d)",
+                from_block,
+                to_block,
+                attempt,
+            )
+            time.sleep(self.retry_seconds)
+        else:
+            raise HeadersUnavailable(
+                f"Headers of blocks {from_block} - {to_block} are missing or kept changing"
+            )
+
+        for n in block_numbers:
+            self._headers[n] = headers[n]
+        self.forget_before(to_block - self.max_depth + 1)
+        return None
+
+    def find_mismatch(self, events: Iterable[Dict[str, Any]]) -> Optional[int]:
+        """
+        Returns the first block with an event whose blockHash is not the recorded hash of its block, or
+        None if all events match. Such events were fetched from a different branch of the chain than the
+        recorded headers.
+        """
+        mismatch: Optional[int] = None
+        for event in events:
+            block_number = event["blockNumber"]
+            recorded_hash = self.get_hash(block_number)
+            if recorded_hash is None:
+                continue
+            if _hash_hex(event["blockHash"]) != recorded_hash:
+                if mismatch is None or block_number < mismatch:
+                    mismatch = block_number
+        if mismatch is not None:
+            self.metrics["event_hash_mismatches"] += 1
+        return mismatch
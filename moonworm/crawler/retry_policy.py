@@ -0,0 +1,300 @@
+"""
+Decides how to retry failed JSON-RPC requests for a block range, based on the error the provider
+returned.
+
+Hosted JSON-RPC providers return structured errors when they refuse an `eth_getLogs` request. For
+example, they report that a query would return too many results and suggest a block range which would
+work, or they rate limit us with HTTP 429 and a Retry-After header. `classify_error` recognizes these
+errors, and `RetryPolicy` turns them into a [`RetryAction`][moonworm.crawler.retry_policy.RetryAction]
+for the fetch loops in [`moonworm.crawler.log_scanner`][moonworm.crawler.log_scanner] and
+[`moonworm.crawler.async_log_scanner`][moonworm.crawler.async_log_scanner].
+"""
+
+import asyncio
+import datetime
+import email.utils
+import logging
+import random
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+TOO_MANY_RESULTS = "too_many_results"
+RATE_LIMITED = "rate_limited"
+TIMEOUT = "timeout"
+TRANSIENT = "transient"
+UNKNOWN = "unknown"
+
+ERROR_KINDS = [TOO_MANY_RESULTS, RATE_LIMITED, TIMEOUT, TRANSIENT, UNKNOWN]
+
+TOO_MANY_RESULTS_PATTERN = re.compile(
+    r"more than \d+ results|response size (is larger|exceeded|should not)|query exceeds max results|"
+    r"(block range|range) (is )?too (large|wide)|too many (results|logs|blocks)|"
+    r"exceed(s|ed)? (maximum|max) block range",
+    re.IGNORECASE,
+)
+RATE_LIMITED_PATTERN = re.compile(
+    r"rate limit|too many requests|request count exceeded|compute units",
+    re.IGNORECASE,
+)
+TIMEOUT_PATTERN = re.compile(
+    r"context cancel+ed|deadline exceeded|timed out|timeout",
+    re.IGNORECASE,
+)
+TRANSIENT_PATTERN = re.compile(
+    r"connection (reset|refused|aborted)|bad gateway|service unavailable|header not found",
+    re.IGNORECASE,
+)
+# Providers suggest a block range which would work as "[0x1b4, 0x1c2]" in the error message
+HINTED_RANGE_PATTERN = re.compile(r"\[\s*(0x[0-9a-fA-F]+)\s*,\s*(0x[0-9a-fA-F]+)\s*\]")
+
+
+@dataclass
+class ClassifiedError:
+    kind: str
+    # Block range (inclusive) suggested by the provider, for TOO_MANY_RESULTS errors
+    hinted_range: Optional[Tuple[int, int]] = None
+    # Seconds the provider asked us to wait, for RATE_LIMITED errors
+    retry_after: Optional[float] = None
+
+
+@dataclass
+class RetryAction:
+    kind: str
+    # Seconds to wait before making the next request
+    delay: float = 0.0
+    # Requests which replace the failed one, as (from_block, to_block, addresses).
+    # If empty, the failed request is retried as it is.
+    requests: List[Tuple[int, int, Optional[List[str]]]] = field(default_factory=list)
+    # True if the requests cover the same block range for different addresses, in which case their
+    # results have to be merged back into log order
+    split_addresses: bool = False
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max((retry_at - now).total_seconds(), 0.0)
+
+
+def _error_message_and_data(error: Exception) -> Tuple[str, Any]:
+    # web3 raises JSON-RPC errors as ValueError(error_dict)
+    if error.args and isinstance(error.args[0], dict):
+        rpc_error = error.args[0]
+        return str(rpc_error.get("message", "")), rpc_error.get("data")
+    return str(error), None
+
+
+def _hinted_range(message: str, data: Any) -> Optional[Tuple[int, int]]:
+    # Infura puts the suggested range into the "data" field of the error
+    if isinstance(data, dict) and "from" in data and "to" in data:
+        try:
+            return int(data["from"], 16), int(data["to"], 16)
+        except (TypeError, ValueError):
+            pass
+    match = HINTED_RANGE_PATTERN.search(message)
+    if match is not None:
+        return int(match.group(1), 16), int(match.group(2), 16)
+    return None
+
+
+def classify_error(error: Exception) -> ClassifiedError:
+    """
+    Classifies an exception raised by a JSON-RPC request into one of the ERROR_KINDS.
+    """
+    # HTTP errors: requests.HTTPError for web3.HTTPProvider, aiohttp.ClientResponseError for
+    # web3.AsyncHTTPProvider
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None) or getattr(error, "status", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None)
+    if status == 429:
+        retry_after = None
+        if headers is not None:
+            retry_after = _parse_retry_after(headers.get("Retry-After"))
+        return ClassifiedError(RATE_LIMITED, retry_after=retry_after)
+    if status in (502, 503, 504):
+        return ClassifiedError(TRANSIENT)
+
+    message, data = _error_message_and_data(error)
+    if TOO_MANY_RESULTS_PATTERN.search(message):
+        return ClassifiedError(
+            TOO_MANY_RESULTS, hinted_range=_hinted_range(message, data)
+        )
+    if RATE_LIMITED_PATTERN.search(message):
+        return ClassifiedError(RATE_LIMITED)
+    if isinstance(
+        error, (requests.exceptions.Timeout, asyncio.TimeoutError)
+    ) or TIMEOUT_PATTERN.search(message):
+        return ClassifiedError(TIMEOUT)
+    if isinstance(error, OSError) or TRANSIENT_PATTERN.search(message):
+        # Includes requests.ConnectionError and aiohttp.ClientConnectionError
+        return ClassifiedError(TRANSIENT)
+    return ClassifiedError(UNKNOWN)
+
+
+class RetryPolicy:
+    """
+    Decides how to retry a failed request for a block range:
+
+    - Too many results: request the block range suggested by the provider, followed by the rest of the
+    range. Without a suggestion, bisect the range. A single block which still returns too many results
+    is requested separately for two halves of the address list.
+    - Rate limited: retry after the delay given by the Retry-After header, or after a jittered
+    exponential backoff, whichever is longer.
+    - Transient transport errors: retry immediately, then back off exponentially if the error persists.
+    - Timeouts (e.g. Go Ethereum's "context cancelled") and unknown errors: bisect the range. A range
+    that cannot be split further is retried after a delay.
+
+    The policy is thread-safe. Its decisions are counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 30,
+        delay: float = 3.0,
+        max_delay: float = 60.0,
+        jitter: float = 0.5,
+        min_range: int = 1,
+        immediate_retries: int = 1,
+    ):
+        """
+        :param max_retries: How many failed requests we accept in total for a block range
+        :param delay: Base delay between retries, in seconds
+        :param max_delay: Maximum delay between retries, in seconds
+        :param jitter: Fraction of each backoff delay which is randomized
+        :param min_range: Number of blocks below which we do not bisect a failing range
+        :param immediate_retries: How many times a transient error is retried without waiting
+        """
+        self.max_retries = max_retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.min_range = min_range
+        self.immediate_retries = immediate_retries
+
+        self._lock = threading.Lock()
+        self.metrics: Dict[str, int] = {kind: 0 for kind in ERROR_KINDS}
+        self.metrics.update(
+            {"hinted_splits": 0, "bisections": 0, "address_splits": 0, "retries": 0}
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Jittered exponential backoff delay for the given (0-based) attempt.
+        """
+        delay = min(self.max_delay, self.delay * 2**attempt)
+        return delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+
+    def _count(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self.metrics[key] += 1
+
+    def _split(
+        self,
+        kind: str,
+        from_block: int,
+        to_block: int,
+        addresses: Optional[List[str]],
+        attempt: int,
+    ) -> RetryAction:
+        if to_block - from_block + 1 > self.min_range:
+            middle = from_block + (to_block - from_block) // 2
+            self._count(kind, "bisections")
+            return RetryAction(
+                kind,
+                requests=[
+                    (from_block, middle, addresses),
+                    (middle + 1, to_block, addresses),
+                ],
+            )
+        if kind == TOO_MANY_RESULTS and addresses is not None and len(addresses) > 1:
+            middle = len(addresses) // 2
+            self._count(kind, "address_splits")
+            return RetryAction(
+                kind,
+                requests=[
+                    (from_block, to_block, addresses[:middle]),
+                    (from_block, to_block, addresses[middle:]),
+                ],
+                split_addresses=True,
+            )
+        self._count(kind, "retries")
+        if kind == UNKNOWN:
+            return RetryAction(kind, delay=self.delay)
+        return RetryAction(kind, delay=self.backoff(attempt))
+
+    def on_error(
+        self,
+        error: Exception,
+        from_block: int,
+        to_block: int,
+        addresses: Optional[List[str]] = None,
+        attempt: int = 0,
+    ) -> RetryAction:
+        """
+        Decides what to do after a request for blocks from_block to to_block (inclusive) failed with
+        the given error. attempt is the number of times the same request failed before.
+        """
+        classified = classify_error(error)
+        kind = classified.kind
+
+        if kind == RATE_LIMITED:
+            delay = self.backoff(attempt)
+            if classified.retry_after is not None:
+                delay = max(delay, classified.retry_after)
+            self._count(kind, "retries")
+            action = RetryAction(kind, delay=delay)
+        elif kind == TRANSIENT:
+            delay = 0.0
+            if attempt >= self.immediate_retries:
+                delay = self.backoff(attempt - self.immediate_retries)
+            self._count(kind, "retries")
+            action = RetryAction(kind, delay=delay)
+        elif (
+            kind == TOO_MANY_RESULTS
+            and classified.hinted_range is not None
+            and from_block <= classified.hinted_range[1] < to_block
+        ):
+            hinted_to_block = classified.hinted_range[1]
+            self._count(kind, "hinted_splits")
+            action = RetryAction(
+                kind,
+                requests=[
+                    (from_block, hinted_to_block, addresses),
+                    (hinted_to_block + 1, to_block, addresses),
+                ],
+            )
+        else:
+            action = self._split(kind, from_block, to_block, addresses, attempt)
+
+        logger.warning(
+            "Request for block range %d - %d (%d) failed with %s (%s): %s",
+            from_block,
+            to_block,
+            to_block - from_block + 1,
+            error,
+            kind,
+            (
+                f"splitting it into {[(start, end) for start, end, _ in action.requests]}"
+                if action.requests
+                else f"retrying in {action.delay:.2f} seconds"
+            ),
+        )
+        return action
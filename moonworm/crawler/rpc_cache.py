@@ -0,0 +1,522 @@
+"""
+Persistent cache of JSON-RPC responses about finalized blocks.
+
+Responses to requests about blocks which are at least `finality_depth` blocks below the head of the
+chain (logs, blocks, receipts, transactions, and calls or state lookups at a fixed block) never change.
+[`ResponseCache`][moonworm.crawler.rpc_cache.ResponseCache] stores them in an SQLite database, keyed by
+the chain id and a normalised form of the request, so that reruns of a crawler (e.g. after fixing an
+ABI, or with a fresh state) are served from disk instead of the JSON-RPC endpoint. The least recently
+used responses are evicted when the cache grows beyond its size budget.
+
+With a `grid`, eth_getLogs responses are stored per grid cell (grid-aligned ranges of `grid` blocks),
+so that a request over any range made of whole cells can be answered from the cache, whatever the
+chunk sizes of the run which filled it. Crawlers align their chunks to the grid with their
+`chunk_grid` argument (see `EventScanner`).
+
+Usage:
+```python
+from moonworm.crawler.rpc_cache import ResponseCache, add_response_cache
+from moonworm.web3_util import connect
+
+web3 = connect("https://eth-mainnet.example.com/v2/KEY")
+add_response_cache(web3, ResponseCache("rpc_cache.sqlite", grid=1000))
+```
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from web3 import Web3
+from web3.types import RPCEndpoint, RPCResponse
+
+logger = logging.getLogger(__name__)
+
+# Request handlers of the web3 clients with a response cache, used for JSON-RPC batches, which do not go
+# through the middlewares of the client (see moonworm.crawler.batch_rpc)
+_batch_handlers: "weakref.WeakKeyDictionary[Web3, _CachingRequestHandler]" = (
+    weakref.WeakKeyDictionary()
+)
+
+# Path of the cache used by the moonworm CLI by default
+DEFAULT_CACHE_PATH = os.environ.get(
+    "MOONWORM_RPC_CACHE",
+    os.path.join(os.path.expanduser("~"), ".moonworm", "rpc_cache.sqlite"),
+)
+
+# Methods whose responses are cached, and the position of their block parameter, if any
+BLOCK_PARAMETER_METHODS = {
+    "eth_getBlockByNumber": 0,
+    "eth_getBlockReceipts": 0,
+    "eth_call": 1,
+    "eth_getCode": 1,
+    "eth_getBalance": 1,
+    "eth_getStorageAt": 2,
+    "eth_getTransactionCount": 1,
+}
+# Methods whose results say in which block the object they describe was included
+RESULT_BLOCK_METHODS = frozenset(
+    [
+        "eth_getBlockByHash",
+        "eth_getTransactionByHash",
+        "eth_getTransactionReceipt",
+    ]
+)
+
+
+def _block_number(value: Any) -> Optional[int]:
+    """
+    Parses a block number given as a JSON-RPC quantity. Returns None for tags such as "latest".
+    """
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.startswith("0x"):
+        return int(value, 16)
+    return None
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return value.lower()
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    return value
+
+
+def _log_filter(params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The part of an eth_getLogs filter which selects logs within a block range.
+    """
+    addresses = params.get("address")
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    return {
+        "address": sorted(_normalize(addresses)) if addresses else None,
+        "topics": _normalize(params.get("topics")) or None,
+    }
+
+
+class ResponseCache:
+    """
+    SQLite store of JSON-RPC results, with a size budget in bytes.
+
+    The cache is thread-safe, and can be shared by several web3 clients (of any chains). Its activity
+    is counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        max_bytes: int = 1 << 30,
+        finality_depth: int = 64,
+        grid: Optional[int] = None,
+        head_refresh_seconds: float = 5.0,
+    ):
+        """
+        :param path: Path to the SQLite database. It is created if it does not exist.
+        :param max_bytes: Size budget for the stored results, in bytes
+        :param finality_depth: Number of confirmations after which a block is considered final
+        :param grid: If set, eth_getLogs results are stored per aligned range of this many blocks
+        :param head_refresh_seconds: Minimum number of seconds between two eth_blockNumber requests made to
+        check whether a block is final
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.finality_depth = finality_depth
+        self.grid = grid
+        self.head_refresh_seconds = head_refresh_seconds
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """)
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._connection.commit()
+        self._size = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "stored": 0,
+            "evicted": 0,
+            "bytes_stored": self._size,
+        }
+
+    @staticmethod
+    def key(chain_id: int, method: str, params: Any) -> str:
+        """
+        Key of a request in the cache.
+        """
+        request = json.dumps(
+            [chain_id, method, _normalize(params)],
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, Any]:
+        """
+        Returns the cached results for the given keys, if they are in the cache.
+        """
+        if not keys:
+            return {}
+        with self._lock:
+            rows = []
+            # SQLite limits the number of parameters of a statement
+            for i in range(0, len(keys), 500):
+                part = keys[i : i + 500]
+                rows.extend(
+                    self._connection.execute(
+                        f"SELECT key, result FROM responses WHERE key IN ({','.join('?' * len(part))})",
+                        part,
+                    ).fetchall()
+                )
+            if rows:
+                self._connection.executemany(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    [(time.time(), key) for key, _ in rows],
+                )
+                self._connection.commit()
+            self.metrics["hits"] += len(rows)
+            self.metrics["misses"] += len(keys) - len(rows)
+        return {key: json.loads(result) for key, result in rows}
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """
+        Returns (True, result) if the result for the key is cached, and (False, None) otherwise.
+        """
+        results = self.get_many([key])
+        if key in results:
+            return True, results[key]
+        return False, None
+
+    def put_many(self, items: Dict[str, Any]) -> None:
+        """
+        Stores results by key, then evicts the least recently used results beyond the size budget.
+        """
+        if not items:
+            return
+        rows = [
+            (key, encoded, len(encoded), time.time())
+            for key, encoded in (
+                (key, json.dumps(result, separators=(",", ":")))
+                for key, result in items.items()
+            )
+        ]
+        with self._lock:
+            existing = self._connection.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM responses WHERE key IN ({','.join('?' * len(rows))})",
+                [row[0] for row in rows],
+            ).fetchone()[0]
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO responses (key, result, size, last_used) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self._size += sum(row[2] for row in rows) - existing
+            self.metrics["stored"] += len(rows)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._connection.commit()
+            self.metrics["bytes_stored"] = self._size
+
+    def put(self, key: str, result: Any) -> None:
+        self.put_many({key: result})
+
+    def _evict(self) -> None:
+        # Evicts down to 90% of the budget, so that eviction does not run after every insertion
+        target = int(self.max_bytes * 0.9)
+        while self._size > target:
+            rows = self._connection.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 100"
+            ).fetchall()
+            if not rows:
+                self._size = 0
+                return
+            evicted = []
+            for key, size in rows:
+                if self._size <= target:
+                    break
+                evicted.append((key,))
+                self._size -= size
+            self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            self.metrics["evicted"] += len(evicted)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class _CachingRequestHandler:
+    """
+    Serves the requests of one web3 client from a ResponseCache, as far as possible.
+    """
+
+    def __init__(
+        self, cache: ResponseCache, make_request: Callable[[RPCEndpoint, Any], Any]
+    ):
+        self.cache = cache
+        self.make_request = make_request
+        self._chain_id: Optional[int] = None
+        self._head: Optional[int] = None
+        self._head_checked_at = 0.0
+
+    def chain_id(self) -> int:
+        if self._chain_id is None:
+            response = self.make_request(RPCEndpoint("eth_chainId"), [])
+            self._chain_id = int(response["result"], 16)
+        return self._chain_id
+
+    def is_final(self, block_number: Optional[int]) -> bool:
+        if block_number is None:
+            return False
+        depth = self.cache.finality_depth
+        if self._head is not None and block_number <= self._head - depth:
+            return True
+        # The head only moves forward, so it is only worth checking again after a while
+        if time.monotonic() - self._head_checked_at < self.cache.head_refresh_seconds:
+            return False
+        self._head_checked_at = time.monotonic()
+        response = self.make_request(RPCEndpoint("eth_blockNumber"), [])
+        if "result" not in response:
+            return False
+        self._head = int(response["result"], 16)
+        return block_number <= self._head - depth
+
+    def _cached_request(
+        self, method: RPCEndpoint, params: Any, final_block: Optional[int]
+    ) -> RPCResponse:
+        """
+        Serves requests whose result is final if final_block is, or if the result says so (when
+        final_block is None).
+        """
+        if final_block is not None and not self.is_final(final_block):
+            return self.make_request(method, params)
+        key = ResponseCache.key(self.chain_id(), method, params)
+        found, result = self.cache.get(key)
+        if found:
+            return {"jsonrpc": "2.0", "id": 0, "result": result}
+
+        response = self.make_request(method, params)
+        result = response.get("result")
+        if "error" in response or result is None:
+            return response
+        if final_block is None:
+            final = isinstance(result, dict) and self.is_final(
+                _block_number(result.get("blockNumber", result.get("number")))
+            )
+        else:
+            final = True
+        if final:
+            self.cache.put(key, result)
+        return response
+
+    def _final_block(self, method: str, params: Any) -> Tuple[bool, Optional[int]]:
+        """
+        Returns whether responses to the request can be cached, and the block they are final with (None
+        if the response says which block it is about).
+        """
+        if method in RESULT_BLOCK_METHODS:
+            return True, None
+        position = BLOCK_PARAMETER_METHODS.get(method)
+        if position is None or len(params) <= position:
+            return False, None
+        block_number = _block_number(params[position])
+        return block_number is not None, block_number
+
+    def batch(
+        self,
+        calls: Sequence[Tuple[str, Any]],
+        send_batch: Callable[[Sequence[Tuple[str, Any]]], List[Any]],
+    ) -> List[Any]:
+        """
+        Serves the (method, params) calls of a JSON-RPC batch from the cache, as far as possible, and sends
+        the others with send_batch, which returns their results in order. Final results are cached.
+        """
+        keys: List[Optional[str]] = []
+        result_blocks: List[bool] = []
+        for method, params in calls:
+            cacheable, final_block = self._final_block(method, params)
+            if cacheable and (final_block is None or self.is_final(final_block)):
+                keys.append(ResponseCache.key(self.chain_id(), method, params))
+            else:
+                keys.append(None)
+            result_blocks.append(final_block is None)
+
+        cached = self.cache.get_many([key for key in keys if key is not None])
+        missing = [i for i, key in enumerate(keys) if key is None or key not in cached]
+        results: List[Any] = [None if key is None else cached.get(key) for key in keys]
+        if not missing:
+            return results
+
+        fetched = send_batch([calls[i] for i in missing])
+        new_items: Dict[str, Any] = {}
+        for i, result in zip(missing, fetched):
+            results[i] = result
+            key = keys[i]
+            if key is None or result is None:
+                continue
+            if result_blocks[i] and not (
+                isinstance(result, dict)
+                and self.is_final(
+                    _block_number(result.get("blockNumber", result.get("number")))
+                )
+            ):
+                continue
+            new_items[key] = result
+        if new_items:
+            self.cache.put_many(new_items)
+        return results
+
+    def _get_logs(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        log_filter = params[0] if params else {}
+        from_block = _block_number(log_filter.get("fromBlock"))
+        to_block = _block_number(log_filter.get("toBlock"))
+        if (
+            "blockHash" in log_filter
+            or from_block is None
+            or to_block is None
+            or not self.is_final(to_block)
+        ):
+            return self.make_request(method, params)
+
+        grid = self.cache.grid
+        first_cell = -(-from_block // grid) if grid else 0
+        last_cell = (to_block + 1) // grid - 1 if grid else -1
+        if first_cell > last_cell:
+            return self._cached_request(method, params, to_block)
+
+        # Whole cells are looked up in the cache, the blocks before the first and after the last cell
+        # are requested separately
+        selection = _log_filter(log_filter)
+        chain_id = self.chain_id()
+        cell_keys = [
+            ResponseCache.key(chain_id, method, [selection, grid, cell])
+            for cell in range(first_cell, last_cell + 1)
+        ]
+        cached = self.cache.get_many(cell_keys)
+        if len(cached) < len(cell_keys):
+            response = self.make_request(method, params)
+            if "error" in response or response.get("result") is None:
+                return response
+            cells: Dict[str, List[Any]] = {key: [] for key in cell_keys}
+            for log in response["result"]:
+                cell = int(log["blockNumber"], 16) // grid
+                if first_cell <= cell <= last_cell:
+                    cells[cell_keys[cell - first_cell]].append(log)
+            self.cache.put_many(cells)
+            return response
+
+        logs: List[Any] = []
+        edges = [
+            (from_block, first_cell * grid - 1),
+            (None, None),
+            ((last_cell + 1) * grid, to_block),
+        ]
+        for edge_from, edge_to in edges:
+            if edge_from is None:
+                for key in cell_keys:
+                    logs.extend(cached[key])
+                continue
+            if edge_from > edge_to:
+                continue
+            edge_filter = {
+                **log_filter,
+                "fromBlock": hex(edge_from),
+                "toBlock": hex(edge_to),
+            }
+            response = self._cached_request(method, [edge_filter], edge_to)
+            if "error" in response:
+                return response
+            logs.extend(response["result"])
+        return {"jsonrpc": "2.0", "id": 0, "result": logs}
+
+    def __call__(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        if method == "eth_getLogs":
+            return self._get_logs(method, params)
+        if method in RESULT_BLOCK_METHODS:
+            return self._cached_request(method, params, None)
+        position = BLOCK_PARAMETER_METHODS.get(method)
+        if position is not None:
+            block_number = (
+                _block_number(params[position]) if len(params) > position else None
+            )
+            if block_number is None:
+                return self.make_request(method, params)
+            return self._cached_request(method, params, block_number)
+        return self.make_request(method, params)
+
+
+def construct_response_cache_middleware(
+    cache: ResponseCache,
+) -> Callable[[Callable[[RPCEndpoint, Any], Any], Web3], Any]:
+    """
+    Builds a web3 middleware which answers requests about finalized blocks from the cache.
+
+    The middleware expects JSON-RPC formatted requests and responses, so it must be one of the
+    innermost middlewares of the client (see add_response_cache).
+    """
+
+    def response_cache_middleware(
+        make_request: Callable[[RPCEndpoint, Any], Any], web3: Web3
+    ) -> Callable[[RPCEndpoint, Any], RPCResponse]:
+        handler = _CachingRequestHandler(cache, make_request)
+        _batch_handlers[web3] = handler
+        return handler
+
+    return response_cache_middleware
+
+
+def add_response_cache(web3: Web3, cache: ResponseCache) -> None:
+    """
+    Adds a response cache middleware to the web3 client, inside all of its middlewares but the rate
+    limiter (see moonworm.crawler.rate_limit), so that cache hits do not count against rate limits.
+
+    JSON-RPC batches sent with moonworm.crawler.batch_rpc are served from the same cache.
+    """
+    onion = web3.middleware_onion
+    onion.inject(construct_response_cache_middleware(cache), "response_cache", layer=0)
+    if "rate_limit" in onion:
+        rate_limit = onion.get("rate_limit")
+        onion.remove("rate_limit")
+        onion.inject(rate_limit, "rate_limit", layer=0)
+
+
+def cached_batch_request(
+    web3: Web3,
+    calls: Sequence[Tuple[str, Any]],
+    send_batch: Callable[[Sequence[Tuple[str, Any]]], List[Any]],
+) -> List[Any]:
+    """
+    Serves the calls of a JSON-RPC batch from the response cache of the web3 client, if it has one (see
+    add_response_cache), and sends the others with send_batch.
+    """
+    onion = getattr(web3, "middleware_onion", None)
+    if onion is None or "response_cache" not in onion:
+        return send_batch(calls)
+    # The handler is created when web3 builds its middleware stack, which it caches
+    web3.provider.request_func(web3, onion)
+    handler = _batch_handlers.get(web3)
+    if handler is None:
+        return send_batch(calls)
+    return handler.batch(calls, send_batch)
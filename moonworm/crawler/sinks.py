@@ -0,0 +1,270 @@
+"""
+Buffered JSON Lines sink for crawled events and method calls.
+
+[`JSONLinesSink`][moonworm.crawler.sinks.JSONLinesSink] takes batches of records from the crawl
+thread, and encodes, compresses and writes them on a background writer thread, so that crawling
+continues while records reach the disk in batches. It uses orjson to encode records if it is installed,
+and can compress its output with gzip or zstd (the latter requires the zstandard package) and rotate
+files by block range or size.
+
+Usage:
+```python
+from moonworm.crawler.sinks import JSONLinesSink
+
+sink = JSONLinesSink("crawldata.jsonl.gz", compression="gzip", rotate_blocks=100000)
+for batch in iter_watch(...):
+    sink.write(batch.events, batch.from_block)
+sink.close()
+```
+"""
+
+import gzip
+import json
+import os
+import queue
+import threading
+from typing import IO, Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPRESSIONS = ("gzip", "zstd")
+
+# File extensions appended to the path of compressed files, if it does not end with them already
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def json_safe(value: Any) -> Any:
+    """
+    Returns a copy of value which the json module can encode: bytes become hex strings, mappings become
+    dicts and tuples become lists, recursively.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + bytes(value).hex()
+    if isinstance(value, Mapping):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [json_safe(item) for item in value]
+    return value
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray)):
+        return "0x" + bytes(value).hex()
+    if isinstance(value, tuple):
+        return list(value)
+    if hasattr(value, "items"):
+        return dict(value.items())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_records(records: Iterable[Dict[str, Any]]) -> bytes:
+    """
+    Encodes records as JSON lines, with orjson if it is installed. Bytes are encoded as hex strings.
+    """
+    if orjson is not None:
+        return b"".join(
+            orjson.dumps(
+                record, default=_json_default, option=orjson.OPT_APPEND_NEWLINE
+            )
+            for record in records
+        )
+    return "".join(
+        json.dumps(record, default=_json_default) + "\n" for record in records
+    ).encode("utf-8")
+
+
+def _open(path: str, compression: Optional[str]) -> IO[bytes]:
+    if compression is None:
+        return open(path, "ab")
+    if compression == "gzip":
+        # Appending to a gzip file adds a member to it, which readers decompress as one stream
+        return gzip.open(path, "ab", compresslevel=6)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(
+                "zstandard not installed, to install, run: `pip install moonworm[zstd]`"
+            )
+        # Appending a frame to a zstd file works the same way
+        return zstandard.ZstdCompressor().stream_writer(open(path, "ab"))
+    raise ValueError(
+        f"Unknown compression: {compression}. Supported compressions: {COMPRESSIONS}"
+    )
+
+
+class JSONLinesSink:
+    """
+    Writes records in JSON Lines format from a background thread.
+
+    Files are opened in append mode, so the sink never deletes old data. With rotation, the first block
+    of every file is added to its name: "crawldata.jsonl" becomes "crawldata-0000012345.jsonl". A file
+    is rotated before a batch of records is written, if the batch starts rotate_blocks blocks or more
+    after the first block of the file, or if rotate_bytes bytes (before compression) have been written
+    to it. Batches are never split between files.
+
+    Errors of the writer thread are raised by the next call to write, flush or close.
+
+    The records written are counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compression: Optional[str] = None,
+        rotate_blocks: Optional[int] = None,
+        rotate_bytes: Optional[int] = None,
+        max_pending_batches: int = 64,
+    ):
+        """
+        :param path: Path of the output file
+        :param compression: None, "gzip" or "zstd"
+        :param rotate_blocks: Number of blocks after which to start a new file, if any
+        :param rotate_bytes: Number of bytes after which to start a new file, if any
+        :param max_pending_batches: Maximum number of batches waiting to be written. Beyond it, write
+        blocks until the writer catches up.
+        """
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression: {compression}. Supported compressions: {COMPRESSIONS}"
+            )
+        extension = COMPRESSION_EXTENSIONS.get(compression or "", "")
+        if extension and not path.endswith(extension):
+            path += extension
+        self.path = path
+        self.compression = compression
+        self.rotate_blocks = rotate_blocks
+        self.rotate_bytes = rotate_bytes
+
+        self._queue: (
+            "queue.Queue[Optional[Tuple[List[Dict[str, Any]], Optional[int]]]]"
+        ) = queue.Queue(max_pending_batches)
+        self._error: Optional[BaseException] = None
+        self._file: Optional[IO[bytes]] = None
+        self._file_first_block: Optional[int] = None
+        self._file_bytes = 0
+        self._closed = False
+
+        self.metrics = {
+            "records_written": 0,
+            "bytes_written": 0,
+            "batches_written": 0,
+            "files": 0,
+        }
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def rotates(self) -> bool:
+        return self.rotate_blocks is not None or self.rotate_bytes is not None
+
+    def file_path(self, first_block: Optional[int]) -> str:
+        """
+        Returns the path of the file whose first block is first_block.
+        """
+        if not self.rotates or first_block is None:
+            return self.path
+        directory, name = os.path.split(self.path)
+        stem, dot, extensions = name.partition(".")
+        return os.path.join(directory, f"{stem}-{first_block:010d}{dot}{extensions}")
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(
+        self, records: List[Dict[str, Any]], block_number: Optional[int] = None
+    ) -> None:
+        """
+        Queues a batch of records to be written. block_number is the first block of the batch, which
+        the sink uses to rotate files by block range.
+        """
+        self._raise_error()
+        if self._closed:
+            raise ValueError("write to a closed sink")
+        if records:
+            self._queue.put((records, block_number))
+
+    def flush(self) -> None:
+        """
+        Waits until all the queued records are written and flushed to the file.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self) -> None:
+        """
+        Writes the queued records and closes the file.
+        """
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _rotate(self, block_number: Optional[int]) -> None:
+        if self._file is not None:
+            if not self.rotates:
+                return
+            full = (
+                self.rotate_bytes is not None and self._file_bytes >= self.rotate_bytes
+            )
+            old = (
+                self.rotate_blocks is not None
+                and block_number is not None
+                and self._file_first_block is not None
+                and block_number - self._file_first_block >= self.rotate_blocks
+            )
+            if not (full or old):
+                return
+            self._file.close()
+
+        self._file = _open(self.file_path(block_number), self.compression)
+        self._file_first_block = block_number
+        self._file_bytes = 0
+        self.metrics["files"] += 1
+
+    def _write_batches(
+        self, batches: List[Tuple[List[Dict[str, Any]], Optional[int]]]
+    ) -> None:
+        for records, block_number in batches:
+            self._rotate(block_number)
+            data = encode_records(records)
+            assert self._file is not None
+            self._file.write(data)
+            self._file_bytes += len(data)
+            self.metrics["records_written"] += len(records)
+            self.metrics["bytes_written"] += len(data)
+            self.metrics["batches_written"] += 1
+        if self._file is not None:
+            self._file.flush()
+
+    def _run(self) -> None:
+        done = False
+        while not done:
+            # Writes everything queued since the last write in one go
+            batches = [self._queue.get()]
+            while True:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = batches[-1] is None
+            try:
+                if self._error is None:
+                    self._write_batches(
+                        [batch for batch in batches if batch is not None]
+                    )
+                if done and self._file is not None:
+                    self._file.close()
+                    self._file = None
+            except BaseException as e:
+                self._error = e
+            finally:
+                for _ in batches:
+                    self._queue.task_done()
@@ -1,2 +1,4 @@
 from .event_scanner_state import EventScannerState
 from .json_state import JSONifiedState
+from .sqlite_state import SQLiteState
+from .wal_state import WriteAheadLogState
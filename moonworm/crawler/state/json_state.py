@@ -32,6 +32,16 @@ class JSONifiedState(EventScannerState):
         """Restore the last scan state from a file."""
         try:
             self.state = json.load(open(self.fname, "rt"))
+            # JSON object keys are strings, while blocks and log indices are keyed by integers
+            self.state["blocks"] = {
+                int(block_number): {
+                    txhash: {
+                        int(log_index): transfer for log_index, transfer in logs.items()
+                    }
+                    for txhash, logs in block.items()
+                }
+                for block_number, block in self.state["blocks"].items()
+            }
             print(
                 f"Restored the state, previously {self.state['last_scanned_block']} blocks have been scanned"
             )
@@ -55,9 +65,11 @@ class JSONifiedState(EventScannerState):
 
     def delete_data(self, since_block):
         """Remove potentially reorganised blocks from the scan data."""
-        for block_num in range(since_block, self.get_last_scanned_block()):
-            if block_num in self.state["blocks"]:
-                del self.state["blocks"][block_num]
+        for block_num in [b for b in self.state["blocks"] if b >= since_block]:
+            del self.state["blocks"][block_num]
+        self.state["last_scanned_block"] = min(
+            self.get_last_scanned_block(), since_block - 1
+        )
 
     def start_chunk(self, block_number, chunk_size):
         pass
@@ -1,31 +1,51 @@
+import calendar
+import datetime
+from typing import Optional
+
 from sqlalchemy.orm import Query, Session
 from web3 import Web3
 
 from ..networks import EthereumBlock, EthereumLabel
+from ..timestamp_index import BlockTimestampIndex
 from .event_scanner_state import EventScannerState
 
 BLOCK_TIMESTAMP_CACHE = {}
 
 
-def get_block_timestamp(db_session: Session, web3: Web3, block_number: int) -> int:
+def get_block_timestamp(
+    db_session: Session,
+    web3: Web3,
+    block_number: int,
+    timestamp_index: Optional[BlockTimestampIndex] = None,
+) -> int:
     """
     Get the timestamp of a block.
+
+    If a timestamp index is given, it is used instead of the in-memory cache.
     """
-    if block_number in BLOCK_TIMESTAMP_CACHE:
+    if timestamp_index is not None:
+        timestamp = timestamp_index.get(block_number)
+        if timestamp is not None:
+            return timestamp
+    elif block_number in BLOCK_TIMESTAMP_CACHE:
         return BLOCK_TIMESTAMP_CACHE[block_number]
     try:
         block = (
             db_session.query(EthereumBlock)
             .filter(EthereumBlock.block_number == block_number)
-            .query.one()
+            .one_or_none()
         )
         if block is None:
             raise ValueError("Block not found is db")
-        timstamp = block.timestamp
+        timestamp = block.timestamp
     except Exception as e:
         print(e)
         timestamp = web3.eth.get_block(block_number)["timestamp"]
 
+    if timestamp_index is not None:
+        timestamp_index.put(block_number, timestamp)
+        return timestamp
+
     # clear cache if size is > 100
     if len(BLOCK_TIMESTAMP_CACHE) > 100:
         BLOCK_TIMESTAMP_CACHE.clear()
@@ -39,10 +59,17 @@ class MoonStreamEventState(EventScannerState):
     MoonStream event state.
     """
 
-    def __init__(self, db_session: Session, web3: Web3, label_name: str):
+    def __init__(
+        self,
+        db_session: Session,
+        web3: Web3,
+        label_name: str,
+        timestamp_index: Optional[BlockTimestampIndex] = None,
+    ):
         self.db_session = db_session
         self.web3 = web3
         self.label_name = label_name
+        self.timestamp_index = timestamp_index
 
         self.cache_state = []
 
@@ -72,12 +99,22 @@ class MoonStreamEventState(EventScannerState):
             print(e)
             self.db_session.rollback()
 
-    def process_event(self, event: dict) -> None:
+    def process_event(
+        self, block_when: Optional[datetime.datetime], event: dict
+    ) -> None:
         """
         Process an event.
+
+        The scanner resolves block timestamps for the whole chunk before it processes events, so the
+        timestamp is only looked up here if block_when is None.
         """
         block_number = event["blockNumber"]
-        timestamp = get_block_timestamp(self.db_session, self.web3, block_number)
+        if block_when is not None:
+            timestamp = calendar.timegm(block_when.utctimetuple())
+        else:
+            timestamp = get_block_timestamp(
+                self.db_session, self.web3, block_number, self.timestamp_index
+            )
         label = EthereumLabel(
             label_name=self.label_name,
             block_number=block_number,
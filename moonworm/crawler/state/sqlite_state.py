@@ -0,0 +1,275 @@
+"""
+State backend which stores crawled events and method calls in a SQLite database.
+
+The database runs in WAL mode, so it can be queried while a crawler writes to it, and every chunk
+(events, the method calls registered while the chunk was open, and both cursors) or flush (method calls
+registered outside of a chunk) is written in a single transaction, so the database is consistent after
+a crash.
+
+Tables:
+
+- `events`: one row per event, keyed by (block_number, log_index), with indexes on the contract
+  address and the event name. Event arguments are stored as JSON in the `args` column.
+- `calls`: one row per method call, unique by transaction hash, indexed by block number, contract
+  address and function name. Function arguments are stored as JSON in the `function_args` column.
+- `cursors`: last block crawled for events ("events") and method calls ("calls").
+"""
+
+import datetime
+import json
+import logging
+import sqlite3
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from web3.datastructures import AttributeDict
+
+from ..function_call_crawler import ContractFunctionCall, FunctionCallCrawlerState
+from ..sinks import json_safe
+from .event_scanner_state import EventScannerState
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    block_number INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    block_hash TEXT,
+    block_timestamp INTEGER,
+    transaction_hash TEXT,
+    address TEXT,
+    event_name TEXT,
+    args TEXT,
+    PRIMARY KEY (block_number, log_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS events_address_idx ON events (address, block_number);
+CREATE INDEX IF NOT EXISTS events_event_name_idx ON events (event_name, block_number);
+
+CREATE TABLE IF NOT EXISTS calls (
+    block_number INTEGER NOT NULL,
+    block_hash TEXT,
+    block_timestamp INTEGER,
+    transaction_hash TEXT NOT NULL,
+    contract_address TEXT,
+    caller_address TEXT,
+    function_name TEXT,
+    function_args TEXT,
+    gas_used INTEGER,
+    status INTEGER
+);
+CREATE UNIQUE INDEX IF NOT EXISTS calls_transaction_hash_idx ON calls (transaction_hash);
+CREATE INDEX IF NOT EXISTS calls_block_number_idx ON calls (block_number);
+CREATE INDEX IF NOT EXISTS calls_contract_address_idx ON calls (contract_address, block_number);
+CREATE INDEX IF NOT EXISTS calls_function_name_idx ON calls (function_name, block_number);
+
+CREATE TABLE IF NOT EXISTS cursors (
+    name TEXT PRIMARY KEY,
+    block_number INTEGER NOT NULL
+);
+"""
+
+EVENTS_CURSOR = "events"
+CALLS_CURSOR = "calls"
+
+
+def _timestamp(block_when: Optional[datetime.datetime]) -> Optional[int]:
+    if block_when is None:
+        return None
+    # Scanners pass naive datetimes in UTC (datetime.utcfromtimestamp)
+    if block_when.tzinfo is None:
+        block_when = block_when.replace(tzinfo=datetime.timezone.utc)
+    return int(block_when.timestamp())
+
+
+class SQLiteState(EventScannerState, FunctionCallCrawlerState):
+    """
+    Implements both the EventScannerState and the FunctionCallCrawlerState interfaces on top of a SQLite
+    database.
+
+    Events are buffered until the end of their chunk. Method calls registered while a chunk is open are
+    written with the events of the chunk, and other method calls when the state is flushed (every
+    batch_size calls, and at the end of every crawl). Either way, rows are written in one transaction
+    together with the crawler's progress. A method call is stored once per transaction hash, so
+    crawling a range of blocks again does not duplicate calls.
+
+    The rows written are counted in the `metrics` dictionary.
+    """
+
+    def __init__(self, path: str, batch_size: int = 1000):
+        """
+        :param path: Path of the database file. It is created if it does not exist.
+        :param batch_size: Number of method calls after which register_call flushes them
+        """
+        self.path = path
+        self.batch_size = batch_size
+        # The crawlers may run in another thread than the one which created the state
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode, transactions are durable once the WAL is synced at checkpoints
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+        self._events: List[Tuple[Any, ...]] = []
+        self._calls: List[Tuple[Any, ...]] = []
+        self._last_crawled_block: Optional[int] = None
+        self._calls_cursor_changed = False
+        self._in_chunk = False
+
+        self.metrics = {
+            "events_written": 0,
+            "calls_written": 0,
+            "transactions": 0,
+            "rows_deleted": 0,
+        }
+
+    def _write_calls(self) -> None:
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self._calls,
+        )
+        if self._last_crawled_block is not None:
+            self._set_cursor(CALLS_CURSOR, self._last_crawled_block)
+
+    def _get_cursor(self, name: str) -> Optional[int]:
+        row = self.conn.execute(
+            "SELECT block_number FROM cursors WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _set_cursor(self, name: str, block_number: int) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cursors (name, block_number) VALUES (?, ?)",
+            (name, block_number),
+        )
+
+    def close(self) -> None:
+        self.flush()
+        self.conn.close()
+
+    #
+    # EventScannerState methods implemented below
+    #
+
+    def get_last_scanned_block(self) -> int:
+        block_number = self._get_cursor(EVENTS_CURSOR)
+        return 0 if block_number is None else block_number
+
+    def start_chunk(self, block_number: int, chunk_size: Optional[int] = None):
+        self._events = []
+        self._in_chunk = True
+
+    def process_event(
+        self, block_when: Optional[datetime.datetime], event: AttributeDict
+    ) -> str:
+        transaction_hash = json_safe(event["transactionHash"])
+        self._events.append(
+            (
+                event["blockNumber"],
+                event["logIndex"],
+                json_safe(event.get("blockHash")),
+                _timestamp(block_when),
+                transaction_hash,
+                event.get("address"),
+                event.get("event"),
+                json.dumps(json_safe(event.get("args", {}))),
+            )
+        )
+        return f"{event['blockNumber']}-{transaction_hash}-{event['logIndex']}"
+
+    def end_chunk(self, block_number: int):
+        """
+        Writes the events of the chunk, the method calls registered since the chunk started and the
+        last scanned and crawled blocks in one transaction.
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._events,
+            )
+            self._set_cursor(EVENTS_CURSOR, block_number)
+            self._write_calls()
+        self.metrics["events_written"] += len(self._events)
+        self.metrics["calls_written"] += len(self._calls)
+        self.metrics["transactions"] += 1
+        self._events = []
+        self._calls = []
+        self._calls_cursor_changed = False
+        self._in_chunk = False
+
+    def delete_data(self, since_block: int):
+        """
+        Deletes the events and method calls of blocks since since_block.
+        """
+        self._events = [row for row in self._events if row[0] < since_block]
+        self._calls = [row for row in self._calls if row[0] < since_block]
+        with self.conn:
+            deleted = self.conn.execute(
+                "DELETE FROM events WHERE block_number >= ?", (since_block,)
+            ).rowcount
+            deleted += self.conn.execute(
+                "DELETE FROM calls WHERE block_number >= ?", (since_block,)
+            ).rowcount
+            self.conn.execute(
+                "UPDATE cursors SET block_number = ? WHERE block_number >= ?",
+                (since_block - 1, since_block),
+            )
+        if self._last_crawled_block is not None:
+            self._last_crawled_block = min(self._last_crawled_block, since_block - 1)
+        self.metrics["rows_deleted"] += deleted
+        self.metrics["transactions"] += 1
+
+    #
+    # FunctionCallCrawlerState methods implemented below
+    #
+
+    def get_last_crawled_block(self) -> int:
+        if self._last_crawled_block is not None:
+            return self._last_crawled_block
+        block_number = self._get_cursor(CALLS_CURSOR)
+        return -1 if block_number is None else block_number
+
+    def register_call(self, function_call: ContractFunctionCall) -> None:
+        call: Dict[str, Any] = asdict(function_call)
+        self._calls.append(
+            (
+                call["block_number"],
+                json_safe(call["block_hash"]),
+                call["block_timestamp"],
+                json_safe(call["transaction_hash"]),
+                call["contract_address"],
+                call["caller_address"],
+                call["function_name"],
+                json.dumps(json_safe(call["function_args"])),
+                call["gas_used"],
+                call["status"],
+            )
+        )
+        self._last_crawled_block = max(
+            self.get_last_crawled_block(), function_call.block_number
+        )
+        self._calls_cursor_changed = True
+        # Calls registered during a chunk are written with it
+        if not self._in_chunk and len(self._calls) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered method calls and the last crawled block in one transaction.
+        """
+        if not self._calls and not self._calls_cursor_changed:
+            return
+        with self.conn:
+            self._write_calls()
+        self.metrics["calls_written"] += len(self._calls)
+        self.metrics["transactions"] += 1
+        self._calls = []
+        self._calls_cursor_changed = False
+
+    def set_last_crawled_block(self, block_number: int) -> None:
+        """
+        Records that method calls were crawled up to block_number, including blocks without calls. The
+        block is written at the next flush.
+        """
+        self._last_crawled_block = block_number
+        self._calls_cursor_changed = True
@@ -0,0 +1,446 @@
+"""
+EventScannerState which persists events in an append-only, segmented write-ahead log.
+
+Unlike [`JSONifiedState`][moonworm.crawler.state.json_state.JSONifiedState], which rewrites its whole
+JSON file on save, the cost of persisting a chunk only depends on the size of the chunk:
+
+- Events are appended to the active segment file as they are processed, and `end_chunk` appends a
+  checkpoint record and fsyncs the segment. A chunk without a checkpoint is discarded on restore.
+- Full segments are closed, and a background thread compacts closed segments into a snapshot of the
+  state. On startup, the state is restored from the latest snapshot and the segments written after it.
+- `delete_data` truncates the log right before the first chunk with deleted blocks, instead of
+  rewriting it.
+
+Directory layout:
+
+- `segment-<id>.log`: JSON lines, either `{"event": <record>}` or `{"checkpoint": <block number>}`
+- `snapshot-<id>.jsonl`: state after all segments up to `<id>`. The first line holds
+  `{"last_scanned_block": <block number>}`, then every line holds `{"block": <block number>, "events":
+  [<record>, ...]}`.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from web3.datastructures import AttributeDict
+
+from ..sinks import json_safe
+from .event_scanner_state import EventScannerState
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_FILE_REGEX = re.compile(r"^segment-(\d+)\.log$")
+SNAPSHOT_FILE_REGEX = re.compile(r"^snapshot-(\d+)\.jsonl$")
+
+
+def _encode(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class WriteAheadLogState(EventScannerState):
+    """
+    Stores scanned events in memory, keyed by block number, and persists them in a write-ahead log in
+    the given directory. The state is restored from the directory when it is created.
+
+    Subclasses can override `event_record` to store events in another format. Records must be
+    JSON-serializable and have a "blockNumber" key.
+
+    The activity of the log is counted in the `metrics` dictionary.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 64 * 2**20,
+        compact_after_segments: int = 4,
+        fsync: bool = True,
+    ):
+        """
+        :param directory: Directory holding the log. It is created if it does not exist.
+        :param segment_bytes: Size after which a segment is closed and a new one started
+        :param compact_after_segments: Number of closed segments after which they are compacted into a
+        new snapshot in the background
+        :param fsync: Whether to fsync segments at every checkpoint. Without fsync, the last chunks may
+        be lost if the machine crashes.
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compact_after_segments = compact_after_segments
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        self.blocks: Dict[int, List[Dict[str, Any]]] = {}
+        self.last_scanned_block = 0
+
+        # Held while the log is compacted or truncated
+        self._lock = threading.Lock()
+        # Protects the list of chunks and the snapshot position, which the compaction thread updates
+        self._index_lock = threading.Lock()
+        self._compaction_thread: Optional[threading.Thread] = None
+
+        self._snapshot_id = -1
+        self._snapshot_block = 0
+        # (segment id, offset of the first record, last block) of every committed chunk after the snapshot
+        self._chunks: List[Tuple[int, int, int]] = []
+        self._segment_id = 0
+        self._file: Any = None
+        self._offset = 0
+        # Offset in the active segment at which the current chunk starts
+        self._chunk_start = 0
+
+        self.metrics = {
+            "bytes_written": 0,
+            "checkpoints": 0,
+            "compactions": 0,
+            "truncations": 0,
+        }
+
+        self.restore()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _segment_name(segment_id: int) -> str:
+        return f"segment-{segment_id:010d}.log"
+
+    @staticmethod
+    def _snapshot_name(segment_id: int) -> str:
+        return f"snapshot-{segment_id:010d}.jsonl"
+
+    def _list(self, regex: "re.Pattern[str]") -> List[int]:
+        ids = []
+        for name in os.listdir(self.directory):
+            match = regex.match(name)
+            if match is not None:
+                ids.append(int(match.group(1)))
+        return sorted(ids)
+
+    @staticmethod
+    def _read_snapshot(
+        path: str,
+    ) -> Tuple[int, Dict[int, List[Dict[str, Any]]]]:
+        blocks: Dict[int, List[Dict[str, Any]]] = {}
+        with open(path, "rt") as ifp:
+            last_scanned_block = json.loads(ifp.readline())["last_scanned_block"]
+            for line in ifp:
+                item = json.loads(line)
+                blocks[item["block"]] = item["events"]
+        return last_scanned_block, blocks
+
+    @staticmethod
+    def _replay_segment(
+        path: str,
+    ) -> Iterator[Tuple[int, int, int, List[Dict[str, Any]]]]:
+        """
+        Yields (start offset, end offset, checkpoint, events) for every committed chunk of the segment.
+        Stops at the first torn record.
+        """
+        events: List[Dict[str, Any]] = []
+        start = offset = 0
+        with open(path, "rb") as ifp:
+            for line in ifp:
+                if not line.endswith(b"\n"):
+                    return
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    return
+                offset += len(line)
+                if "checkpoint" in record:
+                    yield start, offset, record["checkpoint"], events
+                    events = []
+                    start = offset
+                else:
+                    events.append(record["event"])
+
+    @staticmethod
+    def _apply(
+        blocks: Dict[int, List[Dict[str, Any]]], events: List[Dict[str, Any]]
+    ) -> None:
+        for event in events:
+            blocks.setdefault(event["blockNumber"], []).append(event)
+
+    def restore(self) -> None:
+        """
+        Restores the state from the latest snapshot and the segments written after it, and discards
+        the records of chunks which were not committed.
+        """
+        snapshot_ids = self._list(SNAPSHOT_FILE_REGEX)
+        if snapshot_ids:
+            self._snapshot_id = snapshot_ids[-1]
+            self._snapshot_block, self.blocks = self._read_snapshot(
+                self._path(self._snapshot_name(self._snapshot_id))
+            )
+            self.last_scanned_block = self._snapshot_block
+        # Leftovers of a compaction which was interrupted before it could clean up
+        for snapshot_id in snapshot_ids[:-1]:
+            os.remove(self._path(self._snapshot_name(snapshot_id)))
+        segment_ids = self._list(SEGMENT_FILE_REGEX)
+        for segment_id in segment_ids:
+            if segment_id <= self._snapshot_id:
+                os.remove(self._path(self._segment_name(segment_id)))
+        segment_ids = [
+            segment_id for segment_id in segment_ids if segment_id > self._snapshot_id
+        ]
+
+        self._segment_id = self._snapshot_id + 1
+        self._offset = 0
+        for segment_id in segment_ids:
+            self._segment_id = segment_id
+            self._offset = 0
+            for start, end, checkpoint, events in self._replay_segment(
+                self._path(self._segment_name(segment_id))
+            ):
+                self._apply(self.blocks, events)
+                self.last_scanned_block = checkpoint
+                self._chunks.append((segment_id, start, checkpoint))
+                self._offset = end
+
+        # Anything after the last checkpoint is an uncommitted chunk
+        self._open_segment(self._segment_id, truncate_at=self._offset)
+        logger.info(
+            "Restored the state, previously %d blocks have been scanned",
+            self.last_scanned_block,
+        )
+
+    def _open_segment(self, segment_id: int, truncate_at: int = 0) -> None:
+        if self._file is not None:
+            self._file.close()
+        path = self._path(self._segment_name(segment_id))
+        self._file = open(path, "ab")
+        self._file.truncate(truncate_at)
+        self._segment_id = segment_id
+        self._offset = truncate_at
+        self._chunk_start = truncate_at
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        data = _encode(record)
+        self._file.write(data)
+        self._offset += len(data)
+        self.metrics["bytes_written"] += len(data)
+
+    def _sync(self) -> None:
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def event_record(
+        self, block_when: Optional[datetime.datetime], event: AttributeDict
+    ) -> Dict[str, Any]:
+        """
+        Converts a decoded event into the record stored in the state.
+        """
+        record = json_safe(event)
+        if block_when is not None:
+            record["timestamp"] = block_when.isoformat()
+        return record
+
+    def get_events(
+        self, from_block: int = 0, to_block: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the records of the events in the given range of blocks, in block order.
+        """
+        return [
+            record
+            for block_number in sorted(self.blocks)
+            if block_number >= from_block
+            and (to_block is None or block_number <= to_block)
+            for record in self.blocks[block_number]
+        ]
+
+    #
+    # EventScannerState methods implemented below
+    #
+
+    def get_last_scanned_block(self) -> int:
+        return self.last_scanned_block
+
+    def start_chunk(self, block_number: int, chunk_size: Optional[int] = None):
+        pass
+
+    def process_event(
+        self, block_when: Optional[datetime.datetime], event: AttributeDict
+    ) -> str:
+        record = self.event_record(block_when, event)
+        self._append({"event": record})
+        self._apply(self.blocks, [record])
+        return f"{record['blockNumber']}-{record.get('transactionHash')}-{record.get('logIndex')}"
+
+    def end_chunk(self, block_number: int):
+        """
+        Commits the events of the chunk: appends a checkpoint record and fsyncs the segment.
+        """
+        self._append({"checkpoint": block_number})
+        self._sync()
+        self.last_scanned_block = block_number
+        self.metrics["checkpoints"] += 1
+        with self._index_lock:
+            self._chunks.append((self._segment_id, self._chunk_start, block_number))
+        self._chunk_start = self._offset
+
+        if self._offset >= self.segment_bytes:
+            self._open_segment(self._segment_id + 1)
+            self._maybe_compact()
+
+    def delete_data(self, since_block: int):
+        """
+        Deletes the events of blocks since since_block, and truncates the log accordingly.
+        """
+        with self._lock:
+            for block_number in [b for b in self.blocks if b >= since_block]:
+                del self.blocks[block_number]
+            self.last_scanned_block = min(self.last_scanned_block, since_block - 1)
+            self.metrics["truncations"] += 1
+
+            if since_block <= self._snapshot_block:
+                # Reaches into the snapshot, which is rare enough to rewrite the state from scratch
+                self._rewrite()
+                return
+
+            with self._index_lock:
+                first_deleted = next(
+                    (
+                        i
+                        for i, (_, _, end_block) in enumerate(self._chunks)
+                        if end_block >= since_block
+                    ),
+                    None,
+                )
+                if first_deleted is None:
+                    truncate_segment, truncate_at = self._segment_id, self._chunk_start
+                    previous_end = (
+                        self._chunks[-1][2] if self._chunks else self._snapshot_block
+                    )
+                else:
+                    truncate_segment, truncate_at, _ = self._chunks[first_deleted]
+                    previous_end = (
+                        self._chunks[first_deleted - 1][2]
+                        if first_deleted > 0
+                        else self._snapshot_block
+                    )
+                    del self._chunks[first_deleted:]
+
+            self._file.close()
+            self._file = None
+            for segment_id in range(truncate_segment + 1, self._segment_id + 1):
+                path = self._path(self._segment_name(segment_id))
+                if os.path.exists(path):
+                    os.remove(path)
+            self._open_segment(truncate_segment, truncate_at=truncate_at)
+
+            # The blocks of the truncated chunk which were not deleted are written again
+            for record in self.get_events(previous_end + 1):
+                self._append({"event": record})
+            if first_deleted is not None:
+                self.end_chunk(self.last_scanned_block)
+            else:
+                self._sync()
+
+    def _rewrite(self) -> None:
+        """
+        Writes the whole state as a new snapshot and starts a new segment after it.
+        """
+        snapshot_id = self._segment_id
+        self._write_snapshot(snapshot_id, self.last_scanned_block, self.blocks)
+        self._file.close()
+        self._file = None
+        for segment_id in self._list(SEGMENT_FILE_REGEX):
+            os.remove(self._path(self._segment_name(segment_id)))
+        self._remove_snapshots_before(snapshot_id)
+        with self._index_lock:
+            self._snapshot_id = snapshot_id
+            self._snapshot_block = self.last_scanned_block
+            self._chunks = []
+        self._open_segment(snapshot_id + 1)
+
+    def _write_snapshot(
+        self,
+        snapshot_id: int,
+        last_scanned_block: int,
+        blocks: Dict[int, List[Dict[str, Any]]],
+    ) -> None:
+        path = self._path(self._snapshot_name(snapshot_id))
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as ofp:
+            ofp.write(_encode({"last_scanned_block": last_scanned_block}))
+            for block_number in sorted(blocks):
+                ofp.write(
+                    _encode({"block": block_number, "events": blocks[block_number]})
+                )
+            ofp.flush()
+            if self.fsync:
+                os.fsync(ofp.fileno())
+        os.replace(temporary_path, path)
+
+    def _remove_snapshots_before(self, snapshot_id: int) -> None:
+        for other_id in self._list(SNAPSHOT_FILE_REGEX):
+            if other_id < snapshot_id:
+                os.remove(self._path(self._snapshot_name(other_id)))
+
+    def _maybe_compact(self) -> None:
+        closed_segments = self._segment_id - self._snapshot_id - 1
+        if closed_segments < self.compact_after_segments:
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        self._compaction_thread = threading.Thread(
+            target=self.compact, args=(self._segment_id - 1,), daemon=True
+        )
+        self._compaction_thread.start()
+
+    def compact(self, through_segment: Optional[int] = None) -> None:
+        """
+        Merges the snapshot and the closed segments up to through_segment (all closed segments by
+        default) into a new snapshot, then removes them. Runs in a background thread when enough
+        segments were closed.
+        """
+        with self._lock:
+            # The log may have been truncated since the compaction was scheduled
+            if through_segment is None or through_segment >= self._segment_id:
+                through_segment = self._segment_id - 1
+            if through_segment <= self._snapshot_id:
+                return
+
+            last_scanned_block = 0
+            blocks: Dict[int, List[Dict[str, Any]]] = {}
+            if self._snapshot_id >= 0:
+                last_scanned_block, blocks = self._read_snapshot(
+                    self._path(self._snapshot_name(self._snapshot_id))
+                )
+            for segment_id in range(self._snapshot_id + 1, through_segment + 1):
+                for _, _, checkpoint, events in self._replay_segment(
+                    self._path(self._segment_name(segment_id))
+                ):
+                    self._apply(blocks, events)
+                    last_scanned_block = checkpoint
+
+            self._write_snapshot(through_segment, last_scanned_block, blocks)
+            with self._index_lock:
+                previous_snapshot_id = self._snapshot_id
+                self._snapshot_id = through_segment
+                self._snapshot_block = last_scanned_block
+                self._chunks = [
+                    chunk for chunk in self._chunks if chunk[0] > through_segment
+                ]
+            self._remove_snapshots_before(through_segment)
+            for segment_id in range(previous_snapshot_id + 1, through_segment + 1):
+                os.remove(self._path(self._segment_name(segment_id)))
+            self.metrics["compactions"] += 1
+
+    def close(self) -> None:
+        """
+        Waits for a running compaction and closes the active segment.
+        """
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
@@ -0,0 +1,313 @@
+"""
+Persistent index of block timestamps.
+
+The index for a chain is a file which holds an array of unsigned integers in native byte order: the
+timestamp of block n is stored at position n, plus one, and 0 (`UNKNOWN`) marks blocks whose
+timestamp is not known yet. The offset keeps genesis blocks with a timestamp of 0 apart from unknown
+blocks, while extending the file still fills the gap with unknown blocks.
+The file is only ever extended, never truncated: timestamps of blocks replaced by a chain
+reorganization are overwritten or cleared in place (see `BlockTimestampIndex.forget`). Readers
+memory-map it, so any number of crawlers (in the same or in different processes) can share one index
+without copying it into memory.
+
+Once the index holds the timestamps of the blocks a crawler needs, looking them up costs no JSON-RPC
+calls at all. Missing timestamps are fetched in bulk with JSON-RPC batches (see
+[`moonworm.crawler.batch_rpc`][moonworm.crawler.batch_rpc]) and appended to the index.
+
+Usage:
+```python
+from web3 import Web3
+from moonworm.crawler.timestamp_index import BlockTimestampIndex
+
+web3 = Web3(Web3.HTTPProvider("http://localhost:8545"))
+index = BlockTimestampIndex.for_web3(web3)
+timestamps = index.get_block_timestamps(web3, range(15000000, 15000100))
+```
+"""
+
+import mmap
+import os
+import struct
+import threading
+from typing import Dict, Iterable, Optional
+
+from web3 import Web3
+
+from .batch_rpc import get_block_timestamps
+
+# Directory in which indices are stored by default, one file per chain id
+DEFAULT_INDEX_DIR = os.environ.get(
+    "MOONWORM_TIMESTAMP_INDEX_DIR",
+    os.path.join(os.path.expanduser("~"), ".moonworm", "block_timestamps"),
+)
+
+# uint32 timestamps are valid until 2106, uint64 can be used for chains with unusual timestamps
+TIMESTAMP_FORMATS = {4: "I", 8: "Q"}
+
+# Value of the slots of blocks whose timestamp is not known, stored timestamps are offset by one
+UNKNOWN = 0
+
+_indices: Dict[str, "BlockTimestampIndex"] = {}
+_indices_lock = threading.Lock()
+
+
+def _pwrite(fd: int, data: bytes, offset: int) -> None:
+    """
+    Writes data at the given offset of the file. os.pwrite is not available on Windows, where we seek
+    and write instead. Callers hold the lock of the index, so the position of fd is not shared.
+    """
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+        return
+    os.lseek(fd, offset, os.SEEK_SET)
+    os.write(fd, data)
+
+
+class BlockTimestampIndex:
+    """
+    Memory-mapped array of block timestamps for a single chain.
+
+    If interpolate is set, timestamps of blocks which are not in the index are interpolated linearly
+    between the closest known blocks before and after them (at most max_interpolation_distance blocks
+    away). This is only accurate for chains with regular block times.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        timestamp_bytes: int = 4,
+        interpolate: bool = False,
+        max_interpolation_distance: int = 1000,
+    ):
+        """
+        :param path: Path to the index file. It is created if it does not exist.
+        :param timestamp_bytes: Size of each timestamp in the file, 4 (uint32) or 8 (uint64) bytes. Must
+        be the same for every user of the file.
+        :param interpolate: Interpolate timestamps of blocks which are not in the index
+        :param max_interpolation_distance: Maximum distance to the blocks we interpolate from
+        """
+        if timestamp_bytes not in TIMESTAMP_FORMATS:
+            raise ValueError(
+                f"timestamp_bytes must be one of {list(TIMESTAMP_FORMATS)}, not {timestamp_bytes}"
+            )
+        self.path = path
+        self.timestamp_bytes = timestamp_bytes
+        self.format = TIMESTAMP_FORMATS[timestamp_bytes]
+        self.interpolate = interpolate
+        self.max_interpolation_distance = max_interpolation_distance
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # O_BINARY only exists (and matters) on Windows
+        self._fd = os.open(
+            path, os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644
+        )
+        self._lock = threading.Lock()
+        self._mmap: Optional[mmap.mmap] = None
+        self._timestamps: Optional[memoryview] = None
+        self._remap()
+
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "interpolated": 0,
+            "written": 0,
+        }
+
+    @classmethod
+    def for_chain(
+        cls, chain_id: int, directory: Optional[str] = None, **kwargs
+    ) -> "BlockTimestampIndex":
+        """
+        Returns the index for the given chain. Indices are shared by everything in the process which
+        uses the same file.
+        """
+        if directory is None:
+            directory = DEFAULT_INDEX_DIR
+        path = os.path.abspath(os.path.join(directory, f"{chain_id}.bin"))
+        with _indices_lock:
+            if path not in _indices:
+                _indices[path] = cls(path, **kwargs)
+            return _indices[path]
+
+    @classmethod
+    def for_web3(
+        cls, web3: Web3, directory: Optional[str] = None, **kwargs
+    ) -> "BlockTimestampIndex":
+        """
+        Returns the index for the chain the web3 client is connected to.
+        """
+        return cls.for_chain(web3.eth.chain_id, directory, **kwargs)
+
+    def _remap(self) -> None:
+        size = os.fstat(self._fd).st_size
+        size -= size % self.timestamp_bytes
+        if (
+            self._timestamps is not None
+            and len(self._timestamps) * self.timestamp_bytes == size
+        ):
+            return
+        if size == 0:
+            # Empty files cannot be memory-mapped
+            return
+        # The previous mapping is not closed explicitly, as other threads may still be reading from it.
+        # It is unmapped once it is no longer referenced.
+        self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+        self._timestamps = memoryview(self._mmap).cast(self.format)
+
+    def __len__(self) -> int:
+        """
+        Number of blocks the index has room for (known or not).
+        """
+        return 0 if self._timestamps is None else len(self._timestamps)
+
+    def _lookup(self, block_number: int, remap: bool = True) -> Optional[int]:
+        if block_number < 0:
+            return None
+        if block_number >= len(self):
+            if not remap:
+                return None
+            # Other processes may have extended the index since we mapped it
+            with self._lock:
+                self._remap()
+            if block_number >= len(self):
+                return None
+        value = self._timestamps[block_number]
+        if value == UNKNOWN:
+            return None
+        return value - 1
+
+    def _interpolate(self, block_number: int) -> Optional[int]:
+        # The mapping is refreshed once for the whole search, not for every block probed past its end
+        if block_number + self.max_interpolation_distance >= len(self):
+            with self._lock:
+                self._remap()
+        before = after = None
+        for distance in range(1, self.max_interpolation_distance + 1):
+            if before is None:
+                timestamp = self._lookup(block_number - distance, remap=False)
+                if timestamp is not None:
+                    before = (block_number - distance, timestamp)
+            if after is None:
+                timestamp = self._lookup(block_number + distance, remap=False)
+                if timestamp is not None:
+                    after = (block_number + distance, timestamp)
+            if before is not None and after is not None:
+                break
+        if before is None or after is None:
+            return None
+        (before_block, before_timestamp), (after_block, after_timestamp) = before, after
+        return before_timestamp + round(
+            (after_timestamp - before_timestamp)
+            * (block_number - before_block)
+            / (after_block - before_block)
+        )
+
+    def get(self, block_number: int) -> Optional[int]:
+        """
+        Returns the timestamp of the given block, or None if it is not in the index (and cannot be
+        interpolated).
+        """
+        timestamp = self._lookup(block_number)
+        if timestamp is not None:
+            self.metrics["hits"] += 1
+            return timestamp
+        if self.interpolate:
+            interpolated = self._interpolate(block_number)
+            if interpolated is not None:
+                self.metrics["interpolated"] += 1
+                return interpolated
+        self.metrics["misses"] += 1
+        return None
+
+    def get_many(self, block_numbers: Iterable[int]) -> Dict[int, int]:
+        """
+        Returns the timestamps of the given blocks which are in the index (or can be interpolated).
+        """
+        timestamps = {}
+        for block_number in block_numbers:
+            timestamp = self.get(block_number)
+            if timestamp is not None:
+                timestamps[block_number] = timestamp
+        return timestamps
+
+    def put(self, block_number: int, timestamp: int) -> None:
+        """
+        Stores the timestamp of the given block.
+        """
+        self.put_many({block_number: timestamp})
+
+    def put_many(self, timestamps: Dict[int, int]) -> None:
+        """
+        Stores the timestamps of the given blocks. Blocks which are already in the index with the same
+        timestamp are skipped, others are overwritten.
+        """
+        with self._lock:
+            for block_number in sorted(timestamps):
+                timestamp = timestamps[block_number]
+                if block_number < 0 or timestamp is None:
+                    continue
+                value = timestamp + 1
+                if block_number < len(self) and self._timestamps[block_number] == value:
+                    continue
+                # Writing past the end of the file extends it, with unknown blocks in between
+                _pwrite(
+                    self._fd,
+                    struct.pack(self.format, value),
+                    block_number * self.timestamp_bytes,
+                )
+                self.metrics["written"] += 1
+            self._remap()
+
+    def forget(self, from_block: int) -> None:
+        """
+        Clears the timestamps of the given block and the blocks after it, once a chain reorganization
+        replaced them. The file keeps its size, as other readers may have mapped it.
+        """
+        from_block = max(from_block, 0)
+        with self._lock:
+            self._remap()
+            if from_block >= len(self):
+                return
+            _pwrite(
+                self._fd,
+                struct.pack(self.format, UNKNOWN) * (len(self) - from_block),
+                from_block * self.timestamp_bytes,
+            )
+
+    def get_block_timestamps(
+        self, web3: Web3, block_numbers: Iterable[int]
+    ) -> Dict[int, int]:
+        """
+        Returns the timestamps of the given blocks. Blocks which are not in the index (and cannot be
+        interpolated) are fetched with JSON-RPC batches and added to the index.
+
+        Blocks which were not found on chain are left out of the result.
+        """
+        timestamps = {}
+        missing = []
+        for block_number in set(block_numbers):
+            timestamp = self.get(block_number)
+            if timestamp is not None:
+                timestamps[block_number] = timestamp
+            else:
+                missing.append(block_number)
+
+        if missing:
+            fetched = get_block_timestamps(web3, missing)
+            self.put_many(fetched)
+            timestamps.update(fetched)
+        return timestamps
+
+    def close(self) -> None:
+        with _indices_lock:
+            if _indices.get(os.path.abspath(self.path)) is self:
+                del _indices[os.path.abspath(self.path)]
+        with self._lock:
+            if self._timestamps is not None:
+                self._timestamps.release()
+                self._timestamps = None
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            os.close(self._fd)
@@ -38,7 +38,7 @@ def was_deployed_at_block(
             last_call = config.get(CONFIG_KEY_WEB3_LAST_CALL)
             current_time = time.time()
             if last_call is not None and current_time < last_call + interval:
-                time.sleep(last_call + interval - current_time + 1)
+                time.sleep(last_call + interval - current_time)
 
     code = web3_client.eth.get_code(contract_address, block_identifier=block_number)
 
@@ -0,0 +1,159 @@
+import asyncio
+import unittest
+from typing import Any, Dict, List
+
+from eth_abi import encode_abi
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+
+from moonworm.contracts import ERC20
+from moonworm.crawler.async_log_scanner import AsyncEventScanner
+from moonworm.crawler.state import EventScannerState
+
+CONTRACT = Web3.toChecksumAddress("0x00000000000000000000000000000000000000cc")
+SENDER = "0x00000000000000000000000000000000000000aa"
+RECEIVER = "0x00000000000000000000000000000000000000bb"
+
+
+class ListState(EventScannerState):
+    def __init__(self) -> None:
+        self.events: List[Any] = []
+        self.last_scanned_block = 0
+
+    def get_last_scanned_block(self) -> int:
+        return self.last_scanned_block
+
+    def start_chunk(self, block_number, chunk_size=None):
+        pass
+
+    def end_chunk(self, block_number):
+        self.last_scanned_block = block_number
+
+    def process_event(self, block_when, event):
+        self.events.append((block_when, event))
+        return (event["blockNumber"], event["logIndex"])
+
+    def delete_data(self, since_block):
+        pass
+
+
+class FakeAsyncEth:
+    """
+    Serves eth_getLogs and eth_getBlockByNumber from memory, like web3.eth.AsyncEth would against a node.
+    """
+
+    def __init__(self, logs: List[Dict[str, Any]], fail_first_get_logs: bool = False):
+        self.logs = logs
+        self.fail_next_get_logs = fail_first_get_logs
+        self.get_logs_calls = 0
+        self.get_block_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def get_logs(self, filter_params):
+        self.get_logs_calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.in_flight -= 1
+        if self.fail_next_get_logs:
+            self.fail_next_get_logs = False
+            raise ValueError("query returned more than 10000 results")
+        topics = filter_params.get("topics", [None])[0]
+        if isinstance(topics, str):
+            topics = [topics]
+        return [
+            log
+            for log in self.logs
+            if filter_params["fromBlock"]
+            <= log["blockNumber"]
+            <= filter_params["toBlock"]
+            and (topics is None or Web3.toHex(log["topics"][0]) in topics)
+        ]
+
+    async def get_block(self, block_number):
+        self.get_block_calls += 1
+        return {"number": block_number, "timestamp": 1600000000 + block_number}
+
+
+class FakeAsyncWeb3:
+    def __init__(self, eth: FakeAsyncEth):
+        self.eth = eth
+        self.codec = Web3().codec
+
+
+def transfer_log(block_number: int, log_index: int, value: int) -> Dict[str, Any]:
+    transfer_abi = [
+        item
+        for item in ERC20.abi()
+        if item["type"] == "event" and item["name"] == "Transfer"
+    ][0]
+    return {
+        "address": CONTRACT,
+        "blockHash": HexBytes(block_number.to_bytes(32, "big")),
+        "blockNumber": block_number,
+        "data": Web3.toHex(encode_abi(["uint256"], [value])),
+        "logIndex": log_index,
+        "topics": [
+            HexBytes(event_abi_to_log_topic(transfer_abi)),
+            HexBytes(encode_abi(["address"], [SENDER])),
+            HexBytes(encode_abi(["address"], [RECEIVER])),
+        ],
+        "transactionHash": HexBytes(
+            (block_number * 100 + log_index).to_bytes(32, "big")
+        ),
+        "transactionIndex": 0,
+    }
+
+
+class TestAsyncEventScanner(unittest.TestCase):
+    def setUp(self) -> None:
+        self.logs = [
+            transfer_log(block_number, log_index, block_number * 10 + log_index)
+            for block_number in [3, 5, 40, 41, 99]
+            for log_index in range(2)
+        ]
+        self.event_abis = [item for item in ERC20.abi() if item["type"] == "event"]
+
+    def scan(self, eth: FakeAsyncEth, **kwargs):
+        state = ListState()
+        scanner = AsyncEventScanner(
+            FakeAsyncWeb3(eth),
+            self.event_abis,
+            addresses=[CONTRACT],
+            scanner_state=state,
+            request_retry_seconds=0,
+            **kwargs,
+        )
+        processed, _ = asyncio.run(scanner.scan(1, 100, start_chunk_size=30))
+        return state, processed
+
+    def test_scan(self) -> None:
+        eth = FakeAsyncEth(self.logs)
+        state, processed = self.scan(eth, max_concurrent_requests=2)
+
+        self.assertListEqual(
+            processed, [(log["blockNumber"], log["logIndex"]) for log in self.logs]
+        )
+        self.assertEqual(state.last_scanned_block, 100)
+        self.assertListEqual(
+            [event["args"]["value"] for _, event in state.events],
+            [log["blockNumber"] * 10 + log["logIndex"] for log in self.logs],
+        )
+        for block_when, event in state.events:
+            self.assertEqual(block_when.timestamp(), 1600000000 + event["blockNumber"])
+        self.assertLessEqual(eth.max_in_flight, 2)
+
+    def test_scan_combined_requests_with_retry(self) -> None:
+        eth = FakeAsyncEth(self.logs, fail_first_get_logs=True)
+        state, processed = self.scan(eth, combine_event_requests=True)
+
+        self.assertListEqual(
+            processed, [(log["blockNumber"], log["logIndex"]) for log in self.logs]
+        )
+        self.assertEqual(state.last_scanned_block, 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from moonworm.crawler.backfill import (
+    SQLiteBackfillQueue,
+    merge_outputs,
+    run_backfill_worker,
+)
+
+
+def crawl_unit(from_block: int, to_block: int):
+    # One record every 10 blocks
+    for block_number in range(from_block, to_block + 1):
+        if block_number % 10 == 0:
+            yield {"blockNumber": block_number}
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(directory.name, "queue.sqlite")
+        self.output_directory = os.path.join(directory.name, "outputs")
+
+    def queue(self, **kwargs) -> SQLiteBackfillQueue:
+        backfill_queue = SQLiteBackfillQueue(self.path, **kwargs)
+        self.addCleanup(backfill_queue.close)
+        return backfill_queue
+
+    def merged_blocks(self):
+        outfile = os.path.join(self.directory, "merged.jsonl")
+        merge_outputs(self.queue(), outfile)
+        with open(outfile) as ifp:
+            return [json.loads(line)["blockNumber"] for line in ifp]
+
+    def test_workers_share_the_queue(self) -> None:
+        self.assertEqual(self.queue().add_range(0, 9999, 250), 40)
+        # Planning again does not add the same units
+        self.assertEqual(self.queue().add_range(0, 9999, 250), 0)
+
+        completed = []
+
+        def _work() -> None:
+            def _crawl(from_block: int, to_block: int):
+                time.sleep(0.01)
+                return crawl_unit(from_block, to_block)
+
+            completed.append(
+                run_backfill_worker(self.queue(), _crawl, self.output_directory)
+            )
+
+        workers = [threading.Thread(target=_work) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(sum(completed), 40)
+        self.assertEqual(self.queue().progress()["done"], 40)
+        self.assertListEqual(self.merged_blocks(), list(range(0, 10000, 10)))
+
+    def test_abandoned_leases_are_retried(self) -> None:
+        backfill_queue = self.queue(lease_seconds=0.1)
+        backfill_queue.add_range(0, 199, 100)
+        # A worker which dies after leasing a unit
+        abandoned = backfill_queue.lease("dead-worker")
+        self.assertEqual(abandoned.from_block, 0)
+        with self.assertRaises(ValueError):
+            self.merged_blocks()
+
+        self.assertEqual(
+            run_backfill_worker(backfill_queue, crawl_unit, self.output_directory), 1
+        )
+        time.sleep(0.2)
+        self.assertEqual(
+            run_backfill_worker(backfill_queue, crawl_unit, self.output_directory), 1
+        )
+        self.assertFalse(backfill_queue.heartbeat(abandoned, "dead-worker"))
+        self.assertListEqual(self.merged_blocks(), list(range(0, 200, 10)))
+
+    def test_heartbeats_keep_leases(self) -> None:
+        backfill_queue = self.queue(lease_seconds=0.2)
+        backfill_queue.add_range(0, 99, 100)
+        other_worker = self.queue(lease_seconds=0.2)
+        leased_by_other_worker = []
+
+        def _slow_crawl(from_block: int, to_block: int):
+            for _ in range(5):
+                time.sleep(0.1)
+                leased_by_other_worker.append(other_worker.lease("other-worker"))
+            return crawl_unit(from_block, to_block)
+
+        run_backfill_worker(
+            backfill_queue, _slow_crawl, self.output_directory, heartbeat_seconds=0.05
+        )
+        self.assertListEqual(leased_by_other_worker, [None] * 5)
+
+    def test_failures(self) -> None:
+        backfill_queue = self.queue(max_attempts=2)
+        backfill_queue.add_range(0, 299, 100)
+        failures = []
+
+        def _flaky_crawl(from_block: int, to_block: int):
+            for record in crawl_unit(from_block, to_block):
+                # Fails after some records of the unit were written
+                if record["blockNumber"] == 150:
+                    failures.append(from_block)
+                    raise RuntimeError("node unavailable")
+                yield record
+
+        self.assertEqual(
+            run_backfill_worker(backfill_queue, _flaky_crawl, self.output_directory), 2
+        )
+        self.assertListEqual(failures, [100, 100])
+        self.assertEqual(backfill_queue.progress()["failed"], 1)
+
+        self.assertEqual(backfill_queue.retry_failed(), 1)
+        run_backfill_worker(backfill_queue, crawl_unit, self.output_directory)
+        self.assertListEqual(self.merged_blocks(), list(range(0, 300, 10)))
+        self.assertListEqual(
+            [name for name in os.listdir(self.output_directory) if "tmp" in name], []
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,277 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+
+import web3
+
+from moonworm.crawler import ethereum_state_provider
+from moonworm.crawler.batch_rpc import get_block_headers, get_block_timestamps
+from moonworm.crawler.ethereum_state_provider import Web3StateProvider
+
+LATEST_BLOCK = 200
+TRANSACTIONS_PER_BLOCK = 3
+
+
+def block_hash(block_number):
+    return "0x" + format(block_number + 1, "064x")
+
+
+def block_response(request):
+    block_number = int(request["params"][0], 16)
+    result = None
+    if block_number <= LATEST_BLOCK:
+        result = {
+            "number": hex(block_number),
+            "hash": block_hash(block_number),
+            "parentHash": block_hash(block_number - 1),
+            "timestamp": hex(1600000000 + block_number),
+        }
+    return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+
+def transaction_hash(block_number, transaction_index):
+    return "0x" + format(block_number * 1000 + transaction_index, "064x")
+
+
+def receipt(block_number, transaction_index):
+    return {
+        "blockHash": block_hash(block_number),
+        "blockNumber": hex(block_number),
+        "transactionHash": transaction_hash(block_number, transaction_index),
+        "transactionIndex": hex(transaction_index),
+        "gasUsed": hex(21000 + transaction_index),
+        "status": "0x1",
+        "logs": [],
+    }
+
+
+def rpc_response(server, request):
+    if request["method"] == "eth_getBlockReceipts":
+        if server.block_receipts_error is not None:
+            return {
+                "jsonrpc": "2.0",
+                "id": request["id"],
+                "error": server.block_receipts_error,
+            }
+        if not server.supports_block_receipts:
+            return {
+                "jsonrpc": "2.0",
+                "id": request["id"],
+                "error": {"code": -32601, "message": "the method does not exist"},
+            }
+        block_number = int(request["params"][0], 16)
+        return {
+            "jsonrpc": "2.0",
+            "id": request["id"],
+            "result": [
+                receipt(block_number, transaction_index)
+                for transaction_index in range(TRANSACTIONS_PER_BLOCK)
+            ],
+        }
+    if request["method"] == "eth_getTransactionReceipt":
+        value = int(request["params"][0], 16)
+        return {
+            "jsonrpc": "2.0",
+            "id": request["id"],
+            "result": receipt(value // 1000, value % 1000),
+        }
+    return block_response(request)
+
+
+class JSONRPCHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        if isinstance(body, list):
+            if self.server.supports_batches:
+                response = [rpc_response(self.server, request) for request in body]
+            else:
+                response = {
+                    "jsonrpc": "2.0",
+                    "id": None,
+                    "error": {"code": -32600, "message": "batches are not supported"},
+                }
+        else:
+            response = rpc_response(self.server, body)
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JSONRPCServerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = HTTPServer(("127.0.0.1", 0), JSONRPCHandler)
+        self.server.requests = []
+        self.server.supports_batches = True
+        self.server.supports_block_receipts = True
+        self.server.block_receipts_error = None
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.web3_client = web3.Web3(
+            web3.HTTPProvider(f"http://127.0.0.1:{self.server.server_port}")
+        )
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestGetBlockTimestamps(JSONRPCServerTestCase):
+    def test_batches(self) -> None:
+        block_numbers = list(range(60, 210)) + [60, 61]
+        timestamps = get_block_timestamps(self.web3_client, block_numbers)
+
+        self.assertDictEqual(
+            timestamps,
+            {
+                block_number: 1600000000 + block_number
+                for block_number in range(60, LATEST_BLOCK + 1)
+            },
+        )
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertListEqual([len(batch) for batch in self.server.requests], [100, 50])
+
+    def test_fallback_to_single_requests(self) -> None:
+        self.server.supports_batches = False
+        timestamps = get_block_timestamps(self.web3_client, [5, 7])
+
+        self.assertDictEqual(timestamps, {5: 1600000005, 7: 1600000007})
+        self.assertIsInstance(self.server.requests[0], list)
+        self.assertListEqual(
+            [request["method"] for request in self.server.requests[1:]],
+            ["eth_getBlockByNumber", "eth_getBlockByNumber"],
+        )
+
+    def test_block_headers(self) -> None:
+        expected = {
+            block_number: {
+                "number": block_number,
+                "hash": block_hash(block_number),
+                "parentHash": block_hash(block_number - 1),
+                "timestamp": 1600000000 + block_number,
+            }
+            for block_number in [5, 7]
+        }
+        self.assertDictEqual(
+            get_block_headers(self.web3_client, [5, 7, LATEST_BLOCK + 1]), expected
+        )
+        self.server.supports_batches = False
+        self.assertDictEqual(get_block_headers(self.web3_client, [5, 7]), expected)
+
+    def test_providers_without_batches(self) -> None:
+        tester_client = web3.Web3(web3.EthereumTesterProvider())
+        block = tester_client.eth.get_block("latest")
+        self.assertDictEqual(
+            get_block_timestamps(tester_client, [block.number, block.number + 100]),
+            {block.number: block.timestamp},
+        )
+
+
+class TestReceipts(JSONRPCServerTestCase):
+    def transactions(self, block_numbers):
+        return [
+            {"hash": transaction_hash(block_number, 1), "blockNumber": block_number}
+            for block_number in block_numbers
+        ]
+
+    def test_block_receipts(self) -> None:
+        provider = Web3StateProvider(self.web3_client)
+        receipts = provider.get_transaction_receipts(self.transactions(range(10, 20)))
+        self.assertListEqual(
+            [(r["blockNumber"], r["gasUsed"], r["status"]) for r in receipts],
+            [(block_number, 21001, 1) for block_number in range(10, 20)],
+        )
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertListEqual(
+            [request["method"] for request in self.server.requests[0]],
+            ["eth_getBlockReceipts"] * 10,
+        )
+        self.assertEqual(provider.metrics["receipt_round_trips_saved"], 9)
+
+        # Other receipts of the blocks were cached
+        other_transaction = {"hash": transaction_hash(12, 2), "blockNumber": 12}
+        self.assertEqual(
+            provider.get_transaction_receipts([other_transaction])[0]["gasUsed"],
+            21002,
+        )
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(provider.metrics["receipt_cache_hits"], 1)
+
+        provider.forget_blocks(15)
+        provider.get_transaction_receipts(self.transactions(range(14, 16)))
+        self.assertListEqual(
+            [request["params"] for request in self.server.requests[1]],
+            [[hex(15)]],
+        )
+
+    def test_receipts_cache_size(self) -> None:
+        provider = Web3StateProvider(self.web3_client)
+        with mock.patch.object(ethereum_state_provider, "RECEIPTS_CACHE_SIZE", 5):
+            # A single batch of block receipts returns more receipts than the cache holds
+            receipts = provider.get_transaction_receipts(
+                self.transactions(range(10, 20))
+            )
+            self.assertListEqual(
+                [r["blockNumber"] for r in receipts], list(range(10, 20))
+            )
+            self.assertEqual(len(provider.receipts_cache), 5)
+
+    def test_fallback_to_transaction_receipts(self) -> None:
+        self.server.supports_block_receipts = False
+        provider = Web3StateProvider(self.web3_client, batch_size=4)
+        receipts = provider.get_transaction_receipts(self.transactions(range(10, 20)))
+        self.assertListEqual([r["blockNumber"] for r in receipts], list(range(10, 20)))
+        self.assertFalse(provider.use_block_receipts)
+        # The rejected batch of block receipts, then 3 batches of transaction receipts
+        self.assertListEqual(
+            [len(batch) for batch in self.server.requests], [4, 4, 4, 2]
+        )
+        self.assertEqual(provider.metrics["web3_get_transaction_receipts_requests"], 3)
+        self.assertEqual(provider.metrics["receipt_round_trips_saved"], 7)
+
+    def test_transient_errors(self) -> None:
+        self.server.block_receipts_error = {
+            "code": -32005,
+            "message": "rate limit exceeded",
+        }
+        provider = Web3StateProvider(self.web3_client)
+        with self.assertRaises(ValueError):
+            provider.get_transaction_receipts(self.transactions([5, 7]))
+        self.assertTrue(provider.use_block_receipts)
+
+        self.server.block_receipts_error = None
+        receipts = provider.get_transaction_receipts(self.transactions([5, 7]))
+        self.assertListEqual([r["blockNumber"] for r in receipts], [5, 7])
+        self.assertEqual(provider.metrics["web3_get_block_receipts_requests"], 1)
+
+    def test_fallback_to_single_requests(self) -> None:
+        self.server.supports_batches = False
+        self.server.supports_block_receipts = False
+        provider = Web3StateProvider(self.web3_client)
+        receipts = provider.get_transaction_receipts(self.transactions([5, 7]))
+        self.assertListEqual([r["blockNumber"] for r in receipts], [5, 7])
+        self.assertListEqual(
+            [
+                request["method"]
+                for request in self.server.requests
+                if not isinstance(request, list)
+            ],
+            [
+                "eth_getBlockReceipts",
+                "eth_getTransactionReceipt",
+                "eth_getTransactionReceipt",
+            ],
+        )
+        self.assertEqual(provider.metrics["receipt_round_trips_saved"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
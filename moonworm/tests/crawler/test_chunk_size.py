@@ -0,0 +1,63 @@
+import unittest
+
+from moonworm.crawler.chunk_size import AdaptiveChunkSizeController, align_chunk_end
+
+
+class TestAdaptiveChunkSizeController(unittest.TestCase):
+    def test_sparse_ranges_ramp_up_to_max(self) -> None:
+        controller = AdaptiveChunkSizeController(10, 1000)
+        chunk_size = 10
+        sizes = []
+        for _ in range(8):
+            chunk_size = controller.next_chunk_size(chunk_size, 0, 0.01)
+            sizes.append(chunk_size)
+        self.assertListEqual(sizes[:4], [20, 40, 80, 160])
+        self.assertEqual(sizes[-1], 1000)
+        self.assertEqual(controller.metrics["limited_by"], "max_chunk_size")
+
+    def test_dense_ranges_target_payload(self) -> None:
+        controller = AdaptiveChunkSizeController(10, 10000, target_events=1000)
+        # 5 events per block: the next chunk should hold about 1000 events, not shrink to 10 blocks
+        chunk_size = controller.next_chunk_size(1000, 5000, 0.1)
+        self.assertEqual(chunk_size, 200)
+        self.assertEqual(controller.metrics["limited_by"], "payload")
+        self.assertEqual(controller.metrics["decreases"], 1)
+
+        chunk_size = controller.next_chunk_size(chunk_size, 1000, 0.1)
+        self.assertEqual(chunk_size, 200)
+
+    def test_slow_requests_target_latency(self) -> None:
+        controller = AdaptiveChunkSizeController(10, 10000, target_duration=2.0)
+        chunk_size = controller.next_chunk_size(1000, 0, 10.0)
+        self.assertEqual(chunk_size, 200)
+        self.assertEqual(controller.metrics["limited_by"], "latency")
+
+    def test_failure_decreases_chunk_size(self) -> None:
+        controller = AdaptiveChunkSizeController(10, 10000)
+        self.assertEqual(controller.on_failure(1000), 500)
+        self.assertEqual(controller.on_failure(15), 10)
+        self.assertEqual(controller.metrics["failures"], 2)
+        self.assertEqual(controller.metrics["chunk_size"], 10)
+
+    def test_failure_caps_next_chunk_size(self) -> None:
+        controller = AdaptiveChunkSizeController(10, 10000)
+        controller.on_failure(1000)
+        controller.on_failure(500)
+        # The failed range was eventually fetched quickly, but the next chunk stays below the size which
+        # failed
+        self.assertEqual(controller.next_chunk_size(1000, 0, 0.01), 500)
+        self.assertEqual(controller.metrics["limited_by"], "failure")
+        self.assertEqual(controller.next_chunk_size(500, 0, 0.01), 1000)
+
+
+class TestAlignChunkEnd(unittest.TestCase):
+    def test_align_chunk_end(self) -> None:
+        self.assertEqual(align_chunk_end(1234, 1800, 100), 1799)
+        self.assertEqual(align_chunk_end(1234, 1799, 100), 1799)
+        # Chunks which do not cross the end of a cell are not shortened
+        self.assertEqual(align_chunk_end(1234, 1250, 100), 1250)
+        self.assertEqual(align_chunk_end(1234, 1800, None), 1800)
+
+
+if __name__ == "__main__":
+    unittest.main()
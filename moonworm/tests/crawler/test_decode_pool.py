@@ -0,0 +1,127 @@
+import unittest
+
+import web3
+
+from moonworm.contracts import ERC20
+from moonworm.crawler.decode_pool import DecodeError, DecodePool
+from moonworm.crawler.log_scanner import (
+    EventScanner,
+    _crawl_all_events,
+    _crawl_events,
+)
+
+
+class TestDecodePool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.event_abis = [item for item in ERC20.abi() if item["type"] == "event"]
+        # Tasks of one log, so that every chunk is decoded by several workers
+        cls.decode_pool = DecodePool(cls.event_abis, processes=2, logs_per_task=1)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.decode_pool.close()
+
+    def setUp(self) -> None:
+        self.web3_client = web3.Web3(web3.EthereumTesterProvider())
+        self.web3_client.eth.default_account = self.web3_client.eth.accounts[0]
+        accounts = self.web3_client.eth.accounts
+
+        deployment_transaction = (
+            self.web3_client.eth.contract(abi=ERC20.abi(), bytecode=ERC20.bytecode())
+            .constructor("Test ERC20 token", "TEST", accounts[0])
+            .transact()
+        )
+        self.contract_address = self.web3_client.eth.wait_for_transaction_receipt(
+            deployment_transaction
+        ).contractAddress
+        contract = self.web3_client.eth.contract(
+            address=self.contract_address, abi=ERC20.abi()
+        )
+
+        self.start_block = self.web3_client.eth.block_number + 1
+        contract.functions.mint(accounts[0], 1000).transact()
+        for i in range(1, 6):
+            contract.functions.transfer(accounts[1], i).transact()
+            contract.functions.approve(accounts[2], i).transact()
+        self.end_block = self.web3_client.eth.block_number
+
+    def test_crawl_all_events(self) -> None:
+        expected_events, _ = _crawl_all_events(
+            self.web3_client,
+            self.event_abis,
+            self.start_block,
+            self.end_block,
+            3,
+            self.contract_address,
+            min_blocks_batch=3,
+        )
+        events, _ = _crawl_all_events(
+            self.web3_client,
+            self.event_abis,
+            self.start_block,
+            self.end_block,
+            3,
+            self.contract_address,
+            min_blocks_batch=3,
+            decode_pool=self.decode_pool,
+        )
+        self.assertEqual(len(events), 11)
+        self.assertListEqual(events, expected_events)
+
+    def test_crawl_events(self) -> None:
+        for event_abi in self.event_abis:
+            expected_events, _ = _crawl_events(
+                self.web3_client,
+                event_abi,
+                self.start_block,
+                self.end_block,
+                2,
+                self.contract_address,
+                min_blocks_batch=2,
+            )
+            events, _ = _crawl_events(
+                self.web3_client,
+                event_abi,
+                self.start_block,
+                self.end_block,
+                2,
+                self.contract_address,
+                min_blocks_batch=2,
+                concurrency=2,
+                decode_pool=self.decode_pool,
+            )
+            self.assertListEqual(events, expected_events)
+
+    def test_event_scanner(self) -> None:
+        scanner = EventScanner(
+            self.web3_client,
+            self.event_abis,
+            addresses=[self.contract_address],
+            skip_block_timestamp=True,
+            decode_pool=self.decode_pool,
+        )
+        self.assertEqual(
+            len(scanner._fetch_chunk_events(self.start_block, self.end_block)), 11
+        )
+
+    def test_decode_errors(self) -> None:
+        logs = self.web3_client.eth.get_logs(
+            {"fromBlock": self.start_block, "toBlock": self.end_block}
+        )
+        # Truncated data cannot be decoded
+        broken_log = {**logs[0], "data": "0x01"}
+        errors = []
+        events = self.decode_pool.decode(
+            [broken_log] + logs[1:], on_decode_error=errors.append
+        )
+        self.assertEqual(len(events), len(logs) - 1)
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], DecodeError)
+
+        with self.assertRaises(ValueError):
+            self.decode_pool.submit(logs, event_abi={"name": "Unknown", "inputs": []})
+
+
+if __name__ == "__main__":
+    unittest.main()
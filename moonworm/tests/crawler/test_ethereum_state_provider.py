@@ -0,0 +1,84 @@
+import unittest
+
+from web3 import Web3
+
+from moonworm.crawler.ethereum_state_provider import Web3StateProvider
+
+TRANSFER_SELECTOR = "0xa9059cbb"
+APPROVE_SELECTOR = "0x095ea7b3"
+
+
+def address(i: int) -> str:
+    return Web3.toChecksumAddress(f"0x{i:040x}")
+
+
+class TestGetTransactionsToAddresses(unittest.TestCase):
+    def setUp(self) -> None:
+        self.provider = Web3StateProvider(None)
+        self.addresses = [address(i) for i in range(1, 501)]
+        # Blocks are served from the provider cache, so no node is needed
+        for block_number in range(10, 13):
+            self.provider.blocks_cache[block_number] = {
+                "timestamp": block_number,
+                "transactions": [
+                    {
+                        "blockNumber": block_number,
+                        "to": address(i),
+                        "input": (TRANSFER_SELECTOR if i % 2 else APPROVE_SELECTOR)
+                        + "00" * 64,
+                    }
+                    for i in range(495, 505)
+                ]
+                + [
+                    {"blockNumber": block_number, "to": None, "input": "0x60806040"},
+                    # Addresses which are not checksummed by the node
+                    {
+                        "blockNumber": block_number,
+                        "to": address(7).lower(),
+                        "input": TRANSFER_SELECTOR,
+                    },
+                ],
+            }
+
+    def test_one_pass_per_block(self) -> None:
+        transactions = self.provider.get_transactions_to_addresses(
+            self.addresses, 10, 12
+        )
+        self.assertEqual(self.provider.metrics["web3_get_block_calls"], 3)
+        self.assertListEqual(
+            [tx["blockNumber"] for tx in transactions], [10] * 7 + [11] * 7 + [12] * 7
+        )
+        self.assertListEqual(
+            [tx["to"] for tx in transactions[:7]],
+            [address(i) for i in range(495, 501)] + [address(7).lower()],
+        )
+
+    def test_selectors(self) -> None:
+        transactions = self.provider.get_transactions_to_addresses(
+            self.addresses, 10, 12, selectors={APPROVE_SELECTOR}
+        )
+        self.assertEqual(len(transactions), 9)
+        self.assertTrue(
+            all(tx["input"].startswith(APPROVE_SELECTOR) for tx in transactions)
+        )
+
+    def test_default_implementation(self) -> None:
+        # The implementation of the base class, for providers which only know single addresses
+        transactions = super(
+            Web3StateProvider, self.provider
+        ).get_transactions_to_addresses(
+            self.addresses[10:20], 10, 11, selectors={TRANSFER_SELECTOR}
+        )
+        self.assertListEqual(transactions, [])
+        transactions = super(
+            Web3StateProvider, self.provider
+        ).get_transactions_to_addresses(
+            [address(495), address(497)], 10, 11, selectors={TRANSFER_SELECTOR}
+        )
+        self.assertListEqual(
+            [tx["to"] for tx in transactions], [address(495), address(497)] * 2
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
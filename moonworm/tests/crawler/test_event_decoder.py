@@ -0,0 +1,92 @@
+import json
+import unittest
+
+from eth_abi import encode_abi
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+from web3._utils.events import get_event_data
+
+from moonworm.contracts import ERC20, ERC721
+from moonworm.crawler.event_decoder import EventDecoder, EventDecoderRegistry
+from moonworm.crawler.function_call_crawler import utfy_dict
+
+SENDER = "0x00000000000000000000000000000000000000aa"
+RECEIVER = "0x00000000000000000000000000000000000000bb"
+CONTRACT = Web3.toChecksumAddress("0x00000000000000000000000000000000000000cc")
+
+
+def event_abi(contract, name):
+    return [
+        item
+        for item in contract.abi()
+        if item["type"] == "event" and item["name"] == name
+    ][0]
+
+
+def make_log(topics, data, log_index=0):
+    return {
+        "address": CONTRACT,
+        "blockHash": HexBytes(b"\x01" * 32),
+        "blockNumber": 100,
+        "data": Web3.toHex(data),
+        "logIndex": log_index,
+        "topics": [HexBytes(topic) for topic in topics],
+        "transactionHash": HexBytes(b"\x02" * 32),
+        "transactionIndex": 0,
+    }
+
+
+class TestEventDecoder(unittest.TestCase):
+    def setUp(self) -> None:
+        self.codec = Web3().codec
+        self.erc20_transfer = event_abi(ERC20, "Transfer")
+        self.erc721_transfer = event_abi(ERC721, "Transfer")
+
+        topic0 = event_abi_to_log_topic(self.erc20_transfer)
+        sender_topic = encode_abi(["address"], [SENDER])
+        receiver_topic = encode_abi(["address"], [RECEIVER])
+        self.erc20_log = make_log(
+            [topic0, sender_topic, receiver_topic], encode_abi(["uint256"], [10**30])
+        )
+        self.erc721_log = make_log(
+            [topic0, sender_topic, receiver_topic, encode_abi(["uint256"], [7])],
+            b"",
+            log_index=1,
+        )
+
+    def test_decode_log_matches_get_event_data(self) -> None:
+        for abi, log in [
+            (self.erc20_transfer, self.erc20_log),
+            (self.erc721_transfer, self.erc721_log),
+        ]:
+            raw_event = get_event_data(self.codec, abi, log)
+            expected_args = json.loads(Web3.toJSON(utfy_dict(dict(raw_event["args"]))))
+
+            event = EventDecoder(self.codec, abi).decode_log(log)
+
+            self.assertEqual(event["event"], "Transfer")
+            self.assertDictEqual(event["args"], expected_args)
+            self.assertEqual(event["transactionHash"], "0x" + "02" * 32)
+            self.assertEqual(event["logIndex"], log["logIndex"])
+
+    def test_decoder_rejects_mismatched_topics(self) -> None:
+        with self.assertRaises(Exception):
+            EventDecoder(self.codec, self.erc20_transfer).decode_log(self.erc721_log)
+
+    def test_registry_routes_by_indexed_topic_count(self) -> None:
+        registry = EventDecoderRegistry(
+            self.codec, [self.erc721_transfer, self.erc20_transfer]
+        )
+        self.assertEqual(len(registry.topics), 1)
+
+        erc20_event = registry.decode_log(self.erc20_log)
+        erc721_event = registry.decode_log(self.erc721_log)
+
+        self.assertEqual(erc20_event["args"]["value"], 10**30)
+        self.assertEqual(erc721_event["args"]["tokenId"], 7)
+        self.assertEqual(erc20_event["args"]["from"], Web3.toChecksumAddress(SENDER))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -32,6 +32,9 @@ class EthereumTesterStateProvider(EthereumStateProvider):
     def get_block_timestamp(self, block_number: int) -> int:
         return self.internal_provider.get_block_timestamp(block_number)
 
+    def get_transaction_reciept(self, transaction_hash: str) -> Dict[str, Any]:
+        return self.internal_provider.get_transaction_reciept(transaction_hash)
+
     def get_transactions_to_address(
         self, address: str, block_number: int
     ) -> List[Dict[str, Any]]:
@@ -42,6 +45,7 @@ class EthereumTesterStateProvider(EthereumStateProvider):
         return [
             {
                 "input": transaction["data"],
+                "blockHash": transaction["block_hash"],
                 "blockNumber": transaction["block_number"],
                 **transaction,
             }
@@ -114,6 +118,7 @@ class TestFunctionCallCrawlerWithERC20Token(unittest.TestCase):
 
         expected_calls = [
             {
+                "block_hash": mint_block["hash"].hex(),
                 "block_number": mint_block_number,
                 "block_timestamp": mint_block["timestamp"],
                 "caller_address": self.web3_client.eth.accounts[0],
@@ -123,7 +128,11 @@ class TestFunctionCallCrawlerWithERC20Token(unittest.TestCase):
                     "account": self.web3_client.eth.accounts[0],
                     "amount": self.mint_amount,
                 },
-                "transaction_hash": self.mint_transaction_receipt["transactionHash"],
+                "transaction_hash": self.mint_transaction_receipt[
+                    "transactionHash"
+                ].hex(),
+                "status": 1,
+                "gas_used": self.mint_transaction_receipt["gasUsed"],
             },
         ]
 
@@ -0,0 +1,102 @@
+import json
+import os
+import unittest
+
+from web3 import Web3
+from web3.exceptions import MismatchedABI
+
+from moonworm.contracts import ERC20
+from moonworm.crawler.function_call_crawler import utfy_dict
+from moonworm.crawler.function_decoder import FunctionDecoder, FunctionDecoderRegistry
+
+ABIS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    "fixture",
+    "abis",
+)
+
+ACCOUNT = "0x00000000000000000000000000000000000000aa"
+
+
+def previous_decode(contract, call_data):
+    function, args = contract.decode_function_input(call_data)
+    return function.fn_name, json.loads(Web3.toJSON(utfy_dict(args)))
+
+
+class TestFunctionDecoder(unittest.TestCase):
+    def setUp(self) -> None:
+        self.codec = Web3().codec
+
+    def test_erc20(self) -> None:
+        registry = FunctionDecoderRegistry(self.codec, ERC20.abi())
+        function_abis = [item for item in ERC20.abi() if item["type"] == "function"]
+        # Events and the constructor have no selectors
+        self.assertEqual(len(registry.selectors), len(function_abis))
+
+        contract = Web3().eth.contract(abi=ERC20.abi())
+        call_data = contract.encodeABI(
+            fn_name="transfer", args=[Web3.toChecksumAddress(ACCOUNT), 10]
+        )
+        self.assertIn(call_data[:10], registry.selectors)
+        self.assertTupleEqual(
+            registry.decode_function_input(call_data),
+            ("transfer", {"recipient": Web3.toChecksumAddress(ACCOUNT), "amount": 10}),
+        )
+        self.assertTupleEqual(
+            registry.decode_function_input(Web3.toBytes(hexstr=call_data)),
+            previous_decode(contract, call_data),
+        )
+
+    def test_opensea_exchange(self) -> None:
+        with open(os.path.join(ABIS_DIR, "OpenseaExchange.json")) as ifp:
+            abi = json.load(ifp)
+        registry = FunctionDecoderRegistry(self.codec, abi)
+        contract = Web3().eth.contract(abi=abi)
+
+        addresses = [Web3.toChecksumAddress(f"0x{i:040x}") for i in range(1, 15)]
+        call_data = contract.encodeABI(
+            fn_name="atomicMatch_",
+            args=[
+                addresses,
+                list(range(18)),
+                [0, 1, 0, 1, 1, 0, 1, 0],
+                b"\x01\x02",
+                b"",
+                b"\xff" * 40,
+                b"\x03",
+                b"",
+                b"",
+                [27, 28],
+                [b"\x11" * 32] * 5,
+            ],
+        )
+        name, args = registry.decode_function_input(call_data)
+        self.assertEqual(name, "atomicMatch_")
+        self.assertListEqual(args["addrs"], addresses)
+        self.assertEqual(args["calldataBuy"], "0x0102")
+        self.assertListEqual(args["rssMetadata"], ["0x" + "11" * 32] * 5)
+        self.assertTupleEqual((name, args), previous_decode(contract, call_data))
+
+        # Inputs without names are keyed by the empty string, as web3 does
+        call_data = contract.encodeABI(fn_name="approvedOrders", args=[b"\x22" * 32])
+        self.assertTupleEqual(
+            registry.decode_function_input(call_data),
+            ("approvedOrders", {"": "0x" + "22" * 32}),
+        )
+
+    def test_mismatched_selectors(self) -> None:
+        registry = FunctionDecoderRegistry(self.codec, ERC20.abi())
+        self.assertIsNone(registry.get("0xdeadbeef"))
+        with self.assertRaises(MismatchedABI):
+            registry.decode_function_input("0xdeadbeef")
+
+        decoder = FunctionDecoder(
+            self.codec,
+            [item for item in ERC20.abi() if item.get("name") == "approve"][0],
+        )
+        with self.assertRaises(MismatchedABI):
+            decoder.decode_args("0xdeadbeef" + "00" * 64)
+
+
+if __name__ == "__main__":
+    unittest.main()
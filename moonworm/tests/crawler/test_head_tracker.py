@@ -0,0 +1,254 @@
+import asyncio
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import web3
+import websockets
+
+from moonworm.crawler.head_tracker import HeadTracker
+
+# websockets < 10 passes the removed loop argument to asyncio primitives on Python 3.10+
+WEBSOCKETS_WORKS = (
+    sys.version_info < (3, 10) or int(websockets.__version__.split(".")[0]) >= 10
+)
+
+
+class FakeNode:
+    """
+    Stand-in for a JSON-RPC node, which answers eth_blockNumber and sends newHeads notifications to its
+    subscribers.
+    """
+
+    def __init__(self, head: int, supports_subscriptions: bool = True) -> None:
+        self.head = head
+        self.supports_subscriptions = supports_subscriptions
+        self.block_number_requests = 0
+        self.subscribers = []
+
+    def respond(self, request, subscriber):
+        response = {"jsonrpc": "2.0", "id": request["id"]}
+        if request["method"] == "eth_blockNumber":
+            self.block_number_requests += 1
+            response["result"] = hex(self.head)
+        elif request["method"] == "eth_subscribe" and self.supports_subscriptions:
+            response["result"] = "0x1"
+            self.subscribers.append(subscriber)
+        else:
+            response["error"] = {"code": -32601, "message": "method not found"}
+        return json.dumps(response)
+
+    def notification(self) -> str:
+        return json.dumps(
+            {
+                "jsonrpc": "2.0",
+                "method": "eth_subscription",
+                "params": {"subscription": "0x1", "result": {"number": hex(self.head)}},
+            }
+        )
+
+    def wait_for_subscriber(self, timeout: float = 5) -> None:
+        deadline = time.time() + timeout
+        while not self.subscribers and time.time() < deadline:
+            time.sleep(0.01)
+
+    def web3_client(self) -> web3.Web3:
+        raise NotImplementedError()
+
+    def mine(self) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        raise NotImplementedError()
+
+
+class IPCNode(FakeNode):
+    def __init__(self, head: int, supports_subscriptions: bool = True) -> None:
+        super().__init__(head, supports_subscriptions)
+        self.directory = tempfile.TemporaryDirectory()
+        self.ipc_path = os.path.join(self.directory.name, "node.ipc")
+        node = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self) -> None:
+                decoder = json.JSONDecoder()
+                buffer = ""
+                while True:
+                    data = self.request.recv(4096)
+                    if not data:
+                        return
+                    buffer += data.decode("utf-8")
+                    while buffer.strip():
+                        try:
+                            request, end = decoder.raw_decode(buffer.lstrip())
+                        except ValueError:
+                            break
+                        buffer = buffer.lstrip()[end:]
+                        self.request.sendall(
+                            node.respond(request, self.request).encode("utf-8")
+                        )
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.ipc_path, Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def web3_client(self) -> web3.Web3:
+        return web3.Web3(web3.IPCProvider(self.ipc_path))
+
+    def mine(self) -> None:
+        self.head += 1
+        for subscriber in self.subscribers:
+            subscriber.sendall(self.notification().encode("utf-8"))
+
+    def close(self) -> None:
+        for subscriber in self.subscribers:
+            try:
+                subscriber.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Already closed by the client
+                pass
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+
+class WebsocketNode(FakeNode):
+    def __init__(self, head: int, supports_subscriptions: bool = True) -> None:
+        super().__init__(head, supports_subscriptions)
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def _serve() -> None:
+            asyncio.set_event_loop(self.loop)
+            self.server = self.loop.run_until_complete(
+                websockets.serve(self._handle, "127.0.0.1", 0)
+            )
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=_serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        port = self.server.sockets[0].getsockname()[1]
+        self.uri = f"ws://127.0.0.1:{port}"
+
+    async def _handle(self, connection, path) -> None:
+        async for message in connection:
+            await connection.send(self.respond(json.loads(message), connection))
+
+    async def _notify(self) -> None:
+        for connection in self.subscribers:
+            await connection.send(self.notification())
+
+    def web3_client(self) -> web3.Web3:
+        return web3.Web3(web3.WebsocketProvider(self.uri))
+
+    def mine(self) -> None:
+        self.head += 1
+        asyncio.run_coroutine_threadsafe(self._notify(), self.loop).result()
+
+    def close(self) -> None:
+        async def _close() -> None:
+            self.server.close()
+            await self.server.wait_closed()
+
+        asyncio.run_coroutine_threadsafe(_close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+class HeadTrackerTestMixin:
+    node_class = FakeNode
+
+    def start_node(self, **kwargs) -> FakeNode:
+        node = self.node_class(100, **kwargs)
+        self.addCleanup(node.close)
+        return node
+
+    def start_tracker(self, node: FakeNode, **kwargs) -> HeadTracker:
+        tracker = HeadTracker(node.web3_client(), **kwargs)
+        self.addCleanup(tracker.stop)
+        return tracker
+
+    def test_subscription(self) -> None:
+        node = self.start_node()
+        tracker = self.start_tracker(node)
+        self.assertEqual(tracker.get_head(), 100)
+
+        node.wait_for_subscriber()
+        for _ in range(3):
+            node.mine()
+        self.assertEqual(tracker.wait_for_block(103, timeout=5), 103)
+        self.assertEqual(tracker.metrics["notifications"], 3)
+        self.assertEqual(tracker.metrics["polls"], 0)
+        # One request when the tracker started, one after subscribing
+        self.assertLessEqual(node.block_number_requests, 2)
+
+    def test_polling_fallback(self) -> None:
+        node = self.start_node(supports_subscriptions=False)
+        tracker = self.start_tracker(node, target_latency=0.01)
+        self.assertEqual(tracker.get_head(), 100)
+
+        node.head = 105
+        self.assertEqual(tracker.wait_for_block(105, timeout=5), 105)
+        self.assertEqual(tracker.metrics["subscription_failures"], 1)
+        self.assertGreater(tracker.metrics["polls"], 0)
+
+    def test_wait_for_block_timeout(self) -> None:
+        node = self.start_node()
+        tracker = self.start_tracker(node)
+        self.assertEqual(tracker.wait_for_block(200, timeout=0.1), 100)
+
+    def test_shared_per_endpoint(self) -> None:
+        node = self.start_node()
+        tracker = HeadTracker.for_web3(node.web3_client())
+        self.addCleanup(tracker.stop)
+        self.assertIs(HeadTracker.for_web3(node.web3_client()), tracker)
+
+
+class TestHeadTrackerOverIPC(HeadTrackerTestMixin, unittest.TestCase):
+    node_class = IPCNode
+
+
+@unittest.skipUnless(
+    WEBSOCKETS_WORKS, "installed websockets does not support this Python version"
+)
+class TestHeadTrackerOverWebsocket(HeadTrackerTestMixin, unittest.TestCase):
+    node_class = WebsocketNode
+
+
+class TestHeadTrackerPolling(unittest.TestCase):
+    def test_poll_interval_is_bounded(self) -> None:
+        tester_client = web3.Web3(web3.EthereumTesterProvider())
+        tracker = HeadTracker(
+            tester_client,
+            target_latency=1.0,
+            min_poll_interval=0.5,
+            max_poll_interval=5.0,
+        )
+        self.assertIsNone(tracker.subscription_uri)
+        self.assertEqual(tracker._poll_delay(), 2.0)
+
+        # No polls while the next block is not expected, but at least every max_poll_interval seconds
+        tracker._block_time = 12.0
+        tracker._head_seen_at = time.monotonic()
+        self.assertEqual(tracker._poll_delay(), 5.0)
+        tracker._head_seen_at = time.monotonic() - 11.0
+        self.assertEqual(tracker._poll_delay(), 2.0)
+
+    def test_trackers_without_endpoint_are_not_shared(self) -> None:
+        tester_client = web3.Web3(web3.EthereumTesterProvider())
+        self.assertIsNot(
+            HeadTracker.for_web3(tester_client), HeadTracker.for_web3(tester_client)
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,327 @@
+import datetime
+import threading
+import unittest
+
+import web3
+
+from moonworm.contracts import ERC20, ERC721
+from moonworm.crawler.log_scanner import (
+    EventScanner,
+    _bisect_web3_call,
+    _crawl_all_events,
+    _crawl_chunks,
+    _fetch_all_events_chunk,
+    _fetch_events_chunk,
+)
+from moonworm.crawler.state import EventScannerState
+
+
+class ListState(EventScannerState):
+    def __init__(self) -> None:
+        self.events = []
+        self.last_scanned_block = 0
+
+    def get_last_scanned_block(self) -> int:
+        return self.last_scanned_block
+
+    def start_chunk(self, block_number, chunk_size=None):
+        pass
+
+    def end_chunk(self, block_number):
+        self.last_scanned_block = block_number
+
+    def process_event(self, block_when, event):
+        self.events.append((block_when, event))
+        return event["blockNumber"], event["logIndex"]
+
+    def delete_data(self, since_block):
+        pass
+
+
+from moonworm.crawler.retry_policy import RetryPolicy
+
+
+class TestLogScannerWithERC20Token(unittest.TestCase):
+    """
+    Tests the event crawling functions in moonworm.crawler.log_scanner against a fresh ERC20 token
+    deployment on web3.EthereumTesterProvider.
+    """
+
+    def setUp(self) -> None:
+        self.web3_client = web3.Web3(web3.EthereumTesterProvider())
+        self.web3_client.eth.default_account = self.web3_client.eth.accounts[0]
+        self.accounts = self.web3_client.eth.accounts
+
+        deployment_transaction = (
+            self.web3_client.eth.contract(abi=ERC20.abi(), bytecode=ERC20.bytecode())
+            .constructor("Test ERC20 token", "TEST", self.accounts[0])
+            .transact()
+        )
+        deployment_transaction_receipt = (
+            self.web3_client.eth.wait_for_transaction_receipt(deployment_transaction)
+        )
+        self.contract_address = deployment_transaction_receipt.contractAddress
+        self.contract = self.web3_client.eth.contract(
+            address=self.contract_address, abi=ERC20.abi()
+        )
+
+        self.start_block = self.web3_client.eth.block_number + 1
+        for transaction in [
+            self.contract.functions.mint(self.accounts[0], 1000).transact(),
+            self.contract.functions.transfer(self.accounts[1], 10).transact(),
+            self.contract.functions.approve(self.accounts[2], 5).transact(),
+            self.contract.functions.transfer(self.accounts[2], 20).transact(),
+        ]:
+            self.web3_client.eth.wait_for_transaction_receipt(transaction)
+        self.end_block = self.web3_client.eth.block_number
+
+        self.event_abis = [item for item in ERC20.abi() if item["type"] == "event"]
+
+    def test_event_scanner_scan(self) -> None:
+        state = ListState()
+        scanner = EventScanner(
+            self.web3_client,
+            self.event_abis,
+            addresses=[self.contract_address],
+            scanner_state=state,
+            request_retry_seconds=0,
+        )
+        processed, _ = scanner.scan(self.start_block, self.end_block)
+
+        self.assertListEqual(
+            [event["event"] for _, event in state.events],
+            ["Transfer", "Transfer", "Approval", "Transfer"],
+        )
+        self.assertListEqual(
+            processed,
+            [(event["blockNumber"], event["logIndex"]) for _, event in state.events],
+        )
+        self.assertEqual(state.last_scanned_block, self.end_block)
+        for block_when, event in state.events:
+            self.assertEqual(
+                block_when.replace(tzinfo=datetime.timezone.utc).timestamp(),
+                self.web3_client.eth.get_block(event["blockNumber"]).timestamp,
+            )
+
+    def test_event_scanner_iter_scan(self) -> None:
+        scanner = EventScanner(
+            self.web3_client,
+            self.event_abis,
+            addresses=[self.contract_address],
+            scanner_state=ListState(),
+            request_retry_seconds=0,
+        )
+        batches = list(
+            scanner.iter_scan(
+                self.start_block, self.end_block, start_chunk_size=0, prefetch_chunks=1
+            )
+        )
+
+        self.assertListEqual(
+            [event["event"] for batch in batches for event in batch.events],
+            ["Transfer", "Transfer", "Approval", "Transfer"],
+        )
+        self.assertEqual(batches[-1].cursor, self.end_block)
+
+        # Resuming after the first batch scans the rest of the range
+        resumed_batches = list(
+            scanner.iter_scan(
+                self.start_block,
+                self.end_block,
+                start_chunk_size=0,
+                cursor=batches[0].cursor,
+            )
+        )
+        self.assertEqual(resumed_batches[0].start_block, batches[0].end_block + 1)
+        self.assertListEqual(
+            [event for batch in resumed_batches for event in batch.events],
+            [event for batch in batches[1:] for event in batch.events],
+        )
+
+    def test_fetch_all_events_chunk_matches_per_event_fetch(self) -> None:
+        expected_events = []
+        for event_abi in self.event_abis:
+            expected_events.extend(
+                _fetch_events_chunk(
+                    self.web3_client,
+                    event_abi,
+                    self.start_block,
+                    self.end_block,
+                    [self.contract_address],
+                )
+            )
+        expected_events.sort(
+            key=lambda event: (event["blockNumber"], event["logIndex"])
+        )
+
+        events = _fetch_all_events_chunk(
+            self.web3_client,
+            self.event_abis,
+            self.start_block,
+            self.end_block,
+            [self.contract_address],
+        )
+
+        self.assertListEqual(events, expected_events)
+        self.assertListEqual(
+            [event["event"] for event in events],
+            ["Transfer", "Transfer", "Approval", "Transfer"],
+        )
+
+    def test_fetch_all_events_chunk_routes_shared_topic0_by_indexed_inputs(
+        self,
+    ) -> None:
+        erc721_transfer_abi = [
+            item
+            for item in ERC721.abi()
+            if item["type"] == "event" and item["name"] == "Transfer"
+        ]
+        decode_errors = []
+        events = _fetch_all_events_chunk(
+            self.web3_client,
+            erc721_transfer_abi + self.event_abis,
+            self.start_block,
+            self.end_block,
+            [self.contract_address],
+            on_decode_error=decode_errors.append,
+        )
+
+        self.assertListEqual(decode_errors, [])
+        transfers = [event for event in events if event["event"] == "Transfer"]
+        self.assertListEqual(
+            [transfer["args"]["value"] for transfer in transfers], [1000, 10, 20]
+        )
+
+    def test_crawl_all_events(self) -> None:
+        events, _ = _crawl_all_events(
+            self.web3_client,
+            self.event_abis,
+            self.start_block,
+            self.end_block,
+            1,
+            self.contract_address,
+            min_blocks_batch=1,
+        )
+        self.assertEqual(len(events), 4)
+        self.assertListEqual(
+            [(event["blockNumber"], event["logIndex"]) for event in events],
+            sorted((event["blockNumber"], event["logIndex"]) for event in events),
+        )
+
+
+class TestCrawlChunks(unittest.TestCase):
+    def setUp(self) -> None:
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def fetch_chunk(self, from_block: int, to_block: int):
+        with self.lock:
+            self.requests.append((from_block, to_block))
+        return [
+            {"blockNumber": block_number, "logIndex": 0}
+            for block_number in range(from_block, to_block + 1)
+            if block_number % 7 == 0
+        ]
+
+    def test_parallel_crawl_matches_sequential_crawl(self) -> None:
+        expected_events, _ = _crawl_chunks(
+            self.fetch_chunk, 1, 100000, 100, max_blocks_batch=5000
+        )
+        self.requests = []
+
+        events, _ = _crawl_chunks(
+            self.fetch_chunk, 1, 100000, 100, max_blocks_batch=5000, concurrency=4
+        )
+
+        self.assertListEqual(events, expected_events)
+        covered_blocks = sorted(
+            block_number
+            for from_block, to_block in self.requests
+            for block_number in range(from_block, to_block + 1)
+        )
+        self.assertListEqual(covered_blocks, list(range(1, 100001)))
+
+    def test_chunk_grid(self) -> None:
+        for concurrency in [1, 4]:
+            self.requests = []
+            events, _ = _crawl_chunks(
+                self.fetch_chunk,
+                1,
+                100000,
+                1000,
+                max_blocks_batch=5000,
+                min_blocks_batch=500,
+                concurrency=concurrency,
+                chunk_grid=500,
+            )
+            self.assertEqual(len(events), 100000 // 7)
+            # Batches are at least one cell long, so all of them but the last end at the end of a cell
+            ends = sorted(to_block for _, to_block in self.requests)
+            self.assertListEqual(
+                ends[:-1], [end for end in ends[:-1] if end % 500 == 499]
+            )
+            self.assertGreater(len(ends), 2)
+
+    def test_oversized_block_does_not_shrink_batches(self) -> None:
+        giant_block = 1500
+
+        def fetch_chunk(from_block: int, to_block: int):
+            if from_block < giant_block <= to_block and to_block > from_block:
+                raise ValueError("query returned more than 10000 results")
+            return self.fetch_chunk(from_block, to_block)
+
+        events, batch_size = _crawl_chunks(
+            fetch_chunk, 1, 20000, 1000, max_blocks_batch=5000
+        )
+
+        self.assertListEqual(
+            events,
+            [
+                {"blockNumber": block_number, "logIndex": 0}
+                for block_number in range(1, 20001)
+                if block_number % 7 == 0
+            ],
+        )
+        # Every block was requested successfully exactly once
+        covered_blocks = sorted(
+            block_number
+            for from_block, to_block in self.requests
+            for block_number in range(from_block, to_block + 1)
+        )
+        self.assertListEqual(covered_blocks, list(range(1, 20001)))
+        self.assertEqual(batch_size, 5000)
+
+
+class TestBisectWeb3Call(unittest.TestCase):
+    def test_keeps_completed_sub_ranges(self) -> None:
+        requests = []
+
+        def fetch(from_block: int, to_block: int):
+            requests.append((from_block, to_block))
+            if from_block <= 3 <= to_block and to_block - from_block >= 2:
+                raise ValueError("query returned more than 10000 results")
+            return list(range(from_block, to_block + 1))
+
+        results = _bisect_web3_call(fetch, 0, 15, RetryPolicy(max_retries=10, delay=0))
+
+        self.assertListEqual(results, list(range(16)))
+        self.assertListEqual(
+            requests, [(0, 15), (0, 7), (0, 3), (0, 1), (2, 3), (4, 7), (8, 15)]
+        )
+
+    def test_out_of_retries(self) -> None:
+        requests = []
+
+        def fetch(from_block: int, to_block: int):
+            requests.append((from_block, to_block))
+            raise ValueError("context cancelled")
+
+        with self.assertRaises(ValueError):
+            _bisect_web3_call(
+                fetch, 0, 15, RetryPolicy(max_retries=3, delay=0, min_range=8)
+            )
+        self.assertListEqual(requests, [(0, 15), (0, 7), (0, 7)])
+
+
+if __name__ == "__main__":
+    unittest.main()
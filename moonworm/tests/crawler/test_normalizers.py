@@ -0,0 +1,70 @@
+import unittest
+
+from web3 import Web3
+
+from moonworm.crawler.normalizers import ArgumentsNormalizer, build_normalizer
+
+ADDRESS = "0x00000000000000000000000000000000000000aa"
+
+STRUCT_INPUT = {
+    "name": "facets",
+    "type": "tuple[]",
+    "components": [
+        {"name": "facetAddress", "type": "address"},
+        {"name": "action", "type": "uint8"},
+        {"name": "functionSelectors", "type": "bytes4[]"},
+    ],
+}
+
+
+class TestNormalizers(unittest.TestCase):
+    def test_json_safe_types_need_no_normalizer(self) -> None:
+        for type_str in ["uint256", "int8", "bool", "string"]:
+            self.assertIsNone(build_normalizer({"name": "x", "type": type_str}))
+
+    def test_arguments_normalizer(self) -> None:
+        normalizer = ArgumentsNormalizer(
+            [
+                {"name": "owner", "type": "address"},
+                {"name": "value", "type": "uint256"},
+                {"name": "hashes", "type": "bytes32[2]"},
+                {"name": "data", "type": "bytes"},
+            ]
+        )
+        args = normalizer.normalize(
+            [ADDRESS, 2**255, (b"\x01" * 32, b"\x02" * 32), b"\xff"]
+        )
+        self.assertDictEqual(
+            args,
+            {
+                "owner": Web3.toChecksumAddress(ADDRESS),
+                "value": 2**255,
+                "hashes": ["0x" + "01" * 32, "0x" + "02" * 32],
+                "data": "0xff",
+            },
+        )
+
+    def test_tuples_as_lists_and_dicts(self) -> None:
+        value = ((ADDRESS, 1, (b"\x12\x34\x56\x78",)),)
+
+        as_lists = build_normalizer(STRUCT_INPUT)
+        self.assertListEqual(
+            as_lists(value),
+            [[Web3.toChecksumAddress(ADDRESS), 1, ["0x12345678"]]],
+        )
+
+        as_dicts = build_normalizer(STRUCT_INPUT, named_tuples=True)
+        self.assertListEqual(
+            as_dicts(value),
+            [
+                {
+                    "facetAddress": Web3.toChecksumAddress(ADDRESS),
+                    "action": 1,
+                    "functionSelectors": ["0x12345678"],
+                }
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
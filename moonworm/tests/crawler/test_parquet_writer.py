@@ -0,0 +1,157 @@
+import glob
+import os
+import tempfile
+import unittest
+from dataclasses import replace
+
+from moonworm.contracts import ERC20
+from moonworm.crawler.function_call_crawler import ContractFunctionCall
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from moonworm.crawler.parquet_writer import ParquetExporter, arrow_type
+except ImportError:
+    pa = None
+
+SENDER = "0x" + "01" * 20
+RECEIVER = "0x" + "02" * 20
+
+
+def transfer(block_number: int):
+    return {
+        "event": "Transfer",
+        "args": {"from": SENDER, "to": RECEIVER, "value": 10**30 + block_number},
+        "address": "0x" + "ab" * 20,
+        "blockHash": "0x" + format(block_number, "064x"),
+        "blockNumber": block_number,
+        "transactionHash": "0x" + format(block_number, "064x"),
+        "logIndex": 0,
+    }
+
+
+def approve_call(block_number: int) -> ContractFunctionCall:
+    return ContractFunctionCall(
+        block_hash="0x" + format(block_number, "064x"),
+        block_number=block_number,
+        block_timestamp=1600000000 + block_number,
+        transaction_hash="0x" + format(block_number, "064x"),
+        contract_address="0x" + "ab" * 20,
+        caller_address=SENDER,
+        function_name="approve",
+        function_args={"spender": RECEIVER, "amount": 5},
+        gas_used=21000,
+        status=1,
+    )
+
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class TestParquetExporter(unittest.TestCase):
+    def test_arrow_types(self) -> None:
+        self.assertEqual(arrow_type("uint8"), pa.uint64())
+        self.assertEqual(arrow_type("int64"), pa.int64())
+        self.assertEqual(arrow_type("uint256"), pa.string())
+        self.assertEqual(arrow_type("uint"), pa.string())
+        self.assertEqual(arrow_type("bytes32"), pa.binary())
+        self.assertEqual(arrow_type("address[]"), pa.string())
+        self.assertTrue(pa.types.is_dictionary(arrow_type("address")))
+
+    def test_export(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        exporter = ParquetExporter(directory.name, ERC20.abi(), row_group_blocks=100)
+        for from_block in range(0, 300, 50):
+            exporter.add_events(
+                [transfer(block) for block in range(from_block, from_block + 50, 5)]
+            )
+            exporter.add_calls([approve_call(from_block)])
+            exporter.end_block_range(from_block + 49)
+        exporter.close()
+
+        self.assertListEqual(
+            sorted(os.listdir(directory.name)),
+            ["calls-approve-0000000000.parquet", "events-Transfer-0000000000.parquet"],
+        )
+        events_file = pq.ParquetFile(
+            glob.glob(os.path.join(directory.name, "events-*"))[0]
+        )
+        # One row group per 100 blocks
+        self.assertEqual(events_file.num_row_groups, 3)
+        table = events_file.read()
+        self.assertEqual(table.num_rows, 60)
+        self.assertTrue(pa.types.is_dictionary(table.schema.field("arg_from").type))
+        self.assertTrue(pa.types.is_dictionary(table.schema.field("event").type))
+        self.assertEqual(table.column("arg_value")[1].as_py(), str(10**30 + 5))
+        self.assertEqual(table.column("arg_to")[0].as_py(), RECEIVER)
+
+        calls = pq.read_table(glob.glob(os.path.join(directory.name, "calls-*"))[0])
+        self.assertListEqual(calls.column("arg_amount").to_pylist(), ["5"] * 6)
+        self.assertEqual(exporter.metrics["rows_written"], 66)
+
+    def test_overloaded_methods(self) -> None:
+        def function_abi(name, inputs):
+            return {
+                "type": "function",
+                "name": name,
+                "inputs": [{"name": n, "type": t} for n, t in inputs],
+                "outputs": [],
+            }
+
+        abi = [
+            function_abi(
+                "safeTransferFrom",
+                [("from", "address"), ("to", "address"), ("tokenId", "uint256")],
+            ),
+            function_abi(
+                "safeTransferFrom",
+                [
+                    ("from", "address"),
+                    ("to", "address"),
+                    ("tokenId", "uint256"),
+                    ("data", "bytes"),
+                ],
+            ),
+            function_abi("set", [("value", "uint8")]),
+            function_abi("set", [("value", "string")]),
+        ]
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        exporter = ParquetExporter(directory.name, abi)
+
+        def call(block_number, function_name, function_args):
+            return replace(
+                approve_call(block_number),
+                function_name=function_name,
+                function_args=function_args,
+            )
+
+        exporter.add_calls(
+            [
+                call(
+                    1,
+                    "safeTransferFrom",
+                    {"from": SENDER, "to": RECEIVER, "tokenId": 1},
+                ),
+                call(
+                    2,
+                    "safeTransferFrom",
+                    {"from": SENDER, "to": RECEIVER, "tokenId": 2, "data": b"\x01"},
+                ),
+                call(3, "set", {"value": 7}),
+                call(4, "set", {"value": "seven"}),
+            ]
+        )
+        exporter.close()
+
+        transfers = pq.read_table(
+            glob.glob(os.path.join(directory.name, "calls-safeTransferFrom-*"))[0]
+        )
+        self.assertListEqual(transfers.column("arg_tokenId").to_pylist(), ["1", "2"])
+        self.assertListEqual(transfers.column("arg_data").to_pylist(), [None, b"\x01"])
+        sets = pq.read_table(glob.glob(os.path.join(directory.name, "calls-set-*"))[0])
+        self.assertListEqual(sets.column("arg_value").to_pylist(), ["7", '"seven"'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import web3
+
+from moonworm.crawler.provider_pool import PooledHTTPProvider
+from moonworm.web3_util import connect
+
+
+class JSONRPCHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        if self.server.status != 200:
+            self.send_response(self.server.status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if body["method"] == "eth_getLogs":
+            time.sleep(self.server.get_logs_delay)
+        response = {"jsonrpc": "2.0", "id": body["id"]}
+        if body["method"] == "eth_call":
+            response["error"] = {"code": 3, "message": "execution reverted"}
+        else:
+            response["result"] = self.server.result
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPooledHTTPProvider(unittest.TestCase):
+    def start_node(self, result="0x10", status=200, get_logs_delay=0.0) -> str:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), JSONRPCHandler)
+        server.daemon_threads = True
+        server.requests = []
+        server.result = result
+        server.status = status
+        server.get_logs_delay = get_logs_delay
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    def setUp(self) -> None:
+        self.servers = []
+
+    def test_spreads_requests(self) -> None:
+        uris = [self.start_node() for _ in range(3)]
+        web3_client = web3.Web3(PooledHTTPProvider(uris))
+
+        for _ in range(60):
+            self.assertEqual(web3_client.eth.block_number, 16)
+        for server in self.servers:
+            self.assertGreater(len(server.requests), 0)
+
+    def test_circuit_breaker(self) -> None:
+        failing_uri = self.start_node()
+        healthy_uri = self.start_node()
+        provider = PooledHTTPProvider(
+            [failing_uri, healthy_uri], failure_threshold=2, cooldown=60
+        )
+        web3_client = web3.Web3(provider)
+        for _ in range(10):
+            self.assertEqual(web3_client.eth.block_number, 16)
+
+        # The failing endpoint looks like the better choice
+        self.servers[0].status = 503
+        self.servers[0].requests = []
+        provider.endpoints[0].latency = 0.001
+        provider.endpoints[1].latency = 1.0
+
+        for _ in range(20):
+            self.assertEqual(web3_client.eth.block_number, 16)
+        # Taken out of the pool after two failures
+        self.assertEqual(len(self.servers[0].requests), 2)
+        self.assertEqual(provider.metrics["circuit_breaker_openings"], 1)
+        self.assertEqual(provider.metrics["failovers"], 2)
+        self.assertTrue(provider.endpoint_metrics()[failing_uri]["circuit_open"])
+
+    def test_all_endpoints_failing(self) -> None:
+        provider = PooledHTTPProvider([self.start_node(status=503)])
+        with self.assertRaises(Exception):
+            web3.Web3(provider).eth.block_number
+
+    def test_request_errors_are_not_failed_over(self) -> None:
+        uris = [self.start_node() for _ in range(2)]
+        provider = PooledHTTPProvider(uris)
+        with self.assertRaises(ValueError):
+            web3.Web3(provider).manager.request_blocking("eth_call", [{}, "latest"])
+        self.assertEqual(
+            [
+                request["method"]
+                for server in self.servers
+                for request in server.requests
+            ].count("eth_call"),
+            1,
+        )
+        self.assertEqual(provider.metrics["failovers"], 0)
+
+    def test_hedged_requests(self) -> None:
+        slow_uri = self.start_node(result=[], get_logs_delay=2.0)
+        fast_uri = self.start_node(result=[])
+        provider = PooledHTTPProvider([slow_uri, fast_uri], hedge_delay=0.1)
+        # The slow endpoint looks like the better choice
+        provider.endpoints[0].latency = 0.001
+        provider.endpoints[1].latency = 0.01
+
+        start = time.time()
+        self.assertListEqual(
+            web3.Web3(provider).eth.get_logs({"fromBlock": 1, "toBlock": 2}), []
+        )
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(provider.metrics["hedged_requests"], 1)
+        self.assertEqual(provider.metrics["hedges_won"], 1)
+
+        # Other methods are not hedged
+        provider.make_request("eth_blockNumber", [])
+        self.assertEqual(provider.metrics["hedged_requests"], 1)
+
+    def test_connect(self) -> None:
+        uris = [self.start_node() for _ in range(2)]
+        web3_client = connect(",".join(uris))
+        self.assertIsInstance(web3_client.provider, PooledHTTPProvider)
+        self.assertListEqual(web3_client.provider.endpoint_uris, uris)
+        self.assertEqual(web3_client.eth.block_number, 16)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from web3 import AsyncHTTPProvider, Web3
+from web3.eth import AsyncEth
+
+from moonworm.contracts import ERC20
+from moonworm.crawler.async_log_scanner import AsyncEventScanner
+from moonworm.crawler.batch_rpc import get_block_timestamps
+from moonworm.crawler.rate_limit import (
+    RateLimiter,
+    TokenBucket,
+    get_rate_limiter,
+    remove_rate_limit,
+    set_rate_limit,
+)
+from moonworm.web3_util import connect, connect_async
+
+
+class JSONRPCHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        requests = body if isinstance(body, list) else [body]
+        with self.server.lock:
+            self.server.request_times.extend(time.monotonic() for _ in requests)
+        responses = [
+            {
+                "jsonrpc": "2.0",
+                "id": request["id"],
+                "result": (
+                    {
+                        "number": request["params"][0],
+                        "hash": "0x" + "11" * 32,
+                        "parentHash": "0x" + "22" * 32,
+                        "timestamp": "0x10",
+                    }
+                    if request["method"] == "eth_getBlockByNumber"
+                    else "0x10"
+                ),
+            }
+            for request in requests
+        ]
+        data = json.dumps(responses if isinstance(body, list) else responses[0])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data.encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_rate(self) -> None:
+        bucket = TokenBucket(rate=20, capacity=5)
+        delays = [bucket.reserve() for _ in range(10)]
+        self.assertListEqual(delays[:5], [0.0] * 5)
+        # Every further unit is available 1/20 seconds after the previous one
+        for i, delay in enumerate(delays[5:]):
+            self.assertAlmostEqual(delay, (i + 1) / 20, delta=0.01)
+
+    def test_refill_is_capped(self) -> None:
+        bucket = TokenBucket(rate=1000, capacity=2)
+        time.sleep(0.05)
+        self.assertEqual(bucket.reserve(2), 0.0)
+        self.assertGreater(bucket.reserve(1), 0.0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_compute_units(self) -> None:
+        limiter = RateLimiter(
+            compute_units_per_second=100, compute_units={"eth_getLogs": 50}
+        )
+        self.assertEqual(limiter.reserve(["eth_getLogs", "eth_getLogs"]), 0.0)
+        self.assertAlmostEqual(limiter.reserve(["eth_getLogs"]), 0.5, delta=0.01)
+        # Free methods are never held back
+        self.assertEqual(limiter.reserve(["eth_chainId"]), 0.0)
+        self.assertEqual(limiter.metrics["compute_units"], 150)
+        self.assertEqual(limiter.metrics["throttled_requests"], 1)
+
+    def test_method_limits(self) -> None:
+        limiter = RateLimiter(method_requests_per_second={"eth_getLogs": 1})
+        self.assertEqual(limiter.reserve(["eth_getLogs"]), 0.0)
+        self.assertEqual(limiter.reserve(["eth_blockNumber"]), 0.0)
+        self.assertAlmostEqual(limiter.reserve(["eth_getLogs"]), 1.0, delta=0.01)
+
+
+class TestRateLimitedEndpoint(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), JSONRPCHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.request_times = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.uri = f"http://127.0.0.1:{self.server.server_port}"
+        self.addCleanup(remove_rate_limit, self.uri)
+
+    def test_clients_share_the_limit(self) -> None:
+        limiter = set_rate_limit(self.uri, requests_per_second=20, burst_seconds=0.1)
+        clients = [connect(self.uri) for _ in range(4)]
+
+        def _crawl(client) -> None:
+            for _ in range(5):
+                client.eth.block_number
+
+        threads = [
+            threading.Thread(target=_crawl, args=(client,)) for client in clients
+        ]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(limiter.metrics["requests"], 20)
+        # The first two requests make up the burst, the others are 1/20 seconds apart
+        self.assertGreaterEqual(time.monotonic() - start, 18 / 20 - 0.05)
+        self.assertEqual(len(self.server.request_times), 20)
+
+    def test_batches_count_every_call(self) -> None:
+        limiter = set_rate_limit(self.uri, compute_units_per_second=1000)
+        client = connect(self.uri)
+        get_block_timestamps(client, list(range(10)))
+        self.assertEqual(limiter.metrics["requests"], 10)
+        self.assertEqual(limiter.metrics["compute_units"], 160)
+
+    def test_connect_sets_limits(self) -> None:
+        client = connect(self.uri, requests_per_second=1000)
+        client.eth.block_number
+        client.eth.block_number
+        self.assertEqual(get_rate_limiter(self.uri).metrics["requests"], 2)
+
+    def test_async_clients(self) -> None:
+        client = connect_async(self.uri, requests_per_second=1000)
+
+        async def _block_numbers():
+            return [await client.eth.block_number for _ in range(3)]
+
+        self.assertListEqual(asyncio.run(_block_numbers()), [16] * 3)
+        self.assertEqual(get_rate_limiter(self.uri).metrics["requests"], 3)
+
+    def test_async_event_scanner_adds_the_middleware(self) -> None:
+        limiter = set_rate_limit(self.uri, requests_per_second=1000)
+        client = Web3(
+            AsyncHTTPProvider(self.uri), modules={"eth": (AsyncEth,)}, middlewares=[]
+        )
+        AsyncEventScanner(
+            client, [item for item in ERC20.abi() if item["type"] == "event"]
+        )
+        asyncio.run(client.eth.block_number)
+        self.assertEqual(limiter.metrics["requests"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
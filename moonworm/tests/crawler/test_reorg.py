@@ -0,0 +1,289 @@
+import threading
+import unittest
+from typing import Any, Dict, List
+
+from hexbytes import HexBytes
+from web3.exceptions import BlockNotFound
+
+from moonworm.crawler.head_tracker import HeadTracker
+from moonworm.crawler.log_scanner import EventScanner
+from moonworm.crawler.reorg import HeadersUnavailable, ReorgDetector
+from moonworm.crawler.state import EventScannerState
+
+
+def block_hash(branch: int, block_number: int) -> HexBytes:
+    return HexBytes(format(branch * 10**6 + block_number + 1, "064x"))
+
+
+class FakeChain:
+    """
+    A chain of blocks with one event each, which can be reorganized.
+    """
+
+    def __init__(self, length: int) -> None:
+        self.blocks: List[Dict[str, Any]] = []
+        self.extend(length)
+
+    def extend(self, num_blocks: int, branch: int = 0) -> None:
+        for _ in range(num_blocks):
+            block_number = len(self.blocks)
+            self.blocks.append(
+                {
+                    "number": block_number,
+                    "hash": block_hash(branch, block_number),
+                    "parentHash": (
+                        self.blocks[-1]["hash"] if self.blocks else HexBytes(32)
+                    ),
+                    "timestamp": 1600000000 + 12 * block_number + branch,
+                }
+            )
+
+    def reorg(self, fork_block: int, length: int, branch: int) -> None:
+        """
+        Replaces the blocks from fork_block onwards by a new branch, which ends at block length - 1.
+        """
+        del self.blocks[fork_block:]
+        self.extend(length - fork_block, branch)
+
+    def events(self, from_block: int, to_block: int) -> List[Dict[str, Any]]:
+        return [
+            {
+                "event": "Ping",
+                "args": {},
+                "blockNumber": block["number"],
+                "blockHash": block["hash"],
+                "logIndex": 0,
+            }
+            for block in self.blocks[from_block : to_block + 1]
+        ]
+
+
+class FakeEth:
+    def __init__(self, chain: FakeChain) -> None:
+        self.chain = chain
+        # Head reported by another endpoint which is ahead of this one, if any
+        self.reported_head = None
+
+    @property
+    def block_number(self) -> int:
+        if self.reported_head is not None:
+            return self.reported_head
+        return len(self.chain.blocks) - 1
+
+    def get_block(self, block_number: int) -> Dict[str, Any]:
+        if block_number >= len(self.chain.blocks):
+            raise BlockNotFound(block_number)
+        return self.chain.blocks[block_number]
+
+
+class FakeWeb3:
+    codec = None
+
+    def __init__(self, chain: FakeChain) -> None:
+        self.provider = None
+        self.eth = FakeEth(chain)
+
+
+class FakeChainScanner(EventScanner):
+    def __init__(self, chain: FakeChain, state: EventScannerState, **kwargs) -> None:
+        super().__init__(FakeWeb3(chain), [], scanner_state=state, **kwargs)
+        self.chain = chain
+
+    def _fetch_chunk_events(self, start_block, end_block):
+        return self.chain.events(start_block, end_block)
+
+
+class ListState(EventScannerState):
+    def __init__(self) -> None:
+        self.events = []
+        self.last_scanned_block = 0
+        self.deleted_since = []
+
+    def get_last_scanned_block(self) -> int:
+        return self.last_scanned_block
+
+    def start_chunk(self, block_number, chunk_size=None):
+        pass
+
+    def end_chunk(self, block_number):
+        self.last_scanned_block = block_number
+
+    def process_event(self, block_when, event):
+        self.events.append(event)
+        return event["blockNumber"]
+
+    def delete_data(self, since_block):
+        self.deleted_since.append(since_block)
+        self.events = [
+            event for event in self.events if event["blockNumber"] < since_block
+        ]
+        self.last_scanned_block = min(self.last_scanned_block, since_block - 1)
+
+
+class TestReorgDetector(unittest.TestCase):
+    def setUp(self) -> None:
+        self.chain = FakeChain(100)
+        self.detector = ReorgDetector(FakeWeb3(self.chain), max_depth=10)
+
+    def test_advance_without_reorg(self) -> None:
+        self.assertIsNone(self.detector.advance(0, 89))
+        self.assertIsNone(self.detector.advance(90, 99))
+        self.assertEqual(self.detector.last_block, 99)
+        self.assertIsNone(self.detector.get_hash(89))
+        self.assertEqual(self.detector.get_hash(90), block_hash(0, 90).hex())
+        # Only the last max_depth blocks of the first range were fetched
+        self.assertEqual(self.detector.metrics["headers_fetched"], 10 + 1 + 10)
+        self.assertEqual(self.detector.metrics["reorgs"], 0)
+
+    def test_exact_fork_block(self) -> None:
+        self.detector.advance(90, 99)
+        self.chain.reorg(96, 102, branch=1)
+
+        self.assertEqual(self.detector.advance(100, 101), 96)
+        self.assertEqual(self.detector.last_block, 95)
+        self.assertEqual(self.detector.metrics["reorgs"], 1)
+        self.assertEqual(self.detector.metrics["max_reorg_depth"], 4)
+
+        self.assertIsNone(self.detector.advance(96, 101))
+        self.assertEqual(self.detector.get_hash(96), block_hash(1, 96).hex())
+
+    def test_shorter_branch(self) -> None:
+        self.detector.advance(90, 99)
+        self.chain.reorg(98, 99, branch=1)
+        # Nothing new to advance over, the last recorded block is checked
+        self.assertEqual(self.detector.advance(100, 98), 98)
+
+    def test_reorg_deeper_than_max_depth(self) -> None:
+        self.detector.advance(90, 99)
+        self.chain.reorg(50, 100, branch=1)
+        self.assertEqual(self.detector.advance(100, 99), 90)
+
+    def test_headers_unavailable(self) -> None:
+        detector = ReorgDetector(FakeWeb3(self.chain), max_depth=10, retry_seconds=0)
+        with self.assertRaises(HeadersUnavailable):
+            detector.advance(90, 102)
+        self.assertIsNone(detector.get_hash(90))
+
+        self.chain.extend(3)
+        self.assertIsNone(detector.advance(90, 102))
+        self.assertEqual(detector.last_block, 102)
+
+    def test_find_mismatch(self) -> None:
+        self.detector.advance(90, 99)
+        events = self.chain.events(90, 99)
+        self.assertIsNone(self.detector.find_mismatch(events))
+        self.chain.reorg(95, 100, branch=1)
+        self.assertEqual(self.detector.find_mismatch(self.chain.events(90, 99)), 95)
+
+    def test_find_mismatch_with_str_hashes(self) -> None:
+        # Calls from MoonstreamEthereumStateProvider carry block hashes as hex strings
+        self.detector.advance(90, 99)
+        calls = [
+            {"blockNumber": event["blockNumber"], "blockHash": event["blockHash"].hex()}
+            for event in self.chain.events(90, 99)
+        ]
+        self.assertIsNone(self.detector.find_mismatch(calls))
+        self.assertIsNone(
+            self.detector.find_mismatch(
+                [{**call, "blockHash": call["blockHash"].upper()[2:]} for call in calls]
+            )
+        )
+        self.chain.reorg(97, 100, branch=1)
+        calls = [
+            {"blockNumber": event["blockNumber"], "blockHash": event["blockHash"].hex()}
+            for event in self.chain.events(90, 99)
+        ]
+        self.assertEqual(self.detector.find_mismatch(calls), 97)
+
+
+class TestEventScannerIterFollow(unittest.TestCase):
+    def follow(self, scanner: EventScanner, **kwargs):
+        head_tracker = HeadTracker(scanner.web3, target_latency=0.01)
+        self.addCleanup(head_tracker.stop)
+        return scanner.iter_follow(
+            0,
+            num_confirmations=10,
+            poll_interval=0.05,
+            head_tracker=head_tracker,
+            **kwargs,
+        )
+
+    def test_provisional_events_and_retraction(self) -> None:
+        chain = FakeChain(50)
+        state = ListState()
+        scanner = FakeChainScanner(chain, state)
+
+        batches = self.follow(scanner, end_block=60)
+        batch = next(batches)
+        while batch.end_block < 49:
+            batch = next(batches)
+        self.assertEqual(batch.confirmed_block, 39)
+        self.assertTrue(batch.is_provisional(batch.events[-1]))
+        self.assertFalse(batch.is_provisional({"blockNumber": 39}))
+        self.assertEqual(len(state.events), 50)
+
+        chain.reorg(45, 53, branch=1)
+        batch = next(batches)
+        self.assertEqual(batch.retracted_from_block, 45)
+        self.assertEqual(batch.cursor, 44)
+        self.assertListEqual(batch.events, [])
+        # Exactly the replaced blocks were deleted
+        self.assertListEqual(state.deleted_since, [45])
+        self.assertEqual(len(state.events), 45)
+
+        batch = next(batches)
+        self.assertEqual(batch.start_block, 45)
+        self.assertIsNone(batch.retracted_from_block)
+        self.assertEqual(batch.events[0]["blockHash"], block_hash(1, 45))
+
+        chain.extend(10, branch=1)
+        for batch in batches:
+            pass
+        self.assertEqual(batch.end_block, 60)
+        self.assertListEqual(
+            [event["blockHash"] for event in state.events],
+            [block_hash(0, n) for n in range(45)]
+            + [block_hash(1, n) for n in range(45, 61)],
+        )
+
+    def test_lagging_endpoint(self) -> None:
+        chain = FakeChain(50)
+        state = ListState()
+        scanner = FakeChainScanner(chain, state)
+        scanner.reorg_detector = ReorgDetector(
+            scanner.web3, max_depth=10, retry_seconds=0
+        )
+        # The head tracker reports blocks which the endpoint only serves a bit later
+        scanner.web3.eth.reported_head = 52
+        timer = threading.Timer(0.2, chain.extend, (3,))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        batches = list(self.follow(scanner, end_block=52))
+        self.assertEqual(batches[-1].end_block, 52)
+        self.assertListEqual(
+            [event["blockNumber"] for event in state.events], list(range(53))
+        )
+
+    def test_suggested_scan_start_block(self) -> None:
+        chain = FakeChain(30)
+        state = ListState()
+        scanner = FakeChainScanner(chain, state)
+        for _ in self.follow(scanner, end_block=29):
+            pass
+        self.assertEqual(scanner.get_suggested_scan_start_block(), 30)
+
+        chain.reorg(27, 31, branch=1)
+        self.assertEqual(scanner.get_suggested_scan_start_block(), 27)
+        self.assertListEqual(state.deleted_since, [27])
+
+        # Without records of the scanned blocks, the scanner rescans blindly
+        scanner = FakeChainScanner(chain, state)
+        self.assertEqual(
+            scanner.get_suggested_scan_start_block(),
+            26 - EventScanner.NUM_BLOCKS_RESCAN_FOR_FORKS,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
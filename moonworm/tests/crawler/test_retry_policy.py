@@ -0,0 +1,151 @@
+import unittest
+
+import requests
+
+from moonworm.crawler.log_scanner import _bisect_web3_call
+from moonworm.crawler.retry_policy import (
+    RATE_LIMITED,
+    TIMEOUT,
+    TOO_MANY_RESULTS,
+    TRANSIENT,
+    UNKNOWN,
+    RetryPolicy,
+    classify_error,
+)
+
+
+def http_error(status_code: int, headers=None) -> requests.exceptions.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return requests.exceptions.HTTPError(f"{status_code} Error", response=response)
+
+
+class TestClassifyError(unittest.TestCase):
+    def test_too_many_results_with_hint_in_data(self) -> None:
+        classified = classify_error(
+            ValueError(
+                {
+                    "code": -32005,
+                    "message": "query returned more than 10000 results",
+                    "data": {"from": "0x10", "to": "0x1f"},
+                }
+            )
+        )
+        self.assertEqual(classified.kind, TOO_MANY_RESULTS)
+        self.assertEqual(classified.hinted_range, (16, 31))
+
+    def test_too_many_results_with_hint_in_message(self) -> None:
+        classified = classify_error(
+            ValueError(
+                {
+                    "code": -32602,
+                    "message": "Log response size exceeded. Based on your parameters, this block range should work: [0x10, 0x1f]",
+                }
+            )
+        )
+        self.assertEqual(classified.kind, TOO_MANY_RESULTS)
+        self.assertEqual(classified.hinted_range, (16, 31))
+
+    def test_rate_limited(self) -> None:
+        classified = classify_error(http_error(429, {"Retry-After": "7"}))
+        self.assertEqual(classified.kind, RATE_LIMITED)
+        self.assertEqual(classified.retry_after, 7.0)
+
+    def test_other_kinds(self) -> None:
+        self.assertEqual(
+            classify_error(requests.exceptions.ReadTimeout("Read timed out.")).kind,
+            TIMEOUT,
+        )
+        self.assertEqual(
+            classify_error(ValueError({"message": "context canceled"})).kind, TIMEOUT
+        )
+        self.assertEqual(
+            classify_error(requests.exceptions.ConnectionError("reset")).kind,
+            TRANSIENT,
+        )
+        self.assertEqual(classify_error(http_error(503)).kind, TRANSIENT)
+        self.assertEqual(classify_error(ValueError("execution reverted")).kind, UNKNOWN)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_jumps_to_hinted_range(self) -> None:
+        requests_made = []
+
+        def fetch(from_block: int, to_block: int):
+            requests_made.append((from_block, to_block))
+            if to_block - from_block >= 10:
+                raise ValueError(
+                    {
+                        "message": "query returned more than 10000 results",
+                        "data": {"from": hex(from_block), "to": hex(from_block + 9)},
+                    }
+                )
+            return list(range(from_block, to_block + 1))
+
+        policy = RetryPolicy(delay=0)
+        results = _bisect_web3_call(fetch, 0, 24, policy)
+
+        self.assertListEqual(results, list(range(25)))
+        self.assertListEqual(
+            requests_made, [(0, 24), (0, 9), (10, 24), (10, 19), (20, 24)]
+        )
+        self.assertEqual(policy.metrics["hinted_splits"], 2)
+        self.assertEqual(policy.metrics["bisections"], 0)
+
+    def test_reports_failed_ranges(self) -> None:
+        def fetch(from_block: int, to_block: int):
+            if to_block - from_block >= 10:
+                raise ValueError({"message": "query timeout exceeded"})
+            return list(range(from_block, to_block + 1))
+
+        failed_ranges = []
+        results = _bisect_web3_call(
+            fetch, 0, 24, RetryPolicy(delay=0), on_failure=failed_ranges.append
+        )
+
+        self.assertListEqual(results, list(range(25)))
+        self.assertListEqual(failed_ranges, [25, 13, 12])
+
+    def test_splits_single_block_by_addresses(self) -> None:
+        addresses = ["0xa", "0xb", "0xc"]
+
+        def fetch(from_block: int, to_block: int, fetch_addresses):
+            if len(fetch_addresses) > 1:
+                raise ValueError({"message": "query returned more than 10000 results"})
+            return [
+                {
+                    "blockNumber": from_block,
+                    "logIndex": addresses.index(fetch_addresses[0]),
+                }
+            ]
+
+        policy = RetryPolicy(delay=0)
+        results = _bisect_web3_call(fetch, 5, 5, policy, addresses=addresses)
+
+        self.assertListEqual(
+            results, [{"blockNumber": 5, "logIndex": index} for index in range(3)]
+        )
+        self.assertEqual(policy.metrics["address_splits"], 2)
+
+    def test_rate_limit_honours_retry_after(self) -> None:
+        policy = RetryPolicy(delay=0.1)
+        action = policy.on_error(http_error(429, {"Retry-After": "7"}), 0, 10)
+        self.assertEqual(action.requests, [])
+        self.assertEqual(action.delay, 7.0)
+
+        action = policy.on_error(http_error(429), 0, 10, attempt=3)
+        self.assertGreaterEqual(action.delay, 0.4)
+        self.assertLessEqual(action.delay, 0.8)
+
+    def test_transient_errors_retry_immediately(self) -> None:
+        policy = RetryPolicy(delay=1.0)
+        error = requests.exceptions.ConnectionError("Connection reset by peer")
+        self.assertEqual(policy.on_error(error, 0, 1000).delay, 0.0)
+        self.assertEqual(policy.on_error(error, 0, 1000).requests, [])
+        self.assertGreater(policy.on_error(error, 0, 1000, attempt=1).delay, 0.0)
+        self.assertEqual(policy.metrics[TRANSIENT], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
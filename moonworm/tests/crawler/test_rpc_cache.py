@@ -0,0 +1,200 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from web3 import Web3
+
+from moonworm.crawler.batch_rpc import get_transaction_receipts
+from moonworm.crawler.rpc_cache import ResponseCache, add_response_cache
+from moonworm.web3_util import connect
+
+HEAD = 1000
+ADDRESS = Web3.toChecksumAddress("0x" + "ab" * 20)
+
+
+def log(block_number: int):
+    return {
+        "address": ADDRESS,
+        "blockNumber": hex(block_number),
+        "blockHash": "0x" + format(block_number, "064x"),
+        "transactionHash": "0x" + format(block_number, "064x"),
+        "transactionIndex": "0x0",
+        "logIndex": "0x0",
+        "data": "0x",
+        "topics": [],
+        "removed": False,
+    }
+
+
+def rpc_result(server, request):
+    method = request["method"]
+    server.requests[method] += 1
+    if method == "eth_chainId":
+        return "0x1"
+    if method == "eth_blockNumber":
+        return hex(HEAD)
+    if method == "eth_getLogs":
+        log_filter = request["params"][0]
+        # One log every 10 blocks
+        return [
+            log(block_number)
+            for block_number in range(
+                int(log_filter["fromBlock"], 16), int(log_filter["toBlock"], 16) + 1
+            )
+            if block_number % 10 == 0
+        ]
+    if method == "eth_getBlockByNumber":
+        block_number = (
+            HEAD if request["params"][0] == "latest" else int(request["params"][0], 16)
+        )
+        return {
+            "number": hex(block_number),
+            "hash": "0x" + format(block_number, "064x"),
+            "timestamp": hex(1600000000 + block_number),
+        }
+    if method == "eth_getTransactionReceipt":
+        # Transaction hashes are the numbers of their blocks
+        block_number = int(request["params"][0], 16)
+        return {
+            "blockNumber": hex(block_number),
+            "transactionHash": request["params"][0],
+            "status": "0x1",
+        }
+    return None
+
+
+class JSONRPCHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if isinstance(request, list):
+            self.server.batches += 1
+            response = [
+                {
+                    "jsonrpc": "2.0",
+                    "id": item["id"],
+                    "result": rpc_result(self.server, item),
+                }
+                for item in request
+            ]
+        else:
+            response = {
+                "jsonrpc": "2.0",
+                "id": request["id"],
+                "result": rpc_result(self.server, request),
+            }
+        data = json.dumps(response)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data.encode("utf-8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), JSONRPCHandler)
+        self.server.daemon_threads = True
+        self.server.requests = Counter()
+        self.server.batches = 0
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "cache.sqlite")
+
+    def client(self, **kwargs):
+        web3_client = connect(f"http://127.0.0.1:{self.server.server_port}")
+        cache = ResponseCache(self.path, finality_depth=10, **kwargs)
+        self.addCleanup(cache.close)
+        add_response_cache(web3_client, cache)
+        return web3_client, cache
+
+    def get_logs(self, web3_client, from_block: int, to_block: int):
+        return web3_client.eth.get_logs(
+            {"fromBlock": from_block, "toBlock": to_block, "address": ADDRESS}
+        )
+
+    def test_rerun_is_served_from_disk(self) -> None:
+        web3_client, _ = self.client()
+        logs = self.get_logs(web3_client, 100, 199)
+        block = web3_client.eth.get_block(150)
+        self.assertEqual(len(logs), 10)
+        self.assertEqual(self.server.requests["eth_getLogs"], 1)
+
+        # A new process with the same cache file
+        web3_client, cache = self.client()
+        self.assertListEqual(self.get_logs(web3_client, 100, 199), logs)
+        self.assertEqual(web3_client.eth.get_block(150), block)
+        self.assertEqual(self.server.requests["eth_getLogs"], 1)
+        self.assertEqual(self.server.requests["eth_getBlockByNumber"], 1)
+        self.assertEqual(cache.metrics["hits"], 2)
+
+    def test_blocks_which_are_not_final_are_not_cached(self) -> None:
+        web3_client, _ = self.client()
+        self.get_logs(web3_client, 980, 995)
+        self.get_logs(web3_client, 980, 995)
+        web3_client.eth.get_block("latest")
+        web3_client.eth.get_block("latest")
+        self.assertEqual(self.server.requests["eth_getLogs"], 2)
+        self.assertEqual(self.server.requests["eth_getBlockByNumber"], 2)
+
+    def test_batches(self) -> None:
+        web3_client, _ = self.client()
+        transaction_hashes = ["0x" + format(n, "064x") for n in range(980, 1000, 2)]
+        receipts, _ = get_transaction_receipts(web3_client, transaction_hashes)
+        self.assertEqual(len(receipts), 10)
+        self.assertEqual(self.server.batches, 1)
+
+        # Receipts of final blocks are served from disk, the others are requested again
+        web3_client, cache = self.client()
+        self.assertDictEqual(
+            get_transaction_receipts(web3_client, transaction_hashes)[0], receipts
+        )
+        self.assertEqual(self.server.batches, 2)
+        self.assertEqual(self.server.requests["eth_getTransactionReceipt"], 14)
+        self.assertEqual(cache.metrics["hits"], 6)
+
+    def test_grid(self) -> None:
+        web3_client, _ = self.client(grid=100)
+        logs = self.get_logs(web3_client, 100, 399)
+        self.assertEqual(self.server.requests["eth_getLogs"], 1)
+
+        # Any range made of whole cells is served from the cache
+        self.assertListEqual(self.get_logs(web3_client, 200, 299), logs[10:20])
+        self.assertListEqual(self.get_logs(web3_client, 100, 399), logs)
+        self.assertEqual(self.server.requests["eth_getLogs"], 1)
+
+        # Blocks outside of whole cells are requested
+        self.assertListEqual(self.get_logs(web3_client, 150, 399), logs[5:])
+        self.assertEqual(self.server.requests["eth_getLogs"], 2)
+
+        # Other filters are stored separately
+        web3_client.eth.get_logs({"fromBlock": 100, "toBlock": 199})
+        self.assertEqual(self.server.requests["eth_getLogs"], 3)
+
+    def test_size_budget(self) -> None:
+        cache = ResponseCache(self.path, max_bytes=1000)
+        self.addCleanup(cache.close)
+        for i in range(20):
+            cache.put(str(i), "x" * 100)
+            # Keeps the first result in use
+            self.assertTrue(cache.get("0")[0])
+        self.assertLessEqual(cache.metrics["bytes_stored"], 1000)
+        self.assertGreater(cache.metrics["evicted"], 0)
+        self.assertTrue(cache.get("0")[0])
+        self.assertFalse(cache.get("1")[0])
+        self.assertTrue(cache.get("19")[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import gzip
+import json
+import os
+import tempfile
+import unittest
+
+from hexbytes import HexBytes
+
+from moonworm.crawler.sinks import JSONLinesSink, encode_records, json_safe
+
+
+def records(from_block: int, to_block: int):
+    return [
+        {"blockNumber": block_number, "blockHash": HexBytes(b"\x01\x02")}
+        for block_number in range(from_block, to_block)
+    ]
+
+
+class TestJSONLinesSink(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def read(self, name: str):
+        path = os.path.join(self.directory, name)
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(path, "rt") as ifp:
+            return [json.loads(line) for line in ifp]
+
+    def test_encode_records(self) -> None:
+        lines = encode_records(records(1, 3)).decode("utf-8").splitlines()
+        self.assertListEqual(
+            [json.loads(line) for line in lines],
+            [
+                {"blockNumber": 1, "blockHash": "0x0102"},
+                {"blockNumber": 2, "blockHash": "0x0102"},
+            ],
+        )
+
+    def test_json_safe(self) -> None:
+        self.assertEqual(
+            json_safe({"hash": HexBytes(b"\x01"), "args": {"ids": (1, 2)}}),
+            {"hash": "0x01", "args": {"ids": [1, 2]}},
+        )
+
+    def test_append(self) -> None:
+        path = os.path.join(self.directory, "crawldata.jsonl")
+        for from_block in (0, 10):
+            sink = JSONLinesSink(path)
+            for start in range(from_block, from_block + 10, 2):
+                sink.write(records(start, start + 2), start)
+            sink.close()
+            self.assertEqual(sink.metrics["records_written"], 10)
+        self.assertListEqual(
+            [record["blockNumber"] for record in self.read("crawldata.jsonl")],
+            list(range(20)),
+        )
+
+    def test_gzip_and_rotation(self) -> None:
+        sink = JSONLinesSink(
+            os.path.join(self.directory, "crawldata.jsonl"),
+            compression="gzip",
+            rotate_blocks=100,
+        )
+        for start in range(0, 250, 50):
+            sink.write(records(start, start + 50), start)
+            sink.flush()
+        sink.close()
+
+        self.assertListEqual(
+            sorted(os.listdir(self.directory)),
+            [
+                "crawldata-0000000000.jsonl.gz",
+                "crawldata-0000000100.jsonl.gz",
+                "crawldata-0000000200.jsonl.gz",
+            ],
+        )
+        self.assertEqual(len(self.read("crawldata-0000000100.jsonl.gz")), 100)
+        self.assertEqual(sink.metrics["files"], 3)
+
+    def test_rotation_by_size(self) -> None:
+        sink = JSONLinesSink(
+            os.path.join(self.directory, "crawldata.jsonl"), rotate_bytes=1000
+        )
+        for start in range(0, 100, 10):
+            sink.write(records(start, start + 10), start)
+        sink.close()
+        names = sorted(os.listdir(self.directory))
+        self.assertGreater(len(names), 1)
+        self.assertListEqual(
+            [record["blockNumber"] for name in names for record in self.read(name)],
+            list(range(100)),
+        )
+
+    def test_errors_are_raised(self) -> None:
+        sink = JSONLinesSink(os.path.join(self.directory, "crawldata.jsonl"))
+        sink.write([{"value": object()}], 0)
+        with self.assertRaises(TypeError):
+            sink.flush()
+        sink.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
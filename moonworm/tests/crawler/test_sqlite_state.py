@@ -0,0 +1,178 @@
+import os
+import tempfile
+import unittest
+
+from hexbytes import HexBytes
+
+from moonworm.crawler.function_call_crawler import ContractFunctionCall
+from moonworm.crawler.state import SQLiteState
+from moonworm.watch import WatchBatch, _store_batch
+
+
+def event(block_number: int, log_index: int = 0):
+    return {
+        "event": "Transfer" if log_index % 2 == 0 else "Approval",
+        "args": {"from": "0x01", "to": "0x02", "value": 10},
+        "address": "0xab",
+        "blockHash": HexBytes(block_number.to_bytes(32, "big")),
+        "blockNumber": block_number,
+        "transactionHash": "0x" + format(block_number, "064x"),
+        "logIndex": log_index,
+    }
+
+
+def call(block_number: int) -> ContractFunctionCall:
+    return ContractFunctionCall(
+        block_hash="0x" + format(block_number, "064x"),
+        block_number=block_number,
+        block_timestamp=1600000000 + block_number,
+        transaction_hash="0x" + format(block_number, "064x"),
+        contract_address="0xab",
+        caller_address="0xcd",
+        function_name="transfer",
+        function_args={"to": "0x02", "data": b"\x01\x02"},
+        gas_used=21000,
+        status=1,
+    )
+
+
+class TestSQLiteState(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "state.sqlite")
+
+    def state(self, **kwargs) -> SQLiteState:
+        state = SQLiteState(self.path, **kwargs)
+        self.addCleanup(state.conn.close)
+        return state
+
+    def test_events(self) -> None:
+        state = self.state()
+        for start in range(1, 100, 10):
+            state.start_chunk(start, 10)
+            for block_number in range(start, start + 10, 3):
+                state.process_event(None, event(block_number, 0))
+                state.process_event(None, event(block_number, 1))
+            state.end_chunk(start + 9)
+        # Not committed
+        state.start_chunk(101, 10)
+        state.process_event(None, event(101))
+
+        restored = self.state()
+        self.assertEqual(restored.get_last_scanned_block(), 100)
+        self.assertEqual(
+            restored.conn.execute(
+                "SELECT COUNT(*) FROM events WHERE event_name = 'Approval'"
+            ).fetchone()[0],
+            40,
+        )
+        self.assertEqual(restored.metrics["events_written"], 0)
+        self.assertEqual(state.metrics["transactions"], 10)
+
+        restored.delete_data(50)
+        self.assertEqual(restored.get_last_scanned_block(), 49)
+        self.assertEqual(
+            restored.conn.execute("SELECT MAX(block_number) FROM events").fetchone()[0],
+            47,
+        )
+
+    def test_calls(self) -> None:
+        state = self.state(batch_size=3)
+        self.assertEqual(state.get_last_crawled_block(), -1)
+        for block_number in range(10):
+            state.register_call(call(block_number))
+        # Every 3 calls are written in one transaction
+        self.assertEqual(state.metrics["calls_written"], 9)
+        state.close()
+
+        restored = self.state()
+        self.assertEqual(restored.get_last_crawled_block(), 9)
+        rows = restored.conn.execute(
+            "SELECT block_number, function_args FROM calls ORDER BY block_number"
+        ).fetchall()
+        self.assertEqual(len(rows), 10)
+        self.assertEqual(rows[0][1], '{"to": "0x02", "data": "0x0102"}')
+
+        restored.delete_data(5)
+        self.assertEqual(restored.get_last_crawled_block(), 4)
+        self.assertEqual(
+            restored.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0], 5
+        )
+
+    def test_block_hashes_are_hex_strings(self) -> None:
+        state = self.state()
+        function_call = call(10)
+        function_call.block_hash = HexBytes(function_call.block_hash)
+        state.start_chunk(1, 20)
+        state.register_call(function_call)
+        state.process_event(None, event(10))
+        state.end_chunk(20)
+        self.assertEqual(
+            state.conn.execute(
+                "SELECT COUNT(*) FROM calls JOIN events USING (block_hash)"
+            ).fetchone()[0],
+            1,
+        )
+        self.assertEqual(
+            state.conn.execute("SELECT typeof(block_hash) FROM calls").fetchone()[0],
+            "text",
+        )
+
+    def test_watch_batches(self) -> None:
+        state = self.state()
+        _store_batch(
+            state,
+            WatchBatch(
+                from_block=1,
+                to_block=20,
+                events=[event(5), event(15)],
+                calls=[call(10)],
+                block_timestamps={5: 1600000005, 10: 1600000010, 15: 1600000015},
+            ),
+        )
+        self.assertEqual(
+            state.conn.execute(
+                "SELECT block_number, block_timestamp FROM events ORDER BY block_number"
+            ).fetchall(),
+            [(5, 1600000005), (15, 1600000015)],
+        )
+        _store_batch(
+            state,
+            WatchBatch(
+                from_block=15, to_block=14, events=[], calls=[], retracted_from_block=15
+            ),
+        )
+        self.assertEqual(state.get_last_scanned_block(), 14)
+        self.assertEqual(
+            state.conn.execute("SELECT block_number FROM events").fetchall(), [(5,)]
+        )
+        self.assertEqual(
+            state.conn.execute("SELECT block_number FROM calls").fetchall(), [(10,)]
+        )
+
+    def test_batches_are_written_in_one_transaction(self) -> None:
+        state = self.state(batch_size=1)
+        batch = WatchBatch(
+            from_block=1,
+            to_block=20,
+            events=[event(5), event(15)],
+            calls=[call(3), call(10)],
+        )
+        _store_batch(state, batch)
+        self.assertEqual(state.metrics["transactions"], 1)
+        self.assertEqual(state.get_last_scanned_block(), 20)
+        self.assertEqual(state._get_cursor("calls"), 10)
+
+        # A batch stored again, e.g. after a crash before the cursor was read, keeps one row per call
+        _store_batch(state, batch)
+        for block_number in range(10):
+            state.register_call(call(block_number))
+        state.flush()
+        self.assertEqual(
+            state.conn.execute("SELECT COUNT(*) FROM calls").fetchone()[0], 11
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import web3
+
+from moonworm.crawler import timestamp_index
+from moonworm.crawler.ethereum_state_provider import Web3StateProvider
+from moonworm.crawler.timestamp_index import BlockTimestampIndex
+
+
+class TestBlockTimestampIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "1.bin")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_put_and_get(self) -> None:
+        index = BlockTimestampIndex(self.path)
+        self.assertIsNone(index.get(10))
+
+        index.put_many({10: 1700000000, 3: 1600000003})
+        # Blocks replaced by a chain reorganization are overwritten
+        index.put(10, 1600000010)
+
+        self.assertEqual(index.get(10), 1600000010)
+        self.assertEqual(index.get(3), 1600000003)
+        self.assertIsNone(index.get(5))
+        self.assertIsNone(index.get(11))
+        self.assertEqual(os.path.getsize(self.path), 11 * 4)
+
+        # Another reader of the same file sees the timestamps, including ones written after it mapped
+        # the file
+        reader = BlockTimestampIndex(self.path)
+        self.assertEqual(reader.get(3), 1600000003)
+        index.put(100, 1600000100)
+        self.assertEqual(reader.get(100), 1600000100)
+
+        index.close()
+        reader.close()
+
+    def test_forget(self) -> None:
+        index = BlockTimestampIndex(self.path)
+        reader = BlockTimestampIndex(self.path)
+        index.put_many({n: 1600000000 + n for n in range(1, 21)})
+        self.assertEqual(reader.get(20), 1600000020)
+
+        index.forget(15)
+        self.assertEqual(index.get(14), 1600000014)
+        self.assertIsNone(index.get(15))
+        self.assertIsNone(reader.get(20))
+        self.assertEqual(os.path.getsize(self.path), 21 * 4)
+
+        index.close()
+        reader.close()
+
+    def test_zero_timestamp(self) -> None:
+        # Genesis blocks of some chains have a timestamp of 0
+        index = BlockTimestampIndex(
+            self.path, interpolate=True, max_interpolation_distance=10
+        )
+        index.put_many({0: 0, 4: 40})
+        self.assertEqual(index.get(0), 0)
+        self.assertEqual(index.get(2), 20)
+        self.assertEqual(index.metrics["hits"], 1)
+
+        index.forget(0)
+        self.assertIsNone(index.get(0))
+        index.close()
+
+    def test_without_pwrite(self) -> None:
+        index = BlockTimestampIndex(self.path)
+        with mock.patch.object(timestamp_index.os, "pwrite", create=True):
+            del timestamp_index.os.pwrite
+            index.put_many({3: 1600000003, 1: 1600000001})
+            index.forget(3)
+
+        self.assertEqual(index.get(1), 1600000001)
+        self.assertIsNone(index.get(3))
+        self.assertEqual(os.path.getsize(self.path), 4 * 4)
+        index.close()
+
+    def test_interpolation(self) -> None:
+        index = BlockTimestampIndex(
+            self.path, interpolate=True, max_interpolation_distance=10
+        )
+        index.put_many({10: 1000, 14: 1048, 40: 2000})
+
+        self.assertEqual(index.get(12), 1024)
+        self.assertEqual(index.get(11), 1012)
+        # Too far from the known blocks
+        self.assertIsNone(index.get(27))
+        self.assertEqual(index.metrics["interpolated"], 2)
+        index.close()
+
+    def test_warm_index_makes_no_requests(self) -> None:
+        web3_client = web3.Web3(web3.EthereumTesterProvider())
+        block = web3_client.eth.get_block("latest")
+        index = BlockTimestampIndex(self.path)
+
+        self.assertDictEqual(
+            index.get_block_timestamps(web3_client, [block.number]),
+            {block.number: block.timestamp},
+        )
+
+        # Nothing listens on this port, so any JSON-RPC request would fail
+        offline_client = web3.Web3(web3.HTTPProvider("http://127.0.0.1:9"))
+        self.assertDictEqual(
+            index.get_block_timestamps(offline_client, [block.number]),
+            {block.number: block.timestamp},
+        )
+        state_provider = Web3StateProvider(offline_client, timestamp_index=index)
+        self.assertEqual(
+            state_provider.get_block_timestamp(block.number), block.timestamp
+        )
+        self.assertEqual(state_provider.metrics["web3_get_block_calls"], 0)
+        index.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
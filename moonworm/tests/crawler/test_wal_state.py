@@ -0,0 +1,141 @@
+import os
+import tempfile
+import unittest
+
+from hexbytes import HexBytes
+from web3.datastructures import AttributeDict
+
+from moonworm.crawler.state import JSONifiedState, WriteAheadLogState
+
+
+def event(block_number: int, log_index: int = 0) -> AttributeDict:
+    return AttributeDict(
+        {
+            "event": "Transfer",
+            "args": AttributeDict({"from": "0x01", "to": "0x02", "value": 10}),
+            "blockNumber": block_number,
+            "logIndex": log_index,
+            "transactionHash": HexBytes(block_number.to_bytes(32, "big")),
+        }
+    )
+
+
+class TestWriteAheadLogState(unittest.TestCase):
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def state(self, **kwargs) -> WriteAheadLogState:
+        state = WriteAheadLogState(self.directory, fsync=False, **kwargs)
+        self.addCleanup(state.close)
+        return state
+
+    def scan(self, state: WriteAheadLogState, from_block: int, to_block: int) -> None:
+        """
+        Scans one chunk per 10 blocks, with an event every 5 blocks.
+        """
+        for start in range(from_block, to_block + 1, 10):
+            end = min(start + 9, to_block)
+            state.start_chunk(start, 10)
+            for block_number in range(start, end + 1):
+                if block_number % 5 == 0:
+                    state.process_event(None, event(block_number))
+            state.end_chunk(end)
+
+    def blocks(self, state: WriteAheadLogState):
+        return sorted(record["blockNumber"] for record in state.get_events())
+
+    def test_restore(self) -> None:
+        state = self.state()
+        self.scan(state, 1, 100)
+        # Not committed
+        state.process_event(None, event(105))
+        state.close()
+
+        restored = self.state()
+        self.assertEqual(restored.get_last_scanned_block(), 100)
+        self.assertListEqual(self.blocks(restored), list(range(5, 101, 5)))
+        self.assertEqual(
+            restored.get_events(10, 10)[0]["transactionHash"],
+            "0x" + (10).to_bytes(32, "big").hex(),
+        )
+
+    def test_torn_tail(self) -> None:
+        state = self.state()
+        self.scan(state, 1, 50)
+        state.close()
+        segment = os.path.join(self.directory, "segment-0000000000.log")
+        with open(segment, "ab") as ofp:
+            ofp.write(b'{"event": {"blockNum')
+
+        restored = self.state()
+        self.assertEqual(restored.get_last_scanned_block(), 50)
+        self.scan(restored, 51, 60)
+        restored.close()
+        self.assertListEqual(self.blocks(self.state()), list(range(5, 61, 5)))
+
+    def test_delete_data(self) -> None:
+        state = self.state()
+        self.scan(state, 1, 100)
+        size = state.metrics["bytes_written"]
+        state.delete_data(75)
+        self.assertEqual(state.get_last_scanned_block(), 74)
+        self.assertListEqual(self.blocks(state), list(range(5, 75, 5)))
+        # Only the chunk of blocks 71-80 was rewritten
+        self.assertLess(state.metrics["bytes_written"] - size, size / 5)
+
+        self.scan(state, 75, 90)
+        state.close()
+        restored = self.state()
+        self.assertEqual(restored.get_last_scanned_block(), 90)
+        self.assertListEqual(self.blocks(restored), list(range(5, 91, 5)))
+
+    def test_compaction(self) -> None:
+        state = self.state(segment_bytes=1000, compact_after_segments=2)
+        self.scan(state, 1, 500)
+        state.close()
+        self.assertGreater(state.metrics["compactions"], 0)
+        # Compacts the segments closed while the background compaction was running
+        state.compact()
+        names = os.listdir(self.directory)
+        self.assertEqual(
+            len([name for name in names if name.startswith("snapshot")]), 1
+        )
+        self.assertEqual(len([name for name in names if name.startswith("segment")]), 1)
+
+        restored = self.state(segment_bytes=1000, compact_after_segments=2)
+        self.assertEqual(restored.get_last_scanned_block(), 500)
+        self.assertListEqual(self.blocks(restored), list(range(5, 501, 5)))
+
+        # Deleting blocks in the snapshot rewrites it
+        restored.delete_data(101)
+        restored.close()
+        restored = self.state()
+        self.assertEqual(restored.get_last_scanned_block(), 100)
+        self.assertListEqual(self.blocks(restored), list(range(5, 101, 5)))
+
+
+class TestJSONifiedState(unittest.TestCase):
+    def test_delete_data_after_restore(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        state = JSONifiedState()
+        state.fname = os.path.join(directory.name, "state.json")
+        state.reset()
+        for block_number in (10, 20, 30):
+            state.process_event(None, event(block_number))
+        state.end_chunk(30)
+        state.save()
+
+        restored = JSONifiedState()
+        restored.fname = state.fname
+        restored.restore()
+        self.assertListEqual(sorted(restored.state["blocks"]), [10, 20, 30])
+        restored.delete_data(20)
+        self.assertListEqual(list(restored.state["blocks"]), [10])
+        self.assertEqual(restored.get_last_scanned_block(), 19)
+
+
+if __name__ == "__main__":
+    unittest.main()
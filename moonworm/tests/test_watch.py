@@ -0,0 +1,155 @@
+import unittest
+from unittest import mock
+
+import web3
+
+from moonworm.contracts import ERC20
+from moonworm.crawler.ethereum_state_provider import Web3StateProvider
+from moonworm.crawler.head_tracker import HeadTracker
+from moonworm.crawler.reorg import HeadersUnavailable, ReorgDetector
+from moonworm.watch import iter_watch
+
+
+class TestIterWatchWithERC20Token(unittest.TestCase):
+    def setUp(self) -> None:
+        self.web3_client = web3.Web3(web3.EthereumTesterProvider())
+        self.web3_client.eth.default_account = self.web3_client.eth.accounts[0]
+        self.accounts = self.web3_client.eth.accounts
+
+        deployment_transaction = (
+            self.web3_client.eth.contract(abi=ERC20.abi(), bytecode=ERC20.bytecode())
+            .constructor("Test ERC20 token", "TEST", self.accounts[0])
+            .transact()
+        )
+        self.contract_address = self.web3_client.eth.wait_for_transaction_receipt(
+            deployment_transaction
+        ).contractAddress
+        contract = self.web3_client.eth.contract(
+            address=self.contract_address, abi=ERC20.abi()
+        )
+
+        self.start_block = self.web3_client.eth.block_number + 1
+        for transaction in [
+            contract.functions.mint(self.accounts[0], 1000).transact(),
+            contract.functions.transfer(self.accounts[1], 10).transact(),
+            contract.functions.approve(self.accounts[2], 5).transact(),
+            contract.functions.transfer(self.accounts[2], 20).transact(),
+        ]:
+            self.web3_client.eth.wait_for_transaction_receipt(transaction)
+        self.end_block = self.web3_client.eth.block_number
+
+    def iter_watch(self, num_confirmations=0, **kwargs):
+        return iter_watch(
+            self.web3_client,
+            Web3StateProvider(self.web3_client),
+            self.contract_address,
+            ERC20.abi(),
+            num_confirmations=num_confirmations,
+            sleep_time=0,
+            start_block=self.start_block,
+            end_block=self.end_block,
+            min_blocks_batch=1,
+            max_blocks_batch=1,
+            **kwargs,
+        )
+
+    def test_iter_watch(self) -> None:
+        batches = list(self.iter_watch(only_events=True))
+
+        self.assertEqual(batches[0].from_block, self.start_block)
+        self.assertEqual(batches[-1].to_block, self.end_block)
+        self.assertListEqual(
+            [event["event"] for batch in batches for event in batch.events],
+            ["Transfer", "Transfer", "Approval", "Transfer"],
+        )
+        for batch in batches:
+            self.assertListEqual(batch.calls, [])
+
+    def test_block_timestamps(self) -> None:
+        batches = list(self.iter_watch(only_events=True, resolve_block_timestamps=True))
+
+        for batch in batches:
+            self.assertDictEqual(
+                batch.block_timestamps,
+                {
+                    event["blockNumber"]: self.web3_client.eth.get_block(
+                        event["blockNumber"]
+                    )["timestamp"]
+                    for event in batch.events
+                },
+            )
+        self.assertDictEqual(
+            next(self.iter_watch(only_events=True)).block_timestamps, {}
+        )
+
+    def test_resume_from_cursor(self) -> None:
+        watcher = self.iter_watch(only_events=True)
+        first_batch = next(watcher)
+        watcher.close()
+
+        resumed_batches = list(
+            self.iter_watch(only_events=True, cursor=first_batch.cursor)
+        )
+
+        self.assertEqual(resumed_batches[0].from_block, first_batch.to_block + 1)
+        self.assertListEqual(
+            [
+                event["event"]
+                for batch in [first_batch] + resumed_batches
+                for event in batch.events
+            ],
+            ["Transfer", "Transfer", "Approval", "Transfer"],
+        )
+
+    def test_follow_head(self) -> None:
+        batches = list(
+            self.iter_watch(only_events=True, num_confirmations=2, follow_head=True)
+        )
+
+        # Blocks without enough confirmations are crawled as well
+        self.assertEqual(batches[-1].to_block, self.end_block)
+        for batch in batches:
+            self.assertIsNone(batch.retracted_from_block)
+            self.assertEqual(batch.confirmed_block, self.end_block - 2)
+        self.assertListEqual(
+            [
+                batch.is_provisional(event["blockNumber"])
+                for batch in batches
+                for event in batch.events
+            ],
+            [False, False, True, True],
+        )
+
+    def test_follow_head_with_lagging_endpoint(self) -> None:
+        advance = ReorgDetector.advance
+        attempts = []
+
+        def _advance(detector, from_block, to_block):
+            attempts.append(from_block)
+            if len(attempts) == 1:
+                raise HeadersUnavailable("Headers of the head are not served yet")
+            return advance(detector, from_block, to_block)
+
+        head_tracker = HeadTracker(self.web3_client, max_poll_interval=0.05)
+        self.addCleanup(head_tracker.stop)
+        with mock.patch.object(ReorgDetector, "advance", _advance):
+            batches = list(
+                self.iter_watch(
+                    only_events=True,
+                    num_confirmations=2,
+                    follow_head=True,
+                    head_tracker=head_tracker,
+                )
+            )
+
+        # The range is crawled again once the headers are available
+        self.assertEqual(attempts[0], attempts[1])
+        self.assertEqual(batches[-1].to_block, self.end_block)
+        self.assertListEqual(
+            [event["event"] for batch in batches for event in batch.events],
+            ["Transfer", "Transfer", "Approval", "Transfer"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,11 +5,11 @@ The [`watch_contract`][moonworm.watch.watch_contract] method is the entrypoint t
 and it is what powers the "moonworm watch" command.
 """
 
-import json
+import datetime
+import logging
 import pprint as pp
-import time
-from dataclasses import asdict
-from typing import Any, Dict, List, Optional, Tuple
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from eth_typing.evm import ChecksumAddress
 from tqdm import tqdm
@@ -18,13 +18,27 @@ from web3 import Web3
 from moonworm.crawler.ethereum_state_provider import EthereumStateProvider
 
 from .contracts import CU, ERC721
+from .crawler.batch_rpc import get_block_timestamps
+from .crawler.chunk_size import AdaptiveChunkSizeController, align_chunk_end
+from .crawler.decode_pool import DecodePool
+from .crawler.event_decoder import EventDecoder, EventDecoderRegistry
 from .crawler.function_call_crawler import (
     ContractFunctionCall,
     FunctionCallCrawler,
     FunctionCallCrawlerState,
     Web3StateProvider,
 )
-from .crawler.log_scanner import _crawl_events, _fetch_events_chunk
+from .crawler.head_tracker import HeadTracker
+from .crawler.log_scanner import (
+    _crawl_all_events,
+    _crawl_events,
+    _fetch_events_chunk,
+)
+from .crawler.reorg import HeadersUnavailable, ReorgDetector
+from .crawler.sinks import JSONLinesSink
+from .crawler.state import EventScannerState
+
+logger = logging.getLogger(__name__)
 
 
 class MockState(FunctionCallCrawlerState):
@@ -50,8 +64,42 @@ class MockState(FunctionCallCrawlerState):
         self.state = []
 
 
+@dataclass
+class WatchBatch:
+    """
+    Events and method calls crawled by [`iter_watch`][moonworm.watch.iter_watch] from one range of blocks.
+    """
+
+    from_block: int
+    to_block: int
+    # Decoded events, in (blockNumber, logIndex) order
+    events: List[Dict[str, Any]]
+    # Method calls, in block order
+    calls: List[ContractFunctionCall]
+    # The last block with enough confirmations. Events and calls after it are provisional.
+    confirmed_block: Optional[int] = None
+    # Set in follow_head mode if a chain reorganization replaced blocks whose events and calls were
+    # yielded before: everything from this block onwards has to be dropped.
+    retracted_from_block: Optional[int] = None
+    # Timestamps of the blocks of the method calls, and with resolve_block_timestamps, of the events
+    block_timestamps: Dict[int, int] = field(default_factory=dict)
+
+    @property
+    def cursor(self) -> int:
+        """
+        Pass this as cursor to iter_watch to resume the crawl after this batch.
+        """
+        return self.to_block
+
+    def is_provisional(self, block_number: int) -> bool:
+        """
+        True if the given block may still be replaced by a chain reorganization.
+        """
+        return self.confirmed_block is not None and block_number > self.confirmed_block
+
+
 # TODO(yhtiyar), use state_provider.get_last_block
-def watch_contract(
+def iter_watch(
     web3: Web3,
     state_provider: EthereumStateProvider,
     contract_address: ChecksumAddress,
@@ -64,10 +112,21 @@ def watch_contract(
     max_blocks_batch: int = 5000,
     batch_size_update_threshold: int = 100,
     only_events: bool = False,
-    outfile: Optional[str] = None,
-) -> None:
+    combine_event_requests: bool = False,
+    concurrency: int = 1,
+    cursor: Optional[int] = None,
+    follow_head: bool = False,
+    head_tracker: Optional[HeadTracker] = None,
+    chunk_grid: Optional[int] = None,
+    decode_pool: Optional[DecodePool] = None,
+    resolve_block_timestamps: bool = False,
+) -> Iterator[WatchBatch]:
     """
-    Watches a contract for events and method calls.
+    Watches a contract for events and method calls, yielding them in batches as ranges of blocks are
+    crawled.
+
+    The crawler only moves on to the next range of blocks when the consumer asks for the next batch, so
+    a single batch is held in memory at a time.
 
     Currently supports crawling events and direct method calls on a smart contract.
 
@@ -86,8 +145,8 @@ def watch_contract(
     exhaustive ABI. Any events not present in the ABI will not be crawled. Any methods not present
     in the ABI will be signalled as warnings by the crawler but not stored in the crawldata.
     5. `num_confirmations`: The crawler will remain this many blocks behind the current head of the blockchain.
-    6. `sleep_time`: The number of seconds for which to wait between polls of the state provider. Useful
-    if the provider rate limits clients.
+    6. `sleep_time`: The minimum number of seconds for which to wait between polls of the head of the
+    blockchain, if it has to be polled (see `head_tracker`). Useful if the provider rate limits clients.
     7. `start_block`: Optional block number from which to start the crawl. If not provided, crawl will
     start at block 0.
     8. `end_block`: Optional block number at which to end crawl. If not provided, crawl will continue
@@ -105,12 +164,37 @@ def watch_contract(
     based on number of events processed in the current batch.
     13. `only_events`: If this argument is set to True, the crawler will only crawl events and ignore
     method calls. Crawling events is much, much faster than crawling method calls.
-    14. `outfile`: An optional file to which to write events and/or method calls in [JSON Lines format](https://jsonlines.org/).
-    Data is written to this file in append mode, so the crawler never deletes old data.
+    14. `combine_event_requests`: If this argument is set to True, all events in the ABI are fetched
+    with a single `eth_getLogs` call per batch of blocks (filtering on an OR-list of event signatures)
+    instead of one call per event type.
+    15. `concurrency`: Number of `eth_getLogs` requests to make in parallel. Each step of the crawl then
+    covers up to `concurrency` batches of blocks, which are fetched by separate workers over disjoint
+    block ranges. Default is 1, which crawls one batch at a time.
+    16. `cursor`: The cursor of the last batch consumed by a previous watch. If provided, the crawl
+    resumes from the block after it, instead of `start_block`.
+    17. `follow_head`: If this argument is set to True, the crawler does not remain `num_confirmations`
+    blocks behind the head of the blockchain. Events and method calls are yielded as soon as their
+    blocks are mined, and those in blocks after the `confirmed_block` of their batch are provisional.
+    The crawler records the hash and parentHash of the last `num_confirmations` blocks it crawled. If a
+    chain reorganization replaces any of them, it yields an empty batch whose `retracted_from_block` is
+    the first replaced block, and crawls the new blocks from there.
+    18. `head_tracker`: The [`HeadTracker`][moonworm.crawler.head_tracker.HeadTracker] which tells the
+    crawler about new blocks. Defaults to the tracker shared by all crawlers using the same JSON-RPC
+    endpoint, which subscribes to new heads over WebSocket and IPC connections and polls otherwise.
+    19. `chunk_grid`: If set, batches of blocks end at the end of aligned ranges of this many blocks
+    where possible, so that reruns request the same block ranges and can be answered by a
+    [`ResponseCache`][moonworm.crawler.rpc_cache.ResponseCache].
+    20. `decode_pool`: An optional [`DecodePool`][moonworm.crawler.decode_pool.DecodePool], built for
+    the events of `contract_abi`, whose worker processes decode event logs while the crawler fetches
+    the next ones.
+    21. `resolve_block_timestamps`: If this argument is set to True, the `block_timestamps` of every
+    batch also hold the timestamps of the blocks of its events, which are requested in JSON-RPC batches.
+    Otherwise they only hold the timestamps of the blocks of its method calls.
 
     ## Outputs
 
-    None. Results are printed to stdout and, if an outfile has been provided, also to the file.
+    An iterator over [`WatchBatch`][moonworm.watch.WatchBatch] objects, one per range of blocks crawled.
+    If `end_block` is not provided, the iterator never ends.
     """
 
     contract_abi = [item for item in contract_abi if item.get("name") is not None]
@@ -125,47 +209,92 @@ def watch_contract(
     )
 
     event_abis = [item for item in contract_abi if item["type"] == "event"]
+    event_decoders = [EventDecoder(web3.codec, event_abi) for event_abi in event_abis]
+    event_decoder_registry = EventDecoderRegistry(web3.codec, event_abis)
+
+    # Chunk size controllers keep their observations of event density and request latency between
+    # steps of the crawl. Each event type gets its own, as their densities can differ widely.
+    def _chunk_size_controller() -> AdaptiveChunkSizeController:
+        return AdaptiveChunkSizeController(
+            min_blocks_batch,
+            max_blocks_batch,
+            target_events=batch_size_update_threshold,
+        )
 
-    if start_block is None:
-        current_block = web3.eth.blockNumber - num_confirmations * 2
+    combined_chunk_size_controller = _chunk_size_controller()
+    event_chunk_size_controllers = [_chunk_size_controller() for _ in event_decoders]
+
+    reorg_detector = None
+    if follow_head:
+        reorg_detector = ReorgDetector(web3, max_depth=max(num_confirmations, 1))
+
+    if head_tracker is None:
+        head_tracker = HeadTracker.for_web3(web3, min_poll_interval=sleep_time)
+
+    if cursor is not None:
+        current_block = cursor + 1
+    elif start_block is None:
+        current_block = head_tracker.get_head() - num_confirmations * 2
     else:
         current_block = start_block
 
-    progress_bar = tqdm(unit=" blocks")
-    progress_bar.set_description(f"Current block {current_block}")
-    ofp = None
-    if outfile is not None:
-        ofp = open(outfile, "a")
+    while end_block is None or current_block <= end_block:
+        head_block = head_tracker.get_head()
+        confirmed_block = head_block - num_confirmations
+        until_block = min(
+            head_block if follow_head else confirmed_block,
+            current_block + current_batch_size * max(concurrency, 1),
+        )
+        if end_block is not None:
+            until_block = min(until_block, end_block)
+        until_block = align_chunk_end(current_block, until_block, chunk_grid)
 
-    try:
-        while end_block is None or current_block <= end_block:
-            time.sleep(sleep_time)
-            until_block = min(
-                web3.eth.blockNumber - num_confirmations,
-                current_block + current_batch_size,
-            )
-            if end_block is not None:
-                until_block = min(until_block, end_block)
-            if until_block < current_block:
-                sleep_time *= 2
+        # Only blocks without enough confirmations are checked for reorganizations
+        if reorg_detector is not None and (
+            until_block > confirmed_block or until_block < current_block
+        ):
+            try:
+                fork_block = reorg_detector.advance(current_block, until_block)
+            except HeadersUnavailable as e:
+                # The endpoint has not caught up with the head yet
+                logger.warning("%s, retrying on the next head", e)
+                head_tracker.wait_for_block(
+                    head_block + 1, timeout=head_tracker.max_poll_interval
+                )
+                continue
+            if fork_block is not None:
+                state_provider.forget_blocks(fork_block)
+                current_block = fork_block
+                yield WatchBatch(
+                    from_block=fork_block,
+                    to_block=fork_block - 1,
+                    events=[],
+                    calls=[],
+                    confirmed_block=confirmed_block,
+                    retracted_from_block=fork_block,
+                )
                 continue
 
-            sleep_time /= 2
-            if not only_events:
-                crawler.crawl(current_block, until_block)
-                if state.state:
-                    print("Got transaction calls:")
-                    for call in state.state:
-                        pp.pprint(call, width=200, indent=4)
-                        if ofp is not None:
-                            print(json.dumps(asdict(call)), file=ofp)
-                            ofp.flush()
-                    state.flush()
-
-            for event_abi in event_abis:
-                all_events, new_batch_size = _crawl_events(
+        if until_block < current_block:
+            # Wakes up regularly even if no block is mined, so that in follow_head mode the last
+            # crawled block is checked for reorganizations
+            head_tracker.wait_for_block(
+                current_block if follow_head else current_block + num_confirmations,
+                timeout=head_tracker.max_poll_interval,
+            )
+            continue
+
+        calls: List[ContractFunctionCall] = []
+        if not only_events:
+            crawler.crawl(current_block, until_block)
+            calls = state.state
+            state.flush()
+
+        if combine_event_requests:
+            event_batches = [
+                _crawl_all_events(
                     web3,
-                    event_abi,
+                    event_abis,
                     current_block,
                     until_block,
                     current_batch_size,
@@ -173,24 +302,275 @@ def watch_contract(
                     batch_size_update_threshold,
                     max_blocks_batch,
                     min_blocks_batch,
+                    decoders=event_decoder_registry,
+                    concurrency=concurrency,
+                    chunk_size_controller=combined_chunk_size_controller,
+                    chunk_grid=chunk_grid,
+                    decode_pool=decode_pool,
+                )
+            ]
+        else:
+            event_batches = [
+                _crawl_events(
+                    web3,
+                    event_decoder.event_abi,
+                    current_block,
+                    until_block,
+                    current_batch_size,
+                    contract_address,
+                    batch_size_update_threshold,
+                    max_blocks_batch,
+                    min_blocks_batch,
+                    decoder=event_decoder,
+                    concurrency=concurrency,
+                    chunk_size_controller=chunk_size_controller,
+                    chunk_grid=chunk_grid,
+                    decode_pool=decode_pool,
+                )
+                for event_decoder, chunk_size_controller in zip(
+                    event_decoders, event_chunk_size_controllers
+                )
+            ]
+
+        events: List[Dict[str, Any]] = []
+        for all_events, new_batch_size in event_batches:
+            if only_events:
+                # Updating batch size only in `--only-events` mode
+                # otherwise it will start taking too much if we also crawl transactions
+                current_batch_size = new_batch_size
+            events.extend(all_events)
+        events.sort(key=lambda event: (event["blockNumber"], event["logIndex"]))
+
+        if reorg_detector is not None:
+            mismatch = reorg_detector.find_mismatch(
+                events
+                + [
+                    {"blockNumber": call.block_number, "blockHash": call.block_hash}
+                    for call in calls
+                ]
+            )
+            if mismatch is not None:
+                # Crawled from another branch of the chain than the headers we recorded. Fetching the
+                # headers again finds the fork if it reaches back before this range.
+                reorg_detector.forget(current_block)
+                state_provider.forget_blocks(current_block)
+                continue
+
+        block_timestamps = {call.block_number: call.block_timestamp for call in calls}
+        if resolve_block_timestamps:
+            missing_blocks = {event["blockNumber"] for event in events}.difference(
+                block_timestamps
+            )
+            if missing_blocks:
+                block_timestamps.update(
+                    get_block_timestamps(web3, sorted(missing_blocks))
+                )
+
+        yield WatchBatch(
+            from_block=current_block,
+            to_block=until_block,
+            events=events,
+            calls=calls,
+            confirmed_block=confirmed_block,
+            block_timestamps=block_timestamps,
+        )
+        current_block = until_block + 1
+
+
+def _store_batch(state: EventScannerState, batch: WatchBatch) -> None:
+    if batch.retracted_from_block is not None:
+        state.delete_data(batch.retracted_from_block)
+        return
+
+    # States which store both, like SQLiteState, write the calls registered during a chunk together
+    # with its events
+    state.start_chunk(batch.from_block, batch.to_block - batch.from_block + 1)
+    if isinstance(state, FunctionCallCrawlerState):
+        for call in batch.calls:
+            state.register_call(call)
+    for event in batch.events:
+        timestamp = batch.block_timestamps.get(event["blockNumber"])
+        block_when = (
+            None if timestamp is None else datetime.datetime.utcfromtimestamp(timestamp)
+        )
+        state.process_event(block_when, event)
+    state.end_chunk(batch.to_block)
+    if isinstance(state, FunctionCallCrawlerState):
+        state.flush()
+
+
+def watch_contract(
+    web3: Web3,
+    state_provider: EthereumStateProvider,
+    contract_address: ChecksumAddress,
+    contract_abi: List[Dict[str, Any]],
+    num_confirmations: int = 10,
+    sleep_time: float = 1,
+    start_block: Optional[int] = None,
+    end_block: Optional[int] = None,
+    min_blocks_batch: int = 100,
+    max_blocks_batch: int = 5000,
+    batch_size_update_threshold: int = 100,
+    only_events: bool = False,
+    outfile: Optional[str] = None,
+    combine_event_requests: bool = False,
+    concurrency: int = 1,
+    follow_head: bool = False,
+    head_tracker: Optional[HeadTracker] = None,
+    chunk_grid: Optional[int] = None,
+    state: Optional[EventScannerState] = None,
+    parquet_directory: Optional[str] = None,
+    quiet: bool = False,
+    compression: Optional[str] = None,
+    rotate_blocks: Optional[int] = None,
+    rotate_bytes: Optional[int] = None,
+    decode_processes: Optional[int] = None,
+) -> None:
+    """
+    Watches a contract for events and method calls, and prints them as they are crawled.
+
+    Accepts the same inputs as [`iter_watch`][moonworm.watch.iter_watch] (except for `cursor`), as well
+    as:
+
+    - `outfile`: An optional file to which to write events and/or method calls in [JSON Lines format](https://jsonlines.org/).
+    Data is written to this file in append mode, so the crawler never deletes old data. Records are
+    encoded and written in batches by a background thread (see
+    [`JSONLinesSink`][moonworm.crawler.sinks.JSONLinesSink]).
+
+    - `decode_processes`: If set, event logs are decoded by a pool of this many worker processes (see
+    [`DecodePool`][moonworm.crawler.decode_pool.DecodePool]).
+
+    - `quiet`: If set to True, events and method calls are not printed to stdout.
+
+    - `compression`: Optional compression of the outfile: "gzip" or "zstd".
+
+    - `rotate_blocks`, `rotate_bytes`: If set, a new outfile is started after this many blocks or bytes.
+    The first block of every file is added to its name.
+
+    - `state`: An optional [`EventScannerState`][moonworm.crawler.state.EventScannerState] in which to
+    store events, such as a [`SQLiteState`][moonworm.crawler.state.sqlite_state.SQLiteState]. Every
+    batch is stored as one chunk, with the timestamps of the blocks of its events, and retracted blocks
+    are deleted from it. If the state is also a
+    `FunctionCallCrawlerState`, method calls are stored in it too. If the state has already scanned
+    blocks, the crawl resumes after its last scanned block instead of `start_block`.
+
+    - `parquet_directory`: An optional directory in which to write events and method calls to Parquet
+    files, one per event type and per method, with a typed column per argument (see
+    [`ParquetExporter`][moonworm.crawler.parquet_writer.ParquetExporter]). Requires pyarrow, and cannot
+    be combined with `follow_head`, as rows written to Parquet files cannot be retracted.
+
+    With `follow_head`, provisional events and method calls are marked with `"provisional": true`, and
+    retractions are written as `{"retracted_from_block": <block number>}` lines.
+
+    ## Outputs
+
+    None. Results are printed to stdout and, if an outfile has been provided, also to the file.
+    """
+
+    exporter = None
+    if parquet_directory is not None:
+        if follow_head:
+            raise ValueError("Parquet export cannot be combined with follow_head")
+
+        from .crawler.parquet_writer import ParquetExporter
+
+        exporter = ParquetExporter(parquet_directory, contract_abi)
+
+    cursor = None
+    if state is not None and state.get_last_scanned_block() > 0:
+        cursor = state.get_last_scanned_block()
+
+    decode_pool = None
+    if decode_processes:
+        decode_pool = DecodePool(
+            [item for item in contract_abi if item.get("type") == "event"],
+            processes=decode_processes,
+        )
+
+    progress_bar = tqdm(unit=" blocks")
+    sink = None
+    if outfile is not None:
+        sink = JSONLinesSink(
+            outfile,
+            compression=compression,
+            rotate_blocks=rotate_blocks,
+            rotate_bytes=rotate_bytes,
+        )
+
+    try:
+        for batch in iter_watch(
+            web3,
+            state_provider,
+            contract_address,
+            contract_abi,
+            num_confirmations=num_confirmations,
+            sleep_time=sleep_time,
+            start_block=start_block,
+            end_block=end_block,
+            min_blocks_batch=min_blocks_batch,
+            max_blocks_batch=max_blocks_batch,
+            batch_size_update_threshold=batch_size_update_threshold,
+            only_events=only_events,
+            combine_event_requests=combine_event_requests,
+            concurrency=concurrency,
+            follow_head=follow_head,
+            head_tracker=head_tracker,
+            chunk_grid=chunk_grid,
+            cursor=cursor,
+            decode_pool=decode_pool,
+            resolve_block_timestamps=state is not None,
+        ):
+            if state is not None:
+                _store_batch(state, batch)
+            if exporter is not None:
+                exporter.add_events(batch.events)
+                exporter.add_calls(batch.calls)
+                exporter.end_block_range(batch.to_block)
+
+            if batch.retracted_from_block is not None:
+                print(
+                    f"Chain reorganization: retracting everything from block {batch.retracted_from_block}"
                 )
+                if sink is not None:
+                    sink.write(
+                        [{"retracted_from_block": batch.retracted_from_block}],
+                        batch.retracted_from_block,
+                    )
+                continue
+
+            records: List[Dict[str, Any]] = []
+            if batch.calls and not quiet:
+                print("Got transaction calls:")
+            for call in batch.calls:
+                call_item = asdict(call)
+                if follow_head:
+                    call_item["provisional"] = batch.is_provisional(call.block_number)
+                if not quiet:
+                    pp.pprint(call_item, width=200, indent=4)
+                records.append(call_item)
 
-                if only_events:
-                    # Updating batch size only in `--only-events` mode
-                    # otherwise it will start taking too much if we also crawl transactions
-                    current_batch_size = new_batch_size
-                for event in all_events:
+            for event in batch.events:
+                if follow_head:
+                    event = {
+                        **event,
+                        "provisional": batch.is_provisional(event["blockNumber"]),
+                    }
+                if not quiet:
                     print("Got event:")
                     pp.pprint(event, width=200, indent=4)
-                    if ofp is not None:
-                        print(json.dumps(event), file=ofp)
-                        ofp.flush()
+                records.append(event)
+
+            if sink is not None:
+                sink.write(records, batch.from_block)
 
             progress_bar.set_description(
-                f"Current block {until_block}, Already watching for"
+                f"Current block {batch.to_block}, Already watching for"
             )
-            progress_bar.update(until_block - current_block + 1)
-            current_block = until_block + 1
+            progress_bar.update(batch.to_block - batch.from_block + 1)
     finally:
-        if ofp is not None:
-            ofp.close()
+        if sink is not None:
+            sink.close()
+        if exporter is not None:
+            exporter.close()
+        if decode_pool is not None:
+            decode_pool.close()
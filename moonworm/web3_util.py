@@ -6,12 +6,22 @@ import web3
 from eth_account.account import Account  # type: ignore
 from eth_typing.evm import ChecksumAddress
 from hexbytes.main import HexBytes
-from web3 import Web3
+from web3 import AsyncHTTPProvider, Web3
 from web3.contract import Contract, ContractFunction
+from web3.eth import AsyncEth
 from web3.providers.ipc import IPCProvider
 from web3.providers.rpc import HTTPProvider
+from web3.providers.websocket import WebsocketProvider
 from web3.types import ABI, Nonce, TxParams, TxReceipt, Wei
 
+from .crawler.head_tracker import endpoint_uri
+from .crawler.provider_pool import PooledHTTPProvider, parse_endpoint_uris
+from .crawler.rate_limit import (
+    async_rate_limit_middleware,
+    rate_limit_middleware,
+    set_rate_limit,
+)
+
 
 class ContractConstructor:
     def __init__(self, *args: Any):
@@ -163,13 +173,74 @@ def read_keys_from_env() -> Tuple[ChecksumAddress, str]:
         )
 
 
-def connect(web3_uri: str) -> Web3:
-    web3_provider: Union[IPCProvider, HTTPProvider] = Web3.IPCProvider()
-    if web3_uri.startswith("http://") or web3_uri.startswith("https://"):
+def connect(
+    web3_uri: str,
+    requests_per_second: Optional[float] = None,
+    compute_units_per_second: Optional[float] = None,
+) -> Web3:
+    """
+    Connects to a JSON-RPC endpoint over HTTP(S), WebSocket or IPC, depending on the URI.
+
+    A comma-separated list of HTTP(S) URIs connects to all of them, through a PooledHTTPProvider.
+
+    Requests of the client are subject to the process-wide rate limits of the endpoint (see
+    moonworm.crawler.rate_limit). If requests_per_second or compute_units_per_second are given, they
+    are set as the rate limits of the endpoint (of each endpoint, for a list of URIs).
+    """
+    web3_provider: Union[
+        IPCProvider, HTTPProvider, WebsocketProvider, PooledHTTPProvider
+    ] = Web3.IPCProvider()
+    if "," in web3_uri:
+        web3_provider = PooledHTTPProvider(parse_endpoint_uris(web3_uri))
+    elif web3_uri.startswith("http://") or web3_uri.startswith("https://"):
         web3_provider = Web3.HTTPProvider(web3_uri)
+    elif web3_uri.startswith("ws://") or web3_uri.startswith("wss://"):
+        web3_provider = Web3.WebsocketProvider(web3_uri)
     else:
         web3_provider = Web3.IPCProvider(web3_uri)
     web3_client = Web3(web3_provider)
+    if requests_per_second is not None or compute_units_per_second is not None:
+        endpoint_uris = (
+            web3_provider.endpoint_uris
+            if isinstance(web3_provider, PooledHTTPProvider)
+            else [endpoint_uri(web3_client)]
+        )
+        for uri in endpoint_uris:
+            set_rate_limit(
+                uri,
+                requests_per_second=requests_per_second,
+                compute_units_per_second=compute_units_per_second,
+            )
+    # Innermost, so that only requests which reach the provider count against the limits
+    web3_client.middleware_onion.inject(rate_limit_middleware, "rate_limit", layer=0)
+    return web3_client
+
+
+def connect_async(
+    web3_uri: str,
+    requests_per_second: Optional[float] = None,
+    compute_units_per_second: Optional[float] = None,
+) -> Web3:
+    """
+    Connects to a JSON-RPC endpoint over HTTP(S) with an asynchronous provider and the AsyncEth module,
+    as expected by moonworm.crawler.async_log_scanner.AsyncEventScanner.
+
+    Requests of the client are subject to the process-wide rate limits of the endpoint, as in connect.
+    """
+    if not (web3_uri.startswith("http://") or web3_uri.startswith("https://")):
+        raise ValueError(f"Asynchronous clients need an HTTP(S) URI, got: {web3_uri}")
+    web3_client = Web3(
+        AsyncHTTPProvider(web3_uri), modules={"eth": (AsyncEth,)}, middlewares=[]
+    )
+    if requests_per_second is not None or compute_units_per_second is not None:
+        set_rate_limit(
+            web3_uri,
+            requests_per_second=requests_per_second,
+            compute_units_per_second=compute_units_per_second,
+        )
+    web3_client.middleware_onion.inject(
+        async_rate_limit_middleware, "rate_limit", layer=0
+    )
     return web3_client
 
 
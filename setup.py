@@ -23,6 +23,8 @@ setup(
     extras_require={
         "dev": ["isort", "mypy", "wheel", "web3>=5.27.0"],
         "moonstream": ["moonstreamdb>=0.3.3", "moonstream-types>=0.0.3"],
+        "parquet": ["pyarrow>=8.0.0"],
+        "zstd": ["zstandard"],
         "distribute": ["setuptools", "twine", "wheel"],
     },
     description="moonworm: Generate a command line interface to any Ethereum smart contract",